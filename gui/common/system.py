@@ -40,9 +40,6 @@ from .log import log_traceback
 
 from freenasUI.middleware.client import client
 
-RE_MOUNT = re.compile(
-    r'^(?P<fs_spec>.+?) on (?P<fs_file>.+?) \((?P<fs_vfstype>\w+)', re.S
-)
 VERSION_FILE = '/etc/version'
 _VERSION = None
 log = logging.getLogger("common.system")
@@ -174,11 +171,13 @@ def get_fstype(path):
     if not os.access(path, os.F_OK):
         return None
 
-    lines = subprocess.check_output(['/bin/df', '-T', path], encoding='utf8').splitlines()
+    with client as c:
+        mount = c.call('mount.path_to_mount', path)
 
-    out = (lines[len(lines) - 1]).split()
+    if mount is None:
+        return None
 
-    return (out[1].upper())
+    return mount['fstype'].upper()
 
 
 def get_mounted_filesystems():
@@ -189,32 +188,23 @@ def get_mounted_filesystems():
         - fs_file (dest)
         - fs_vfstype
     """
-    mounted = []
-
-    lines = subprocess.check_output(['/sbin/mount'], encoding='utf8').splitlines()
-
-    for line in lines:
-        reg = RE_MOUNT.search(line)
-        if not reg:
-            continue
-        mounted.append(reg.groupdict())
+    with client as c:
+        mounts = c.call('mount.query')
 
-    return mounted
+    return [
+        {
+            'fs_spec': mount['source'],
+            'fs_file': mount['dest'],
+            'fs_vfstype': mount['fstype'],
+        }
+        for mount in mounts
+    ]
 
 
 def is_mounted(**kwargs):
 
-    mounted = get_mounted_filesystems()
-    for mountpt in mounted:
-        ret = False
-        if 'device' in kwargs:
-            ret = True if mountpt['fs_spec'] == kwargs['device'] else False
-        if 'path' in kwargs:
-            ret = True if mountpt['fs_file'] == kwargs['path'] else False
-        if ret:
-            break
-
-    return ret
+    with client as c:
+        return c.call('mount.is_mounted', kwargs.get('path'), kwargs.get('device'))
 
 
 def mount(dev, path, mntopts=None, fstype=None):
@@ -253,6 +243,8 @@ def mount(dev, path, mntopts=None, fstype=None):
             output[1]
         )))
     else:
+        with client as c:
+            c.call('mount.invalidate')
         return True
 
 
@@ -278,6 +270,8 @@ def umount(path, force=False):
             output[1]
         )))
     else:
+        with client as c:
+            c.call('mount.invalidate')
         return True
 
 
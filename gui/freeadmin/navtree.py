@@ -26,11 +26,14 @@
 import json
 import logging
 import re
+import threading
+import time
 import urllib.request
 
 from django.conf import settings
 from django.core.urlresolvers import NoReverseMatch, resolve, reverse
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from django.forms import ModelForm
 from django.utils.translation import ugettext_lazy as _
 
@@ -58,6 +61,13 @@ ssl.create_default_context = ssl._create_unverified_context
 
 log = logging.getLogger('freeadmin.navtree')
 
+# Model signals only see writes made by this process, changes made through
+# middlewared (datastore calls, jail state changes) are only picked up once
+# a cached menu is older than this.
+MENU_CACHE_TTL = 300
+# Plugin menus older than this are served while being refreshed in background.
+PLUGIN_MENU_TTL = 60
+
 
 class ModelFormsDict(dict):
 
@@ -97,6 +107,16 @@ class NavTree(object):
         self._modelforms = ModelFormsDict()
         self._navs = {}
         self._generated = False
+        self._lock = threading.RLock()
+        # (role, failover status) -> (generation, generated at, dijit tree)
+        self._menus = {}
+        self._generation = 0
+        # (role, plugin id) -> (fetched at, treemenu data)
+        self._plugin_menus = {}
+        # Enabled plugins found by the last generation
+        self._plugins = []
+        # Roles whose plugin menus are being refreshed
+        self._plugin_refreshing = set()
 
     def isGenerated(self):
         return self._generated
@@ -211,7 +231,56 @@ class NavTree(object):
                             _models[form._meta.model] = form
             self._modelforms.update(_models)
 
-    def generate(self, request=None):
+    def invalidate(self):
+        """
+        Discard cached menus, they will be generated again on next request.
+        """
+        with self._lock:
+            self._generation += 1
+            self._menus.clear()
+
+    def _failover_status(self):
+        if hasattr(notifier, 'failover_status'):
+            return notifier().failover_status()
+        else:
+            return 'SINGLE'
+
+    def _role(self, user):
+        if user.is_superuser:
+            return 'superuser'
+        return tuple(sorted(user.get_all_permissions()))
+
+    def menu(self, request):
+        """
+        Returns dijit tree of the menu for the user of the request.
+
+        Generated trees are cached per user role and failover status until
+        a model is saved or deleted in this process, a plugin menu changes or
+        MENU_CACHE_TTL has passed. The TTL is the only invalidation for
+        changes made outside of the GUI process (middlewared datastore writes,
+        jails being started or stopped).
+        """
+        fstatus = self._failover_status()
+        role = self._role(request.user)
+        key = (role, fstatus)
+        with self._lock:
+            cached = self._menus.get(key)
+            if (
+                cached is not None and
+                cached[0] == self._generation and
+                time.monotonic() - cached[1] < MENU_CACHE_TTL
+            ):
+                self._refresh_plugin_menus(request, role)
+                return cached[2]
+
+            generation = self._generation
+            self.generate(request, fstatus=fstatus)
+            menu = self.dijitTree(request.user)
+            if generation == self._generation:
+                self._menus[key] = (generation, time.monotonic(), menu)
+            return menu
+
+    def generate(self, request=None, fstatus=None):
         """
         Tree Menu Auto Generate
 
@@ -232,10 +301,8 @@ class NavTree(object):
         tree_roots.clear()
         childs_of = []
 
-        if hasattr(notifier, 'failover_status'):
-            fstatus = notifier().failover_status()
-        else:
-            fstatus = 'SINGLE'
+        if fstatus is None:
+            fstatus = self._failover_status()
 
         for app in settings.INSTALLED_APPS:
 
@@ -537,20 +604,19 @@ class NavTree(object):
                     subopt.type = 'viewmodel'
                     self.register_option(subopt, navopt)
 
+    def _plugin_url(self, host, plugin):
+        return "%s/plugins/%s/%d/_s/treemenu" % (host, plugin.plugin_name, plugin.id)
+
     def _plugin_fetch(self, args):
-        plugin, host, request, timeout = args
+        plugin, host, sessionid, timeout = args
 
         data = None
-        url = "%s/plugins/%s/%d/_s/treemenu" % (host, plugin.plugin_name, plugin.id)
+        url = self._plugin_url(host, plugin)
         try:
             opener = urllib.request.build_opener()
             opener.addheaders = [(
-                'Cookie', 'sessionid=%s' % (
-                    request.COOKIES.get("sessionid", ''),
-                )
+                'Cookie', 'sessionid=%s' % (sessionid,)
             )]
-            # TODO: Increase timeout based on number of plugins
-            # Have done above ^ but still sucky, try to use caching if possible
             response = opener.open(url, None, timeout)
             data = response.read()
             if not data:
@@ -562,63 +628,139 @@ class NavTree(object):
             })
         return plugin, url, data
 
+    def _plugin_fetch_timeout(self, count):
+        if count > 1:
+            return count * 5
+        else:
+            return 6
+
+    def _refresh_plugin_menus(self, request, role):
+        """
+        Fetch plugin menus of `role` that are out of date in background
+        (stale-while-revalidate). Menus are invalidated if any of them has
+        changed.
+
+        Plugin menus are fetched with the session of `request`, which is only
+        used by this refresh and never kept for later ones.
+        """
+        host = get_base_url(request)
+        sessionid = request.COOKIES.get("sessionid", '')
+        with self._lock:
+            if role in self._plugin_refreshing:
+                return
+
+            now = time.monotonic()
+            stale = [
+                plugin for plugin in self._plugins
+                if now - self._plugin_menus.get((role, plugin.id), (0, None))[0] > PLUGIN_MENU_TTL
+            ]
+            if not stale:
+                return
+
+            self._plugin_refreshing.add(role)
+
+        def refresh():
+            try:
+                timeout = self._plugin_fetch_timeout(len(stale))
+                args = [(plugin, host, sessionid, timeout) for plugin in stale]
+                changed = False
+                with ThreadPool(10) as pool:
+                    for plugin, url, data in pool.imap(self._plugin_fetch, args):
+                        with self._lock:
+                            old = self._plugin_menus.get((role, plugin.id), (None, None))[1]
+                            if data is None and old is not None:
+                                # Keep serving last known menu if plugin is temporarily unavailable
+                                data = old
+                            self._plugin_menus[(role, plugin.id)] = (time.monotonic(), data)
+                            changed |= data != old
+                if changed:
+                    self.invalidate()
+            except Exception:
+                log.warn("Failed to refresh plugin menus", exc_info=True)
+            finally:
+                with self._lock:
+                    self._plugin_refreshing.discard(role)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
     def _get_plugins_nodes(self, request, jails):
 
         host = get_base_url(request)
+        sessionid = request.COOKIES.get("sessionid", '')
+        role = self._role(request.user)
         plugs = Plugins.objects.filter(plugin_enabled=True, plugin_jail__in=[jail.jail_host for jail in jails])
-        if len(plugs) > 1:
-            timeout = len(plugs) * 5
-        else:
-            timeout = 6
-        args = [(y, host, request, timeout) for y in plugs]
 
-        with ThreadPool(10) as pool:
-            for plugin, url, data in pool.imap(self._plugin_fetch, args):
+        # Plugin menus are fetched with the credentials of the user, so they
+        # are only shared between users of the same role
+        with self._lock:
+            self._plugins = list(plugs)
+            ids = {plugin.id for plugin in plugs}
+            for key in list(self._plugin_menus.keys()):
+                if key[1] not in ids:
+                    self._plugin_menus.pop(key)
+            missing = [plugin for plugin in plugs if (role, plugin.id) not in self._plugin_menus]
+
+        # Menus of plugins seen for the first time are fetched right away,
+        # the others are served from cache and refreshed in background.
+        if missing:
+            timeout = self._plugin_fetch_timeout(len(missing))
+            args = [(y, host, sessionid, timeout) for y in missing]
+            with ThreadPool(10) as pool:
+                for plugin, url, data in pool.imap(self._plugin_fetch, args):
+                    with self._lock:
+                        self._plugin_menus[(role, plugin.id)] = (time.monotonic(), data)
+
+        self._refresh_plugin_menus(request, role)
+
+        for plugin in plugs:
+            url = self._plugin_url(host, plugin)
+            with self._lock:
+                data = self._plugin_menus.get((role, plugin.id), (None, None))[1]
 
-                if not data:
-                    continue
+            if not data:
+                continue
 
-                try:
-                    data = json.loads(data)
-
-                    nodes = unserialize_tree(data)
-                    for node in nodes:
-                        # We have our TreeNode's, find out where to place them
-
-                        found = False
-                        if node.append_to:
-                            log.debug(
-                                "Plugin %s requested to be appended to %s",
-                                plugin.plugin_name, node.append_to)
-                            places = node.append_to.split('.')
-                            places.reverse()
-                            for root in tree_roots:
-                                find = root.find_place(list(places))
-                                if find is not None:
-                                    find.append_child(node)
-                                    found = True
-                                    break
-                        else:
-                            log.debug(
-                                "Plugin %s didn't request to be appended "
-                                "anywhere specific",
-                                plugin.plugin_name)
+            try:
+                data = json.loads(data)
+
+                nodes = unserialize_tree(data)
+                for node in nodes:
+                    # We have our TreeNode's, find out where to place them
+
+                    found = False
+                    if node.append_to:
+                        log.debug(
+                            "Plugin %s requested to be appended to %s",
+                            plugin.plugin_name, node.append_to)
+                        places = node.append_to.split('.')
+                        places.reverse()
+                        for root in tree_roots:
+                            find = root.find_place(list(places))
+                            if find is not None:
+                                find.append_child(node)
+                                found = True
+                                break
+                    else:
+                        log.debug(
+                            "Plugin %s didn't request to be appended "
+                            "anywhere specific",
+                            plugin.plugin_name)
 
-                        if not found:
-                            tree_roots.register(node)
+                    if not found:
+                        tree_roots.register(node)
 
-                except Exception as e:
-                    log.warn(_(
-                        "An error occurred while unserializing from "
-                        "%(url)s: %(error)s") % {'url': url, 'error': e})
-                    log.debug(_(
-                        "Error unserializing %(url)s (%(error)s), data "
-                        "retrieved:"
-                    ) % {
-                        'url': url,
-                        'error': e,
-                    })
-                    continue
+            except Exception as e:
+                log.warn(_(
+                    "An error occurred while unserializing from "
+                    "%(url)s: %(error)s") % {'url': url, 'error': e})
+                log.debug(_(
+                    "Error unserializing %(url)s (%(error)s), data "
+                    "retrieved:"
+                ) % {
+                    'url': url,
+                    'error': e,
+                })
+                continue
 
     def _build_nav(self, user):
         navs = []
@@ -729,3 +871,12 @@ class NavTree(object):
 
 
 navtree = NavTree()
+
+
+def invalidate_navtree(sender, **kwargs):
+    if sender.__module__.startswith('freenasUI.'):
+        navtree.invalidate()
+
+
+post_save.connect(invalidate_navtree, dispatch_uid='navtree_post_save')
+post_delete.connect(invalidate_navtree, dispatch_uid='navtree_post_delete')
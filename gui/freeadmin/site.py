@@ -257,8 +257,7 @@ class FreeAdminSite(object):
     def menu(self, request):
         from freenasUI.freeadmin.navtree import navtree
         try:
-            navtree.generate(request)
-            final = navtree.dijitTree(request.user)
+            final = navtree.menu(request)
             data = json.dumps(final)
         except Exception as e:
             log.debug(
@@ -0,0 +1,161 @@
+import json
+import time
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase
+
+from freenasUI.common.warden import WARDEN_STATUS_RUNNING, WARDEN_TYPE_PLUGINJAIL
+from freenasUI.freeadmin import navtree as navtree_module
+from freenasUI.freeadmin.navtree import NavTree
+from freenasUI.freeadmin.tree import TreeRoot
+
+JAILS = 500
+PLUGINS = 100
+FETCH_DELAY = 0.02
+
+
+class FakeJail(object):
+
+    def __init__(self, id):
+        self.jail_host = 'jail%d' % id
+        self.jail_type = WARDEN_TYPE_PLUGINJAIL
+        self.jail_status = WARDEN_STATUS_RUNNING
+
+
+class FakePlugin(object):
+
+    def __init__(self, id):
+        self.id = id
+        self.plugin_name = 'plugin%d' % id
+        self.plugin_jail = 'jail%d' % id
+
+
+class FakeUser(object):
+
+    def __init__(self, is_superuser=True, permissions=()):
+        self.is_superuser = is_superuser
+        self.permissions = set(permissions)
+
+    def get_all_permissions(self):
+        return self.permissions
+
+    def has_perm(self, perm):
+        return self.is_superuser or perm in self.permissions
+
+
+def plugin_nodes(menu):
+    return [node for root in menu if root['gname'] == 'plugins' for node in root['children']]
+
+
+class NavTreeTest(SimpleTestCase):
+
+    def setUp(self):
+        self.navtree = NavTree()
+        self.fetched = []
+        self.sessions = []
+
+        def plugin_fetch(args):
+            plugin, host, sessionid, timeout = args
+            self.fetched.append(plugin.id)
+            self.sessions.append(sessionid)
+            time.sleep(FETCH_DELAY)
+            return plugin, '', json.dumps([{
+                'append_to': 'plugins',
+                'gname': plugin.plugin_name,
+                'name': '%s (%s)' % (plugin.plugin_name, sessionid),
+                'url': '/plugins/%s/' % plugin.plugin_name,
+            }]).encode()
+
+        jails = mock.Mock()
+        jails.objects.all.return_value = [FakeJail(i) for i in range(JAILS)]
+        plugins = mock.Mock()
+        plugins.objects.filter.return_value = [FakePlugin(i) for i in range(PLUGINS)]
+
+        for patcher in (
+            mock.patch.object(navtree_module, 'Jails', jails),
+            mock.patch.object(navtree_module, 'Plugins', plugins),
+            mock.patch.object(navtree_module, 'notifier', mock.Mock(spec=[])),
+            mock.patch.object(navtree_module, 'navtree', self.navtree),
+            mock.patch.object(navtree_module, 'settings', mock.Mock(
+                INSTALLED_APPS=['freenasUI.plugins'], BLACKLIST_NAV=[],
+            )),
+            # Only the root node plugin menus are appended to
+            mock.patch.object(
+                NavTree, '_generate_app',
+                lambda self, app, request, tree_roots, *args: tree_roots.register(TreeRoot('plugins')),
+            ),
+            mock.patch.object(self.navtree, '_plugin_fetch', plugin_fetch),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.request = self._request(FakeUser(), 'root')
+
+    def _request(self, user, sessionid):
+        request = RequestFactory().get('/admin/menu.json')
+        request.COOKIES['sessionid'] = sessionid
+        request.user = user
+        return request
+
+    def _wait_refresh(self):
+        for i in range(100):
+            if not self.navtree._plugin_refreshing:
+                break
+            time.sleep(0.1)
+
+    def test_menu_cached(self):
+        start = time.monotonic()
+        menu = self.navtree.menu(self.request)
+        cold = time.monotonic() - start
+
+        start = time.monotonic()
+        self.assertIs(self.navtree.menu(self.request), menu)
+        warm = time.monotonic() - start
+
+        self.assertEqual(sorted(self.fetched), list(range(PLUGINS)))
+        self.assertEqual(len(plugin_nodes(menu)), PLUGINS)
+        self.assertLess(warm, cold / 10)
+
+    def test_menu_invalidated_without_refetching_plugins(self):
+        menu = self.navtree.menu(self.request)
+
+        navtree_module.invalidate_navtree(FakePlugin)
+        start = time.monotonic()
+        self.assertIsNot(self.navtree.menu(self.request), menu)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(self.fetched), PLUGINS)
+        self.assertLess(elapsed, PLUGINS * FETCH_DELAY / 10)
+
+    def test_stale_plugin_menus_refreshed_in_background(self):
+        menu = self.navtree.menu(self.request)
+
+        with mock.patch.object(navtree_module, 'PLUGIN_MENU_TTL', 0):
+            start = time.monotonic()
+            self.assertIs(self.navtree.menu(self.request), menu)
+            self.assertLess(time.monotonic() - start, FETCH_DELAY * 5)
+
+            self._wait_refresh()
+
+        self.assertEqual(len(self.fetched), PLUGINS * 2)
+
+    def test_plugin_menus_not_shared_between_roles(self):
+        self.navtree.menu(self.request)
+        operator = self._request(FakeUser(False, {'plugins.view'}), 'operator')
+        menu = self.navtree.menu(operator)
+
+        # Fetched again with the credentials of the other role
+        self.assertEqual(self.sessions, ['root'] * PLUGINS + ['operator'] * PLUGINS)
+        self.assertIn('plugin0 (operator)', [node['name'] for node in plugin_nodes(menu)])
+
+    def test_stale_plugin_menus_refreshed_with_current_session(self):
+        self.navtree.menu(self.request)
+        operator = self._request(FakeUser(False, {'plugins.view'}), 'operator')
+        self.navtree.menu(operator)
+
+        with mock.patch.object(navtree_module, 'PLUGIN_MENU_TTL', 0):
+            self.navtree.menu(self._request(FakeUser(), 'root2'))
+            self._wait_refresh()
+
+        # Only menus of the requesting role are refreshed, with its own session
+        self.assertEqual(self.sessions[PLUGINS * 2:], ['root2'] * PLUGINS)
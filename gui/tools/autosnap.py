@@ -28,7 +28,6 @@
 import pickle as pickle
 import logging
 import os
-import re
 import sys
 import uuid
 import ssl
@@ -54,8 +53,10 @@ from datetime import datetime, time, timedelta
 from freenasUI.common.locks import mntlock
 from freenasUI.common.pipesubr import pipeopen
 from freenasUI.common.system import send_mail
-from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.storage.models import VMWarePlugin
+from freenasUI.tools.autosnap_retention import (
+    destroy_snapshots, isMatchingTime, parse_snapshot_list, plan_retention, snapshot_name,
+)
 from freenasUI.tools.replication_adapter import query_model
 
 from lockfile import LockFile
@@ -85,52 +86,6 @@ VMWARESNAPDELETE_FAILS = '/var/tmp/.vmwaresnapdelete_fails'
 debug = False
 
 
-def snapinfodict2datetime(snapinfo):
-    year = int(snapinfo['year'])
-    month = int(snapinfo['month'])
-    day = int(snapinfo['day'])
-    hour = int(snapinfo['hour'])
-    minute = int(snapinfo['minute'])
-    return datetime(year, month, day, hour, minute)
-
-
-def snap_expired(snapinfo, snaptime):
-    snapinfo_expirationtime = snapinfodict2datetime(snapinfo)
-    snap_ttl_value = int(snapinfo['retcount'])
-    snap_ttl_unit = snapinfo['retunit']
-
-    if snap_ttl_unit == 'h':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(hours=snap_ttl_value)
-    elif snap_ttl_unit == 'd':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=snap_ttl_value)
-    elif snap_ttl_unit == 'w':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=7 * snap_ttl_value)
-    elif snap_ttl_unit == 'm':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=int(30.436875 * snap_ttl_value))
-    elif snap_ttl_unit == 'y':
-        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=int(365.2425 * snap_ttl_value))
-
-    return snapinfo_expirationtime <= snaptime
-
-
-def isMatchingTime(task, snaptime):
-    curtime = time(snaptime.hour, snaptime.minute)
-    repeat_type = task.task_repeat_unit
-
-    if not isTimeBetween(curtime, task.task_begin, task.task_end):
-        return False
-
-    if repeat_type == 'daily':
-        return True
-
-    if repeat_type == 'weekly':
-        cur_weekday = snaptime.weekday() + 1
-        if ('%d' % cur_weekday) in task.task_byweekday.split(','):
-            return True
-
-    return False
-
-
 # Detect if another instance is running
 def exit_if_running(pid):
     log.debug("Checking if process %d is still alive", pid)
@@ -243,136 +198,33 @@ if now.second < 30 or now.minute == 59:
 else:
     snaptime = now.replace(minute=now.minute + 1, second=0)
 
-mp_to_task_map = {}
-
-# Grab all matching tasks into a tree.
-# Since the snapshot we make have the name 'foo@auto-%Y%m%d.%H%M-{expire time}'
-# format, we just keep one task.
 TaskObjects = query_model("storage/task", "task_enabled")
-taskpath = {'recursive': [], 'nonrecursive': []}
 for task in TaskObjects:
     task.task_begin = time(*map(int, task.task_begin.split(':')))
     task.task_end = time(*map(int, task.task_end.split(':')))
 
-    vol_name = task.task_filesystem.split('/')[0]
-    if isMatchingTime(task, snaptime):
-        proc = pipeopen(f'/sbin/zpool list {vol_name}')
-        proc.communicate()
-        if proc.returncode != 0:
-            log.warn(f'Volume {vol_name} not imported, skipping snapshot task #{task.id}')
-            continue
-        if task.task_recursive:
-            taskpath['recursive'].append(task.task_filesystem)
-        else:
-            taskpath['nonrecursive'].append(task.task_filesystem)
-        fs = task.task_filesystem
-        recursive = task.task_recursive
-        expire_time = ('%s%s' % (task.task_ret_count, task.task_ret_unit[0])).__str__()
-        tasklist = []
-        if (fs, expire_time, recursive) in mp_to_task_map:
-            tasklist = mp_to_task_map[(fs, expire_time, recursive)]
-            tasklist.append(task)
-        else:
-            tasklist = [task]
-        mp_to_task_map[(fs, expire_time, recursive)] = tasklist
-
-re_path = re.compile("^((" + '|'.join(taskpath['nonrecursive']) +
-                     ")@|(" + '|'.join(taskpath['recursive']) + ")[@/])")
-# Only proceed further if we are  going to generate any snapshots for this run
-if len(mp_to_task_map) > 0:
+snapshots = []
+imported_pools = set()
+# Listing every snapshot is expensive, skip it if no task is due this minute.
+if any(isMatchingTime(task, snaptime) for task in TaskObjects):
+    proc = pipeopen('/sbin/zpool list -H -o name')
+    imported_pools = set(proc.communicate()[0].split())
 
-    # Grab all existing snapshot and filter out the expiring ones
-    snapshots = {}
-    snapshots_pending_delete = []
-    previous_prefix = '/'
     # Use -s name because its faster. See #18428
     zfsproc = pipeopen("/sbin/zfs list -t snapshot -H -o name -s name", debug, logger=log)
-    lines = zfsproc.communicate()[0].split('\n')
-    # Sort it in python to behave the same way as without "-s name"
-    lines = sorted(lines, key=lambda x: x.split('@'))
-
-    reg_autosnap = re.compile('^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).'
-                              '(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)'
-                              '(?P<retunit>[hdwmy])$')
-    for snapshot_name in lines:
-        if snapshot_name != '':
-            fs, snapname = snapshot_name.split('@')
-            snapname_match = reg_autosnap.match(snapname)
-            if snapname_match is not None:
-                snap_infodict = snapname_match.groupdict()
-                snap_ret_policy = '%s%s' % (snap_infodict['retcount'], snap_infodict['retunit'])
-                if snap_expired(snap_infodict, snaptime):
-                    # Only delete the snapshot if there's a snapshot task enabled that created it.
-                    if re_path:
-                        if re_path.match(snapshot_name):
-                            # Destroy of expired snapshots is recursive, so only request so on the
-                            # toplevel.
-                            if fs.startswith(previous_prefix):
-                                if ('%s@%s' % (previous_prefix[:-1], snapname)) in snapshots_pending_delete:
-                                    continue
-                            else:
-                                previous_prefix = '%s/' % (fs)
-                            snapshots_pending_delete.append(snapshot_name)
-                else:
-                    if (fs, snap_ret_policy, True) in mp_to_task_map:
-                        if (fs, snap_ret_policy, True) in snapshots:
-                            last_snapinfo = snapshots[(fs, snap_ret_policy, True)]
-                            if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
-                                snapshots[(fs, snap_ret_policy, True)] = snap_infodict
-                        else:
-                            snapshots[(fs, snap_ret_policy, True)] = snap_infodict
-                    if (fs, snap_ret_policy, False) in mp_to_task_map:
-                        if (fs, snap_ret_policy, False) in snapshots:
-                            last_snapinfo = snapshots[(fs, snap_ret_policy, False)]
-                            if snapinfodict2datetime(last_snapinfo) < snapinfodict2datetime(snap_infodict):
-                                snapshots[(fs, snap_ret_policy, False)] = snap_infodict
-                        else:
-                            snapshots[(fs, snap_ret_policy, False)] = snap_infodict
-
-    list_mp = list(mp_to_task_map.keys())
-
-    for mpkey in list_mp:
-        tasklist = mp_to_task_map[mpkey]
-        if mpkey in snapshots:
-            snapshot_time = snapinfodict2datetime(snapshots[mpkey])
-            for taskindex in range(len(tasklist) - 1, -1, -1):
-                task = tasklist[taskindex]
-                if snapshot_time + timedelta(minutes=task.task_interval) > snaptime:
-                    del tasklist[taskindex]
-            if len(tasklist) == 0:
-                del mp_to_task_map[mpkey]
-
-    snaptime_str = snaptime.strftime('%Y%m%d.%H%M')
-
-    # This block removes snapshot tasks from mp_to_task_map
-    # if they would be taken by a recursive snapshot task.
-    # For instance if you have datasets:
-    # tank
-    # tank/a
-    # tank/b
-    # tank/c
-    # and a recursive snapshot task on tank as well as a snapshot task
-    # on tank/b
-    # The recursive task works by snapshotting all the dependant datasets
-    # however if there is a name collision (say both snapshot tasks have the same
-    # retention period) then the snapshot task will fail because a dataset already
-    # exists with that name.  If the snapshot task on tank/b runs first then
-    # the entire recursive snapshot task on tank will fail, and the next minute it
-    # will run again.
-    rec = [x for x in list(mp_to_task_map.keys()) if x[2] is True]
-    nonrec = [x for x in list(mp_to_task_map.keys()) if x[2] is False]
-    for nr in nonrec:
-        for r in rec:
-            if (nr[0] + '/').startswith(r[0] + '/') and nr[1] == r[1]:
-                # Delete this item from the dict of snaps to be taken
-                # as it is going to be taken by a recusive task on a
-                # dataset above it.
-                try:
-                    del mp_to_task_map[nr]
-                except:
-                    log.warn("Error removing snapshot task: %s" % nr[0])
-                break
+    snapshots = parse_snapshot_list(zfsproc.communicate()[0])
 
+plan = plan_retention(snapshots, TaskObjects, snaptime, imported_pools)
+
+for task in plan.skipped:
+    vol_name = task.task_filesystem.split('/')[0]
+    log.warn(f'Volume {vol_name} not imported, skipping snapshot task #{task.id}')
+
+mp_to_task_map = plan.create
+snapshots_pending_delete = plan.destroy
+
+# Only proceed further if we are  going to generate any snapshots for this run
+if len(mp_to_task_map) > 0:
     for mpkey, tasklist in list(mp_to_task_map.items()):
         fs, expire, recursive = mpkey
         if recursive:
@@ -380,7 +232,7 @@ if len(mp_to_task_map) > 0:
         else:
             rflag = ''
 
-        snapname = '%s@auto-%s-%s' % (fs, snaptime_str, expire)
+        snapname = snapshot_name(fs, snaptime, expire)
 
         # If there's a VMWare Plugin object for this filesystem
         # snapshot the VMs before taking the ZFS snapshot.
@@ -604,15 +456,12 @@ Hello,
                 )
             connect.Disconnect(si)
 
+# Expired snapshots are destroyed whenever a task is due, even if its interval
+# has not elapsed yet and no new snapshot was taken on this run.
+if snapshots_pending_delete:
     MNTLOCK.lock()
     if not autorepl_running():
-        for snapshot in snapshots_pending_delete:
-            # snapshots with clones will have destruction deferred
-            snapcmd = '/sbin/zfs destroy -r -d "%s"' % (snapshot)
-            proc = pipeopen(snapcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+        destroy_snapshots(snapshots_pending_delete)
     else:
         log.debug("Autorepl running, skip destroying snapshots")
     MNTLOCK.unlock()
@@ -0,0 +1,292 @@
+#
+# Copyright (c) 2018 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Retention planning for periodic snapshot tasks.
+
+This module is split in two parts:
+
+  - `plan_retention` is a pure function which, given the output of
+    `zfs list -t snapshot -H -o name` and the periodic snapshot tasks,
+    decides which snapshots have to be taken and which ones have expired.
+  - `destroy_snapshots` executes the destroy part of the plan, grouping
+    expired snapshots per dataset so a single `zfs destroy` is run for
+    every dataset instead of one per snapshot.
+
+Nothing in here requires django so it can be tested from text fixtures.
+"""
+from collections import OrderedDict, namedtuple
+from datetime import datetime, time, timedelta
+import logging
+import re
+
+from freenasUI.common.timesubr import isTimeBetween
+
+log = logging.getLogger('tools.autosnap')
+
+RE_AUTOSNAP = re.compile(
+    r'^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).'
+    r'(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)'
+    r'(?P<retunit>[hdwmy])$'
+)
+
+# Maximum number of snapshots passed to a single `zfs destroy` call.
+# Keeps the command line within a sane size for datasets with a long backlog.
+DESTROY_BATCH_SIZE = 64
+
+RetentionPlan = namedtuple('RetentionPlan', ['create', 'destroy', 'skipped'])
+
+
+def snapinfodict2datetime(snapinfo):
+    year = int(snapinfo['year'])
+    month = int(snapinfo['month'])
+    day = int(snapinfo['day'])
+    hour = int(snapinfo['hour'])
+    minute = int(snapinfo['minute'])
+    return datetime(year, month, day, hour, minute)
+
+
+def snap_expired(snapinfo, snaptime):
+    snapinfo_expirationtime = snapinfodict2datetime(snapinfo)
+    snap_ttl_value = int(snapinfo['retcount'])
+    snap_ttl_unit = snapinfo['retunit']
+
+    if snap_ttl_unit == 'h':
+        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(hours=snap_ttl_value)
+    elif snap_ttl_unit == 'd':
+        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=snap_ttl_value)
+    elif snap_ttl_unit == 'w':
+        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=7 * snap_ttl_value)
+    elif snap_ttl_unit == 'm':
+        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=int(30.436875 * snap_ttl_value))
+    elif snap_ttl_unit == 'y':
+        snapinfo_expirationtime = snapinfo_expirationtime + timedelta(days=int(365.2425 * snap_ttl_value))
+
+    return snapinfo_expirationtime <= snaptime
+
+
+def isMatchingTime(task, snaptime):
+    curtime = time(snaptime.hour, snaptime.minute)
+    repeat_type = task.task_repeat_unit
+
+    if not isTimeBetween(curtime, task.task_begin, task.task_end):
+        return False
+
+    if repeat_type == 'daily':
+        return True
+
+    if repeat_type == 'weekly':
+        cur_weekday = snaptime.weekday() + 1
+        if ('%d' % cur_weekday) in task.task_byweekday.split(','):
+            return True
+
+    return False
+
+
+def snapshot_name(fs, snaptime, expire):
+    return '%s@auto-%s-%s' % (fs, snaptime.strftime('%Y%m%d.%H%M'), expire)
+
+
+def parse_snapshot_list(output):
+    """
+    Parse the output of `zfs list -t snapshot -H -o name`.
+
+    Snapshots are sorted by (dataset, snapshot) so parents always come
+    before their children, regardless of `-s name` being used.
+    """
+    lines = [line.strip() for line in output.split('\n')]
+    return sorted([line for line in lines if line], key=lambda x: x.split('@'))
+
+
+def _covered_by_task(fs, nonrecursive, recursive):
+    if fs in nonrecursive:
+        return True
+    for path in recursive:
+        if fs == path or fs.startswith(path + '/'):
+            return True
+    return False
+
+
+def _covered_by_parent(fs, snapname, pending):
+    while '/' in fs:
+        fs = fs.rsplit('/', 1)[0]
+        if f'{fs}@{snapname}' in pending:
+            return True
+    return False
+
+
+def plan_retention(snapshots, tasks, snaptime, imported_pools=None):
+    """
+    Compute which snapshots have to be created and destroyed at `snaptime`.
+
+    `snapshots` is a list of snapshot names as returned by `parse_snapshot_list`.
+    `tasks` are the enabled periodic snapshot tasks, with `task_begin` and
+    `task_end` already converted to `datetime.time`.
+    `imported_pools`, when given, is the set of pools currently imported;
+    tasks for any other pool are reported back in `skipped`.
+
+    Returns a `RetentionPlan` where `create` maps (filesystem, expire, recursive)
+    to the list of tasks requesting that snapshot and `destroy` is the ordered
+    list of expired snapshots to be destroyed recursively.
+    """
+    create = OrderedDict()
+    skipped = []
+    taskpath = {'recursive': set(), 'nonrecursive': set()}
+
+    # Grab all matching tasks into a tree.
+    # Since the snapshot we make have the name 'foo@auto-%Y%m%d.%H%M-{expire time}'
+    # format, we just keep one task.
+    for task in tasks:
+        if not isMatchingTime(task, snaptime):
+            continue
+        vol_name = task.task_filesystem.split('/')[0]
+        if imported_pools is not None and vol_name not in imported_pools:
+            skipped.append(task)
+            continue
+        if task.task_recursive:
+            taskpath['recursive'].add(task.task_filesystem)
+        else:
+            taskpath['nonrecursive'].add(task.task_filesystem)
+        expire_time = '%s%s' % (task.task_ret_count, task.task_ret_unit[0])
+        create.setdefault((task.task_filesystem, expire_time, bool(task.task_recursive)), []).append(task)
+
+    # Only proceed further if we are going to generate any snapshots for this run
+    if not create:
+        return RetentionPlan(create, [], skipped)
+
+    latest = {}
+    destroy = []
+    pending = set()
+    for snapshot in snapshots:
+        fs, snapname = snapshot.split('@', 1)
+        snapname_match = RE_AUTOSNAP.match(snapname)
+        if snapname_match is None:
+            continue
+        snapinfo = snapname_match.groupdict()
+        if snap_expired(snapinfo, snaptime):
+            # Only delete the snapshot if there's a snapshot task enabled that created it.
+            if not _covered_by_task(fs, taskpath['nonrecursive'], taskpath['recursive']):
+                continue
+            # Destroy of expired snapshots is recursive, so only request so on the
+            # toplevel.
+            if _covered_by_parent(fs, snapname, pending):
+                continue
+            pending.add(snapshot)
+            destroy.append(snapshot)
+        else:
+            snap_ret_policy = '%s%s' % (snapinfo['retcount'], snapinfo['retunit'])
+            snapshot_time = snapinfodict2datetime(snapinfo)
+            for recursive in (True, False):
+                key = (fs, snap_ret_policy, recursive)
+                if key in create and (key not in latest or latest[key] < snapshot_time):
+                    latest[key] = snapshot_time
+
+    # Drop tasks whose interval has not elapsed since the last snapshot taken.
+    for key in list(create.keys()):
+        if key in latest:
+            create[key] = [
+                task for task in create[key]
+                if latest[key] + timedelta(minutes=task.task_interval) <= snaptime
+            ]
+            if not create[key]:
+                del create[key]
+
+    # Remove non recursive snapshots if they would be taken by a recursive
+    # snapshot task on a dataset above it with the same retention.
+    # If the non recursive snapshot is taken first the recursive snapshot
+    # would fail because of the name collision.
+    rec = [x for x in create.keys() if x[2] is True]
+    nonrec = [x for x in create.keys() if x[2] is False]
+    for nr in nonrec:
+        for r in rec:
+            if (nr[0] + '/').startswith(r[0] + '/') and nr[1] == r[1]:
+                del create[nr]
+                break
+
+    return RetentionPlan(create, destroy, skipped)
+
+
+def group_snapshots(snapshots, batch_size=DESTROY_BATCH_SIZE):
+    """
+    Group snapshot names per dataset into `dataset@a,b,c` destroy arguments.
+
+    Every argument holds at most `batch_size` snapshots and the original
+    order of the datasets is preserved.
+    """
+    grouped = OrderedDict()
+    for snapshot in snapshots:
+        fs, snapname = snapshot.split('@', 1)
+        grouped.setdefault(fs, []).append(snapname)
+
+    batches = []
+    for fs, snapnames in grouped.items():
+        for i in range(0, len(snapnames), batch_size):
+            batch = snapnames[i:i + batch_size]
+            batches.append(('%s@%s' % (fs, ','.join(batch)), ['%s@%s' % (fs, s) for s in batch]))
+    return batches
+
+
+def _run_pipeopen(cmd):
+    from freenasUI.common.pipesubr import pipeopen
+    proc = pipeopen(cmd, logger=log)
+    err = proc.communicate()[1]
+    return proc.returncode, err
+
+
+def destroy_snapshots(snapshots, run=None, progress=None, batch_size=DESTROY_BATCH_SIZE):
+    """
+    Destroy expired snapshots, one `zfs destroy -r -d` per dataset batch.
+
+    `run` receives the command line and returns a (returncode, stderr) tuple,
+    defaulting to `pipeopen`. `progress` is called with (done, total) after
+    every batch. If a batch fails each of its snapshots is retried on its own
+    so a single snapshot that cannot be destroyed does not hold back the others.
+
+    Returns the list of snapshots which failed to be destroyed.
+    """
+    run = run or _run_pipeopen
+    total = len(snapshots)
+    done = 0
+    failed = []
+    for argument, batch in group_snapshots(snapshots, batch_size):
+        # snapshots with clones will have destruction deferred
+        returncode, err = run('/sbin/zfs destroy -r -d "%s"' % argument)
+        if returncode != 0:
+            if len(batch) == 1:
+                log.error("Failed to destroy snapshot '%s': %s", batch[0], err)
+                failed.append(batch[0])
+            else:
+                log.debug("Failed to destroy snapshots '%s', retrying one by one: %s", argument, err)
+                for snapshot in batch:
+                    returncode, err = run('/sbin/zfs destroy -r -d "%s"' % snapshot)
+                    if returncode != 0:
+                        log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+                        failed.append(snapshot)
+        done += len(batch)
+        if progress:
+            progress(done, total)
+        else:
+            log.debug('Destroyed expired snapshots: %d/%d', done, total)
+    return failed
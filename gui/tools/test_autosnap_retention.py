@@ -0,0 +1,142 @@
+from datetime import datetime, time
+from types import SimpleNamespace
+
+from freenasUI.tools.autosnap_retention import (
+    destroy_snapshots, group_snapshots, parse_snapshot_list, plan_retention,
+)
+
+ZFS_LIST = """\
+tank@manual-backup
+tank@auto-20180101.0000-2w
+tank/a@auto-20180101.0000-2w
+tank/a/b@auto-20180101.0000-2w
+tank@auto-20180201.0900-2w
+tank/a@auto-20180201.0900-2w
+tank/a/b@auto-20180201.0900-2w
+tank/vms@auto-20180101.0000-1h
+tank/vms@auto-20180201.0800-1h
+tank/vms@auto-20180201.0900-1h
+tank/other@auto-20180101.0000-1h
+"""
+
+SNAPTIME = datetime(2018, 2, 1, 10, 0)
+
+
+def task(id, filesystem, recursive=False, ret_count=2, ret_unit='week', interval=60):
+    return SimpleNamespace(
+        id=id,
+        task_filesystem=filesystem,
+        task_recursive=recursive,
+        task_ret_count=ret_count,
+        task_ret_unit=ret_unit,
+        task_interval=interval,
+        task_begin=time(0, 0),
+        task_end=time(23, 59),
+        task_repeat_unit='daily',
+        task_byweekday='1,2,3,4,5,6,7',
+    )
+
+
+def test__parse_snapshot_list__sorts_parents_first():
+    assert parse_snapshot_list('tank/a@x\ntank@x\n\n') == ['tank@x', 'tank/a@x']
+
+
+def test__plan_retention__destroys_only_toplevel_of_recursive_task():
+    plan = plan_retention(parse_snapshot_list(ZFS_LIST), [task(1, 'tank/a', recursive=True)], SNAPTIME)
+
+    assert plan.destroy == ['tank/a@auto-20180101.0000-2w']
+
+
+def test__plan_retention__ignores_datasets_without_task():
+    plan = plan_retention(
+        parse_snapshot_list(ZFS_LIST), [task(1, 'tank/vms', ret_count=1, ret_unit='hour')], SNAPTIME,
+    )
+
+    assert plan.destroy == [
+        'tank/vms@auto-20180101.0000-1h',
+        'tank/vms@auto-20180201.0800-1h',
+        'tank/vms@auto-20180201.0900-1h',
+    ]
+
+
+def test__plan_retention__creates_when_interval_elapsed():
+    plan = plan_retention(parse_snapshot_list(ZFS_LIST), [task(1, 'tank', recursive=True)], SNAPTIME)
+
+    assert list(plan.create.keys()) == [('tank', '2w', True)]
+
+
+def test__plan_retention__skips_create_within_interval():
+    plan = plan_retention(
+        parse_snapshot_list(ZFS_LIST), [task(1, 'tank/a', recursive=True, interval=120)], SNAPTIME,
+    )
+
+    assert plan.create == {}
+    assert plan.destroy == ['tank/a@auto-20180101.0000-2w']
+
+
+def test__plan_retention__nonrecursive_covered_by_recursive():
+    plan = plan_retention([], [task(1, 'tank', recursive=True), task(2, 'tank/a')], SNAPTIME)
+
+    assert list(plan.create.keys()) == [('tank', '2w', True)]
+
+
+def test__plan_retention__nothing_due_keeps_snapshots():
+    t = task(1, 'tank', recursive=True)
+    t.task_begin = time(12, 0)
+
+    plan = plan_retention(parse_snapshot_list(ZFS_LIST), [t], SNAPTIME)
+
+    assert plan.create == {}
+    assert plan.destroy == []
+
+
+def test__plan_retention__pool_not_imported():
+    t = task(1, 'tank', recursive=True)
+
+    plan = plan_retention(parse_snapshot_list(ZFS_LIST), [t], SNAPTIME, imported_pools={'other'})
+
+    assert plan.skipped == [t]
+    assert plan.destroy == []
+
+
+def test__group_snapshots__per_dataset_batches():
+    assert group_snapshots(['tank@a', 'tank@b', 'tank@c', 'tank/x@a'], batch_size=2) == [
+        ('tank@a,b', ['tank@a', 'tank@b']),
+        ('tank@c', ['tank@c']),
+        ('tank/x@a', ['tank/x@a']),
+    ]
+
+
+def test__destroy_snapshots__single_call_per_dataset():
+    commands = []
+    progress = []
+
+    failed = destroy_snapshots(
+        ['tank/vms@a', 'tank/vms@b', 'tank/other@a'],
+        run=lambda cmd: commands.append(cmd) or (0, ''),
+        progress=lambda done, total: progress.append((done, total)),
+    )
+
+    assert failed == []
+    assert commands == [
+        '/sbin/zfs destroy -r -d "tank/vms@a,b"',
+        '/sbin/zfs destroy -r -d "tank/other@a"',
+    ]
+    assert progress == [(2, 3), (3, 3)]
+
+
+def test__destroy_snapshots__batch_failure_retries_one_by_one():
+    commands = []
+
+    def run(cmd):
+        commands.append(cmd)
+        return (1, 'busy') if 'b' in cmd.split('@')[1] else (0, '')
+
+    failed = destroy_snapshots(['tank@a', 'tank@b'], run=run)
+
+    assert failed == ['tank@b']
+    assert commands == [
+        '/sbin/zfs destroy -r -d "tank@a,b"',
+        '/sbin/zfs destroy -r -d "tank@a"',
+        '/sbin/zfs destroy -r -d "tank@b"',
+    ]
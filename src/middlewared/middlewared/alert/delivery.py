@@ -0,0 +1,268 @@
+import asyncio
+from contextlib import closing
+from datetime import datetime
+import json
+import logging
+import sqlite3
+import time
+
+from middlewared.alert.base import Alert, AlertLevel
+
+__all__ = ["AlertOutbox", "CircuitBreaker", "AlertDelivery"]
+
+logger = logging.getLogger(__name__)
+
+
+def alert_to_dict(alert):
+    d = alert.__dict__.copy()
+    d["level"] = d["level"].value if d["level"] is not None else None
+    d["datetime"] = d["datetime"].isoformat() if d["datetime"] is not None else None
+    return d
+
+
+def alert_from_dict(d):
+    d = d.copy()
+    if d["level"] is not None:
+        d["level"] = AlertLevel(d["level"])
+    if d["datetime"] is not None:
+        d["datetime"] = datetime.fromisoformat(d["datetime"])
+    return Alert(**d)
+
+
+class AlertOutbox:
+    """
+    Persistent per-destination queues of alert notifications, stored in SQLite.
+
+    Failed deliveries are retried with exponential backoff (`backoff` seconds
+    doubled after every attempt, at most `max_backoff`) and dropped after
+    `max_attempts`.
+    """
+
+    def __init__(self, path, max_attempts=10, backoff=30, max_backoff=3600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS delivery (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    service_id INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    last_error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS delivery_service_id ON delivery (service_id, id)")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30, isolation_level=None))
+
+    def append(self, service_id, alerts, gone_alerts, new_alerts, now=None):
+        now = time.time() if now is None else now
+        payload = json.dumps([[alert_to_dict(alert) for alert in group] for group in (alerts, gone_alerts, new_alerts)])
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO delivery (service_id, created, payload, next_attempt) VALUES (?, ?, ?, ?)",
+                (service_id, now, payload, now),
+            )
+
+    def services(self):
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT service_id FROM delivery")]
+
+    def head(self, service_id):
+        """
+        Returns oldest queued notification of `service_id` as (id, attempts, next_attempt, (alerts, gone_alerts,
+        new_alerts)) or None. Notifications are delivered in order, so only the oldest one can be sent.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, attempts, next_attempt, payload FROM delivery WHERE service_id = ? ORDER BY id LIMIT 1",
+                (service_id,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        id, attempts, next_attempt, payload = row
+        return id, attempts, next_attempt, tuple([alert_from_dict(d) for d in group] for group in json.loads(payload))
+
+    def delivered(self, id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM delivery WHERE id = ?", (id,))
+
+    def failed(self, id, attempts, error, now=None):
+        """
+        Record a failed delivery attempt. Returns False if the notification was dropped.
+        """
+        now = time.time() if now is None else now
+        attempts += 1
+        with self._connect() as conn:
+            if attempts >= self.max_attempts:
+                conn.execute("DELETE FROM delivery WHERE id = ?", (id,))
+                return False
+
+            conn.execute(
+                "UPDATE delivery SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                (attempts, now + min(self.backoff * 2 ** (attempts - 1), self.max_backoff), error, id),
+            )
+            return True
+
+    def remove_service(self, service_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM delivery WHERE service_id = ?", (service_id,))
+
+    def stats(self, service_id, now=None):
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            count, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(created) FROM delivery WHERE service_id = ?", (service_id,),
+            ).fetchone()
+            error = conn.execute(
+                "SELECT last_error FROM delivery WHERE service_id = ? ORDER BY id LIMIT 1", (service_id,),
+            ).fetchone()
+        return {
+            "queued": count,
+            "lag": now - oldest if oldest is not None else 0,
+            "last_error": error[0] if error else None,
+        }
+
+
+class CircuitBreaker:
+    """
+    Stops delivery attempts to a destination for `cooldown` seconds after
+    `threshold` consecutive failures. Once the cooldown has passed one attempt
+    is let through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, threshold=5, cooldown=300):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def state(self, now=None):
+        if self.opened_at is None:
+            return "CLOSED"
+        now = time.monotonic() if now is None else now
+        if now - self.opened_at < self.cooldown:
+            return "OPEN"
+        return "HALF_OPEN"
+
+    def allow(self, now=None):
+        return self.state(now) != "OPEN"
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self, now=None):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic() if now is None else now
+
+
+class AlertDelivery:
+    """
+    Delivers queued alert notifications.
+
+    Every destination (a `system.alertservice` id) has its own queue and is
+    sent to independently of the others, so a slow or failing destination
+    only delays its own notifications.
+
+    `get_alert_service(service_id)` is a coroutine returning the `AlertService`
+    instance for a destination, or None if the destination no longer exists.
+
+    Outbox database is only accessed through `run_in_thread(method, *args)` so a
+    slow or locked database does not block the event loop (default executor is
+    used if it is not given).
+    """
+
+    def __init__(self, outbox, get_alert_service, timeout=60, breaker_threshold=5, breaker_cooldown=300,
+                 run_in_thread=None):
+        self.outbox = outbox
+        self.get_alert_service = get_alert_service
+        self.run_in_thread = run_in_thread or self._run_in_executor
+        self.timeout = timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = {}
+        self.running = {}
+        self.last_success = {}
+
+    def _breaker(self, service_id):
+        if service_id not in self.breakers:
+            self.breakers[service_id] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+        return self.breakers[service_id]
+
+    async def _run_in_executor(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, lambda: method(*args))
+
+    async def enqueue(self, service_id, alerts, gone_alerts, new_alerts):
+        await self.run_in_thread(self.outbox.append, service_id, alerts, gone_alerts, new_alerts)
+
+    async def deliver(self):
+        """
+        Deliver due notifications to all destinations concurrently.
+
+        A destination still busy with a previous `deliver` call is skipped.
+        """
+        await asyncio.gather(*[
+            self._deliver_service(service_id)
+            for service_id in await self.run_in_thread(self.outbox.services)
+            if service_id not in self.running
+        ])
+
+    async def _deliver_service(self, service_id):
+        self.running[service_id] = True
+        try:
+            while True:
+                head = await self.run_in_thread(self.outbox.head, service_id)
+                if head is None:
+                    return
+
+                id, attempts, next_attempt, (alerts, gone_alerts, new_alerts) = head
+                breaker = self._breaker(service_id)
+                if next_attempt > time.time() or not breaker.allow():
+                    return
+
+                try:
+                    alert_service = await self.get_alert_service(service_id)
+                    if alert_service is None:
+                        await self.run_in_thread(self.outbox.remove_service, service_id)
+                        self.breakers.pop(service_id, None)
+                        return
+
+                    await asyncio.wait_for(alert_service.send(alerts, gone_alerts, new_alerts), self.timeout)
+                except Exception as e:
+                    error = str(e) or repr(e)
+                    logger.warning("Error in alert service %r: %s", service_id, error,
+                                   exc_info=not isinstance(e, asyncio.TimeoutError))
+                    breaker.failure()
+                    if not await self.run_in_thread(self.outbox.failed, id, attempts, error):
+                        logger.error("Dropping alert notification for alert service %r after %d attempts",
+                                     service_id, attempts + 1)
+                    return
+
+                breaker.success()
+                await self.run_in_thread(self.outbox.delivered, id)
+                self.last_success[service_id] = time.time()
+        finally:
+            self.running.pop(service_id, None)
+
+    def status(self, service_id):
+        """
+        Delivery status of a destination: number of `queued` notifications, `lag`
+        in seconds of the oldest one, `last_error`, `last_success` timestamp and
+        `circuit` breaker state.
+
+        Reads the outbox database, so it must not be called from the event loop.
+        """
+        status = self.outbox.stats(service_id)
+        status["last_success"] = self.last_success.get(service_id)
+        breaker = self.breakers.get(service_id)
+        status["circuit"] = breaker.state() if breaker else "CLOSED"
+        return status
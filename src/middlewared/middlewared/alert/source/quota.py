@@ -1,17 +1,125 @@
+from collections import defaultdict, namedtuple
 from datetime import timedelta
 import logging
 import os
 import socket
+import subprocess
 
-from bsd import getmntinfo
 import humanfriendly
-import libzfs
 
 from middlewared.alert.base import Alert, AlertLevel, ThreadedAlertSource
 from middlewared.alert.schedule import IntervalSchedule
 
 logger = logging.getLogger(__name__)
 
+THRESHOLDS = [("org.freenas:quota_warning", 80), ("org.freenas:quota_critical", 95),
+              ("org.freenas:refquota_warning", 80), ("org.freenas:refquota_critical", 95)]
+PROPERTIES = ["quota", "used", "refquota", "usedbydataset", "mounted", "mountpoint"] + [k for k, v in THRESHOLDS]
+
+QuotaExcess = namedtuple("QuotaExcess", ["dataset", "quota_property", "id", "used", "quota", "used_fraction",
+                                         "level"])
+
+
+def parse_zfs_get(output):
+    """
+    Parse `zfs get -H -p -o name,property,value` output into {dataset: {property: value}}.
+    """
+    datasets = defaultdict(dict)
+    for line in output.splitlines():
+        try:
+            name, property, value = line.split("\t")
+        except ValueError:
+            logger.debug("Unable to parse zfs get output line %r", line)
+            continue
+        datasets[name][property] = value
+    return dict(datasets)
+
+
+def parse_userspace(output):
+    """
+    Parse `zfs userspace -H -n -p -o type,name,used,quota` output into a list
+    of (quota property, id, used, quota) for users and groups having a quota.
+    """
+    result = []
+    for line in output.splitlines():
+        type, id, used, quota = line.split("\t")
+        try:
+            quota = int(quota)
+        except ValueError:
+            continue
+        if quota == 0:
+            continue
+
+        quota_property = {"POSIX User": "userquota", "POSIX Group": "groupquota"}.get(type)
+        if quota_property is None:
+            continue
+
+        result.append((quota_property, int(id), int(used), quota))
+    return result
+
+
+def _threshold(properties, name, default):
+    try:
+        return int(properties[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _level(used, quota, warning_threshold, critical_threshold):
+    try:
+        used_fraction = 100 * used / quota
+    except ZeroDivisionError:
+        used_fraction = 100
+
+    if critical_threshold != 0 and used_fraction >= critical_threshold:
+        return used_fraction, AlertLevel.CRITICAL
+    elif warning_threshold != 0 and used_fraction >= warning_threshold:
+        return used_fraction, AlertLevel.WARNING
+    return used_fraction, None
+
+
+def evaluate_quotas(datasets, userspace):
+    """
+    Return list of `QuotaExcess` for quotas used above their warning or critical threshold.
+
+    `datasets` is {dataset: {property: value}} as returned by `parse_zfs_get` and
+    `userspace` is {dataset: [(quota property, id, used, quota)]} as returned by
+    `parse_userspace`. User and group quotas use the dataset quota thresholds.
+    """
+    result = []
+    for name in sorted(datasets):
+        properties = datasets[name]
+        thresholds = {k: _threshold(properties, k, default) for k, default in THRESHOLDS}
+
+        quotas = []
+        for quota_property, used_property in [("quota", "used"), ("refquota", "usedbydataset")]:
+            try:
+                quota = int(properties[quota_property])
+                used = int(properties[used_property])
+            except (KeyError, ValueError):
+                continue
+
+            if quota == 0:
+                continue
+
+            quotas.append((quota_property, None, used, quota, quota_property))
+
+        for quota_property, id, used, quota in userspace.get(name, []):
+            quotas.append((quota_property, id, used, quota, "quota"))
+
+        for quota_property, id, used, quota, thresholds_property in quotas:
+            used_fraction, level = _level(
+                used, quota,
+                thresholds[f"org.freenas:{thresholds_property}_warning"],
+                thresholds[f"org.freenas:{thresholds_property}_critical"],
+            )
+            if level is None:
+                continue
+
+            result.append(QuotaExcess(name, quota_property, id, used, quota, used_fraction, level))
+
+    return result
+
 
 class QuotaAlertSource(ThreadedAlertSource):
     level = AlertLevel.WARNING
@@ -20,118 +128,122 @@ class QuotaAlertSource(ThreadedAlertSource):
     schedule = IntervalSchedule(timedelta(minutes=5))
 
     def check_sync(self):
+        datasets = parse_zfs_get(self._run([
+            "/sbin/zfs", "get", "-H", "-p", "-o", "name,property,value", "-t", "filesystem,volume",
+            ",".join(PROPERTIES),
+        ], check=False))
+
+        userspace = {}
+        for name, properties in datasets.items():
+            if properties.get("mounted") != "yes":
+                continue
+
+            try:
+                output = self._run([
+                    "/sbin/zfs", "userspace", "-H", "-n", "-p", "-o", "type,name,used,quota",
+                    "-t", "posixuser,posixgroup", name,
+                ])
+            except subprocess.CalledProcessError as e:
+                logger.debug("Unable to get user and group quotas of dataset %r: %s", name, e.stderr)
+                continue
+
+            userspace[name] = parse_userspace(output)
+
+        excesses = evaluate_quotas(datasets, userspace)
+        if not excesses:
+            return []
+
+        emails = {
+            user["bsdusr_uid"]: user["bsdusr_email"]
+            for user in self.middleware.call_sync("datastore.query", "account.bsdusers")
+        }
+        mounts = None
+        owners = {}
+        hostname = socket.gethostname()
+
         alerts = []
+        for excess in excesses:
+            quota_name = {
+                "quota": "Quota",
+                "refquota": "Refquota",
+                "userquota": "User quota",
+                "groupquota": "Group quota",
+            }[excess.quota_property]
 
-        with libzfs.ZFS() as zfs:
-            datasets = [
-                {
-                    k: v.__getstate__()
-                    for k, v in i.properties.items()
-                    if k in ["name", "quota", "used", "refquota", "usedbydataset", "mounted", "mountpoint",
-                             "org.freenas:quota_warning", "org.freenas:quota_critical",
-                             "org.freenas:refquota_warning", "org.freenas:refquota_critical"]
-                }
-                for i in zfs.datasets
-            ]
-
-        for d in datasets:
-            d["name"] = d["name"]["rawvalue"]
-
-            for k, default in [("org.freenas:quota_warning", 80), ("org.freenas:quota_critical", 95),
-                               ("org.freenas:refquota_warning", 80), ("org.freenas:refquota_critical", 95)]:
-                try:
-                    d[k] = int(d[k]["rawvalue"])
-                except (KeyError, ValueError):
-                    d[k] = default
-
-        datasets = sorted(datasets, key=lambda ds: ds["name"])
-
-        for dataset in datasets:
-            for quota_property, used_property in [
-                ("quota", "used"),
-                ("refquota", "usedbydataset"),
-            ]:
-                try:
-                    quota_value = int(dataset[quota_property]["rawvalue"])
-                except (AttributeError, KeyError, ValueError):
-                    continue
-
-                if quota_value == 0:
-                    continue
-
-                used = int(dataset[used_property]["rawvalue"])
-                try:
-                    used_fraction = 100 * used / quota_value
-                except ZeroDivisionError:
-                    used_fraction = 100
-
-                critical_threshold = dataset[f"org.freenas:{quota_property}_critical"]
-                warning_threshold = dataset[f"org.freenas:{quota_property}_warning"]
-                if critical_threshold != 0 and used_fraction >= critical_threshold:
-                    level = AlertLevel.CRITICAL
-                elif warning_threshold != 0 and used_fraction >= warning_threshold:
-                    level = AlertLevel.WARNING
-                else:
-                    continue
-
-                quota_name = quota_property[0].upper() + quota_property[1:]
-
-                hostname = socket.gethostname()
-
-                title = ("%(name)s exceed on dataset %(dataset)s. "
+            title = ("%(name)s exceed on dataset %(dataset)s. "
+                     "Used %(used_fraction).2f%% (%(used)s of %(quota_value)s)")
+            args = {
+                "name": quota_name,
+                "dataset": excess.dataset,
+                "used_fraction": excess.used_fraction,
+                "used": humanfriendly.format_size(excess.used),
+                "quota_value": humanfriendly.format_size(excess.quota),
+            }
+            key = [excess.dataset, excess.quota_property, excess.level.name]
+            if excess.id is not None:
+                title = ("%(name)s exceed on dataset %(dataset)s for %(id_type)s %(id)d. "
                          "Used %(used_fraction).2f%% (%(used)s of %(quota_value)s)")
-                args = {
-                    "name": quota_name,
-                    "dataset": dataset["name"],
-                    "used_fraction": used_fraction,
-                    "used": humanfriendly.format_size(used),
-                    "quota_value": humanfriendly.format_size(quota_value),
-                }
-
-                mail = None
-                owner = self._get_owner(dataset)
-                if owner != 0:
-                    try:
-                        bsduser = self.middleware.call_sync(
-                            "datastore.query",
-                            "account.bsdusers",
-                            [["bsdusr_uid", "=", owner]],
-                            {"get": True},
-                        )
-                        to = bsduser["bsdusr_email"] or None
-                    except IndexError:
-                        logger.debug("Unable to query bsduser with uid %r", owner)
-                        to = None
-
-                    if to is not None:
-                        mail = {
-                            "to": [to],
-                            "subject": f"{hostname}: {quota_name} exceed on dataset {dataset['name']}",
-                            "text": title % args
-                        }
-
-                alerts.append(Alert(
-                    title=title,
-                    args=args,
-                    key=[dataset["name"], quota_property, level.name],
-                    level=level,
-                    mail=mail,
-                ))
+                args["id_type"] = "user" if excess.quota_property == "userquota" else "group"
+                args["id"] = excess.id
+                key.insert(2, excess.id)
+
+            if excess.quota_property == "userquota":
+                owner = excess.id
+            else:
+                if excess.dataset not in owners:
+                    if mounts is None:
+                        mounts = {m["source"]: m["dest"] for m in self.middleware.call_sync("mount.query")}
+                    owners[excess.dataset] = self._get_owner(excess.dataset, datasets[excess.dataset], mounts)
+                owner = owners[excess.dataset]
+
+            mail = None
+            if owner != 0:
+                to = emails.get(owner)
+                if to is None:
+                    logger.debug("Unable to find email of uid %r", owner)
+                elif to:
+                    mail = {
+                        "to": [to],
+                        "subject": f"{hostname}: {quota_name} exceed on dataset {excess.dataset}",
+                        "text": title % args
+                    }
+
+            alerts.append(Alert(
+                title=title,
+                args=args,
+                key=key,
+                level=excess.level,
+                mail=mail,
+            ))
 
         return alerts
 
-    def _get_owner(self, dataset):
+    def _run(self, args, check=True):
+        """
+        Run `args` and return its output.
+
+        With `check=False` a failure (e.g. a dataset being destroyed while it is listed) is logged and whatever was
+        printed for the other datasets is returned.
+        """
+        cp = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf8")
+        if cp.returncode != 0:
+            if check:
+                raise subprocess.CalledProcessError(cp.returncode, args, cp.stdout, cp.stderr)
+
+            logger.debug("%r exited with code %d, ignoring failed datasets: %s", args[:2], cp.returncode,
+                         cp.stderr.strip())
+
+        return cp.stdout
+
+    def _get_owner(self, name, properties, mounts):
         mountpoint = None
-        if dataset["mounted"]["value"] == "yes":
-            if dataset["mountpoint"]["value"] == "legacy":
-                for m in getmntinfo():
-                    if m.source == dataset["name"]["value"]:
-                        mountpoint = m.dest
-                        break
+        if properties.get("mounted") == "yes":
+            if properties.get("mountpoint") == "legacy":
+                mountpoint = mounts.get(name)
             else:
-                mountpoint = dataset["mountpoint"]["value"]
+                mountpoint = properties.get("mountpoint")
         if mountpoint is None:
-            logger.debug("Unable to get mountpoint for dataset %r, assuming owner = root", dataset["name"]["value"])
+            logger.debug("Unable to get mountpoint for dataset %r, assuming owner = root", name)
             uid = 0
         else:
             try:
@@ -1 +1 @@
-from .client import Client, ClientException, CallTimeout, ValidationErrors, ErrnoMixin  # NOQA
+from .client import AsyncClient, Client, ClientException, CallTimeout, ValidationErrors, ErrnoMixin  # NOQA
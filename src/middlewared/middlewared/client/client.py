@@ -1,24 +1,26 @@
 from . import ejson as json
-from .protocol import DDPProtocol
 from .utils import ProgressBar
-from collections import defaultdict, namedtuple, Callable
-from threading import Event as TEvent, Lock, Thread
-from ws4py.client.threadedclient import WebSocketClient
-from ws4py.websocket import WebSocket
+from collections import defaultdict, namedtuple
+from threading import Event as TEvent, Thread
 
+import aiohttp
 import argparse
-from base64 import b64decode, b64encode
-import ctypes
+import asyncio
+from base64 import b64decode
+import contextlib
 import errno
+import logging
 import os
 import pickle
 import socket
-import ssl
 import sys
 import threading
 import time
+import urllib.parse
 import uuid
 
+logger = logging.getLogger(__name__)
+
 
 class Event(TEvent):
 
@@ -46,174 +48,19 @@ class Event(TEvent):
 
 
 CALL_TIMEOUT = int(os.environ.get('CALL_TIMEOUT', 60))
+HANDSHAKE_TIMEOUT = 10
+RECONNECT_DELAY = 0.5
+RECONNECT_DELAY_MAX = 30
+# Source ports `rresvport(3)` picks from
+RESERVED_PORTS = range(1023, 511, -1)
+LOGIN_METHODS = ('auth.login', 'auth.token')
+JOB_FINISHED = ('SUCCESS', 'FAILED', 'ABORTED')
+# Jobs are polled if no event was received for that long (servers before `core.get_jobs:<id>` do not send any)
+JOB_POLL_INTERVAL = 10
 
-
-class WSClient(WebSocketClient):
-    def __init__(self, url, *args, **kwargs):
-        self.client = kwargs.pop('client')
-        reserved_ports = kwargs.pop('reserved_ports')
-        reserved_ports_blacklist = kwargs.pop('reserved_ports_blacklist')
-        self.reserved_fd = None
-        self.protocol = DDPProtocol(self)
-        if not reserved_ports:
-            super(WSClient, self).__init__(url, *args, **kwargs)
-        else:
-            """
-            All this code has been copied from WebSocketClient.__init__
-            because it is not prepared to handle a custom socket via method
-            overriding. We need to use socket.fromfd in case reserved_ports
-            is specified.
-            """
-            self.url = url
-            self.host = None
-            self.scheme = None
-            self.port = None
-            self.unix_socket_path = None
-            self.resource = None
-            self.ssl_options = kwargs.get('ssl_options') or {}
-            self.extra_headers = kwargs.get('headers') or []
-            self.exclude_headers = kwargs.get('exclude_headers') or []
-            self.exclude_headers = [x.lower() for x in self.exclude_headers]
-
-            if self.scheme == "wss":
-                # Prevent check_hostname requires server_hostname (ref #187)
-                if "cert_reqs" not in self.ssl_options:
-                    self.ssl_options["cert_reqs"] = ssl.CERT_NONE
-
-            self._parse_url()
-
-            if self.unix_socket_path:
-                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
-            else:
-                # Let's handle IPv4 and IPv6 addresses
-                # Simplified from CherryPy's code
-                try:
-                    family, socktype, proto, canonname, sa = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
-                except socket.gaierror:
-                    family = socket.AF_INET
-                    if self.host.startswith('::'):
-                        family = socket.AF_INET6
-
-                    socktype = socket.SOCK_STREAM
-                    proto = 0
-
-                """
-                This is the line replaced to use socket.fromfd
-                """
-                try:
-                    self.reserved_fd = self.get_reserved_portfd(blacklist=reserved_ports_blacklist)
-                    sock = socket.fromfd(self.reserved_fd, family, socktype, proto)
-                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                    if hasattr(socket, 'AF_INET6') and family == socket.AF_INET6 and self.host.startswith('::'):
-                        try:
-                            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
-                        except (AttributeError, socket.error):
-                            pass
-                except Exception as e:
-                    if self.reserved_fd:
-                        try:
-                            os.close(self.reserved_fd)
-                        except OSError:
-                            pass
-                    raise e
-
-            WebSocket.__init__(self, sock, protocols=kwargs.get('protocols'),
-                               extensions=kwargs.get('extensions'),
-                               heartbeat_freq=kwargs.get('heartbeat_freq'))
-
-            self.stream.always_mask = True
-            self.stream.expect_masking = False
-            self.key = b64encode(os.urandom(16))
-            self._th = threading.Thread(target=self.run, name='WebSocketClient')
-            self._th.daemon = True
-
-    def get_reserved_portfd(self, blacklist=None):
-        """
-        Get a file descriptor with a reserved port (<=1024).
-        The port is arbitrary using the libc "rresvport" call and its tried
-        again if its within `blacklist` list.
-        """
-        if blacklist is None:
-            blacklist = []
-
-        libc = ctypes.cdll.LoadLibrary('libc.so.7')
-        port = ctypes.c_int(0)
-        pport = ctypes.pointer(port)
-        fd = libc.rresvport(pport)
-        retries = 5
-        while True:
-            if retries == 0:
-                break
-            if fd < 0:
-                time.sleep(0.1)
-                fd = libc.rresvport(pport)
-                retries -= 1
-                continue
-            if pport.contents.value in blacklist:
-                oldfd = fd
-                fd = libc.rresvport(pport)
-                os.close(oldfd)
-                retries -= 1
-                continue
-            else:
-                break
-        if fd < 0:
-            raise ValueError('Failed to reserv a privileged port')
-        return fd
-
-    def connect(self):
-        self.sock.settimeout(10)
-        max_attempts = 3
-        for i in range(max_attempts):
-            try:
-                rv = super(WSClient, self).connect()
-            except OSError as e:
-                # Lets retry a few times in case the error is
-                # [Errno 48] Address already in use
-                # which I believe may be caused by a race condition
-                if e.errno == errno.EADDRINUSE and i < max_attempts - 1:
-                    continue
-                raise
-            else:
-                break
-        if self.sock:
-            self.sock.settimeout(None)
-        return rv
-
-    def opened(self):
-        self.protocol.on_open()
-
-    def closed(self, code, reason=None):
-        self.protocol.on_close(code, reason)
-
-    def __close_reserved_fd(self):
-        try:
-            if self.reserved_fd:
-                os.close(self.reserved_fd)
-        except OSError:
-            pass
-        finally:
-            self.reserved_fd = None
-
-    def close_connection(self):
-        self.__close_reserved_fd()
-        return super().close_connection()
-
-    def received_message(self, message):
-        self.protocol.on_message(message.data.decode('utf8'))
-
-    def on_open(self):
-        self.client.on_open()
-
-    def on_message(self, message):
-        self.client._recv(message)
-
-    def on_close(self, code, reason=None):
-        self.client.on_close(code, reason)
-
-    def __del__(self):
-        self.__close_reserved_fd()
+# Queued for subscription iterators after reconnecting (events might have been missed) and when unsubscribed
+RESUBSCRIBED = object()
+UNSUBSCRIBED = object()
 
 
 class Call(object):
@@ -222,7 +69,7 @@ class Call(object):
         self.id = str(uuid.uuid4())
         self.method = method
         self.params = params
-        self.returned = Event()
+        self.returned = asyncio.get_event_loop().create_future()
         self.result = None
         self.errno = None
         self.error = None
@@ -231,6 +78,30 @@ class Call(object):
         self.extra = None
         self.py_exception = None
 
+    def set_result(self, message, py_exceptions=False):
+        self.result = message.get('result')
+        if 'error' in message:
+            self.errno = message['error'].get('error')
+            self.error = message['error'].get('reason')
+            self.trace = message['error'].get('trace')
+            self.type = message['error'].get('type')
+            self.extra = message['error'].get('extra')
+            self.py_exception = message['error'].get('py_exception')
+            if py_exceptions and self.py_exception:
+                self.py_exception = pickle.loads(b64decode(
+                    self.py_exception
+                ))
+        if not self.returned.done():
+            self.returned.set_result(None)
+
+    def raise_error(self):
+        if self.errno:
+            if self.py_exception:
+                raise self.py_exception
+            if self.trace and self.type == 'VALIDATION':
+                raise ValidationErrors(self.extra)
+            raise ClientException(self.error, self.errno, self.trace, self.extra)
+
 
 class ErrnoMixin:
     ENOMETHOD = 201
@@ -279,239 +150,524 @@ class CallTimeout(ClientException):
     pass
 
 
-class Client(object):
+class Subscription(object):
+    """
+    Subscription to events of collection `name`.
+
+    Events are passed to `callback(event_type, **message)` if there is one, otherwise they are queued for async
+    iteration which stops once unsubscribed or the client is closed.
+    """
+
+    def __init__(self, client, name, callback=None):
+        self.id = str(uuid.uuid4())
+        self.client = client
+        self.name = name
+        self.callback = callback
+        self.ready = None
+        self.queue = asyncio.Queue()
+
+    def _put(self, message):
+        if self.callback is None:
+            self.queue.put_nowait(message)
+        elif message is not RESUBSCRIBED and message is not UNSUBSCRIBED:
+            try:
+                self.callback(message['msg'].upper(), **message)
+            except Exception:
+                logger.error('Callback for %r events failed', self.name, exc_info=True)
+
+    async def _next(self):
+        """
+        Next event, `RESUBSCRIBED` or `UNSUBSCRIBED`.
+        """
+        message = await self.queue.get()
+        if message is UNSUBSCRIBED:
+            # Wake up other waiters too
+            self.queue.put_nowait(UNSUBSCRIBED)
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            message = await self._next()
+            if message is UNSUBSCRIBED:
+                raise StopAsyncIteration
+            if message is not RESUBSCRIBED:
+                return message
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, typ, value, traceback):
+        await self.unsubscribe()
+
+    async def unsubscribe(self):
+        await self.client.unsubscribe(self)
+
+
+class AsyncClient(object):
+    """
+    asyncio middleware client.
+
+    Calls are pipelined: any number of them can be in flight over the connection and their results are matched to
+    them by message id.
+
+    With `reconnect` a lost connection is reestablished in background: calls that were in flight fail, new calls wait
+    until the last successful login is replayed and subscriptions are renewed.
+    """
 
     def __init__(
         self, uri=None, reserved_ports=False, reserved_ports_blacklist=None,
-        py_exceptions=False,
+        py_exceptions=False, reconnect=False,
     ):
         """
         Arguments:
            :reserved_ports(bool): whether the connection should origin using a reserved port (<= 1024)
            :reserved_ports_blacklist(list): list of ports that should not be used as origin
+           :reconnect(bool): whether a lost connection should be reestablished
         """
+        self._uri = uri or 'ws+unix:///var/run/middlewared.sock'
+        self._reserved_ports = reserved_ports
+        self._reserved_ports_blacklist = reserved_ports_blacklist or []
+        self._py_exceptions = py_exceptions
+        self._reconnect = reconnect
         self._calls = {}
-        self._jobs = defaultdict(dict)
-        self._jobs_lock = Lock()
-        self._jobs_watching = False
         self._pings = {}
-        self._py_exceptions = py_exceptions
-        self._event_callbacks = {}
-        if uri is None:
-            uri = 'ws+unix:///var/run/middlewared.sock'
-        self._closed = Event()
-        self._connected = Event()
+        self._subscriptions = {}
+        # Subscriptions by name
+        self._subscribed = defaultdict(set)
+        # Method and params of last successful login
+        self._login = None
+        self._session = None
+        self._ws = None
+        self._receiver = None
+        # Set while calls can be sent
+        self._ready = None
+        self._closing = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, typ, value, traceback):
+        await self.close()
+
+    @property
+    def closed(self):
+        return self._receiver is None or self._receiver.done()
+
+    async def connect(self):
+        self._ready = asyncio.Event()
+        await self._handshake()
+        self._receiver = asyncio.ensure_future(self._run())
+        self._ready.set()
+
+    async def _handshake(self):
         try:
-            self._ws = WSClient(
-                uri,
-                client=self,
-                reserved_ports=reserved_ports,
-                reserved_ports_blacklist=reserved_ports_blacklist,
-            )
-            if 'unix://' in uri:
-                self._ws.resource = '/websocket'
-            self._ws.connect()
-            self._connected.wait(10)
-            if not self._connected.is_set():
+            await asyncio.wait_for(self._connect(), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ClientException('Failed connection handshake')
+
+    async def _connect(self):
+        session, ws = await self._open()
+        try:
+            await ws.send_str(json.dumps({
+                'msg': 'connect',
+                'version': '1',
+                'support': ['1'],
+                'features': ['PY_EXCEPTIONS'] if self._py_exceptions else [],
+            }))
+            msg = await ws.receive()
+            message = json.loads(msg.data) if msg.type == aiohttp.WSMsgType.TEXT else {}
+            if message.get('msg') == 'failed':
+                raise ClientException('Unsupported protocol version')
+            if message.get('msg') != 'connected':
                 raise ClientException('Failed connection handshake')
-        except Exception as e:
-            if hasattr(self, '_ws'):
-                del self._ws
-            raise e
+        except BaseException:
+            await ws.close()
+            await session.close()
+            raise
 
-    def __enter__(self):
-        return self
+        self._session = session
+        self._ws = ws
 
-    def __exit__(self, typ, value, traceback):
-        self.close()
-        if typ is not None:
+    async def _open(self):
+        url = urllib.parse.urlsplit(self._uri)
+        if url.scheme == 'ws+unix':
+            return await self._ws_connect('ws://localhost/websocket', aiohttp.UnixConnector(url.path))
+
+        if not self._reserved_ports:
+            return await self._ws_connect(self._uri, aiohttp.TCPConnector())
+
+        local_host = '::' if ':' in url.hostname else '0.0.0.0'
+        for port in RESERVED_PORTS:
+            if port in self._reserved_ports_blacklist:
+                continue
+
+            try:
+                return await self._ws_connect(self._uri, aiohttp.TCPConnector(local_addr=(local_host, port)))
+            except aiohttp.ClientConnectorError as e:
+                if e.os_error.errno != errno.EADDRINUSE:
+                    raise
+
+        raise ClientException('Failed to reserve a privileged port')
+
+    async def _ws_connect(self, url, connector):
+        session = aiohttp.ClientSession(connector=connector)
+        try:
+            # Certificates are not verified, results are not limited in size
+            return session, await session.ws_connect(url, ssl=False, max_msg_size=0)
+        except BaseException:
+            await session.close()
             raise
 
-    def _send(self, data):
-        self._ws.send(json.dumps(data))
+    async def _run(self):
+        try:
+            while True:
+                async for msg in self._ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        try:
+                            self._recv(json.loads(msg.data))
+                        except Exception:
+                            logger.error('Failed to process message %r', msg.data, exc_info=True)
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        break
+
+                await self._connection_lost()
+                if self._closing or not self._reconnect or not await self._reconnect_loop():
+                    break
+        finally:
+            self._closed()
+
+    async def _connection_lost(self):
+        self._ready.clear()
+        self._fail_pending(ClientException('Connection closed', errno.ECONNRESET))
+        await self._ws.close()
+        await self._session.close()
+
+    def _fail_pending(self, exc):
+        futures = [call.returned for call in self._calls.values()]
+        futures += [subscription.ready for subscription in self._subscriptions.values() if subscription.ready]
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+                # Callers that are not waiting anymore do not need to retrieve the exception
+                future.exception()
+
+    async def _reconnect_loop(self):
+        delay = RECONNECT_DELAY
+        while not self._closing:
+            try:
+                await self._handshake()
+            except Exception as e:
+                logger.debug('Failed to reconnect to %r: %r', self._uri, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+            else:
+                # Replies are only received once we are back in the receive loop
+                asyncio.ensure_future(self._restore())
+                return True
+
+        return False
+
+    async def _restore(self):
+        ws = self._ws
+        try:
+            if self._login is not None:
+                try:
+                    await self._call(*self._login, wait_ready=False)
+                except Exception:
+                    logger.warning('Failed to log in after reconnecting', exc_info=True)
+
+            subscriptions = list(self._subscriptions.values())
+            for subscription, result in zip(subscriptions, await asyncio.gather(
+                *[self._subscribe(subscription) for subscription in subscriptions], return_exceptions=True
+            )):
+                if isinstance(result, Exception):
+                    logger.warning('Failed to resubscribe to %r: %r', subscription.name, result)
+                subscription._put(RESUBSCRIBED)
+        finally:
+            if self._ws is ws and not ws.closed:
+                self._ready.set()
+
+    def _closed(self):
+        self._fail_pending(ClientException('Connection closed', errno.ECONNRESET))
+        for subscription in self._subscriptions.values():
+            subscription._put(UNSUBSCRIBED)
+        # Let calls waiting for reconnect fail
+        self._ready.set()
 
     def _recv(self, message):
         _id = message.get('id')
         msg = message.get('msg')
-        if msg == 'connected':
-            self._connected.set()
-        elif msg == 'failed':
-            raise ClientException('Unsupported protocol version')
-        elif msg == 'pong' and _id is not None:
-            ping_event = self._pings.get(_id)
-            if ping_event:
-                ping_event.set()
-        elif _id is not None and msg == 'result':
+        if msg == 'result':
             call = self._calls.get(_id)
             if call:
-                call.result = message.get('result')
-                if 'error' in message:
-                    call.errno = message['error'].get('error')
-                    call.error = message['error'].get('reason')
-                    call.trace = message['error'].get('trace')
-                    call.type = message['error'].get('type')
-                    call.extra = message['error'].get('extra')
-                    call.py_exception = message['error'].get('py_exception')
-                    if self._py_exceptions and call.py_exception:
-                        call.py_exception = pickle.loads(b64decode(
-                            call.py_exception
-                        ))
-                call.returned.set()
-                self._unregister_call(call)
+                call.set_result(message, self._py_exceptions)
+            elif _id in self._subscriptions and 'error' in message:
+                # e.g. not authenticated
+                self._subscription_failed(self._subscriptions[_id], message['error'].get('reason'))
         elif msg in ('added', 'changed', 'removed'):
-            if self._event_callbacks:
-                if '*' in self._event_callbacks:
-                    event = self._event_callbacks['*']
-                    event['callback'](msg.upper(), **message)
-                if message['collection'] in self._event_callbacks:
-                    event = self._event_callbacks[message['collection']]
-                    event['callback'](msg.upper(), **message)
+            collection = message.get('collection')
+            names = [collection, '*']
+            if _id is not None:
+                names.append(f'{collection}:{_id}')
+            for name in names:
+                for subscription in list(self._subscribed.get(name, ())):
+                    subscription._put(message)
+        elif msg == 'pong':
+            ping = self._pings.get(_id)
+            if ping and not ping.done():
+                ping.set_result(True)
         elif msg == 'ready':
             for subid in message['subs']:
-                # FIXME: We may need to keep a different index for id
-                # so we don't hve to iterate through all.
-                # This is fine for just a dozen subscriptions
-                for event in self._event_callbacks.values():
-                    if subid == event['id']:
-                        event['ready'].set()
-                        break
+                subscription = self._subscriptions.get(subid)
+                if subscription and subscription.ready and not subscription.ready.done():
+                    subscription.ready.set_result(None)
+        elif msg == 'nosub':
+            subscription = self._subscriptions.get(_id)
+            if subscription:
+                self._subscription_failed(subscription, (message.get('error') or {}).get('error'))
+
+    def _subscription_failed(self, subscription, error):
+        if subscription.ready and not subscription.ready.done():
+            subscription.ready.set_exception(ClientException(error or 'Subscription failed'))
+
+    async def _send(self, data):
+        if self._ws is None or self._ws.closed:
+            raise ClientException('Connection closed', errno.ECONNRESET)
+        await self._ws.send_str(json.dumps(data))
+
+    async def _wait_ready(self, timeout):
+        if self._ready.is_set():
+            return
 
-    def on_open(self):
-        features = []
-        if self._py_exceptions:
-            features.append('PY_EXCEPTIONS')
-        self._send({
-            'msg': 'connect',
-            'version': '1',
-            'support': ['1'],
-            'features': features,
-        })
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout or None)
+        except asyncio.TimeoutError:
+            raise CallTimeout('Call timeout')
 
-    def on_close(self, code, reason=None):
-        self._closed.set()
+    async def call(self, method, *params, timeout=CALL_TIMEOUT, job=False, callback=None):
+        """
+        Calls `method` waiting at most `timeout` seconds (forever if it is 0 or None) for its result.
 
-    def _register_call(self, call):
-        self._calls[call.id] = call
+        With `job` waits for the job started by `method` to finish and returns its result, passing the job to
+        `callback` on every update.
+        """
+        result = await self._call(method, params, timeout)
+        if job:
+            return await self._wait_job(result, timeout, callback)
+        return result
 
-    def _unregister_call(self, call):
-        self._calls.pop(call.id, None)
+    async def _call(self, method, params, timeout=CALL_TIMEOUT, wait_ready=True):
+        if wait_ready:
+            await self._wait_ready(timeout)
 
-    def _jobs_callback(self, mtype, **message):
-        """
-        Method to process the received job events.
-        """
-        fields = message.get('fields')
-        job_id = fields['id']
-        with self._jobs_lock:
-            if fields:
-                job = self._jobs[job_id]
-                job.update(fields)
-                if isinstance(job.get('__callback'), Callable):
-                    job['__callback'](job)
-                if mtype == 'CHANGED' and job['state'] in ('SUCCESS', 'FAILED', 'ABORTED'):
-                        # If an Event already exist we just set it to mark it finished.
-                        # Otherwise we create a new Event.
-                        # This is to prevent a race-condition of job finishing before
-                        # the client can create the Event.
-                        event = job.get('__ready')
-                        if event is None:
-                            event = job['__ready'] = Event()
-                        event.set()
-
-    def _jobs_subscribe(self):
-        """
-        Subscribe to job updates, calling `_jobs_callback` on every new event.
-        """
-        self._jobs_watching = True
-        self.subscribe('core.get_jobs', self._jobs_callback)
+        c = Call(method, params)
+        self._calls[c.id] = c
+        try:
+            await self._send({
+                'msg': 'method',
+                'method': c.method,
+                'id': c.id,
+                'params': c.params,
+            })
+            try:
+                await asyncio.wait_for(c.returned, timeout or None)
+            except asyncio.TimeoutError:
+                raise CallTimeout('Call timeout')
+        finally:
+            self._calls.pop(c.id, None)
 
-    def call(self, method, *params, **kwargs):
-        timeout = kwargs.pop('timeout', CALL_TIMEOUT)
-        job = kwargs.pop('job', False)
+        c.raise_error()
 
-        # We need to make sure we are subscribed to receive job updates
-        if job and not self._jobs_watching:
-            self._jobs_subscribe()
+        if method in LOGIN_METHODS and c.result:
+            self._login = (method, params)
+        elif method == 'auth.logout':
+            self._login = None
 
-        c = Call(method, params)
-        self._register_call(c)
-        self._send({
-            'msg': 'method',
-            'method': c.method,
-            'id': c.id,
-            'params': c.params,
-        })
+        return c.result
 
-        if not c.returned.wait(timeout):
-            self._unregister_call(c)
-            raise CallTimeout("Call timeout")
+    async def _wait_job(self, job_id, timeout, callback):
+        # Only events of this job are sent to us
+        async with await self.subscribe(f'core.get_jobs:{job_id}') as subscription:
+            job = None
+            while True:
+                if job is None:
+                    # Job might have changed before we subscribed or while we were reconnecting
+                    jobs = await self._call('core.get_jobs', [[['id', '=', job_id]]], timeout)
+                    if not jobs:
+                        raise ClientException(f'Job {job_id} does not exist')
+                    job = jobs[0]
+                else:
+                    try:
+                        message = await asyncio.wait_for(subscription._next(), JOB_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        job = None
+                        continue
+                    if message is RESUBSCRIBED:
+                        job = None
+                        continue
+                    if message is UNSUBSCRIBED:
+                        raise ClientException('Connection closed', errno.ECONNRESET)
+                    job.update(message.get('fields') or {})
+
+                if callback is not None:
+                    callback(job)
+                if job['state'] in JOB_FINISHED:
+                    break
+
+        if job['state'] != 'SUCCESS':
+            if job['exc_info'] and job['exc_info']['type'] == 'VALIDATION':
+                raise ValidationErrors(job['exc_info']['extra'])
+            raise ClientException(job['error'], trace=job['exception'])
+        return job['result']
+
+    async def subscribe(self, name, callback=None):
+        """
+        Subscribes to events of `name` (or `name:id` for events of a single object, e.g. `core.get_jobs:1`).
 
-        if c.errno:
-            if c.py_exception:
-                raise c.py_exception
-            if c.trace and c.type == 'VALIDATION':
-                raise ValidationErrors(c.extra)
-            raise ClientException(c.error, c.errno, c.trace, c.extra)
+        Returns `Subscription` that can be iterated over unless a `callback` is given.
+        """
+        await self._wait_ready(None)
 
-        if job:
-            job_id = c.result
-            # If a job event has been received already then we must set an Event
-            # to wait for this job to finish.
-            # Otherwise we create a new stub for the job with the Event for when
-            # the job event arrives to use existing event.
-            with self._jobs_lock:
-                job = self._jobs.get(job_id)
-                event = None
-                if job:
-                    event = job.get('__ready')
-                if event is None:
-                    event = job['__ready'] = Event()
-                job['__callback'] = kwargs.pop('callback', None)
-
-            # Wait indefinitely for the job event with state SUCCESS/FAILED/ABORTED
-            event.wait()
-            job = self._jobs.pop(job_id, None)
-            if job is None:
-                raise ClientException('No job event was received.')
-            if job['state'] != 'SUCCESS':
-                if job['exc_info'] and job['exc_info']['type'] == 'VALIDATION':
-                    raise ValidationErrors(job['exc_info']['extra'])
-                raise ClientException(job['error'], trace=job['exception'])
-            return job['result']
+        subscription = Subscription(self, name, callback)
+        self._subscriptions[subscription.id] = subscription
+        self._subscribed[name].add(subscription)
+        try:
+            await self._subscribe(subscription)
+        except BaseException:
+            self._forget(subscription)
+            raise
 
-        return c.result
+        return subscription
 
-    def subscribe(self, name, callback):
-        ready = Event()
-        _id = str(uuid.uuid4())
-        self._event_callbacks[name] = {
-            'id': _id,
-            'callback': callback,
-            'ready': ready,
-        }
-        self._send({
+    async def _subscribe(self, subscription):
+        subscription.ready = asyncio.get_event_loop().create_future()
+        await self._send({
             'msg': 'sub',
-            'id': _id,
-            'name': name,
+            'id': subscription.id,
+            'name': subscription.name,
         })
-        ready.wait()
+        await subscription.ready
 
-    def ping(self, timeout=10):
-        _id = str(uuid.uuid4())
-        event = self._pings[_id] = Event()
-        self._send({
-            'msg': 'ping',
-            'id': _id,
-        })
+    def _forget(self, subscription):
+        if self._subscriptions.pop(subscription.id, None) is None:
+            return False
 
-        if not event.wait(timeout):
+        subscribed = self._subscribed[subscription.name]
+        subscribed.discard(subscription)
+        if not subscribed:
+            del self._subscribed[subscription.name]
+        return True
+
+    async def unsubscribe(self, subscription):
+        if not self._forget(subscription):
+            return
+
+        subscription._put(UNSUBSCRIBED)
+        if not self.closed and self._ready.is_set():
+            with contextlib.suppress(ClientException):
+                await self._send({
+                    'msg': 'unsub',
+                    'id': subscription.id,
+                })
+
+    async def ping(self, timeout=10):
+        _id = str(uuid.uuid4())
+        ping = self._pings[_id] = asyncio.get_event_loop().create_future()
+        try:
+            await self._send({
+                'msg': 'ping',
+                'id': _id,
+            })
+            await asyncio.wait_for(ping, timeout)
+        except (asyncio.TimeoutError, ClientException):
             return False
+        finally:
+            self._pings.pop(_id, None)
         return True
 
+    async def close(self):
+        self._closing = True
+        if self._ws is not None:
+            await self._ws.close()
+        if self._receiver is not None:
+            self._receiver.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._receiver
+        if self._session is not None:
+            await self._session.close()
+
+
+class Client(object):
+    """
+    Synchronous client running `AsyncClient` in an event loop of its own thread.
+    """
+
+    def __init__(
+        self, uri=None, reserved_ports=False, reserved_ports_blacklist=None,
+        py_exceptions=False, reconnect=False,
+    ):
+        """
+        Arguments:
+           :reserved_ports(bool): whether the connection should origin using a reserved port (<= 1024)
+           :reserved_ports_blacklist(list): list of ports that should not be used as origin
+           :reconnect(bool): whether a lost connection should be reestablished
+        """
+        self._client = AsyncClient(
+            uri,
+            reserved_ports=reserved_ports,
+            reserved_ports_blacklist=reserved_ports_blacklist,
+            py_exceptions=py_exceptions,
+            reconnect=reconnect,
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, name='middlewared_client', daemon=True)
+        self._thread.start()
+        try:
+            self._run(self._client.connect())
+        except Exception:
+            self._stop()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+        if typ is not None:
+            raise
+
+    def _run(self, coro):
+        # Callbacks run in the client thread, waiting there for a result would never finish
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError('Client can not be called from its own callbacks')
+
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def call(self, method, *params, **kwargs):
+        return self._run(self._client.call(method, *params, **kwargs))
+
+    def subscribe(self, name, callback):
+        self._run(self._client.subscribe(name, callback))
+
+    def ping(self, timeout=10):
+        return self._run(self._client.ping(timeout))
+
     def close(self):
-        self._ws.close()
-        # Wait for websocketclient thread to close
-        self._closed.wait(1)
+        if self._loop.is_closed():
+            return
+
+        self._run(self._client.close())
+        self._stop()
 
 
 def main():
@@ -325,13 +325,14 @@ async def is_disallowed_group(middleware, conf, groupmap, group):
 async def get_groups(middleware):
     _groups = {}
     groups = await middleware.call('group.query', [('builtin', '=', False)])
+    usernames = {u['id']: u['username'] for u in await middleware.call('user.query', [], {'select': ['id', 'username']})}
     for g in groups:
         key = str(g['group'])
         _groups[key] = []
-        members = await middleware.call('user.query', [["id", "in", g["users"]]])
 
-        for m in members:
-            _groups[key].append(str(m['username']))
+        for user_id in sorted(set(g['users'])):
+            if user_id in usernames:
+                _groups[key].append(str(usernames[user_id]))
 
     return _groups
 
@@ -1,17 +1,20 @@
 import asyncio
+import codecs
 from collections import OrderedDict
 import copy
 from datetime import datetime
 import enum
 import logging
-import os
 import sys
 import time
 import traceback
 import threading
 
+from middlewared.event import EventSource
 from middlewared.service_exception import CallError, ValidationError, ValidationErrors
 from middlewared.pipe import Pipes
+from middlewared.utils.call_stats import CallTiming, current_call, timed
+from middlewared.utils.job_logs import JobLogStore
 
 logger = logging.getLogger(__name__)
 
@@ -71,6 +74,8 @@ class JobsQueue(object):
         # Shared lock (JobSharedLock) dict
         self.job_locks = {}
 
+        self.logs = JobLogStore()
+
     def __getitem__(self, item):
         return self.deque[item]
 
@@ -237,6 +242,8 @@ class Job(object):
         self.time_finished = None
         self.loop = asyncio.get_event_loop()
         self.future = None
+        # Validation time of the job method, time spent waiting in the queue is accounted as queue wait
+        self.timing = CallTiming()
 
         self.logs_path = None
         self.logs_fd = None
@@ -326,12 +333,11 @@ class Job(object):
         """
 
         if self.options["logs"]:
-            logs_dir = os.path.join("/tmp/middlewared/jobs")
-            os.makedirs(logs_dir, exist_ok=True)
-            self.logs_path = os.path.join(logs_dir, f"{self.id}.log")
-            self.logs_fd = open(self.logs_path, "wb")
+            self.logs_fd = queue.logs.open(self.id)
+            self.logs_path = self.logs_fd.path
 
         self.set_state('RUNNING')
+        started = time.monotonic()
         try:
             self.future = asyncio.ensure_future(self.__run_body())
             await self.future
@@ -341,6 +347,12 @@ class Job(object):
             self.set_state('FAILED')
             self.set_exception(sys.exc_info())
         finally:
+            self.middleware.call_stats.record(
+                self.method_name, 'job', time.monotonic() - started, started - self.timing.submitted,
+                self.timing.validation, self.state != State.SUCCESS,
+                lambda: self.middleware.redact_args(self.args, self.method),
+            )
+
             await self.__close_logs()
             await self.__close_pipes()
 
@@ -358,43 +370,24 @@ class Job(object):
         and return the result as a json
         """
         if self.options.get('process'):
-            rv = await self.middleware._call_worker(self.serviceobj, self.method_name, *self.args, job={'id': self.id})
+            rv = await self.middleware._call_worker(self.serviceobj, self.method_name, *self.args, job={'id': self.id},
+                                                    timing=self.timing)
         else:
             # Make sure args are not altered during job run
             args = copy.deepcopy(self.args)
             if asyncio.iscoroutinefunction(self.method):
+                # This is a task of its own so context variable does not need to be reset
+                current_call.set(self.timing)
                 rv = await self.method(*([self] + args))
             else:
-                rv = await self.middleware.run_in_thread(self.method, *([self] + args))
+                rv = await self.middleware.run_in_thread(timed, self.timing, self.method, *([self] + args))
         self.set_result(rv)
         self.set_state('SUCCESS')
 
     async def __close_logs(self):
         if self.logs_fd:
-            self.logs_fd.close()
-
-            def get_logs_excerpt():
-                head = []
-                tail = []
-                lines = 0
-                with open(self.logs_path, "r", encoding="utf-8", errors="ignore") as f:
-                    for line in f:
-                        if len(head) < 5:
-                            head.append(line)
-
-                        tail.append(line)
-                        tail = tail[-5:]
-
-                        lines += 1
-
-                if lines > 10:
-                    excerpt = "%s[%d more lines]\n%s" % ("".join(head), lines - 10, "".join(tail))
-                else:
-                    excerpt = "".join(head + tail)
-
-                return excerpt
-
-            self.logs_excerpt = await self.middleware.run_in_thread(get_logs_excerpt)
+            await self.middleware.run_in_thread(self.logs_fd.close)
+            self.logs_excerpt = self.logs_fd.excerpt
 
     async def __close_pipes(self):
         def close_pipes():
@@ -427,7 +420,8 @@ class Job(object):
             'id': self.id,
             'method': self.method_name,
             'arguments': self.middleware.dump_args(self.args, method=self.method),
-            'logs_path': self.logs_path,
+            # Log of a finished job might have been removed to stay within the job logs disk budget
+            'logs_path': self.logs_path if self.logs_fd is None or not self.logs_fd.removed else None,
             'logs_excerpt': self.logs_excerpt,
             'progress': self.progress,
             'result': self.result,
@@ -455,11 +449,44 @@ class Job(object):
         return subjob.result
 
     def cleanup(self):
-        if self.logs_path:
-            try:
-                os.unlink(self.logs_path)
-            except Exception:
-                pass
+        if self.logs_fd:
+            self.logs_fd.store.remove(self.id)
+
+
+class JobLogFollowEventSource(EventSource):
+    """
+    Streams log of job `id` (subscribe to `core.job_log_follow:id` or `core.job_log_follow:id:offset`) starting at
+    byte `offset` (0 by default) until the job finishes.
+
+    Every event carries `data` and `offset` to resume from. Multibyte characters split between reads are decoded
+    as a whole, `offset` never points inside one.
+    """
+
+    def run(self):
+        job_id, offset = ((self.arg or '').split(':', 1) + ['0'])[:2]
+        if not job_id.isdigit() or not offset.isdigit():
+            return
+
+        log = self.middleware.jobs.logs.get(int(job_id))
+        if log is None:
+            return
+
+        offset = int(offset)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while not self._cancel.is_set():
+            data, offset = log.read(offset)
+            if data:
+                data = decoder.decode(data)
+                if data:
+                    # Bytes of an incomplete character are sent with the next event
+                    self.send_event('ADDED', fields={'data': data, 'offset': offset - len(decoder.getstate()[0])})
+            elif log.closed:
+                data = decoder.decode(b'', final=True)
+                if data:
+                    self.send_event('ADDED', fields={'data': data, 'offset': offset})
+                break
+            else:
+                log.wait(offset, 1)
 
 
 class JobProgressBuffer:
@@ -1,7 +1,12 @@
+import atexit
+import copy
 import logging
 import logging.handlers
 import os
+import queue
 import sys
+import threading
+import time
 
 from logging.config import dictConfig
 from .utils import sw_version, sw_version_is_stable
@@ -16,8 +21,6 @@ logging.getLogger('MARKDOWN').setLevel(logging.INFO)
 logging.getLogger('asyncio').setLevel(logging.WARN)
 # We dont need internal aiohttp debug logging
 logging.getLogger('aiohttp.internal').setLevel(logging.WARN)
-# we dont need ws4py close debug messages
-logging.getLogger('ws4py').setLevel(logging.WARN)
 
 LOGFILE = '/var/log/middlewared.log'
 logging.TRACE = 6
@@ -177,6 +180,113 @@ class ErrorProneRotatingFileHandler(logging.handlers.RotatingFileHandler):
             pass
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket rate limit applied to every logger separately.
+
+    Each logger may emit `burst` records at once and `rate` records per second
+    after that. Records at `exempt_level` or above are never limited.
+    """
+
+    def __init__(self, rate=200, burst=1000, exempt_level=logging.ERROR):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.exempt_level = exempt_level
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.exempt_level:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(record.name, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[record.name] = (tokens, now)
+                self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+                return False
+            self.buckets[record.name] = (tokens - 1, now)
+            return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks the caller.
+
+    Records are dropped (and counted) when the queue is full.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format message (and traceback) now, in the caller thread, as arguments
+        # may be mutated or not be picklable by the time the listener handles them.
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueLogging(object):
+    """
+    Moves log handlers off the calling thread.
+
+    Root logger handlers are replaced by a `BoundedQueueHandler` and run by a
+    `QueueListener` thread, so writing and rotating log files never happens
+    in the event loop thread.
+    """
+
+    def __init__(self, maxsize=10000, rate=200, burst=1000):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.handler = BoundedQueueHandler(self.queue)
+        self.rate_limit = RateLimitFilter(rate=rate, burst=burst)
+        self.handler.addFilter(self.rate_limit)
+        self.handlers = []
+        self.listener = None
+
+    def start(self, logger=None):
+        logger = logger or logging.root
+        self.handlers = list(logger.handlers)
+        for handler in self.handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(self.handler)
+        self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self):
+        return {
+            'queue_size': self.queue.qsize(),
+            'queue_maxsize': self.queue.maxsize,
+            'dropped': self.handler.dropped,
+            'rate_limited': dict(self.rate_limit.suppressed),
+        }
+
+
+QUEUE_LOGGING = None
+
+
 class Logger(object):
     """Pseudo-Class for Logger - Wrapper for logging module"""
     DEFAULT_LOGGING = {
@@ -214,7 +324,10 @@ class Logger(object):
         return logging.getLogger(self.application_name)
 
     def stream(self):
-        for handler in logging.root.handlers:
+        handlers = logging.root.handlers
+        if QUEUE_LOGGING is not None:
+            handlers = handlers + QUEUE_LOGGING.handlers
+        for handler in handlers:
             if isinstance(handler, ErrorProneRotatingFileHandler):
                 return handler.stream
 
@@ -264,6 +377,8 @@ class Logger(object):
 
 
 def setup_logging(name, debug_level, log_handler):
+    global QUEUE_LOGGING
+
     _logger = Logger(name, debug_level)
     _logger.getLogger()
 
@@ -276,3 +391,12 @@ def setup_logging(name, debug_level, log_handler):
         _logger.configure_logging('console')
     else:
         _logger.configure_logging('file')
+
+    QUEUE_LOGGING = QueueLogging()
+    QUEUE_LOGGING.start()
+
+
+def logging_stats():
+    if QUEUE_LOGGING is None:
+        return None
+    return QUEUE_LOGGING.stats()
@@ -1,12 +1,18 @@
 from .apidocs import app as apidocs_app
 from .client import ejson as json
 from .event import EventSource
-from .job import Job, JobsQueue
+from .job import Job, JobLogFollowEventSource, JobsQueue
 from .pipe import Pipes, Pipe
 from .restful import RESTfulAPI
 from .schema import Error as SchemaError, Schemas
 from .service import CallError, CallException, ValidationError, ValidationErrors
+from .shell import ShellWorker
 from .utils import start_daemon_thread, load_modules, load_classes
+from .utils.call_stats import CallStats, CallTiming, current_call, timed, timed_in_process
+from .utils.periodic import PeriodicScheduler
+from .utils.process_pool import ProcessPool
+from .utils.plugins import run_setups
+from .utils.transfer import AdaptiveChunkSize, DownloadSpool, UploadSession, open_pipe_writer
 from .webui_auth import WebUIAuth
 from .worker import main_worker, worker_init
 from aiohttp import web
@@ -27,7 +33,6 @@ import linecache
 import multiprocessing
 import os
 import pickle
-import queue
 import select
 import setproctitle
 import signal
@@ -250,7 +255,9 @@ class Application(object):
     def send_event(self, name, event_type, **kwargs):
         if (
             not any(i == name or i == '*' for i in self.__subscribed.values()) and
-            not any(i['name'] == name for i in self.__event_sources.values())
+            not any(i['name'] == name for i in self.__event_sources.values()) and
+            # `name:id` subscriptions only receive events of a single object (e.g. `core.get_jobs:1`)
+            not ('id' in kwargs and f'{name}:{kwargs["id"]}' in self.__subscribed.values())
         ):
             return
         event = {
@@ -344,23 +351,75 @@ class Application(object):
 
 
 class FileApplication(object):
+    """
+    Downloads are served from a spool of job output which is kept for `DOWNLOAD_RETENTION` seconds after the last
+    request so they can be resumed. Resumable uploads are aborted after `UPLOAD_TIMEOUT` seconds of inactivity.
+    """
+
+    DOWNLOAD_RETENTION = 600
+    UPLOAD_TIMEOUT = 3600
 
     def __init__(self, middleware, loop):
         self.middleware = middleware
         self.loop = loop
         self.jobs = {}
+        self.downloads = {}
+        self.uploads = {}
+        self.upload_timeouts = {}
 
     def register_job(self, job_id):
         self.jobs[job_id] = self.middleware.loop.call_later(
             60, lambda: asyncio.ensure_future(self._cleanup_job(job_id)))
 
+    def _reschedule_cleanup(self, job_id, timeout):
+        self.jobs[job_id].cancel()
+        self.jobs[job_id] = self.middleware.loop.call_later(
+            timeout, lambda: asyncio.ensure_future(self._cleanup_job(job_id)))
+
     async def _cleanup_job(self, job_id):
+        spool = self.downloads.get(job_id)
+        if spool is not None and spool.readers:
+            self._reschedule_cleanup(job_id, self.DOWNLOAD_RETENTION)
+            return
+
         self.jobs[job_id].cancel()
         del self.jobs[job_id]
 
+        if spool is not None:
+            del self.downloads[job_id]
+            spool.close()
+
         job = self.middleware.jobs[job_id]
         await job.pipes.close()
 
+    async def _authenticate(self, request):
+        auth = request.headers.get('Authorization')
+        if auth:
+            if auth.startswith('Basic '):
+                try:
+                    auth = binascii.a2b_base64(auth[6:]).decode()
+                    if ':' in auth:
+                        user, password = auth.split(':', 1)
+                        if await self.middleware.call('auth.check_user', user, password):
+                            return True
+                except binascii.Error:
+                    pass
+            elif auth.startswith('Token '):
+                auth_token = auth.split(" ", 1)[1]
+                token = await self.middleware.call('auth.get_token', auth_token)
+
+                if token:
+                    return True
+        else:
+            qs = urllib.parse.parse_qs(request.query_string)
+            if 'auth_token' in qs:
+                auth_token = qs.get('auth_token')[0]
+                token = await self.middleware.call('auth.get_token', auth_token)
+                if token:
+                    return True
+
+        return False
+
     async def download(self, request):
         path = request.path.split('/')
         if not request.path[-1].isdigit():
@@ -401,56 +460,55 @@ class FileApplication(object):
             resp.set_status(410)
             return resp
 
-        resp = web.StreamResponse(status=200, reason='OK', headers={
-            'Content-Type': 'application/octet-stream',
-            'Content-Disposition': f'attachment; filename="{filename}"',
-            'Transfer-Encoding': 'chunked',
-        })
-        await resp.prepare(request)
-
-        def do_copy():
-            while True:
-                read = job.pipes.output.r.read(1048576)
-                if read == b'':
-                    break
-                asyncio.run_coroutine_threadsafe(resp.write(read), loop=self.loop).result()
+        spool = self.downloads.get(job_id)
+        if spool is None:
+            spool = self.downloads[job_id] = DownloadSpool(self.loop, job.pipes.output.r)
+        self._reschedule_cleanup(job_id, self.DOWNLOAD_RETENTION)
 
         try:
-            await self.middleware.run_in_thread(do_copy)
+            return await spool.respond(request, {
+                'Content-Type': 'application/octet-stream',
+                'Content-Disposition': f'attachment; filename="{filename}"',
+            })
         finally:
-            await self._cleanup_job(job_id)
+            if job_id in self.jobs:
+                self._reschedule_cleanup(job_id, self.DOWNLOAD_RETENTION)
+
+    def _schedule_upload_timeout(self, upload_token):
+        if upload_token in self.upload_timeouts:
+            self.upload_timeouts[upload_token].cancel()
+        self.upload_timeouts[upload_token] = self.loop.call_later(
+            self.UPLOAD_TIMEOUT, self._expire_upload, upload_token)
+
+    def _cleanup_upload(self, upload_token):
+        self.upload_timeouts.pop(upload_token).cancel()
+        return self.uploads.pop(upload_token)
+
+    def _expire_upload(self, upload_token):
+        if self.uploads[upload_token].lock.locked():
+            self._schedule_upload_timeout(upload_token)
+            return
 
-        await resp.drain()
-        return resp
+        self._cleanup_upload(upload_token).abort()
 
-    async def upload(self, request):
-        denied = True
-        auth = request.headers.get('Authorization')
-        if auth:
-            if auth.startswith('Basic '):
-                try:
-                    auth = binascii.a2b_base64(auth[6:]).decode()
-                    if ':' in auth:
-                        user, password = auth.split(':', 1)
-                        if await self.middleware.call('auth.check_user', user, password):
-                            denied = False
-                except binascii.Error:
-                    pass
-            elif auth.startswith('Token '):
-                auth_token = auth.split(" ", 1)[1]
-                token = await self.middleware.call('auth.get_token', auth_token)
+    async def _upload_chunk(self, request, upload_token):
+        session = self.uploads.get(upload_token)
+        if session is None:
+            return web.Response(status=404)
 
-                if token:
-                    denied = False
-        else:
-            qs = urllib.parse.parse_qs(request.query_string)
-            if 'auth_token' in qs:
-                auth_token = qs.get('auth_token')[0]
-                token = await self.middleware.call('auth.get_token', auth_token)
-                if token:
-                    denied = False
+        self._schedule_upload_timeout(upload_token)
+        try:
+            return await session.handle(request)
+        finally:
+            if session.closed and upload_token in self.uploads:
+                self._cleanup_upload(upload_token)
 
-        if denied:
+    async def upload(self, request):
+        upload_token = request.match_info.get('path_info', '').strip('/')
+        if upload_token:
+            return await self._upload_chunk(request, upload_token)
+
+        if not await self._authenticate(request):
             resp = web.Response()
             resp.set_status(401)
             return resp
@@ -476,30 +534,58 @@ class FileApplication(object):
         if 'method' not in data:
             return web.Response(status=422)
 
-        filepart = await reader.next()
+        if 'upload_length' in data:
+            # Resumable upload: file is sent later in chunks to /_upload/<upload_token>
+            try:
+                upload_length = int(data['upload_length'])
+                if upload_length < 0:
+                    raise ValueError('"upload_length" must not be negative')
+            except (TypeError, ValueError) as e:
+                return web.Response(status=400, body=str(e))
 
-        if not filepart or filepart.name != 'file':
-            resp = web.Response(status=405, body='"file" not found as second part on payload')
-            resp.set_status(405)
-            return resp
+            filepart = None
+        else:
+            filepart = await reader.next()
 
-        def copy():
-            while True:
-                read = asyncio.run_coroutine_threadsafe(
-                    filepart.read_chunk(1048576),
-                    loop=self.loop,
-                ).result()
-                if read == b'':
-                    break
-                job.pipes.input.w.write(read)
+            if not filepart or filepart.name != 'file':
+                resp = web.Response(status=405, body='"file" not found as second part on payload')
+                resp.set_status(405)
+                return resp
 
         try:
             job = await self.middleware.call(data['method'], *(data.get('params') or []),
                                              pipes=Pipes(input=self.middleware.pipe()))
+            writer = await open_pipe_writer(self.loop, job.pipes.input.w)
+
+            if filepart is None:
+                session = UploadSession(self.loop, writer, job, upload_length)
+                if upload_length == 0:
+                    session.close()
+                    upload_token = None
+                else:
+                    upload_token = uuid.uuid4().hex
+                    self.uploads[upload_token] = session
+                    self._schedule_upload_timeout(upload_token)
+
+                return web.Response(
+                    status=200,
+                    headers={
+                        'Content-Type': 'application/json',
+                    },
+                    body=json.dumps({'job_id': job.id, 'upload_token': upload_token}).encode(),
+                )
+
             try:
-                await self.middleware.run_in_thread(copy)
+                chunk_size = AdaptiveChunkSize()
+                while True:
+                    read = await filepart.read_chunk(chunk_size.size)
+                    if read == b'':
+                        break
+                    chunk_size.update(len(read))
+                    writer.write(read)
+                    await writer.drain()
             finally:
-                await self.middleware.run_in_thread(job.pipes.input.w.close)
+                writer.close()
         except CallError as e:
             if e.errno == CallError.ENOMETHOD:
                 status_code = 422
@@ -519,110 +605,19 @@ class FileApplication(object):
         return resp
 
 
-class ShellWorkerThread(threading.Thread):
-    """
-    Worker thread responsible for forking and running the shell
-    and spawning the reader and writer threads.
-    """
-
-    def __init__(self, ws, input_queue, loop, jail=None):
-        self.ws = ws
-        self.input_queue = input_queue
-        self.loop = loop
-        self.shell_pid = None
-        self.jail = jail
-        self._die = False
-        super(ShellWorkerThread, self).__init__(daemon=True)
-
-    def run(self):
-
-        self.shell_pid, master_fd = os.forkpty()
-        if self.shell_pid == 0:
-            for i in range(3, 1024):
-                if i == master_fd:
-                    continue
-                try:
-                    os.close(i)
-                except Exception:
-                    pass
-            os.chdir('/root')
-            cmd = [
-                '/usr/local/bin/bash'
-            ]
-
-            if self.jail is not None:
-                cmd = [
-                    '/usr/local/bin/iocage',
-                    'console',
-                    self.jail
-                ]
-            os.execve(cmd[0], cmd, {
-                'TERM': 'xterm',
-                'HOME': '/root',
-                'LANG': 'en_US.UTF-8',
-                'PATH': '/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/sbin:/usr/local/bin:/root/bin',
-            })
-
-        def reader():
-            """
-            Reader thread for reading from pty file descriptor
-            and forwarding it to the websocket.
-            """
-            while True:
-                read = os.read(master_fd, 1024)
-                if read == b'':
-                    break
-                asyncio.run_coroutine_threadsafe(
-                    self.ws.send_str(read.decode('utf8')), loop=self.loop
-                ).result()
-
-        def writer():
-            """
-            Writer thread for reading from input_queue and write to
-            the shell pty file descriptor.
-            """
-            while True:
-                try:
-                    get = self.input_queue.get(timeout=1)
-                    os.write(master_fd, get)
-                except queue.Empty:
-                    # If we timeout waiting in input query lets make sure
-                    # the shell process is still alive
-                    try:
-                        os.kill(self.shell_pid, 0)
-                    except ProcessLookupError:
-                        break
-
-        t_reader = threading.Thread(target=reader, daemon=True)
-        t_reader.start()
-
-        t_writer = threading.Thread(target=writer, daemon=True)
-        t_writer.start()
-
-        # Wait for shell to exit
-        while True:
-            try:
-                pid, rv = os.waitpid(self.shell_pid, os.WNOHANG)
-            except ChildProcessError:
-                break
-            if self._die:
-                return
-            if pid <= 0:
-                time.sleep(1)
-
-        t_reader.join()
-        t_writer.join()
-        asyncio.run_coroutine_threadsafe(self.ws.close(), self.loop)
-
-    def die(self):
-        self._die = True
-
-
 class ShellConnectionData(object):
-    t_worker = None
+    worker = None
 
 
 class ShellApplication(object):
+    """
+    Web shell.
+
+    The first message must be a JSON object with an auth `token` (and optionally
+    the `jail` to attach to). Every following text message is written to the
+    shell as-is, except for JSON objects in the form of
+    `{"msg": "resize", "cols": 80, "rows": 24}` which resize the terminal.
+    """
 
     def __init__(self, middleware):
         self.middleware = middleware
@@ -636,22 +631,22 @@ class ShellApplication(object):
         try:
             await self.run(ws, request, conndata)
         except Exception as e:
-            if conndata.t_worker:
-                await self.worker_kill(conndata.t_worker)
+            if conndata.worker:
+                await self.worker_kill(conndata.worker)
         finally:
             return ws
 
     async def run(self, ws, request, conndata):
 
-        # Each connection will have its own input queue
-        input_queue = queue.Queue()
         authenticated = False
 
         async for msg in ws:
             if authenticated:
-                # Add content of every message received in input queue
+                if self._resize(conndata.worker, msg.data):
+                    continue
+                # Write content of every message received to the shell
                 try:
-                    input_queue.put(msg.data.encode())
+                    conndata.worker.write(msg.data.encode())
                 except UnicodeEncodeError:
                     # Should we handle Encode error?
                     # xterm.js seems to operate with the websocket in text mode,
@@ -682,56 +677,86 @@ class ShellApplication(object):
                     'msg': 'connected',
                 })
 
+                cmd = ['/usr/local/bin/bash']
                 jail = data.get('jail')
-                conndata.t_worker = ShellWorkerThread(ws=ws, input_queue=input_queue, loop=asyncio.get_event_loop(), jail=jail)
-                conndata.t_worker.start()
+                if jail is not None:
+                    cmd = ['/usr/local/bin/iocage', 'console', jail]
+
+                conndata.worker = ShellWorker(asyncio.get_event_loop(), ws.send_str, cmd, env={
+                    'TERM': 'xterm',
+                    'HOME': '/root',
+                    'LANG': 'en_US.UTF-8',
+                    'PATH': '/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/sbin:/usr/local/bin:/root/bin',
+                }, cwd='/root')
+                conndata.worker.start()
+                asyncio.ensure_future(self._close_on_exit(ws, conndata.worker))
 
         # If connection was not authenticated, return earlier
         if not authenticated:
             return ws
 
-        if conndata.t_worker:
-            asyncio.ensure_future(self.worker_kill(conndata.t_worker))
+        if conndata.worker:
+            asyncio.ensure_future(self.worker_kill(conndata.worker))
 
         return ws
 
-    async def worker_kill(self, t_worker):
+    def _resize(self, worker, data):
+        if not (data.startswith('{') and data.endswith('}')):
+            return False
+        try:
+            data = json.loads(data)
+        except json.decoder.JSONDecodeError:
+            return False
+        if not isinstance(data, dict) or data.get('msg') != 'resize':
+            return False
+        try:
+            worker.resize(int(data['cols']), int(data['rows']))
+        except Exception:
+            self.middleware.logger.debug('Failed to resize shell', exc_info=True)
+        return True
+
+    async def _close_on_exit(self, ws, worker):
+        await worker.wait()
+        await ws.close()
+
+    async def worker_kill(self, worker):
         # If connection has been closed lets make sure shell is killed
-        if t_worker.shell_pid:
+        if worker.pid and worker.returncode is None:
 
             try:
                 kqueue = select.kqueue()
-                kevent = select.kevent(t_worker.shell_pid, select.KQ_FILTER_PROC, select.KQ_EV_ADD | select.KQ_EV_ENABLE, select.KQ_NOTE_EXIT)
+                kevent = select.kevent(worker.pid, select.KQ_FILTER_PROC, select.KQ_EV_ADD | select.KQ_EV_ENABLE, select.KQ_NOTE_EXIT)
                 kqueue.control([kevent], 0)
 
-                os.kill(t_worker.shell_pid, signal.SIGTERM)
+                os.kill(worker.pid, signal.SIGTERM)
 
                 # If process has not died in 2 seconds, try the big gun
                 events = await self.middleware.run_in_thread(kqueue.control, None, 1, 2)
                 if not events:
-                    os.kill(t_worker.shell_pid, signal.SIGKILL)
+                    os.kill(worker.pid, signal.SIGKILL)
 
                     # If process has not died even with the big gun
                     # There is nothing else we can do, leave it be and
-                    # release the worker thread
+                    # release the worker
                     events = await self.middleware.run_in_thread(kqueue.control, None, 1, 2)
                     if not events:
-                        t_worker.die()
+                        worker.abandon()
             except ProcessLookupError:
                 pass
 
-        # Wait thread join in yet another thread to avoid event loop blockage
-        # There may be a simpler/better way to do this?
-        await self.middleware.run_in_thread(t_worker.join)
+        await worker.wait()
 
 
 class Middleware(object):
 
     CONSOLE_ONCE_PATH = '/tmp/.middlewared-console-once'
+    # Process pool workers are replaced after running this many tasks or using this much memory
+    WORKER_MAX_TASKS = 1000
+    WORKER_MAX_RSS = 512 * 1024 * 1024
 
     def __init__(
         self, loop_debug=False, loop_monitor=True, overlay_dirs=None, debug_level=None,
-        log_handler=None,
+        log_handler=None, worker_pool_size=2,
     ):
         self.logger = logger.Logger('middlewared', debug_level).getLogger()
         self.crash_reporting = logger.CrashReporting()
@@ -742,19 +767,24 @@ class Middleware(object):
         self.debug_level = debug_level
         self.log_handler = log_handler
         self.app = None
+        self.startup_profile = {}
         self.__loop = None
         self.__thread_id = threading.get_ident()
         # Spawn new processes for ProcessPool instead of forking
         multiprocessing.set_start_method('spawn')
-        self.__procpool = concurrent.futures.ProcessPoolExecutor(
-            max_workers=2,
+        self.__procpool = ProcessPool(
+            worker_pool_size,
             initializer=functools.partial(worker_init, debug_level, log_handler),
+            max_tasks=self.WORKER_MAX_TASKS,
+            max_rss=self.WORKER_MAX_RSS,
         )
         self.__threadpool = concurrent.futures.ThreadPoolExecutor(
             initializer=lambda: set_thread_name('threadpool_ws'),
             max_workers=10,
         )
         self.jobs = JobsQueue(self)
+        self.periodic = PeriodicScheduler()
+        self.call_stats = CallStats()
         self.__schemas = Schemas()
         self.__services = {}
         self.__services_aliases = {}
@@ -769,6 +799,7 @@ class Middleware(object):
     def __init_services(self):
         from middlewared.service import CoreService
         self.add_service(CoreService(self))
+        self.register_event_source('core.job_log_follow', JobLogFollowEventSource)
 
     async def __plugins_load(self):
         from middlewared.service import Service, CRUDService, ConfigService, SystemServiceService
@@ -783,18 +814,22 @@ class Middleware(object):
         self.logger.debug('Loading plugins from {0}'.format(','.join(plugins_dirs)))
         self._console_write(f'loading plugins')
 
+        import_timings = {}
         setup_funcs = []
         for plugins_dir in plugins_dirs:
 
             if not os.path.exists(plugins_dir):
                 raise ValueError(f'plugins dir not found: {plugins_dir}')
 
-            for mod in load_modules(plugins_dir):
+            for mod in load_modules(plugins_dir, import_timings):
                 for cls in load_classes(mod, Service, (ConfigService, CRUDService, SystemServiceService)):
                     self.add_service(cls(self))
 
                 if hasattr(mod, 'setup'):
-                    setup_funcs.append((mod.__name__.rsplit('.', 1)[-1], mod.setup))
+                    name = mod.__name__.rsplit('.', 1)[-1]
+                    if any(name == i[0] for i in setup_funcs):
+                        name = mod.__name__
+                    setup_funcs.append((name, mod.setup))
 
         self._console_write(f'resolving plugins schemas')
         # Now that all plugins have been loaded we can resolve all method params
@@ -809,13 +844,28 @@ class Middleware(object):
         # Only call setup after all schemas have been resolved because
         # they can call methods with schemas defined.
         setup_total = len(setup_funcs)
-        for i, setup_func in enumerate(setup_funcs):
-            name, f = setup_func
-            self._console_write(f'setting up plugins ({name}) [{i + 1}/{setup_total}]')
-            call = f(self)
-            # Allow setup to be a coroutine
-            if asyncio.iscoroutinefunction(f):
-                await call
+        setup_done = []
+
+        def on_setup_done(name):
+            setup_done.append(name)
+            self._console_write(f'setting up plugins ({name}) [{len(setup_done)}/{setup_total}]')
+
+        setup_start = time.monotonic()
+        setup_profile = await run_setups(self, setup_funcs, on_setup_done)
+
+        self.startup_profile = {
+            'import_total': sum(import_timings.values()),
+            'setup_total': time.monotonic() - setup_start,
+            'plugins': {
+                name: {
+                    'import': import_timings.get(name),
+                    'setup': setup_profile.get(name, {}).get('duration'),
+                    'setup_start': setup_profile.get(name, {}).get('start'),
+                    'setup_depends': setup_profile.get(name, {}).get('depends', []),
+                }
+                for name in set(import_timings) | set(setup_profile)
+            },
+        }
 
         self.logger.debug('All plugins loaded')
 
@@ -824,39 +874,32 @@ class Middleware(object):
             for task_name in dir(service_obj):
                 method = getattr(service_obj, task_name)
                 if callable(method) and hasattr(method, "_periodic"):
-                    if method._periodic.run_on_start:
-                        delay = 0
-                    else:
-                        delay = method._periodic.interval
-
                     method_name = f'{service_name}.{task_name}'
                     self.logger.debug(f"Setting up periodic task {method_name} to run every {method._periodic.interval} seconds")
 
-                    self.__loop.call_later(
-                        delay,
-                        functools.partial(
-                            self.__call_periodic_task,
-                            method, service_name, service_obj, method_name, method._periodic.interval
-                        )
+                    self.periodic.add(
+                        method_name,
+                        functools.partial(self.__call_periodic_task, method, service_obj, method_name),
+                        method._periodic.interval,
+                        run_on_start=method._periodic.run_on_start,
+                        jitter=method._periodic.jitter,
+                        timeout=method._periodic.timeout,
                     )
 
-    def __call_periodic_task(self, method, service_name, service_obj, method_name, interval):
-        self.__loop.create_task(self.__periodic_task_wrapper(method, service_name, service_obj, method_name, interval))
+        self.periodic.start()
 
-    async def __periodic_task_wrapper(self, method, service_name, service_obj, method_name, interval):
-        self.logger.trace("Calling periodic task %s", method_name)
-        try:
-            await self._call(method_name, service_obj, method)
-        except Exception:
-            self.logger.warning("Exception while calling periodic task", exc_info=True)
+    async def __call_periodic_task(self, method, service_obj, method_name):
+        result = await self._call(method_name, service_obj, method)
+        if isinstance(result, Job):
+            # Run is not finished until its job is
+            try:
+                await result.wait()
+            except asyncio.CancelledError:
+                result.abort()
+                raise
 
-        self.__loop.call_later(
-            interval,
-            functools.partial(
-                self.__call_periodic_task,
-                method, service_name, service_obj, method_name, interval
-            )
-        )
+            if result.error:
+                raise CallError(result.error)
 
     def _console_write(self, text, fill_blank=True, append=False):
         """
@@ -997,7 +1040,11 @@ class Middleware(object):
         return await self.run_in_executor(self.__threadpool, method, *args, **kwargs)
 
     async def run_in_proc(self, method, *args, **kwargs):
-        return await self.run_in_executor(self.__procpool, method, *args, **kwargs)
+        name = getattr(method, '__qualname__', None) or repr(method)
+        return await self.__procpool.run(name, functools.partial(method, *args, **kwargs))
+
+    def process_pool_stats(self):
+        return self.__procpool.stats()
 
     async def run_in_thread(self, method, *args, **kwargs):
         executor = concurrent.futures.ThreadPoolExecutor(
@@ -1038,31 +1085,47 @@ class Middleware(object):
 
         if job:
             return job
-        else:
 
+        timing = CallTiming()
+        error = True
+        token = current_call.set(timing)
+        try:
             # Currently its only a boolean
             if serviceobj._config.process_pool is True:
-                return await self._call_worker(serviceobj, name, *args)
-
-            if asyncio.iscoroutinefunction(methodobj):
-                return await methodobj(*args)
-
-            tpool = None
-            if serviceobj._config.thread_pool:
-                tpool = serviceobj._config.thread_pool
-            if hasattr(methodobj, '_thread_pool'):
-                tpool = methodobj._thread_pool
-            if tpool:
-                return await self.run_in_executor(tpool, methodobj, *args)
-
-            if io_thread:
-                run_method = self.run_in_thread
+                path = 'process'
+                result = await self._call_worker(serviceobj, name, *args, timing=timing)
+            elif asyncio.iscoroutinefunction(methodobj):
+                path = 'coroutine'
+                result = await methodobj(*args)
             else:
-                run_method = self._run_in_conn_threadpool
-            return await run_method(methodobj, *args)
+                tpool = None
+                if serviceobj._config.thread_pool:
+                    tpool = serviceobj._config.thread_pool
+                if hasattr(methodobj, '_thread_pool'):
+                    tpool = methodobj._thread_pool
+
+                if tpool:
+                    path = 'thread_pool'
+                    result = await self.run_in_executor(tpool, timed, timing, methodobj, *args)
+                elif io_thread:
+                    path = 'io_thread'
+                    result = await self.run_in_thread(timed, timing, methodobj, *args)
+                else:
+                    path = 'conn_thread_pool'
+                    result = await self._run_in_conn_threadpool(timed, timing, methodobj, *args)
+
+            error = False
+            return result
+        finally:
+            current_call.reset(token)
+            self.call_stats.record(
+                name, path, time.monotonic() - timing.submitted,
+                None if path == 'coroutine' else timing.started - timing.submitted, timing.validation, error,
+                lambda: self.redact_args(params or [], methodobj),
+            )
 
-    async def _call_worker(self, serviceobj, name, *args, job=None):
-        return await self.run_in_proc(
+    async def _call_worker(self, serviceobj, name, *args, job=None, timing=None):
+        worker_args = (
             main_worker,
             serviceobj.__class__.__module__,
             serviceobj.__class__.__name__,
@@ -1070,6 +1133,11 @@ class Middleware(object):
             args,
             job,
         )
+        if timing is None:
+            return await self.__procpool.run(name, *worker_args)
+
+        timing.started, timing.validation, result = await self.__procpool.run(name, timed_in_process, *worker_args)
+        return result
 
     def _method_lookup(self, name):
         if '.' not in name:
@@ -1095,6 +1163,15 @@ class Middleware(object):
 
         return [method.accepts[i].dump(arg) for i, arg in enumerate(args) if i < len(method.accepts)]
 
+    def redact_args(self, args, method):
+        """
+        Arguments dumped for logging; private ones and those of methods without schema are redacted.
+        """
+        if not hasattr(method, 'accepts'):
+            return ['********'] * len(args)
+
+        return self.dump_args(args, method=method)
+
     async def call_method(self, app, message):
         """Call method from websocket"""
         params = message.get('params') or []
@@ -1259,7 +1336,7 @@ class Middleware(object):
         self.__setup_periodic_tasks()
 
         # Start up middleware worker process pool
-        self.__procpool._start_queue_management_thread()
+        self.__procpool.start()
 
         runner = web.AppRunner(app, handle_signals=False, access_log=None)
         self.__loop.run_until_complete(runner.setup())
@@ -1323,6 +1400,7 @@ def main():
         'console',
         'file',
     ], default='console')
+    parser.add_argument('--worker-pool-size', type=int, default=2)
     args = parser.parse_args()
 
     pidpath = '/var/run/middlewared.pid'
@@ -1353,6 +1431,7 @@ def main():
         overlay_dirs=args.overlay_dirs,
         debug_level=args.debug_level,
         log_handler=args.log_handler,
+        worker_pool_size=args.worker_pool_size,
     ).run()
 
 
@@ -1,8 +1,8 @@
 from middlewared.schema import accepts, Any, Bool, Dict, Int, List, Patch, Str
 from middlewared.service import (
-    CallError, CRUDService, ValidationErrors, item_method, no_auth_required, pass_app, private
+    CallError, CRUDService, ValidationErrors, filterable, item_method, no_auth_required, pass_app, private
 )
-from middlewared.utils import run, Popen
+from middlewared.utils import filter_list, run, Popen
 
 import asyncio
 import binascii
@@ -17,6 +17,12 @@ import subprocess
 import time
 
 SKEL_PATH = '/usr/share/skel/'
+# Attributes of queried users that are not `account.bsdusers` columns (or are serialized differently)
+USER_EXTENDED_ATTRIBUTES = {'attributes', 'group', 'groups', 'sshpubkey'}
+# More user ids than that are not worth a `WHERE ... IN` (and SQLite limits the number of parameters)
+USER_EXTEND_CONTEXT_MAX_IDS = 500
+# `datastore.query` filter operators that match exactly like `filter_list` (e.g. `^` is case insensitive in SQLite)
+USER_DATASTORE_FILTER_OPS = ('=', '!=', '>', '>=', '<', '<=', 'in', 'nin')
 
 
 def pw_checkname(verrors, attribute, name):
@@ -63,28 +69,112 @@ def nt_password(cleartext):
     return binascii.hexlify(nthash).decode().upper()
 
 
+def group_memberships(rows, key, value):
+    """
+    Groups `account_bsdgroupmembership` (or `account_bsdusers`) rows by `key` column.
+    """
+    result = {}
+    for row in rows:
+        result.setdefault(row[key], []).append(row[value])
+    return result
+
+
+def is_datastore_attribute(name):
+    return name not in USER_EXTENDED_ATTRIBUTES and '.' not in name
+
+
+def is_datastore_filter(f):
+    """
+    Whether `user.query` filter `f` gives the same result when done by `datastore.query`.
+    """
+    if len(f) == 2:
+        return f[0] == 'OR' and all(map(is_datastore_filter, f[1]))
+    return len(f) == 3 and is_datastore_attribute(f[0]) and f[1] in USER_DATASTORE_FILTER_OPS
+
+
+def read_sshpubkey(home):
+    try:
+        with open(f'{home}/.ssh/authorized_keys', 'r') as f:
+            return f.read()
+    except Exception:
+        return None
+
+
 class UserService(CRUDService):
 
     class Config:
         datastore = 'account.bsdusers'
         datastore_extend = 'user.user_extend'
+        datastore_extend_context = 'user.user_extend_context'
         datastore_prefix = 'bsdusr_'
 
+    @filterable
+    async def query(self, filters=None, options=None):
+        """
+        Query users.
+
+        `sshpubkey` (contents of `~/.ssh/authorized_keys`) is only read when it is in `select` or
+        `extra.sshpubkey` is true.
+        """
+        filters = filters or []
+        options = dict(options or {})
+        extra = options.pop('extra', None) or {}
+
+        # Only filters and ordering on `account.bsdusers` columns are done by the datastore, the rest is applied to
+        # extended users
+        datastore_filters = [f for f in filters if is_datastore_filter(f)]
+        filters = [f for f in filters if not is_datastore_filter(f)]
+        datastore_options = {'prefix': self._config.datastore_prefix}
+        order_by = options.get('order_by') or []
+        if order_by and all(is_datastore_attribute(o[1:] if o.startswith('-') else o) for o in order_by):
+            datastore_options['order_by'] = order_by
+            options.pop('order_by', None)
+        if not filters and options.get('count'):
+            datastore_options['count'] = True
+
+        users = await self.middleware.call(
+            'datastore.query', self._config.datastore, datastore_filters, datastore_options,
+        )
+        if datastore_options.get('count'):
+            return users
+
+        if users:
+            # Memberships are only loaded for the users that were found
+            context = await self.user_extend_context([user['id'] for user in users] if datastore_filters else None)
+            for user in users:
+                await self.user_extend(user, context)
+
+        if extra.get('sshpubkey') or 'sshpubkey' in (options.get('select') or []):
+            def read_sshpubkeys():
+                for user in users:
+                    user['sshpubkey'] = read_sshpubkey(user['home'])
+
+            await self.middleware.run_in_thread(read_sshpubkeys)
+
+        return await self.middleware.run_in_thread(filter_list, users, filters, options)
+
     @private
-    async def user_extend(self, user):
+    async def user_extend_context(self, ids=None):
+        # Memberships of all users (or of users `ids`) are loaded with a single query instead of one query per user
+        query = 'SELECT bsdgrpmember_user_id, bsdgrpmember_group_id FROM account_bsdgroupmembership'
+        params = None
+        if ids is not None and len(ids) <= USER_EXTEND_CONTEXT_MAX_IDS:
+            query += f' WHERE bsdgrpmember_user_id IN ({", ".join(["%s"] * len(ids))})'
+            params = ids
+        return {
+            'groups': group_memberships(
+                await self.middleware.call('datastore.sql', f'{query} ORDER BY id', params),
+                'bsdgrpmember_user_id', 'bsdgrpmember_group_id',
+            ),
+        }
 
-        # Get group membership
-        user['groups'] = [gm['group']['id'] for gm in await self.middleware.call('datastore.query', 'account.bsdgroupmembership', [('user', '=', user['id'])], {'prefix': 'bsdgrpmember_'})]
+    @private
+    async def user_extend(self, user, context=None):
+        if context is None:
+            context = await self.user_extend_context()
 
-        # Get authorized keys
-        keysfile = f'{user["home"]}/.ssh/authorized_keys'
-        user['sshpubkey'] = None
-        if os.path.exists(keysfile):
-            try:
-                with open(keysfile, 'r') as f:
-                    user['sshpubkey'] = f.read()
-            except Exception:
-                pass
+        # Get group membership
+        user['groups'] = context['groups'].get(user['id'], [])
         return user
 
     @accepts(Dict(
@@ -592,12 +682,34 @@ class GroupService(CRUDService):
         datastore = 'account.bsdgroups'
         datastore_prefix = 'bsdgrp_'
         datastore_extend = 'group.group_extend'
+        datastore_extend_context = 'group.group_extend_context'
 
     @private
-    async def group_extend(self, group):
+    async def group_extend_context(self):
+        # Members of all groups are loaded with two queries instead of two queries per group
+        return {
+            'members': group_memberships(
+                await self.middleware.call(
+                    'datastore.sql',
+                    'SELECT bsdgrpmember_group_id, bsdgrpmember_user_id FROM account_bsdgroupmembership ORDER BY id',
+                ),
+                'bsdgrpmember_group_id', 'bsdgrpmember_user_id',
+            ),
+            'primary_members': group_memberships(
+                await self.middleware.call(
+                    'datastore.sql', 'SELECT id, bsdusr_group_id FROM account_bsdusers ORDER BY id',
+                ),
+                'bsdusr_group_id', 'id',
+            ),
+        }
+
+    @private
+    async def group_extend(self, group, context=None):
+        if context is None:
+            context = await self.group_extend_context()
+
         # Get group membership
-        group['users'] = [gm['user']['id'] for gm in await self.middleware.call('datastore.query', 'account.bsdgroupmembership', [('group', '=', group['id'])], {'prefix': 'bsdgrpmember_'})]
-        group['users'] += [gmu['id'] for gmu in await self.middleware.call('datastore.query', 'account.bsdusers', [('bsdusr_group_id', '=', group['id'])])]
+        group['users'] = context['members'].get(group['id'], []) + context['primary_members'].get(group['id'], [])
         return group
 
     @accepts(Dict(
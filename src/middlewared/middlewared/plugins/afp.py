@@ -242,3 +242,7 @@ class SharingAFPService(CRUDService):
         data['hostsdeny'] = ' '.join(data['hostsdeny'])
 
         return data
+
+
+async def setup(middleware):
+    await middleware.call('attachment.register_source', 'afp', 'sharing.afp', lambda share: [share['path']])
@@ -1,3 +1,4 @@
+import asyncio
 from collections import defaultdict
 import copy
 from datetime import datetime
@@ -19,6 +20,7 @@ from middlewared.alert.base import (
     DismissableAlertSource,
 )
 from middlewared.alert.base import UnavailableException, AlertService as _AlertService
+from middlewared.alert.delivery import AlertDelivery, AlertOutbox
 from middlewared.schema import Any, Bool, Dict, Int, Str, accepts, Patch
 from middlewared.service import (
     ConfigService, CRUDService, Service, ValidationErrors,
@@ -30,6 +32,8 @@ from middlewared.utils import load_modules, load_classes
 POLICIES = ["IMMEDIATELY", "HOURLY", "DAILY", "NEVER"]
 DEFAULT_POLICY = "IMMEDIATELY"
 
+ALERT_OUTBOX_FILE = "/data/alert-outbox.db"
+
 ALERT_SOURCES = {}
 ALERT_SERVICES_FACTORIES = {}
 
@@ -78,8 +82,15 @@ class AlertService(Service):
             "NEVER": AlertPolicy(lambda d: None),
         }
 
+        self.delivery = None
+
     @private
     async def initialize(self):
+        self.delivery = AlertDelivery(
+            await self.middleware.run_in_thread(AlertOutbox, ALERT_OUTBOX_FILE), self.__get_alert_service,
+            run_in_thread=self.middleware.run_in_thread,
+        )
+
         if not await self.middleware.call("system.is_freenas"):
             if await self.middleware.call("failover.node") == "B":
                 self.node = "B"
@@ -168,7 +179,7 @@ class AlertService(Service):
             return
         alert.dismissed = False
 
-    @periodic(60)
+    @periodic(60, jitter=10)
     @job(lock="process_alerts", transient=True)
     async def process_alerts(self, job):
         if not await self.middleware.call("system.ready"):
@@ -207,23 +218,12 @@ class AlertService(Service):
                 if not service_gone_alerts and not service_new_alerts:
                     continue
 
-                factory = ALERT_SERVICES_FACTORIES.get(alert_service_desc["type"])
-                if factory is None:
+                if alert_service_desc["type"] not in ALERT_SERVICES_FACTORIES:
                     self.logger.error("Alert service %r does not exist", alert_service_desc["type"])
                     continue
 
-                try:
-                    alert_service = factory(self.middleware, alert_service_desc["attributes"])
-                except Exception:
-                    self.logger.error("Error creating alert service %r with parameters=%r",
-                                      alert_service_desc["type"], alert_service_desc["attributes"], exc_info=True)
-                    continue
-
-                if all_alerts or service_gone_alerts or service_new_alerts:
-                    try:
-                        await alert_service.send(all_alerts, service_gone_alerts, service_new_alerts)
-                    except Exception:
-                        self.logger.error("Error in alert service %r", alert_service_desc["type"], exc_info=True)
+                # Queued and sent by the delivery layer so a slow or unreachable service does not hold up others
+                await self.delivery.enqueue(alert_service_desc["id"], all_alerts, service_gone_alerts, service_new_alerts)
 
             if policy_name == "IMMEDIATELY":
                 for alert in new_alerts:
@@ -278,6 +278,28 @@ class AlertService(Service):
                                 except Exception:
                                     self.logger.error(f"Failed to create a support ticket", exc_info=True)
 
+        asyncio.ensure_future(self.delivery.deliver())
+
+    async def __get_alert_service(self, service_id):
+        try:
+            alert_service_desc = await self.middleware.call("datastore.query", "system.alertservice",
+                                                            [("id", "=", service_id)], {"get": True})
+        except IndexError:
+            return None
+
+        factory = ALERT_SERVICES_FACTORIES.get(alert_service_desc["type"])
+        if factory is None:
+            self.logger.error("Alert service %r does not exist", alert_service_desc["type"])
+            return None
+
+        return factory(self.middleware, alert_service_desc["attributes"])
+
+    @private
+    def delivery_status(self, service_id):
+        if self.delivery is None:
+            return None
+        return self.delivery.status(service_id)
+
     async def __run_alerts(self):
         master_node = "A"
         backup_node = "B"
@@ -396,7 +418,7 @@ class AlertService(Service):
 
         return alerts
 
-    @periodic(3600)
+    @periodic(3600, jitter=300)
     async def flush_alerts(self):
         if (
             not await self.middleware.call('system.is_freenas') and
@@ -484,6 +506,8 @@ class AlertServiceService(CRUDService):
         except KeyError:
             service["type__title"] = "<Unknown>"
 
+        service["delivery"] = await self.middleware.call("alert.delivery_status", service["id"])
+
         return service
 
     @private
@@ -0,0 +1,84 @@
+import asyncio
+
+from middlewared.schema import accepts, Str
+from middlewared.service import private, Service
+from middlewared.utils.path import PathTrie
+
+
+class AttachmentService(Service):
+    """
+    Index of shares and tasks that depend on a path or a dataset.
+
+    Plugins register a source (a CRUD namespace and a function returning the
+    paths and dataset names of one of its rows) with `attachment.register_source`.
+    Rows are loaded into a prefix trie which is rebuilt on lookup whenever the
+    database has been written to since it was loaded (`datastore.version`), so
+    rows changed outside of CRUD methods (e.g. by the GUI) are never missed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sources = {}
+        self.trie = PathTrie()
+        self.version = None
+        self.lock = asyncio.Lock()
+
+    @private
+    async def register_source(self, name, namespace, keys, filters=None):
+        """
+        Register `namespace` rows matching `filters` as attachments called `name`.
+
+        `keys(row)` returns a list of paths (e.g. /mnt/tank/share) and/or
+        dataset names (e.g. tank/share) the row depends on.
+        """
+        self.sources[name] = {
+            'namespace': namespace,
+            'keys': keys,
+            'filters': filters or [],
+        }
+        self.version = None
+
+    async def _load(self):
+        async with self.lock:
+            # Read before the rows so that writes made while loading are picked up by the next lookup
+            version = await self.middleware.call('datastore.version')
+            if version is not None and version == self.version:
+                return
+
+            trie = PathTrie()
+            for name, source in self.sources.items():
+                for row in await self.middleware.call(f'{source["namespace"]}.query', source['filters']):
+                    for key in source['keys'](row):
+                        trie.add(key, (name, row['id']))
+
+            self.trie = trie
+            self.version = version
+
+    @accepts(Str('path_or_dataset', required=True))
+    async def attachments_for(self, path_or_dataset):
+        """
+        Return a dict composed by the name of sources and ids of each item
+        attached to `path_or_dataset` or to any path/dataset below it.
+
+        `path_or_dataset` is either an absolute path (e.g. /mnt/tank/share)
+        or a dataset name (e.g. tank/share).
+        """
+        await self._load()
+        result = {name: [] for name in self.sources}
+        for name, id in self.trie.under(path_or_dataset):
+            result[name].append(id)
+        for ids in result.values():
+            ids.sort()
+        return result
+
+    @private
+    async def attachments_above(self, path_or_dataset):
+        """
+        Return a list of dicts with `source`, `id` and `key` of each item
+        attached to `path_or_dataset` or to any of its parents.
+        """
+        await self._load()
+        return sorted(
+            [{'source': name, 'id': id, 'key': key} for key, (name, id) in self.trie.above(path_or_dataset)],
+            key=lambda i: (i['source'], i['id'], i['key']),
+        )
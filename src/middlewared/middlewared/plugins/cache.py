@@ -1,83 +1,103 @@
 from middlewared.schema import Any, Str, accepts, Int
 from middlewared.service import Service, private
-from collections import namedtuple
-import time
+from middlewared.utils.cache import LRUCache
+
+import asyncio
 
 
 class CacheService(Service):
 
+    MAX_ENTRIES = 10000
+    MAX_BYTES = 64 * 1024 * 1024
+
     class Config:
         private = True
 
     def __init__(self, *args, **kwargs):
         super(CacheService, self).__init__(*args, **kwargs)
-        self.__cache = {}
-        self.kv_tuple = namedtuple('Cache', ['value', 'timeout'])
+        self.__cache = LRUCache(self.MAX_ENTRIES, self.MAX_BYTES)
+        self.__computing = {}
 
-    @accepts(Str('key'))
-    def has_key(self, key):
+    @accepts(Str('key'), Str('namespace', default=''))
+    def has_key(self, key, namespace):
         """
         Check if given `key` is in cache.
         """
-        return key in self.__cache
+        return self.__cache.has(namespace, key)
 
-    @accepts(Str('key'))
-    def get(self, key):
+    @accepts(Str('key'), Str('namespace', default=''))
+    def get(self, key, namespace):
         """
         Get `key` from cache.
 
         Raises:
             KeyError: not found in the cache
         """
+        return self.__cache.get(namespace, key)
 
-        if self.__cache[key].timeout > 0:
-            self.get_timeout(key)
-
-        return self.__cache[key].value
-
-    @accepts(Str('key'), Any('value'), Int('timeout', default=0))
-    def put(self, key, value, timeout):
+    @accepts(Str('key'), Any('value'), Int('timeout', default=0), Str('namespace', default=''))
+    def put(self, key, value, timeout, namespace):
         """
         Put `key` of `value` in the cache.
-        """
 
-        if timeout != 0:
-            timeout = time.monotonic() + timeout
-
-        v = self.kv_tuple(value=value, timeout=timeout)
-        self.__cache[key] = v
+        Least recently used keys with a `timeout` are evicted when the cache is full, keys that never
+        expire are kept.
+        """
+        self.__cache.put(namespace, key, value, timeout)
 
-    @accepts(Str('key'))
-    def pop(self, key):
+    @accepts(Str('key'), Str('namespace', default=''))
+    def pop(self, key, namespace):
         """
         Removes and returns `key` from cache.
         """
-        cache = self.__cache.pop(key, None)
+        return self.__cache.pop(namespace, key)
 
-        if cache is not None:
-            cache = cache.value
+    @accepts(Str('namespace', null=True, default=None))
+    def clear(self, namespace):
+        """
+        Removes all keys of `namespace` (or all keys if it is null) from cache.
+        """
+        self.__cache.clear(namespace)
 
-        return cache
+    @accepts()
+    def stats(self):
+        """
+        Returns entry count, size, hit/miss/eviction/expiration counters of the cache and each namespace.
+        """
+        return self.__cache.stats()
 
     @private
-    def get_timeout(self, key):
+    async def get_or_compute(self, key, timeout, method, namespace=''):
         """
-        Check if 'key' has expired
+        Get `key` from cache or put the result of `method` there.
+
+        `method` is only called once for concurrent misses of the same key; the other callers wait for its result.
         """
-        now = time.monotonic()
-        value, timeout = self.__cache[key]
+        try:
+            return self.__cache.get(namespace, key)
+        except KeyError:
+            pass
 
-        if now >= timeout:
-            # Bust the cache
-            del self.__cache[key]
+        k = (namespace, key)
+        fut = self.__computing.get(k)
+        if fut is None:
+            fut = self.__computing[k] = asyncio.ensure_future(self.__compute(namespace, key, timeout, method))
 
-            raise KeyError(f'{key} has expired')
+        # Cancelling one of the callers must not cancel the computation others are waiting for
+        return await asyncio.shield(fut)
 
-    @private
-    def get_or_put(self, key, timeout, method):
+    async def __compute(self, namespace, key, timeout, method):
         try:
-            return self.get(key)
-        except KeyError:
-            value = method()
-            self.put(key, value, timeout)
+            if asyncio.iscoroutinefunction(method):
+                value = await method()
+            else:
+                value = await self.middleware.run_in_thread(method)
+
+            self.__cache.put(namespace, key, value, timeout)
             return value
+        finally:
+            self.__computing.pop((namespace, key))
+
+    @private
+    async def get_or_put(self, key, timeout, method):
+        return await self.get_or_compute(key, timeout, method)
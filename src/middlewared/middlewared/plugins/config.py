@@ -5,6 +5,9 @@ import tempfile
 
 from middlewared.schema import Bool, Dict, accepts
 from middlewared.service import Service, job
+from middlewared.utils.sqlite_dump import copy_database
+
+FREENAS_DATABASE = '/data/freenas-v1.db'
 
 
 class ConfigService(Service):
@@ -23,22 +26,29 @@ class ConfigService(Service):
         if options is None:
             options = {}
 
+        # Copy the database within a read transaction so a concurrent write can not leave it inconsistent
+        database = tempfile.mkstemp()[1]
+        os.chmod(database, 0o600)
+        await self.middleware.run_in_thread(copy_database, FREENAS_DATABASE, database)
+
         if not options.get('secretseed'):
             bundle = False
-            filename = '/data/freenas-v1.db'
+            filename = database
         else:
             bundle = True
             filename = tempfile.mkstemp()[1]
             os.chmod(filename, 0o600)
             with tarfile.open(filename, 'w') as tar:
-                tar.add('/data/freenas-v1.db', arcname='freenas-v1.db')
+                tar.add(database, arcname='freenas-v1.db')
                 tar.add('/data/pwenc_secret', arcname='pwenc_secret')
 
-        with open(filename, 'rb') as f:
-            await self.middleware.run_in_thread(shutil.copyfileobj, f, job.pipes.output.w)
-
-        if bundle:
-            os.remove(filename)
+        try:
+            with open(filename, 'rb') as f:
+                await self.middleware.run_in_thread(shutil.copyfileobj, f, job.pipes.output.w)
+        finally:
+            os.remove(database)
+            if bundle:
+                os.remove(filename)
 
     @accepts()
     @job(pipes=["input"])
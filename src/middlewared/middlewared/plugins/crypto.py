@@ -1,6 +1,6 @@
+import copy
 import datetime
-import dateutil
-import dateutil.parser
+import errno
 import josepy as jose
 import json
 import os
@@ -10,6 +10,9 @@ import re
 from middlewared.async_validators import validate_country
 from middlewared.schema import accepts, Bool, Dict, Int, List, Patch, Ref, Str
 from middlewared.service import CallError, CRUDService, job, periodic, private, skip_arg, ValidationErrors
+from middlewared.utils.certificates import (
+    CATree, certificate_info, csr_info, normalize_private_key, signedby_id
+)
 from middlewared.validators import Email, IpAddress, Range
 
 from acme import client, errors, messages
@@ -196,6 +199,7 @@ class CertificateService(CRUDService):
     class Config:
         datastore = 'system.certificate'
         datastore_extend = 'certificate.cert_extend'
+        datastore_extend_context = 'certificate.cert_extend_context'
         datastore_prefix = 'cert_'
 
     def __init__(self, *args, **kwargs):
@@ -210,25 +214,25 @@ class CertificateService(CRUDService):
         }
 
     @private
-    async def cert_extend(self, cert):
+    async def cert_extend_context(self):
+        # Every CA is loaded once per query so `signedby` chains are resolved without querying for each row
+        cas = await self.middleware.call(
+            'datastore.query', 'system.certificateauthority', [], {'prefix': 'cert_'}
+        )
+        return {'ca_tree': CATree(cas), 'extended_cas': {}}
+
+    @private
+    async def cert_extend(self, cert, context=None):
         """Extend certificate with some useful attributes."""
 
-        if cert.get('signedby'):
+        if context is None:
+            context = await self.cert_extend_context()
 
-            # We query for signedby again to make sure it's keys do not have the "cert_" prefix and it has gone through
-            # the cert_extend method
-            # Datastore query is used instead of certificate.query to stop an infinite recursive loop
-
-            cert['signedby'] = await self.middleware.call(
-                'datastore.query',
-                'system.certificateauthority',
-                [('id', '=', cert['signedby']['id'])],
-                {
-                    'prefix': 'cert_',
-                    'extend': 'certificate.cert_extend',
-                    'get': True
-                }
-            )
+        return await self.__cert_extend(cert, context, [])
+
+    async def __cert_extend(self, cert, context, path):
+        if cert.get('signedby'):
+            cert['signedby'] = copy.deepcopy(await self.__extend_ca(signedby_id(cert), context, path))
 
         # Remove ACME related keys if cert is not an ACME based cert
         if not cert.get('acme'):
@@ -284,62 +288,60 @@ class CertificateService(CRUDService):
                 signing_CA['issuer'] = cert_issuer(signing_CA)
                 signing_CA = signing_CA['issuer']
 
-        cert_obj = None
-        try:
-            for c in certs:
-                # XXX Why load certificate if we are going to dump it right after?
-                # Maybe just to verify its integrity?
-                # Logic copied from freenasUI
-                if c:
-                    cert_obj = crypto.load_certificate(crypto.FILETYPE_PEM, c)
-                    cert['chain_list'].append(
-                        crypto.dump_certificate(crypto.FILETYPE_PEM, cert_obj).decode()
-                    )
-        except Exception:
-            self.logger.debug(f'Failed to load certificate {cert["name"]}', exc_info=True)
-
-        try:
-            if cert['privatekey']:
-                key_obj = crypto.load_privatekey(crypto.FILETYPE_PEM, cert['privatekey'])
-                cert['privatekey'] = crypto.dump_privatekey(crypto.FILETYPE_PEM, key_obj).decode()
-        except Exception:
-            self.logger.debug(f'Failed to load privatekey {cert["name"]}', exc_info=True)
+        # Parsed certificates, keys and CSRs are cached by their PEM text
+        cert_info = None
+        for c in certs:
+            if c:
+                info = certificate_info(c)
+                if info is None:
+                    self.logger.debug(f'Failed to load certificate {cert["name"]}')
+                    break
+                cert['chain_list'].append(info['pem'])
+                if cert_info is None:
+                    cert_info = info
+
+        if cert['privatekey']:
+            privatekey = normalize_private_key(cert['privatekey'])
+            if privatekey is None:
+                self.logger.debug(f'Failed to load privatekey {cert["name"]}')
+            else:
+                cert['privatekey'] = privatekey
 
-        try:
-            if cert['CSR']:
-                csr_obj = crypto.load_certificate_request(crypto.FILETYPE_PEM, cert['CSR'])
-                cert['CSR'] = crypto.dump_certificate_request(crypto.FILETYPE_PEM, csr_obj).decode()
-        except Exception:
-            self.logger.debug(f'Failed to load csr {cert["name"]}', exc_info=True)
+        csr = None
+        if cert['CSR']:
+            csr = csr_info(cert['CSR'])
+            if csr is None:
+                self.logger.debug(f'Failed to load csr {cert["name"]}')
+            else:
+                cert['CSR'] = csr['pem']
 
         cert['internal'] = 'NO' if cert['type'] in (CA_TYPE_EXISTING, CERT_TYPE_EXISTING) else 'YES'
 
-        obj = None
+        info = None
         # date not applicable for CSR
         cert['from'] = None
         cert['until'] = None
         if cert['type'] == CERT_TYPE_CSR:
-            obj = csr_obj
-        elif cert_obj:
-            obj = crypto.load_certificate(crypto.FILETYPE_PEM, cert['certificate'])
-            notBefore = obj.get_notBefore()
-            t1 = dateutil.parser.parse(notBefore)
-            t2 = t1.astimezone(dateutil.tz.tzutc())
-            cert['from'] = t2.ctime()
-
-            notAfter = obj.get_notAfter()
-            t1 = dateutil.parser.parse(notAfter)
-            t2 = t1.astimezone(dateutil.tz.tzutc())
-            cert['until'] = t2.ctime()
-
-        if obj:
-            cert['DN'] = '/' + '/'.join([
-                '%s=%s' % (c[0].decode(), c[1].decode())
-                for c in obj.get_subject().get_components()
-            ])
+            info = csr
+        elif cert_info:
+            info = cert_info
+            cert['from'] = cert_info['from']
+            cert['until'] = cert_info['until']
+
+        if info:
+            cert['DN'] = info['DN']
 
         return cert
 
+    async def __extend_ca(self, ca_id, context, path):
+        if ca_id not in context['extended_cas']:
+            ca = context['ca_tree'].cas.get(ca_id)
+            if ca is None or ca_id in path:
+                # Dangling or circular reference
+                return None
+            context['extended_cas'][ca_id] = await self.__cert_extend(dict(ca), context, path + [ca_id])
+        return context['extended_cas'][ca_id]
+
     # HELPER METHODS
 
     @private
@@ -701,7 +703,7 @@ class CertificateService(CRUDService):
                     f'DNS challenge {"completed" if status else "failed"} for {domain}'
                 )
 
-    @periodic(86400, run_on_start=True)
+    @periodic(86400, run_on_start=True, jitter=600)
     @private
     @job(lock='acme_cert_renewal')
     def renew_certs(self, job):
@@ -1314,6 +1316,7 @@ class CertificateAuthorityService(CRUDService):
     class Config:
         datastore = 'system.certificateauthority'
         datastore_extend = 'certificate.cert_extend'
+        datastore_extend_context = 'certificate.cert_extend_context'
         datastore_prefix = 'cert_'
 
     def __init__(self, *args, **kwargs):
@@ -1336,62 +1339,20 @@ class CertificateAuthorityService(CRUDService):
 
     @private
     async def get_serial_for_certificate(self, ca_id):
+        # Whole CA hierarchy is read with two queries and walked in memory
+        tree = CATree(
+            await self.middleware.call(
+                'datastore.query', self._config.datastore, [], {'prefix': self._config.datastore_prefix}
+            ),
+            await self.middleware.call(
+                'datastore.query', 'system.certificate', [], {'prefix': self._config.datastore_prefix}
+            ),
+        )
 
-        ca_data = await self._get_instance(ca_id)
-
-        if ca_data.get('signedby'):
-            # Recursively call the same function for it's parent and let the function gather all serials in a chain
-            return await self.get_serial_for_certificate(ca_data['signedby']['id'])
-        else:
-
-            async def cert_serials(ca_id):
-                return [
-                    data['serial'] for data in
-                    await self.middleware.call(
-                        'datastore.query',
-                        'system.certificate',
-                        [('signedby', '=', ca_id)],
-                        {
-                            'prefix': self._config.datastore_prefix,
-                            'extend': self._config.datastore_extend
-                        }
-                    )
-                ]
-
-            ca_signed_certs = await cert_serials(ca_id)
-
-            async def child_serials(ca_id):
-                serials = []
-                children = await self.middleware.call(
-                    'datastore.query',
-                    self._config.datastore,
-                    [('signedby', '=', ca_id)],
-                    {
-                        'prefix': self._config.datastore_prefix,
-                        'extend': self._config.datastore_extend
-                    }
-                )
-
-                for child in children:
-                    serials.extend((await child_serials(child['id'])))
-
-                serials.extend((await cert_serials(ca_id)))
-                serials.append((await self._get_instance(ca_id))['serial'])
-
-                return serials
-
-            ca_signed_certs.extend((await child_serials(ca_id)))
-
-            # There is for a case when user might have old certs in the db whose serial value
-            # isn't set in the db
-            ca_signed_certs = list(filter(None, ca_signed_certs))
+        if ca_id not in tree.cas:
+            raise CallError(f'Certificate Authority {ca_id} does not exist', errno.ENOENT)
 
-            if not ca_signed_certs:
-                return int(
-                    (await self._get_instance(ca_id))['serial'] or 0
-                ) + 1
-            else:
-                return max(ca_signed_certs) + 1
+        return tree.next_serial(ca_id)
 
     @private
     @accepts(
@@ -1,9 +1,11 @@
-from middlewared.service import CallError, Service
-from middlewared.schema import accepts, Any, Bool, Dict, List, Ref, Str
+from middlewared.client import ejson as json
+from middlewared.service import CallError, Service, job
+from middlewared.schema import accepts, Any, Bool, Dict, Int, List, Ref, Str
 from sqlite3 import OperationalError
 
 import os
 import sys
+import time
 from itertools import chain
 
 sys.path.append('/usr/local/www')
@@ -26,6 +28,7 @@ from freenasUI.freeadmin.sqlite3_ha import base as sqlite3_ha_base
 sqlite3_ha_base.execute_sync = True
 
 from middlewared.utils import django_modelobj_serialize
+from middlewared.utils.sqlite_dump import dump_json, dump_sql, read_transaction, snapshot
 
 
 class DatastoreService(Service):
@@ -283,6 +286,26 @@ class DatastoreService(Service):
             model.objects.get(pk=id_or_filters).delete()
         return True
 
+    @accepts()
+    def version(self):
+        """
+        Returns a value that changes every time the database is written to (by any process, not only through
+        `datastore`) or `None` if a change could go unnoticed because the database was modified too recently.
+        """
+        version = []
+        for path in (connection.settings_dict['NAME'], connection.settings_dict['NAME'] + '-wal'):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                version.append(None)
+                continue
+
+            # Writes within the same timestamp tick would have the same mtime
+            if time.time() - st.st_mtime < 1:
+                return None
+            version.append([st.st_ino, st.st_size, st.st_mtime_ns])
+        return version
+
     def sql(self, query, params=None):
         cursor = connection.cursor()
         try:
@@ -315,25 +338,61 @@ class DatastoreService(Service):
     def dump(self):
         """
         Dumps the database, returning a list of SQL commands.
+
+        Use `datastore.dump_stream` to avoid building the whole dump in memory.
         """
-        # FIXME: This could return a few hundred KB of data,
-        # we need to investigate a way of doing that in chunks.
-        return connection.dump()
+        with read_transaction(connection.settings_dict['NAME']) as conn:
+            return list(dump_sql(conn, exclude=self._dump_exclude()))
 
     @accepts()
-    async def dump_json(self):
-        models = []
-        for model in django.apps.apps.get_models():
-            if not model.__module__.startswith("freenasUI."):
-                continue
+    def dump_json(self):
+        models = {}
+        with read_transaction(connection.settings_dict['NAME']) as conn:
+            for batch in dump_json(conn, self._dump_json_tables()):
+                if batch['table_name'] in models:
+                    models[batch['table_name']]['entries'].extend(batch['entries'])
+                else:
+                    models[batch['table_name']] = batch
+
+        return list(models.values())
+
+    @accepts(Dict(
+        'datastore_dump_stream',
+        Str('format', enum=['SQL', 'JSON'], default='SQL'),
+        Bool('schema', default=False),
+        Int('batch_size', default=1000),
+    ))
+    @job(pipes=['output'])
+    def dump_stream(self, job, options):
+        """
+        Writes a consistent snapshot of the database to job output pipe.
 
-            try:
-                entries = await self.middleware.call("datastore.sql", f"SELECT * FROM {model._meta.db_table}")
-            except CallError as e:
-                self.logger.debug("%r", e)
-                continue
+        `SQL` format is a script of statements terminated by `;` and a newline. With `schema` it also creates
+        tables and indexes, so it can be restored into an empty database.
+
+        `JSON` format is one JSON object per line: table description (like `datastore.dump_json` entries) with up to
+        `batch_size` of its rows in `entries`.
+
+        The dump is read from a copy of the database, so a slow (or absent) reader of the pipe does not keep
+        writers locked out.
+        """
+        with snapshot(connection.settings_dict['NAME']) as conn:
+            if options['format'] == 'SQL':
+                for statement in dump_sql(conn, options['schema'], self._dump_exclude()):
+                    job.pipes.output.w.write(f'{statement};\n'.encode('utf-8'))
+            else:
+                for batch in dump_json(conn, self._dump_json_tables(), options['batch_size']):
+                    job.pipes.output.w.write(json.dumps(batch).encode('utf-8') + b'\n')
 
-            models.append({
+        job.pipes.output.w.close()
+
+    def _dump_exclude(self):
+        # Tables that should not be synced between nodes at all
+        return {table for table, options in sqlite3_ha_base.NO_SYNC_MAP.items() if not options}
+
+    def _dump_json_tables(self):
+        return [
+            {
                 "table_name": model._meta.db_table,
                 "verbose_name": str(model._meta.verbose_name),
                 "fields": [
@@ -345,7 +404,7 @@ class DatastoreService(Service):
                     for field in model._meta.get_fields()
                     if not field.is_relation
                 ],
-                "entries": entries,
-            })
-
-        return models
+            }
+            for model in django.apps.apps.get_models()
+            if model.__module__.startswith("freenasUI.")
+        ]
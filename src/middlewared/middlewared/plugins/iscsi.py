@@ -1258,3 +1258,11 @@ class iSCSITargetToExtentService(CRUDService):
                 f'{schema_name}.target',
                 'Extent is already in this target.'
             )
+
+
+async def setup(middleware):
+    await middleware.call(
+        'attachment.register_source', 'iscsi_extents', 'iscsi.extent',
+        lambda extent: [extent['path'][len('zvol/'):]] if extent['path'].startswith('zvol/') else [],
+        [('type', '=', 'DISK')],
+    )
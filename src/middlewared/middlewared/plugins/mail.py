@@ -1,12 +1,12 @@
 from middlewared.schema import Bool, Dict, Int, List, Ref, Str, accepts
 from middlewared.service import CallError, ConfigService, ValidationErrors, job, periodic, private
+from middlewared.utils.mail_outbox import MailOutbox
 
 from datetime import datetime, timedelta
 from email.message import Message
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
-from lockfile import LockFile, LockTimeout
 from mako.lookup import TemplateLookup
 import markdown2
 
@@ -14,71 +14,11 @@ import base64
 import errno
 import json
 import os
-import pickle
 import smtplib
 import socket
 import syslog
 
 
-class QueueItem(object):
-
-    def __init__(self, message):
-        self.attempts = 0
-        self.message = message
-
-
-class MailQueue(object):
-
-    QUEUE_FILE = '/tmp/mail.queue'
-    MAX_ATTEMPTS = 3
-
-    def __init__(self):
-        self.queue = None
-
-    def append(self, message):
-        self.queue.append(QueueItem(message))
-
-    @classmethod
-    def is_empty(cls):
-        if not os.path.exists(cls.QUEUE_FILE):
-            return True
-        try:
-            return os.stat(cls.QUEUE_FILE).st_size == 0
-        except OSError:
-            return True
-
-    def _get_queue(self):
-        try:
-            with open(self.QUEUE_FILE, 'rb') as f:
-                self.queue = pickle.loads(f.read())
-        except (pickle.PickleError, EOFError):
-            self.queue = []
-
-    def __enter__(self):
-        self._lock = LockFile(self.QUEUE_FILE)
-        while not self._lock.i_am_locking():
-            try:
-                self._lock.acquire(timeout=330)
-            except LockTimeout:
-                self._lock.break_lock()
-
-        if not os.path.exists(self.QUEUE_FILE):
-            open(self.QUEUE_FILE, 'a').close()
-
-        self._get_queue()
-        return self
-
-    def __exit__(self, typ, value, traceback):
-
-        with open(self.QUEUE_FILE, 'wb+') as f:
-            if self.queue:
-                f.write(pickle.dumps(self.queue))
-
-        self._lock.release()
-        if typ is not None:
-            raise
-
-
 class MailService(ConfigService):
 
     class Config:
@@ -86,6 +26,25 @@ class MailService(ConfigService):
         datastore_prefix = 'em_'
         datastore_extend = 'mail.mail_extend'
 
+    OUTBOX_FILE = '/data/mail-outbox.db'
+
+    outbox = None
+    html_template = None
+
+    def _get_outbox(self):
+        if self.outbox is None:
+            MailService.outbox = MailOutbox(self.OUTBOX_FILE)
+        return self.outbox
+
+    def _get_html_template(self):
+        if self.html_template is None:
+            lookup = TemplateLookup(
+                directories=[os.path.join(os.path.dirname(os.path.realpath(__file__)), '../assets/templates')],
+                module_directory="/tmp/mako/templates")
+
+            MailService.html_template = lookup.get_template('mail.html')
+        return self.html_template
+
     @private
     async def mail_extend(self, cfg):
         if cfg['security']:
@@ -181,13 +140,7 @@ class MailService(ConfigService):
         message['subject'] = f'{hostname}: {message["subject"]}'
 
         if 'html' not in message:
-            lookup = TemplateLookup(
-                directories=[os.path.join(os.path.dirname(os.path.realpath(__file__)), '../assets/templates')],
-                module_directory="/tmp/mako/templates")
-
-            tmpl = lookup.get_template('mail.html')
-
-            message['html'] = tmpl.render(body=markdown2.markdown(message['text']))
+            message['html'] = self._get_html_template().render(body=markdown2.markdown(message['text']))
 
         return self.send_raw(job, message, config)
 
@@ -308,7 +261,12 @@ class MailService(ConfigService):
             headers = '\n'.join([f'{k}: {v}' for k, v in msg._headers])
             syslog.syslog(f"sending mail to {', '.join(to)}\n{headers}")
             server.sendmail(config['fromemail'], to, msg.as_string())
-            server.quit()
+            try:
+                # Server is reachable, deliver queued messages over the same session
+                self._get_outbox().send(None, server=server)
+                server.quit()
+            except Exception:
+                self.logger.debug('Failed to close SMTP session', exc_info=True)
         except ValueError as ve:
             # Don't spam syslog with these messages. They should only end up in the
             # test-email pane.
@@ -319,8 +277,7 @@ class MailService(ConfigService):
                 raise CallError(f'Authentication error ({e.smtp_code}): {e.smtp_error}', errno.EAUTH)
             self.logger.warn('Failed to send email: %s', str(e), exc_info=True)
             if message['queue']:
-                with MailQueue() as mq:
-                    mq.append(msg)
+                self._get_outbox().append(config['fromemail'], to, msg)
             raise CallError(f'Failed to send email: {e}')
         return True
 
@@ -350,21 +307,8 @@ class MailService(ConfigService):
             server.login(config['user'], config['pass'])
         return server
 
-    @periodic(600, run_on_start=False)
+    @periodic(60, run_on_start=False, jitter=10)
     @private
     def send_mail_queue(self):
-
-        with MailQueue() as mq:
-            for queue in list(mq.queue):
-                try:
-                    config = self.middleware.call_sync('mail.config')
-                    server = self._get_smtp_server(config)
-                    server.sendmail(queue.message['From'], queue.message['To'].split(', '), queue.message.as_string())
-                    server.quit()
-                except Exception:
-                    self.logger.debug('Sending message from queue failed', exc_info=True)
-                    queue.attempts += 1
-                    if queue.attempts >= mq.MAX_ATTEMPTS:
-                        mq.queue.remove(queue)
-                else:
-                    mq.queue.remove(queue)
+        # Only messages whose backoff has expired are sent, all over one SMTP session
+        self._get_outbox().send(lambda: self._get_smtp_server(self.middleware.call_sync('mail.config')))
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from middlewared.schema import accepts, Str
+from middlewared.service import filterable, private, Service
+from middlewared.utils import filter_list
+from middlewared.utils.mount import default_backend, MountTable
+
+
+class MountService(Service):
+    """
+    Cached table of mounted filesystems.
+
+    The table is read again on mount/unmount events or once it is older than
+    `TTL` seconds.
+    """
+
+    TTL = 5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backend = default_backend()
+        self.lock = threading.Lock()
+        self.table = None
+        self.expires = 0
+
+    @private
+    def get_table(self):
+        with self.lock:
+            if self.table is None or time.monotonic() >= self.expires:
+                self.table = MountTable(self.backend.read())
+                self.expires = time.monotonic() + self.TTL
+            return self.table
+
+    @private
+    def invalidate(self):
+        with self.lock:
+            self.table = None
+
+    @filterable
+    def query(self, filters=None, options=None):
+        """
+        Query mounted filesystems (`source`, `dest`, `fstype` and `options`).
+        """
+        return filter_list(self.get_table().mounts, filters, options)
+
+    @accepts(Str('path'))
+    def path_to_mount(self, path):
+        """
+        Returns mounted filesystem `path` belongs to or null.
+        """
+        return self.get_table().path_to_mount(path)
+
+    @accepts(Str('path', null=True, default=None), Str('source', null=True, default=None))
+    def is_mounted(self, path, source):
+        """
+        Returns whether a filesystem is mounted on `path` or, if `path` is null, from `source`.
+        """
+        return self.get_table().is_mounted(path, source)
+
+
+async def _event_vfs(middleware, event_type, args):
+    await middleware.call('mount.invalidate')
+
+
+def setup(middleware):
+    middleware.event_subscribe('devd.vfs', _event_vfs)
@@ -1,6 +1,7 @@
 from middlewared.service import (CallError, ConfigService, CRUDService, Service,
                                  filterable, pass_app, private)
 from middlewared.utils import Popen, filter_list, run
+from middlewared.utils.interface_cache import InterfaceStateCache, default_watcher
 from middlewared.schema import (Bool, Dict, Int, IPAddr, List, Patch, Ref, Str,
                                 ValidationErrors, accepts)
 from middlewared.validators import Match, Range
@@ -290,38 +291,111 @@ class InterfaceService(CRUDService):
         super().__init__(*args, **kwargs)
         self._original_datastores = {}
         self._rollback_timer = None
+        self._states = InterfaceStateCache(self._list_states, self._get_state)
+
+    def _list_states(self):
+        states = {}
+        for name, iface in netif.list_interfaces().items():
+            try:
+                states[name] = iface.__getstate__()
+            except OSError:
+                self.logger.warn('Failed to get interface state for %s', name, exc_info=True)
+        return states
+
+    def _get_state(self, name):
+        try:
+            return netif.get_interface(name).__getstate__()
+        except KeyError:
+            return None
+        except OSError:
+            self.logger.warn('Failed to get interface state for %s', name, exc_info=True)
+            return None
+
+    @private
+    def start_state_watcher(self):
+        watcher = default_watcher()
+        if watcher is not None:
+            self._states.start(watcher)
+
+    @private
+    def invalidate_states(self):
+        self._states.invalidate()
+
+    @accepts()
+    def state_generation(self):
+        """
+        Returns a number that changes every time the state of any network interface changes.
+
+        It can be used to know if a previous `interface.query` result is still current without querying again.
+        """
+        return self._states.get_generation()
+
+    async def terminate(self):
+        await self.middleware.run_in_thread(self._states.stop)
 
     @filterable
     def query(self, filters, options):
         data = {}
-        configs = {
-            i['int_interface']: i
-            for i in self.middleware.call_sync('datastore.query', 'network.interfaces')
-        }
-        is_freenas = self.middleware.call_sync('system.is_freenas')
-        if not is_freenas:
-            internal_ifaces = self.middleware.call_sync('failover.internal_interfaces')
-        for name, iface in netif.list_interfaces().items():
-            if iface.cloned and name not in configs:
+        context = self.iface_extend_context()
+        states = self._states.get()[0]
+        for name, state in states.items():
+            if state['cloned'] and name not in context['configs']:
                 continue
-            if not is_freenas and name in internal_ifaces:
+            if not context['is_freenas'] and name in context['internal_interfaces']:
                 continue
-            try:
-                data[name] = self.iface_extend(iface.__getstate__(), configs, is_freenas)
-            except OSError:
-                self.logger.warn('Failed to get interface state for %s', name, exc_info=True)
-        for name, config in filter(lambda x: x[0] not in data, configs.items()):
+            data[name] = self.iface_extend(state, context)
+        for name, config in filter(lambda x: x[0] not in data, context['configs'].items()):
             data[name] = self.iface_extend({
                 'name': config['int_interface'],
                 'aliases': [],
                 'link_address': '',
                 'cloned': True,
                 'mtu': 1500,
-            }, configs, is_freenas, fake=True)
+            }, context, fake=True)
         return filter_list(list(data.values()), filters, options)
 
     @private
-    def iface_extend(self, iface_state, configs, is_freenas, fake=False):
+    def iface_extend_context(self):
+        """
+        Loads configuration of all interfaces at once so `iface_extend` does not need to query anything.
+        """
+        is_freenas = self.middleware.call_sync('system.is_freenas')
+        context = {
+            'is_freenas': is_freenas,
+            'internal_interfaces': (
+                [] if is_freenas else self.middleware.call_sync('failover.internal_interfaces') or []
+            ),
+            'configs': {
+                i['int_interface']: i
+                for i in self.middleware.call_sync('datastore.query', 'network.interfaces')
+            },
+            'bridges': {},
+            'laggs': {},
+            'lagg_ports': defaultdict(list),
+            'vlans': {},
+            'aliases': defaultdict(list),
+        }
+
+        for bridge in self.middleware.call_sync('datastore.query', 'network.bridge'):
+            if bridge['interface']:
+                context['bridges'].setdefault(bridge['interface']['id'], bridge)
+        for lag in self.middleware.call_sync('datastore.query', 'network.lagginterface', [], {'prefix': 'lagg_'}):
+            context['laggs'].setdefault(lag['interface']['id'], lag)
+        for port in self.middleware.call_sync(
+            'datastore.query', 'network.lagginterfacemembers', [], {'prefix': 'lagg_'}
+        ):
+            context['lagg_ports'][port['interfacegroup']['id']].append(port['physnic'])
+        for vlan in self.middleware.call_sync('datastore.query', 'network.vlan', [], {'prefix': 'vlan_'}):
+            context['vlans'].setdefault(vlan['vint'], vlan)
+        for alias in self.middleware.call_sync('datastore.query', 'network.alias'):
+            context['aliases'][alias['alias_interface']['id']].append(alias)
+
+        return context
+
+    @private
+    def iface_extend(self, iface_state, context, fake=False):
+        configs = context['configs']
+        is_freenas = context['is_freenas']
 
         if iface_state['name'].startswith('bridge'):
             itype = 'BRIDGE'
@@ -382,40 +456,19 @@ class InterfaceService(CRUDService):
                 })
 
         if iface['name'].startswith('bridge'):
-            bridge = self.middleware.call_sync(
-                'datastore.query',
-                'network.bridge',
-                [('interface', '=', config['id'])],
-            )
+            bridge = context['bridges'].get(config['id'])
             if bridge:
-                bridge = bridge[0]
                 iface.update({'bridge_members': bridge['members']})
         elif iface['name'].startswith('lagg'):
-            lag = self.middleware.call_sync(
-                'datastore.query',
-                'network.lagginterface',
-                [('interface', '=', config['id'])],
-                {'prefix': 'lagg_'}
-            )
+            lag = context['laggs'].get(config['id'])
             if lag:
-                lag = lag[0]
-                iface.update({'lag_protocol': lag['protocol'].upper(), 'lag_ports': []})
-                for port in self.middleware.call_sync(
-                    'datastore.query',
-                    'network.lagginterfacemembers',
-                    [('interfacegroup', '=', lag['id'])],
-                    {'prefix': 'lagg_'}
-                ):
-                    iface['lag_ports'].append(port['physnic'])
+                iface.update({
+                    'lag_protocol': lag['protocol'].upper(),
+                    'lag_ports': list(context['lagg_ports'].get(lag['id'], [])),
+                })
         if iface['name'].startswith('vlan'):
-            vlan = self.middleware.call_sync(
-                'datastore.query',
-                'network.vlan',
-                [('vint', '=', iface['name'])],
-                {'prefix': 'vlan_'}
-            )
+            vlan = context['vlans'].get(iface['name'])
             if vlan:
-                vlan = vlan[0]
                 iface.update({
                     'vlan_parent_interface': vlan['pint'],
                     'vlan_tag': vlan['tag'],
@@ -436,7 +489,7 @@ class InterfaceService(CRUDService):
                     'netmask': int(config['int_v6netmaskbit']),
                 })
 
-        for alias in self.middleware.call_sync('datastore.query', 'network.alias', [('alias_interface', '=', config['id'])]):
+        for alias in context['aliases'].get(config['id'], []):
 
             if alias['alias_v4address']:
                 iface['aliases'].append({
@@ -1470,6 +1523,9 @@ class InterfaceService(CRUDService):
         if wait_dhcp and dhclient_aws:
             await asyncio.wait(dhclient_aws, timeout=30)
 
+        # Not every change (e.g. LAGG ports or CARP configuration) is reported by the routing socket
+        self._states.invalidate()
+
         await self.middleware.call_hook('interface.post_sync')
 
     @private
@@ -1714,9 +1770,9 @@ class InterfaceService(CRUDService):
         ipv6 = choices['ipv6'] if choices.get('ipv6') else False
         list_of_ip = []
         ignore_nics = ('lo', 'bridge', 'tap', 'epair', 'pflog')
-        for if_name, iface in list(netif.list_interfaces().items()):
+        for if_name, state in self._states.get()[0].items():
             if not if_name.startswith(ignore_nics):
-                aliases_list = iface.__getstate__()['aliases']
+                aliases_list = state['aliases']
                 for alias_dict in aliases_list:
 
                     if ipv4 and alias_dict['type'] == 'INET':
@@ -2041,6 +2097,11 @@ async def _event_ifnet(middleware, event_type, args):
     await middleware.call('interface.sync_interface', iface['name'])
 
 
+async def _event_carp(middleware, event_type, args):
+    # CARP MASTER/BACKUP transitions are reported by devd, not by the routing socket
+    await middleware.call('interface.invalidate_states')
+
+
 async def setup(middleware):
     # Configure http proxy on startup and on network.config events
     asyncio.ensure_future(configure_http_proxy(middleware))
@@ -2048,3 +2109,7 @@ async def setup(middleware):
 
     # Listen to IFNET events so we can sync on interface attach
     middleware.event_subscribe('devd.ifnet', _event_ifnet)
+    middleware.event_subscribe('devd.carp', _event_carp)
+
+    # Keep interface states up to date from routing socket messages
+    await middleware.call('interface.start_state_watcher')
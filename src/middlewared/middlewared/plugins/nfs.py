@@ -365,3 +365,7 @@ class SharingNFSService(CRUDService):
         data["hosts"] = " ".join(data["hosts"])
         data["security"] = [s.lower() for s in data["security"]]
         return data
+
+
+async def setup(middleware):
+    await middleware.call('attachment.register_source', 'nfs', 'sharing.nfs', lambda share: share['paths'])
@@ -64,8 +64,7 @@ def _null(x):
 
 
 async def is_mounted(middleware, path):
-    mounted = await middleware.run_in_thread(bsd.getmntinfo)
-    return any(fs.dest == path for fs in mounted)
+    return await middleware.call('mount.is_mounted', path)
 
 
 async def mount(device, path, fs_type, fs_options, options):
@@ -248,10 +247,12 @@ class MountFsContextManager:
 
     async def __aenter__(self):
         await mount(self.device, self.path, *self.args, **self.kwargs)
+        await self.middleware.call('mount.invalidate')
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if await is_mounted(self.middleware, self.path):
             await self.middleware.run_in_thread(bsd.unmount, self.path)
+            await self.middleware.call('mount.invalidate')
 
 
 class PoolService(CRUDService):
@@ -2022,43 +2023,14 @@ class PoolService(CRUDService):
             'vm_devices': [],
         }
 
-        for smb in await self.middleware.call('sharing.smb.query'):
-            if smb['path'] == pool['path'] or smb['path'].startswith(pool['path'] + '/'):
-                attachments['smb'].append(smb['id'])
-
-        for afp in await self.middleware.call('sharing.afp.query'):
-            if afp['path'] == pool['path'] or afp['path'].startswith(pool['path'] + '/'):
-                attachments['afp'].append(afp['id'])
-
-        for nfs in await self.middleware.call('sharing.nfs.query'):
-            for path in nfs['paths']:
-                if (
-                    (path == pool['path'] or path.startswith(pool['path'] + '/')) and
-                    nfs['id'] not in attachments['nfs']
-                ):
-                    attachments['nfs'].append(nfs['id'])
-
-        for extent in await self.middleware.call('iscsi.extent.query', [('type', '=', 'DISK')]):
-            if extent['path'].startswith(f'zvol/{pool["name"]}/'):
-                attachments['iscsi_extents'].append(extent['id'])
+        for key in (pool['path'], pool['name']):
+            for name, ids in (await self.middleware.call('attachment.attachments_for', key)).items():
+                ids = [i for i in ids if i not in attachments.setdefault(name, [])]
+                attachments[name].extend(ids)
 
         for vm_attached in await self.middleware.call('vm.stop_by_pool', pool['name']):
             attachments['vm_devices'].append(vm_attached['device_id'])
 
-        for repl in await self.middleware.call('replication.query'):
-            if any(
-                source_dataset == pool['name'] or source_dataset.startswith(pool['name'] + '/')
-                for source_dataset in repl['source_datasets']
-            ):
-                attachments['replication'].append(repl['id'])
-
-        for snap in await self.middleware.call('pool.snapshottask.query'):
-            if (
-                snap['dataset'] == pool['name'] or
-                snap['dataset'].startswith(pool['name'] + '/')
-            ):
-                attachments['snaptask'].append(snap['id'])
-
         activated_pool = await self.middleware.call('jail.get_activated_pool')
         if activated_pool == pool['name']:
             for j in await self.middleware.call('jail.query', [('state', '=', 'up')]):
@@ -2068,18 +2040,21 @@ class PoolService(CRUDService):
 
     async def __delete_attachments(self, attachments, pool):
         # TODO: use a hook and move delete/stop to each plugin
-        for name, service in (
-            ('smb', 'sharing.smb.delete'),
-            ('afp', 'sharing.afp.delete'),
-            ('nfs', 'sharing.nfs.delete'),
-            ('iscsi_extents', 'iscsi.extent.delete'),
-            ('snaptask', 'pool.snapshottask.delete'),
+        for name, namespace in (
+            ('smb', 'sharing.smb'),
+            ('afp', 'sharing.afp'),
+            ('nfs', 'sharing.nfs'),
+            ('iscsi_extents', 'iscsi.extent'),
+            ('snaptask', 'pool.snapshottask'),
+            ('replication', 'replication'),
         ):
-            for aid in attachments[name]:
-                await self.middleware.call(service, aid)
+            if not attachments[name]:
+                continue
+            # Items might have been deleted since attachments were retrieved
+            for item in await self.middleware.call(f'{namespace}.query', [('id', 'in', attachments[name])]):
+                await self.middleware.call(f'{namespace}.delete', item['id'])
 
         for name, datastore in (
-            ('replication', 'storage.replication'),
             ('vm_devices', 'vm.device'),
         ):
             for aid in attachments[name]:
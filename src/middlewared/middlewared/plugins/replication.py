@@ -604,3 +604,9 @@ class ReplicationService(CRUDService):
             "ssh_port": result["port"],
             "ssh_hostkey": result["host_key"],
         }
+
+
+async def setup(middleware):
+    await middleware.call(
+        'attachment.register_source', 'replication', 'replication', lambda task: task['source_datasets'],
+    )
@@ -389,30 +389,27 @@ class SharingSMBService(CRUDService):
 
     @accepts(Str('path', required=True))
     async def get_storage_tasks(self, path):
-        zfs_datasets = await self.middleware.call('zfs.dataset.query', [('type', '=', 'FILESYSTEM')])
-        task_list = []
-        task_dict = {}
-
-        for ds in zfs_datasets:
-            tasks = []
-            name = ds['name']
-            mountpoint = ds['properties']['mountpoint']['parsed']
-
-            if path == mountpoint:
-                tasks = await self.middleware.call('pool.snapshottask.query', [['dataset', '=', name]])
-            elif path.startswith(f'{mountpoint}/'):
-                tasks = await self.middleware.call('pool.snapshottask.query', [['dataset', '=', name],
-                                                                               ['recursive', '=', True]])
-
-            task_list.extend(tasks)
+        path = path.rstrip('/')
+        # Datasets mounted on `path` or on one of its parents; tasks of the latter only cover `path` if they are
+        # recursive.
+        datasets = {}
+        for m in await self.middleware.call('mount.query', [('fstype', '=', 'zfs')]):
+            if m['dest'] == path:
+                datasets[m['source']] = True
+            elif path.startswith(m['dest'].rstrip('/') + '/'):
+                datasets.setdefault(m['source'], False)
+        if not datasets:
+            return {}
 
-        for task in task_list:
-            task_id = task['id']
+        task_dict = {}
+        for task in await self.middleware.call('pool.snapshottask.query', [['dataset', 'in', list(datasets)]]):
+            if not datasets[task['dataset']] and not task['recursive']:
+                continue
 
             msg = (f'{task["dataset"]} - {task["naming_schema"]} - '
                    f'{task["lifetime_value"]}{task["lifetime_unit"].lower()[0]}')
 
-            task_dict[task_id] = msg
+            task_dict[task['id']] = msg
 
         return task_dict
 
@@ -467,3 +464,7 @@ class SharingSMBService(CRUDService):
             vfs_modules.extend(['streams_xattr'])
 
         return vfs_modules
+
+
+async def setup(middleware):
+    await middleware.call('attachment.register_source', 'smb', 'sharing.smb', lambda share: [share['path']])
@@ -299,3 +299,7 @@ class PeriodicSnapshotTaskService(CRUDService):
 
     async def _legacy_replication_tasks(self):
         return await self.middleware.call('replication.query', [['transport', '=', 'LEGACY']])
+
+
+async def setup(middleware):
+    await middleware.call('attachment.register_source', 'snaptask', 'pool.snapshottask', lambda task: [task['dataset']])
@@ -6,7 +6,7 @@ from middlewared.service import (
     ValidationError, ValidationErrors,
 )
 from middlewared.utils import Nid, Popen
-from urllib.request import urlretrieve
+from middlewared.utils.image import ImageFetchError, fetch_image
 from pipes import quote
 
 import middlewared.logger
@@ -22,8 +22,6 @@ import re
 import stat
 import subprocess
 import sysctl
-import gzip
-import hashlib
 import shutil
 import signal
 
@@ -36,7 +34,6 @@ CONTAINER_IMAGES = {
         'SHA256': '9913e05287fc79407b4949c095419d2369491c4d833f9887a1a88d853701bb87',
     }
 }
-BUFSIZE = 65536
 ZFS_ARC_MAX_INITIAL = None
 
 ZVOL_CLONE_SUFFIX = '_clone'
@@ -457,16 +454,6 @@ class VMUtils(object):
         else:
             return False
 
-    def is_gzip(file_path):
-        """Check if it is a gzip file and not empty"""
-        with gzip.open(file_path, 'rb') as gfile:
-            try:
-                gf_content = gfile.read(1)
-                if len(gf_content) > 0:
-                    return True
-            except:
-                return False
-
     @staticmethod
     def __mkdirs(path):
         if not os.path.exists(os.path.dirname(path)):
@@ -544,20 +531,6 @@ class VMUtils(object):
 
         return vm_private_dir
 
-    def check_sha256(file_path, digest_sha256):
-        sha256 = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(BUFSIZE)
-                if not data:
-                    break
-                sha256.update(data)
-
-        if sha256.hexdigest() == digest_sha256:
-            return True
-        else:
-            return False
-
 
 class VMService(CRUDService):
 
@@ -1246,55 +1219,31 @@ class VMService(CRUDService):
 
     def __fetch_and_decompress(self, container_image, sharefs, dest, size, job):
 
+        def progress(received, total):
+            if total:
+                # Download, verification and decompression are ~80% of the entire process
+                job.set_progress(
+                    int(received * 80 / total),
+                    'Downloading and decompressing the image',
+                    {'downloaded': received, 'total': total}
+                )
+
         file_path = os.path.join(sharefs, 'iso_files', container_image['GZIPFILE'])
         for retry in range(3):
             try:
-                self.__fetch_image(container_image['URL'], file_path, job)
+                # Partial downloads are kept in `file_path` so every retry resumes the previous one
+                fetch_image(container_image['URL'], file_path, dest, container_image['SHA256'], progress)
                 break
-            except Exception:
-                pass
+            except ImageFetchError as e:
+                error = str(e)
+            except Exception as e:
+                error = str(e)
+                self.logger.debug(f'Failed to download {container_image["URL"]}', exc_info=True)
         else:
-            raise CallError(f'Failed to download {container_image["URL"]} (retries={retry + 1})')
-
-        job.set_progress(60, 'Verifying integrity of the image')
+            raise CallError(f'Failed to download {container_image["URL"]} (retries={retry + 1}): {error}')
 
-        if os.path.exists(file_path) and not self.vmutils.check_sha256(
-            file_path, container_image['SHA256']
-        ):
-            self.logger.debug(f'Checksum failed, removing file: {file_path}')
-            os.remove(file_path)
-
-        job.set_progress(70, 'Decompressing the image')
-        self.__decompress_gzip(file_path, dest)
         self.__raw_resize(dest, size)
 
-    def __fetch_image(self, url, path, job):
-
-        def fetch_hookreport(blocknum, blocksize, totalsize):
-            """Hook to report the download progress."""
-            if totalsize > 0:
-                readchunk = blocknum * blocksize
-                percent = readchunk * 1e2 / totalsize
-                # Download is ~50% of the entire process
-                job.set_progress(
-                    int(percent / 2),
-                    'Downloading',
-                    {'downloaded': readchunk, 'total': totalsize}
-                )
-
-        if not os.path.exists(path):
-            urlretrieve(url, path, fetch_hookreport)
-
-    def __decompress_gzip(self, src, dst):
-        if os.path.exists(dst):
-            raise CallError(f'{dst} file already exists.')
-
-        if not self.vmutils.is_gzip(src):
-            raise CallError(f'{src} file is not a compressed file (gzip).')
-
-        with gzip.open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
-            shutil.copyfileobj(src_file, dst_file)
-
     def __raw_resize(self, raw_path, size):
         unit_size = ('M', 'G', 'T')
         expand_size = size if len(size) > 0 and size[-1:] in unit_size else size + 'G'
@@ -6,7 +6,8 @@ import uuid
 
 from middlewared.async_validators import resolve_hostname
 from middlewared.schema import accepts, Dict, Int, Str, Patch
-from middlewared.service import CallError, CRUDService, private, ValidationErrors
+from middlewared.service import CallError, CRUDService, periodic, private, ValidationErrors
+from middlewared.utils.vmware import SessionPool, VMSnapshotOrchestrator, VSphereSession, VSphereVM
 
 from pyVim import connect, task as VimTask
 from pyVmomi import vim, vmodl
@@ -18,6 +19,15 @@ class VMWareService(CRUDService):
         datastore = 'storage.vmwareplugin'
         datastore_extend = 'vmware.item_extend'
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orchestrator = VMSnapshotOrchestrator(SessionPool(self._connect))
+
+    @periodic(60, run_on_start=False, jitter=10)
+    @private
+    def expire_sessions(self):
+        self.orchestrator.pool.expire()
+
     @private
     async def item_extend(self, item):
         try:
@@ -255,6 +265,8 @@ class VMWareService(CRUDService):
                 ],
             ]
         qs = self.middleware.call_sync("vmware.query", f)
+        if not qs:
+            return None
 
         # Generate a unique snapshot name that (hopefully) won't collide with anything
         # that exists on the VMWare side.
@@ -269,79 +281,22 @@ class VMWareService(CRUDService):
         # over all the VMWare tasks for a given ZFS filesystem, do all the VMWare snapshotting
         # then take the ZFS snapshot, then iterate again over all the VMWare "tasks" and undo
         # all the snaps we created in the first place.
-        vmsnapobjs = []
-        for vmsnapobj in qs:
-            # Data structures that will be used to keep track of VMs that are snapped,
-            # as wel as VMs we tried to snap and failed, and VMs we realized we couldn't
-            # snapshot.
-            snapvms = []
-            snapvmfails = []
-            snapvmskips = []
-
-            try:
-                ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-                ssl_context.verify_mode = ssl.CERT_NONE
-                si = connect.SmartConnect(host=vmsnapobj["hostname"], user=vmsnapobj["username"],
-                                          pwd=vmsnapobj["password"], sslContext=ssl_context)
-                content = si.RetrieveContent()
-            except Exception as e:
-                self.logger.warn("VMware login to %s failed", vmsnapobj["hostname"], exc_info=True)
-                self._alert_vmware_login_failed(vmsnapobj, e)
-                continue
-
-            # There's no point to even consider VMs that are paused or powered off.
-            vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
-            for vm in vm_view.view:
-                if vm.summary.runtime.powerState != "poweredOn":
-                    continue
-
-                if self._doesVMDependOnDataStore(vm, vmsnapobj.datastore):
-                    try:
-                        if self._canSnapshotVM(vm):
-                            if not self._doesVMSnapshotByNameExists(vm, vmsnapname):
-                                # have we already created a snapshot of the VM for this volume
-                                # iteration? can happen if the VM uses two datasets (a and b)
-                                # where both datasets are mapped to the same ZFS volume in FreeNAS.
-                                VimTask.WaitForTask(vm.CreateSnapshot_Task(
-                                    name=vmsnapname,
-                                    description=vmsnapdescription,
-                                    memory=False, quiesce=False,
-                                ))
-                            else:
-                                self.logger.debug("Not creating snapshot %s for VM %s because it "
-                                                  "already exists", vmsnapname, vm)
-                        else:
-                            # TODO:
-                            # we can try to shutdown the VM, if the user provided us an ok to do
-                            # so (might need a new list property in obj to know which VMs are
-                            # fine to shutdown and a UI to specify such exceptions)
-                            # otherwise can skip VM snap and then make a crash-consistent zfs
-                            # snapshot for this VM
-                            self.logger.info("Can't snapshot VM %s that depends on "
-                                             "datastore %s and filesystem %s. "
-                                             "Possibly using PT devices. Skipping.",
-                                             vm.name, vmsnapobj.datastore, task["dataset"])
-                            snapvmskips.append(vm.config.uuid)
-                    except Exception as e:
-                        self.logger.warning("Snapshot of VM %s failed", vm.name, exc_info=True)
-                        self.middleware.call("alert.oneshot_create", "VMWareSnapshotCreateFailed", {
-                            "hostname": vmsnapobj["hostname"],
-                            "vm": vm.name,
-                            "snapshot": vmsnapname,
-                            "error": str(e),
-                        })
-                        snapvmfails.append([vm.config.uuid, vm.name])
-
-                    snapvms.append(vm.config.uuid)
-
-            connect.Disconnect(si)
-
-            vmsnapobjs.append({
-                "vmsnapobj": vmsnapobj,
-                "snapvms": snapvms,
-                "snapvmfails": snapvmfails,
-                "snapvmskips": snapvmskips,
-            })
+        # Hosts are snapshotted concurrently and we stop waiting for VMs after the deadline so that
+        # the ZFS snapshot is not delayed indefinitely (it is then crash-consistent for these VMs).
+        vmsnapobjs, login_failures = self.orchestrator.begin(qs, vmsnapname, vmsnapdescription)
+
+        for vmsnapobj, e in login_failures:
+            self._alert_vmware_login_failed(vmsnapobj, e)
+
+        for elem in vmsnapobjs:
+            for outcome in elem["outcomes"].values():
+                if outcome["status"] == "FAILED":
+                    self.middleware.call_sync("alert.oneshot_create", "VMWareSnapshotCreateFailed", {
+                        "hostname": elem["vmsnapobj"]["hostname"],
+                        "vm": outcome["name"],
+                        "snapshot": vmsnapname,
+                        "error": outcome["error"],
+                    })
 
         # At this point we've completed snapshotting VMs.
 
@@ -356,108 +311,146 @@ class VMWareService(CRUDService):
         }
 
     @private
-    async def periodic_snapshot_task_end(self, task_id, context):
+    def periodic_snapshot_task_end(self, task_id, context):
         vmsnapname = context["vmsnapname"]
 
-        for elem in context["vmsnapobjs"]:
-            vmsnapobj = elem["vmsnapobj"]
-
-            try:
-                ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-                ssl_context.verify_mode = ssl.CERT_NONE
-                si = connect.SmartConnect(host=vmsnapobj["hostname"], user=vmsnapobj["username"],
-                                          pwd=vmsnapobj["password"], sslContext=ssl_context)
-                self._delete_vmware_login_failed_alert(vmsnapobj)
-            except Exception as e:
-                self.logger.warning("VMware login failed to %s", vmsnapobj["hostname"])
-                self._alert_vmware_login_failed(vmsnapobj, e)
-                continue
+        login_failures, failures = self.orchestrator.end(vmsnapname, context["vmsnapobjs"])
 
-            # vm is an object, so we'll dereference that object anywhere it's user facing.
-            for vm_uuid in elem["snapvms"]:
-                vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True)
-                if not vm:
-                    self.logger.debug("Could not find VM %s", vm_uuid)
-                    continue
-                if [vm_uuid, vm.name] not in elem["snapvmfails"] and vm_uuid not in elem["snapvmskips"]:
-                    # The test above is paranoia.  It shouldn't be possible for a vm to
-                    # be in more than one of the three dictionaries.
-                    snap = self._doesVMSnapshotByNameExists(vm, vmsnapname)
-                    try:
-                        if snap is not False:
-                            VimTask.WaitForTask(snap.RemoveSnapshot_Task(True))
-                    except Exception as e:
-                        self.logger.debug("Exception removing snapshot %s on %s", vmsnapname, vm.name, exc_info=True)
-                        self.middleware.call("alert.oneshot_create", "VMWareSnapshotDeleteFailed", {
-                            "hostname": vmsnapobj["hostname"],
-                            "vm": vm.name,
-                            "snapshot": vmsnapname,
-                            "error": str(e),
-                        })
-
-            connect.Disconnect(si)
+        failed_hostnames = {vmsnapobj["hostname"] for vmsnapobj, e in login_failures}
+        for vmsnapobj, e in login_failures:
+            self._alert_vmware_login_failed(vmsnapobj, e)
+        for hostname in {elem["vmsnapobj"]["hostname"] for elem in context["vmsnapobjs"]} - failed_hostnames:
+            self._delete_vmware_login_failed_alert(hostname)
+
+        for vmsnapobj, vm_name, error in failures:
+            self.middleware.call_sync("alert.oneshot_create", "VMWareSnapshotDeleteFailed", {
+                "hostname": vmsnapobj["hostname"],
+                "vm": vm_name,
+                "snapshot": vmsnapname,
+                "error": error,
+            })
+
+    def _connect(self, vmsnapobj):
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.verify_mode = ssl.CERT_NONE
+        si = connect.SmartConnect(host=vmsnapobj["hostname"], user=vmsnapobj["username"],
+                                  pwd=vmsnapobj["password"], sslContext=ssl_context)
+        return PyVmomiSession(si, self.logger)
+
+    def _alert_vmware_login_failed(self, vmsnapobj, e):
+        if hasattr(e, "msg"):
+            vmlogin_fail = e.msg
+        else:
+            vmlogin_fail = str(e)
+
+        self.middleware.call_sync("alert.oneshot_create", "VMWareLoginFailed", {
+            "hostname": vmsnapobj["hostname"],
+            "error": vmlogin_fail,
+        })
+
+    def _delete_vmware_login_failed_alert(self, hostname):
+        self.middleware.call_sync("alert.oneshot_delete", "VMWareLoginFailed", hostname)
+
+
+class PyVmomiSession(VSphereSession):
+    def __init__(self, si, logger):
+        self.si = si
+        self.logger = logger
+
+    def alive(self):
+        return self.si.content.sessionManager.currentSession is not None
+
+    def disconnect(self):
+        connect.Disconnect(self.si)
+
+    def powered_on_vms(self):
+        content = self.si.RetrieveContent()
+        vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+        try:
+            # There's no point to even consider VMs that are paused or powered off.
+            return [PyVmomiVM(vm, self.logger) for vm in vm_view.view
+                    if vm.summary.runtime.powerState == "poweredOn"]
+        finally:
+            vm_view.Destroy()
+
+    def find_vm(self, uuid):
+        vm = self.si.content.searchIndex.FindByUuid(None, uuid, True)
+        if vm:
+            return PyVmomiVM(vm, self.logger)
+
+
+class PyVmomiVM(VSphereVM):
+    def __init__(self, vm, logger):
+        self.vm = vm
+        self.logger = logger
+        self.uuid = vm.config.uuid
+        self.name = vm.name
 
     # Check if a VM is using a certain datastore
-    def _doesVMDependOnDataStore(self, vm, dataStore):
+    def depends_on_datastore(self, datastore):
         try:
             # simple case, VM config data is on a datastore.
             # not sure how critical it is to snapshot the store that has config data, but best to do so
-            for i in vm.datastore:
-                if i.info.name.startswith(dataStore):
+            for i in self.vm.datastore:
+                if i.info.name.startswith(datastore):
                     return True
             # check if VM has disks on the data store
             # we check both "diskDescriptor" and "diskExtent" types of files
-            for device in vm.config.hardware.device:
+            for device in self.vm.config.hardware.device:
                 if device.backing is None:
                     continue
                 if hasattr(device.backing, 'fileName'):
-                    if device.backing.datastore.info.name == dataStore:
+                    if device.backing.datastore.info.name == datastore:
                         return True
         except Exception:
-            self.logger.debug('Exception in doesVMDependOnDataStore', exc_info=True)
+            self.logger.debug('Exception in depends_on_datastore', exc_info=True)
 
         return False
 
     # check if VMware can snapshot a VM
-    def _canSnapshotVM(self, vm):
+    def can_snapshot(self):
         try:
             # check for PCI pass-through devices
-            for device in vm.config.hardware.device:
+            for device in self.vm.config.hardware.device:
                 if isinstance(device, vim.VirtualPCIPassthrough):
                     return False
             # consider supporting more cases of VMs that can't be snapshoted
             # https://kb.vmware.com/selfservice/microsites/search.do?language=en_US&cmd=displayKC&externalId=1006392
         except Exception:
-            self.logger.debug('Exception in canSnapshotVM', exc_info=True)
+            self.logger.debug('Exception in can_snapshot', exc_info=True)
 
         return True
 
     # check if there is already a snapshot by a given name
-    def _doesVMSnapshotByNameExists(self, vm, snapshotName):
+    def _find_snapshot(self, name):
         try:
-            tree = vm.snapshot.rootSnapshotList
+            tree = self.vm.snapshot.rootSnapshotList
             while tree[0].childSnapshotList is not None:
                 snap = tree[0]
-                if snap.name == snapshotName:
+                if snap.name == name:
                     return snap.snapshot
                 if len(tree[0].childSnapshotList) < 1:
                     break
                 tree = tree[0].childSnapshotList
         except Exception:
-            self.logger.debug('Exception in doesVMSnapshotByNameExists', exc_info=True)
+            self.logger.debug('Exception in _find_snapshot', exc_info=True)
 
-        return False
+        return None
 
-    def _alert_vmware_login_failed(self, vmsnapobj, e):
-        if hasattr(e, "msg"):
-            vmlogin_fail = e.msg
-        else:
-            vmlogin_fail = str(e)
+    def snapshot_exists(self, name):
+        return self._find_snapshot(name) is not None
 
-        self.middleware.call_sync("alert.oneshot_create", "VMWareLoginFailed", {
-            "hostname": vmsnapobj["hostname"],
-            "error": vmlogin_fail,
-        })
+    def create_snapshot(self, name, description):
+        VimTask.WaitForTask(self.vm.CreateSnapshot_Task(
+            name=name,
+            description=description,
+            memory=False, quiesce=False,
+        ))
+
+    def remove_snapshot(self, name):
+        snap = self._find_snapshot(name)
+        if snap is None:
+            return False
 
-    def _delete_vmware_login_failed_alert(self, vmsnapobj):
-        self.middleware.call_sync("alert.oneshot_delete", "VMWareLoginFailed", vmsnapobj["hostname"])
+        VimTask.WaitForTask(snap.RemoveSnapshot_Task(True))
+        return True
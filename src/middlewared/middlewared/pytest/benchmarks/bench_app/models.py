@@ -0,0 +1,20 @@
+from django.db import models
+
+
+class Group(models.Model):
+    name = models.CharField(max_length=120)
+    gid = models.IntegerField()
+    builtin = models.BooleanField(default=False)
+
+
+class User(models.Model):
+    uid = models.IntegerField()
+    username = models.CharField(max_length=16)
+    full_name = models.CharField(max_length=120)
+    builtin = models.BooleanField(default=False)
+    home = models.CharField(max_length=255)
+    shell = models.CharField(max_length=120)
+    email = models.EmailField(null=True)
+    locked = models.BooleanField(default=False)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+    groups = models.ManyToManyField(Group, related_name="members")
@@ -0,0 +1,137 @@
+"""
+Benchmarks of middleware hot paths.
+
+They are not collected along with unit tests, run them with
+
+    pytest --confcutdir=middlewared/pytest/benchmarks middlewared/pytest/benchmarks
+
+Every benchmark time is divided by the time of a fixed pure-python calibration workload so results recorded on
+different machines are comparable. Calibration runs are interleaved with benchmark runs so that both are equally
+affected by changes of machine load. Each time is the best of `BENCHMARK_REPEAT` (10 by default) runs.
+
+Results are compared with `baseline.json`: a benchmark fails when it is more than `BENCHMARK_THRESHOLD` (a fraction,
+0.5 by default) slower than its baseline. Scores of unchanged code typically vary by 10-30% between sessions on a
+busy machine, so only regressions well above that are reported. Run with `BENCHMARK_SAVE=1` to store current results
+as the new baseline; `baseline.json` holds the median of a few such sessions.
+
+Datastore benchmarks need Django and freenasUI (`/usr/local/www`) and are skipped without them.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import timeit
+
+import pytest
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", "0.5"))
+SAVE = os.environ.get("BENCHMARK_SAVE") == "1"
+REPEAT = int(os.environ.get("BENCHMARK_REPEAT", "10"))
+
+results = {}
+
+
+def calibration_workload():
+    data = {f"key{i}": i for i in range(1000)}
+    return sorted((v, k) for k, v in data.items() if v % 3)
+
+
+def measure(*funcs):
+    """
+    Best time (in seconds) of a single call of each of `funcs`. Their runs are interleaved.
+    """
+    timers = [timeit.Timer(func) for func in funcs]
+    numbers = [timer.autorange()[0] for timer in timers]
+    best = [float("inf")] * len(timers)
+    for _ in range(REPEAT):
+        for i, (timer, number) in enumerate(zip(timers, numbers)):
+            best[i] = min(best[i], timer.timeit(number) / number)
+    return best
+
+
+def load_baseline():
+    try:
+        with open(BASELINE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def synthetic_users(count, seed=0):
+    rnd = random.Random(seed)
+    epoch = datetime(2019, 1, 1)
+    return [
+        {
+            "id": i,
+            "uid": 1000 + i,
+            "username": f"user{i}",
+            "full_name": f"User {i}",
+            "builtin": i % 10 == 0,
+            "home": f"/mnt/tank/home/user{i}",
+            "shell": rnd.choice(["/bin/csh", "/bin/sh", "/usr/local/bin/bash", "/usr/sbin/nologin"]),
+            "email": f"user{i}@example.com" if i % 3 else None,
+            "locked": rnd.random() < 0.05,
+            "group": {"id": i % 50, "name": f"group{i % 50}", "gid": 2000 + i % 50},
+            "groups": rnd.sample(range(50), 5),
+            "attributes": {"preferences": {"theme": rnd.choice(["light", "dark"])}, "logins": rnd.randint(0, 1000)},
+            "last_login": epoch + timedelta(seconds=rnd.randint(0, 10 ** 7)),
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.fixture(scope="session")
+def users():
+    return synthetic_users(10000)
+
+
+@pytest.fixture(scope="session")
+def baseline():
+    return load_baseline()
+
+
+@pytest.fixture
+def benchmark(request, baseline):
+    """
+    `benchmark(func)` measures `func` and fails if it is slower than its baseline.
+    """
+    def run(func, name=None):
+        name = name or request.node.name
+        seconds, calibration = measure(func, calibration_workload)
+        score = seconds / calibration
+        results[name] = {"seconds": seconds, "score": score}
+
+        expected = baseline.get(name)
+        if expected is not None and not SAVE:
+            assert score <= expected * (1 + THRESHOLD), (
+                f"{name} is {score / expected - 1:.0%} slower than baseline ({seconds * 1000:.3f} ms, "
+                f"score {score:.2f} > {expected:.2f})"
+            )
+
+        return seconds
+
+    return run
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not results:
+        return
+
+    baseline = load_baseline()
+    terminalreporter.section("benchmarks")
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        change = f"{result['score'] / expected - 1:+.1%}" if expected else "no baseline"
+        terminalreporter.write_line(
+            f"{name:<60} {result['seconds'] * 1000:>10.3f} ms {result['score']:>10.2f} {change:>12}"
+        )
+
+
+def pytest_sessionfinish(session):
+    if SAVE and results:
+        baseline = load_baseline()
+        baseline.update({name: float(f"{result['score']:.4g}") for name, result in results.items()})
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
@@ -0,0 +1,120 @@
+import asyncio
+import random
+import sqlite3
+
+import pytest
+
+from middlewared.plugins.account import GroupService, UserService
+from middlewared.schema import Bool, Dict, List, Schemas, Str, resolve_methods
+from middlewared.utils import filter_list
+
+USERS = 5000
+GROUPS = 50
+
+
+class Middleware:
+    """
+    `datastore.sql` runs on an in-memory sqlite database, `datastore.query` serves already serialized rows and
+    extends them like the datastore plugin.
+    """
+
+    def __init__(self, users, groups):
+        self.tables = {"account.bsdusers": users, "account.bsdgroups": groups}
+        self.services = {}
+
+        rnd = random.Random(0)
+        self.db = sqlite3.connect(":memory:")
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("CREATE TABLE account_bsdusers (id INTEGER PRIMARY KEY, bsdusr_group_id INTEGER)")
+        self.db.execute(
+            "CREATE TABLE account_bsdgroupmembership "
+            "(id INTEGER PRIMARY KEY, bsdgrpmember_group_id INTEGER, bsdgrpmember_user_id INTEGER)"
+        )
+        self.db.executemany("INSERT INTO account_bsdusers VALUES (?, ?)", [(u["id"], u["group"]["id"]) for u in users])
+        self.db.executemany(
+            "INSERT INTO account_bsdgroupmembership (bsdgrpmember_group_id, bsdgrpmember_user_id) VALUES (?, ?)",
+            [(group_id, u["id"]) for u in users for group_id in rnd.sample(range(1, GROUPS + 1), 3)],
+        )
+
+    def method(self, name):
+        service, method = name.rsplit(".", 1)
+        return getattr(self.services[service], method)
+
+    async def call(self, name, *args):
+        if name == "datastore.query":
+            return await self.datastore_query(*args)
+        if name == "datastore.sql":
+            query, params = (args + (None,))[:2]
+            return [dict(row) for row in self.db.execute(query.replace("%s", "?"), params or ())]
+        return await self.method(name)(*args)
+
+    async def datastore_query(self, name, filters=None, options=None):
+        options = options or {}
+        # Rows are filtered and ordered before they are extended
+        rows = filter_list(self.tables[name], filters, {"order_by": options.get("order_by")})
+        if options.get("count"):
+            return len(rows)
+        # Extend functions modify rows
+        rows = [dict(row) for row in rows]
+        if options.get("extend"):
+            context = None
+            if options.get("extend_context"):
+                context = await self.method(options["extend_context"])()
+            rows = [await self.method(options["extend"])(row, context) for row in rows]
+        return filter_list(rows, None, {"select": options.get("select"), "get": options.get("get")})
+
+    async def run_in_thread(self, method, *args, **kwargs):
+        return method(*args, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def middleware(users):
+    users = [
+        {
+            "id": user["id"] + 1, "uid": user["uid"], "username": user["username"], "full_name": user["full_name"],
+            "builtin": user["builtin"], "home": "/nonexistent", "shell": user["shell"], "email": user["email"],
+            "locked": user["locked"], "group": {"id": user["group"]["id"] + 1},
+        }
+        for user in users[:USERS]
+    ]
+    groups = [{"id": i + 1, "gid": 2000 + i, "group": f"group{i}", "builtin": False} for i in range(GROUPS)]
+    middleware = Middleware(users, groups)
+    middleware.services["user"] = UserService(middleware)
+    middleware.services["group"] = GroupService(middleware)
+
+    schemas = Schemas()
+    schemas.add(List("query-filters", default=None, null=True))
+    schemas.add(Dict(
+        "query-options",
+        Str("extend", default=None, null=True),
+        Str("extend_context", default=None, null=True),
+        Str("prefix", default=None, null=True),
+        Dict("extra", additional_attrs=True),
+        List("order_by", default=[]),
+        List("select", default=[]),
+        Bool("count", default=False),
+        Bool("get", default=False),
+        default=None,
+        null=True,
+    ))
+    resolve_methods(schemas, [service.query for service in middleware.services.values()])
+    return middleware
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.mark.parametrize("filters", [
+    [],
+    [["username", "=", "user100"]],
+], ids=["all", "one"])
+def test_user_query(benchmark, middleware, loop, filters):
+    benchmark(lambda: loop.run_until_complete(middleware.services["user"].query(filters, {})))
+
+
+def test_group_query(benchmark, middleware, loop):
+    benchmark(lambda: loop.run_until_complete(middleware.services["group"].query([], {})))
@@ -0,0 +1,16 @@
+import time
+
+from middlewared.utils.call_stats import CallStats, CallTiming, current_call
+
+
+def test_call_stats_overhead(benchmark):
+    stats = CallStats()
+
+    def call():
+        timing = CallTiming()
+        token = current_call.set(timing)
+        current_call.reset(token)
+        stats.record("service.method", "coroutine", time.monotonic() - timing.submitted, None, timing.validation,
+                     False, None)
+
+    benchmark(call)
@@ -0,0 +1,66 @@
+import random
+import sys
+from unittest.mock import Mock
+
+import pytest
+
+django = pytest.importorskip("django")
+sys.path.append("/usr/local/www")
+# `django_modelobj_serialize` checks for custom model fields of freenasUI
+pytest.importorskip("freenasUI")
+
+from django.conf import settings  # noqa
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+        INSTALLED_APPS=["bench_app"],
+    )
+    django.setup()
+
+from django.db import connection  # noqa
+
+from bench_app.models import Group, User  # noqa
+from middlewared.plugins.datastore import DatastoreService  # noqa
+from middlewared.utils import django_modelobj_serialize  # noqa
+
+
+@pytest.fixture(scope="module")
+def datastore(users):
+    with connection.schema_editor() as editor:
+        editor.create_model(Group)
+        editor.create_model(User)
+
+    rnd = random.Random(0)
+    groups = Group.objects.bulk_create([Group(id=i + 1, name=f"group{i}", gid=2000 + i) for i in range(50)])
+    User.objects.bulk_create([
+        User(
+            id=user["id"] + 1, uid=user["uid"], username=user["username"], full_name=user["full_name"],
+            builtin=user["builtin"], home=user["home"], shell=user["shell"], email=user["email"],
+            locked=user["locked"], group=groups[user["group"]["id"]],
+        )
+        for user in users[:5000]
+    ])
+    User.groups.through.objects.bulk_create([
+        User.groups.through(user_id=user_id, group_id=group_id)
+        for user_id in range(1, 5001)
+        for group_id in rnd.sample(range(1, 51), 3)
+    ])
+
+    return DatastoreService(Mock())
+
+
+def test_django_modelobj_serialize(benchmark, datastore):
+    objects = list(User.objects.all()[:500])
+    benchmark(lambda: [django_modelobj_serialize(None, obj) for obj in objects])
+
+
+@pytest.mark.parametrize("filters,options", [
+    ([], {}),
+    ([["uid", ">", 3000], ["builtin", "=", False]], {"order_by": ["-uid"]}),
+    ([["OR", [["group__name", "=", "group1"], ["username", "^", "user99"]]]], {"prefix": None}),
+    ([["username", "=", "user4000"]], {"get": True}),
+    ([["locked", "=", False]], {"count": True}),
+], ids=["all", "and-order-by", "or", "get", "count"])
+def test_datastore_query(benchmark, datastore, filters, options):
+    benchmark(lambda: datastore.query("bench_app.user", filters, options))
@@ -0,0 +1,15 @@
+from middlewared.client import ejson
+
+
+def message(users):
+    return {"msg": "result", "id": "d51da71b-bb48-4b8b-a8f7-6046fcc892b4", "result": users[:1000]}
+
+
+def test_ejson_dumps(benchmark, users):
+    msg = message(users)
+    benchmark(lambda: ejson.dumps(msg))
+
+
+def test_ejson_loads(benchmark, users):
+    data = ejson.dumps(message(users))
+    benchmark(lambda: ejson.loads(data))
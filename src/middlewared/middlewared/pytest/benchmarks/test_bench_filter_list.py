@@ -0,0 +1,17 @@
+import pytest
+
+from middlewared.utils import filter_list
+
+
+@pytest.mark.parametrize("filters,options", [
+    ([["username", "=", "user5000"]], {}),
+    ([["uid", ">", 5000], ["builtin", "=", False]], {}),
+    ([["OR", [["group.name", "=", "group1"], ["uid", "<", 1100], ["username", "^", "user99"]]]], {}),
+    ([["shell", "in", ["/bin/sh", "/bin/csh"]], ["email", "!=", None]], {"order_by": ["-uid"]}),
+    ([["username", "~", "^user[0-9]*5$"]], {}),
+    ([], {"order_by": ["shell", "username"]}),
+    ([["builtin", "=", False]], {"select": ["id", "username", "uid"]}),
+    ([["locked", "=", False]], {"count": True}),
+], ids=["equal", "and", "or", "in-order-by", "regex", "order-by", "select", "count"])
+def test_filter_list(benchmark, users, filters, options):
+    benchmark(lambda: filter_list(users, filters, options))
@@ -0,0 +1,76 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from middlewared.job import Job, JobsDeque, JobsQueue, State
+from middlewared.service import job
+
+
+@job(lock=lambda args: f"lock{args[0] % 10}")
+def method(job, i):
+    pass
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def middleware():
+    middleware = Mock()
+    middleware.dump_args = lambda args, method=None: args
+    return middleware
+
+
+def jobs(middleware, count, state=State.WAITING):
+    result = [Job(middleware, "bench.method", None, method, [i], method._job, None) for i in range(count)]
+    for j in result:
+        j.state = state
+    return result
+
+
+def test_jobs_queue_schedule(benchmark, loop, middleware):
+    async def schedule(queue, jobs):
+        for j in jobs:
+            queue.add(j)
+
+        # Every lock is held by a running job, the rest have to wait for it to finish
+        for j in range(10):
+            running = await queue.__next__()
+            queue.release_lock(running)
+
+    def run():
+        queue = JobsQueue(middleware)
+        loop.run_until_complete(schedule(queue, jobs(middleware, 200)))
+
+    benchmark(run)
+
+
+def test_jobs_deque_evict(benchmark, middleware, loop):
+    finished = jobs(middleware, 2000, State.SUCCESS)
+
+    def run():
+        deque = JobsDeque(maxlen=1000)
+        for j in finished:
+            deque.add(j)
+
+    benchmark(run)
+
+
+def test_jobs_deque_evict_running(benchmark, middleware, loop):
+    # Oldest jobs are still running, every eviction has to skip them
+    running = jobs(middleware, 900, State.RUNNING)
+    finished = jobs(middleware, 1000, State.SUCCESS)
+
+    def run():
+        deque = JobsDeque(maxlen=1000)
+        for j in running + finished:
+            deque.add(j)
+
+    benchmark(run)
@@ -0,0 +1,70 @@
+import copy
+
+import pytest
+
+from middlewared.schema import accepts, Bool, compile_attribute, Dict, Int, List, Str
+
+USER = Dict(
+    "user",
+    Int("id"),
+    Int("uid", required=True),
+    Str("username", required=True),
+    Str("full_name"),
+    Bool("builtin", default=False),
+    Str("home", default="/nonexistent"),
+    Str("shell", enum=["/bin/csh", "/bin/sh", "/usr/local/bin/bash", "/usr/sbin/nologin"]),
+    Str("email", null=True),
+    Bool("locked", default=False),
+    Dict("group", Int("id"), Str("name"), Int("gid")),
+    List("groups", items=[Int("group")]),
+    Dict("attributes", additional_attrs=True),
+    Str("password", private=True),
+    Bool("smb", default=True),
+)
+
+
+@accepts(USER)
+def update(self, data):
+    return data
+
+
+@accepts(List("users", items=[USER]))
+def bulk_update(self, data):
+    return data
+
+
+def without_dates(users):
+    return [{k: v for k, v in user.items() if k != "last_login"} for user in users]
+
+
+def test_accepts_dict(benchmark, users):
+    user = without_dates(users[:1])[0]
+    benchmark(lambda: update(None, user))
+
+
+def test_accepts_list(benchmark, users):
+    data = without_dates(users[:1000])
+    benchmark(lambda: bulk_update(None, data))
+
+
+def compiled(attr):
+    clean, validate = compile_attribute(attr)
+
+    def run(value):
+        value = clean(value)
+        if validate is not None:
+            validate(value)
+
+    return run
+
+
+def interpretive(attr):
+    # How arguments were validated before schemas were compiled
+    return lambda value: attr.validate(attr.clean(copy.deepcopy(value)))
+
+
+@pytest.mark.parametrize("validator", [compiled, interpretive])
+def test_validate_user(benchmark, users, validator):
+    user = without_dates(users[:1])[0]
+    run = validator(USER)
+    benchmark(lambda: run(user))
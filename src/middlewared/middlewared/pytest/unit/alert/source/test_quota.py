@@ -0,0 +1,144 @@
+import json
+import textwrap
+
+from mock import Mock, patch
+
+from middlewared.alert.base import AlertLevel
+from middlewared.alert.source.quota import (
+    evaluate_quotas, parse_userspace, parse_zfs_get, QuotaAlertSource, QuotaExcess
+)
+
+ZFS_GET = textwrap.dedent("""\
+    tank\tquota\t0\t
+    tank\tused\t1000\t
+    tank\trefquota\t0\t
+    tank\tusedbydataset\t100\t
+    tank\tmounted\tyes\t
+    tank\tmountpoint\t/mnt/tank\t
+    tank\torg.freenas:quota_warning\t-\t
+    tank/warning\tquota\t1000\t
+    tank/warning\tused\t850\t
+    tank/warning\trefquota\t0\t
+    tank/warning\tusedbydataset\t850\t
+    tank/warning\tmounted\tyes\t
+    tank/warning\tmountpoint\t/mnt/tank/warning\t
+    tank/critical\tquota\t0\t
+    tank/critical\tused\t990\t
+    tank/critical\trefquota\t1000\t
+    tank/critical\tusedbydataset\t990\t
+    tank/critical\tmounted\tyes\t
+    tank/critical\tmountpoint\tlegacy\t
+    tank/custom\tquota\t1000\t
+    tank/custom\tused\t850\t
+    tank/custom\tmounted\tno\t
+    tank/custom\tmountpoint\t/mnt/tank/custom\t
+    tank/custom\torg.freenas:quota_warning\t90\t
+    tank/custom\torg.freenas:quota_critical\t0\t
+""").replace("\t\n", "\n")
+
+
+def test__parse_zfs_get():
+    datasets = parse_zfs_get(ZFS_GET)
+
+    assert sorted(datasets) == ["tank", "tank/critical", "tank/custom", "tank/warning"]
+    assert datasets["tank/warning"]["quota"] == "1000"
+    assert datasets["tank/critical"]["mountpoint"] == "legacy"
+
+
+def test__parse_zfs_get__skips_malformed_lines():
+    assert parse_zfs_get("tank\tquota\t0\ncannot open 'tank/gone': dataset does not exist\n") == {
+        "tank": {"quota": "0"},
+    }
+
+
+def test__parse_userspace():
+    assert parse_userspace(textwrap.dedent("""\
+        POSIX User\t0\t4096\tnone
+        POSIX User\t1001\t900\t1000
+        POSIX User\t1002\t100\t0
+        POSIX Group\t0\t4096\t-
+        POSIX Group\t1001\t500\t1000
+        SMB User\tS-1-5-21-1\t10\t100
+    """)) == [
+        ("userquota", 1001, 900, 1000),
+        ("groupquota", 1001, 500, 1000),
+    ]
+
+
+def test__evaluate_quotas():
+    datasets = parse_zfs_get(ZFS_GET)
+    userspace = {
+        "tank": [("userquota", 1001, 960, 1000), ("groupquota", 1001, 500, 1000)],
+        "tank/custom": [("userquota", 1002, 850, 1000)],
+    }
+
+    assert evaluate_quotas(datasets, userspace) == [
+        QuotaExcess("tank", "userquota", 1001, 960, 1000, 96.0, AlertLevel.CRITICAL),
+        QuotaExcess("tank/critical", "refquota", None, 990, 1000, 99.0, AlertLevel.CRITICAL),
+        QuotaExcess("tank/warning", "quota", None, 850, 1000, 85.0, AlertLevel.WARNING),
+    ]
+
+
+def test__evaluate_quotas__custom_thresholds():
+    datasets = parse_zfs_get(ZFS_GET)
+    datasets["tank/custom"]["used"] = "950"
+
+    assert evaluate_quotas({"tank/custom": datasets["tank/custom"]}, {}) == [
+        QuotaExcess("tank/custom", "quota", None, 950, 1000, 95.0, AlertLevel.WARNING),
+    ]
+
+
+def test__quota_alert_source__owners_resolved_once():
+    middleware = Mock()
+    middleware.call_sync.side_effect = lambda method, *args: {
+        "datastore.query": [
+            {"bsdusr_uid": 1001, "bsdusr_email": "user@example.com"},
+            {"bsdusr_uid": 1002, "bsdusr_email": ""},
+        ],
+        "mount.query": [{"source": "tank/critical", "dest": "/mnt/legacy", "fstype": "zfs", "options": []}],
+    }[method]
+    source = QuotaAlertSource(middleware)
+
+    def run(args, check=True):
+        if args[1] == "get":
+            return ZFS_GET
+        if args[-1] == "tank":
+            return "POSIX User\t1001\t960\t1000\nPOSIX User\t1002\t960\t1000\n"
+        return ""
+
+    with patch.object(source, "_run", run), \
+            patch("middlewared.alert.source.quota.os.stat", Mock(return_value=Mock(st_uid=1001))) as stat:
+        alerts = source.check_sync()
+
+    assert [call[0][0] for call in middleware.call_sync.call_args_list] == ["datastore.query", "mount.query"]
+    stat.assert_any_call("/mnt/legacy")
+
+    assert [json.loads(alert.key) for alert in alerts] == [
+        ["tank", "userquota", 1001, "CRITICAL"],
+        ["tank", "userquota", 1002, "CRITICAL"],
+        ["tank/critical", "refquota", "CRITICAL"],
+        ["tank/warning", "quota", "WARNING"],
+    ]
+    assert alerts[0].mail["to"] == ["user@example.com"]
+    assert alerts[1].mail is None
+    assert alerts[2].mail["to"] == ["user@example.com"]
+
+
+def test__quota_alert_source__zfs_get_partial_failure():
+    middleware = Mock()
+    middleware.call_sync.side_effect = lambda method, *args: {"datastore.query": [], "mount.query": []}[method]
+    source = QuotaAlertSource(middleware)
+
+    def run(args, **kwargs):
+        if args[1] == "get":
+            return Mock(returncode=1, stdout=ZFS_GET, stderr="cannot open 'tank/gone': dataset does not exist\n")
+        return Mock(returncode=0, stdout="", stderr="")
+
+    with patch("middlewared.alert.source.quota.subprocess.run", run), \
+            patch("middlewared.alert.source.quota.os.stat", Mock(return_value=Mock(st_uid=0))):
+        alerts = source.check_sync()
+
+    assert [json.loads(alert.key) for alert in alerts] == [
+        ["tank/critical", "refquota", "CRITICAL"],
+        ["tank/warning", "quota", "WARNING"],
+    ]
@@ -0,0 +1,195 @@
+import asyncio
+from datetime import datetime
+import http.server
+import threading
+import time
+
+import pytest
+
+from middlewared.alert.base import Alert, AlertLevel
+from middlewared.alert.delivery import AlertDelivery, AlertOutbox, CircuitBreaker
+from middlewared.alert.service.slack import SlackAlertService
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        behavior = self.server.behavior.get(self.path, "ok")
+        if behavior == "delay":
+            time.sleep(self.server.delay)
+        if behavior == "fail":
+            self.send_response(500)
+        else:
+            self.server.received.append((self.path, time.monotonic()))
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.behavior = {}
+    httpd.delay = 0
+    httpd.received = []
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+
+
+class Middleware:
+    async def run_in_thread(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+
+def delivery(tmpdir, stand_in, **kwargs):
+    async def get_alert_service(service_id):
+        if service_id == 404:
+            return None
+        return SlackAlertService(Middleware(), {
+            "url": f"{stand_in.url}/{service_id}", "channel": "", "username": "", "icon_url": "",
+        })
+
+    return AlertDelivery(AlertOutbox(str(tmpdir.join("outbox.db")), backoff=0), get_alert_service, **kwargs)
+
+
+def alert(title="Pool is degraded"):
+    return Alert(title=title, node="A", source="VolumeStatus", datetime=datetime(2019, 1, 1, 12, 30),
+                 level=AlertLevel.CRITICAL)
+
+
+@pytest.mark.asyncio
+async def test__alert_delivery__slow_destination_does_not_delay_others(tmpdir, stand_in):
+    stand_in.behavior["/1"] = "delay"
+    stand_in.delay = 1
+    d = delivery(tmpdir, stand_in)
+    for service_id in (1, 2, 3):
+        await d.enqueue(service_id, [alert()], [], [alert()])
+
+    start = time.monotonic()
+    await d.deliver()
+
+    received = dict(stand_in.received)
+    assert set(received) == {"/1", "/2", "/3"}
+    assert received["/2"] - start < 0.5
+    assert received["/3"] - start < 0.5
+    assert d.status(1)["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test__alert_delivery__retries_in_order(tmpdir, stand_in):
+    stand_in.behavior["/1"] = "fail"
+    d = delivery(tmpdir, stand_in)
+    await d.enqueue(1, [alert("first")], [], [alert("first")])
+    await d.enqueue(1, [alert("second")], [], [alert("second")])
+
+    await d.deliver()
+    status = d.status(1)
+    assert status["queued"] == 2
+    assert "500" in status["last_error"]
+    assert stand_in.received == []
+
+    stand_in.behavior["/1"] = "ok"
+    await d.deliver()
+    assert [path for path, t in stand_in.received] == ["/1", "/1"]
+    assert d.status(1)["queued"] == 0
+    assert d.status(1)["last_success"] is not None
+
+
+@pytest.mark.asyncio
+async def test__alert_delivery__circuit_breaker(tmpdir, stand_in):
+    stand_in.behavior["/1"] = "fail"
+    d = delivery(tmpdir, stand_in, breaker_threshold=2, breaker_cooldown=3600)
+    await d.enqueue(1, [alert()], [], [alert()])
+
+    await d.deliver()
+    await d.deliver()
+    assert d.status(1)["circuit"] == "OPEN"
+
+    stand_in.behavior["/1"] = "ok"
+    await d.deliver()
+    assert stand_in.received == []
+    assert d.status(1)["queued"] == 1
+
+
+@pytest.mark.asyncio
+async def test__alert_delivery__timeout(tmpdir, stand_in):
+    stand_in.behavior["/1"] = "delay"
+    stand_in.delay = 2
+    d = delivery(tmpdir, stand_in, timeout=0.2)
+    await d.enqueue(1, [alert()], [], [alert()])
+
+    await d.deliver()
+    assert d.status(1)["queued"] == 1
+    assert d.status(1)["last_error"] == "TimeoutError()"
+
+
+@pytest.mark.asyncio
+async def test__alert_delivery__persistent_and_deleted_service(tmpdir, stand_in):
+    stand_in.behavior["/1"] = "fail"
+    d = delivery(tmpdir, stand_in)
+    await d.enqueue(1, [alert()], [], [alert()])
+    await d.enqueue(404, [alert()], [], [alert()])
+    await d.deliver()
+    assert d.status(404)["queued"] == 0
+
+    # Queue survives restart
+    stand_in.behavior["/1"] = "ok"
+    await delivery(tmpdir, stand_in).deliver()
+    assert [path for path, t in stand_in.received] == ["/1"]
+
+
+@pytest.mark.asyncio
+async def test__alert_delivery__outbox_not_accessed_from_event_loop(tmpdir, stand_in):
+    loop_thread = threading.current_thread()
+
+    class Outbox(AlertOutbox):
+        def _connect(self):
+            assert threading.current_thread() is not loop_thread
+            return super()._connect()
+
+    outbox = await Middleware().run_in_thread(Outbox, str(tmpdir.join("outbox.db")))
+    d = AlertDelivery(outbox, delivery(tmpdir, stand_in).get_alert_service, run_in_thread=Middleware().run_in_thread)
+    await d.enqueue(1, [alert()], [], [alert()])
+    await d.enqueue(404, [alert()], [], [alert()])
+    await d.deliver()
+
+    assert [path for path, t in stand_in.received] == ["/1"]
+
+
+def test__alert_outbox__roundtrip_and_backoff(tmpdir):
+    outbox = AlertOutbox(str(tmpdir.join("outbox.db")), max_attempts=3, backoff=30)
+    outbox.append(1, [alert()], [alert("gone")], [], now=0)
+
+    id, attempts, next_attempt, (alerts, gone_alerts, new_alerts) = outbox.head(1)
+    assert alerts == [alert()] and gone_alerts == [alert("gone")] and new_alerts == []
+    assert next_attempt == 0
+
+    assert outbox.failed(id, attempts, "error", now=100)
+    assert outbox.head(1)[2] == 130
+    assert outbox.failed(id, 1, "error", now=200)
+    assert outbox.head(1)[2] == 260
+    assert not outbox.failed(id, 2, "error", now=300)
+    assert outbox.head(1) is None
+
+
+def test__circuit_breaker():
+    breaker = CircuitBreaker(threshold=3, cooldown=10)
+    for i in range(2):
+        breaker.failure(now=0)
+    assert breaker.allow(now=0)
+
+    breaker.failure(now=0)
+    assert breaker.state(now=5) == "OPEN"
+    assert breaker.state(now=10) == "HALF_OPEN"
+
+    breaker.failure(now=10)
+    assert breaker.state(now=15) == "OPEN"
+
+    breaker.success()
+    assert breaker.state() == "CLOSED"
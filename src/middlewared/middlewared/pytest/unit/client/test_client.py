@@ -0,0 +1,360 @@
+import asyncio
+import errno
+import itertools
+import threading
+import time
+from unittest.mock import Mock
+
+from aiohttp import web
+import pytest
+
+from middlewared.client import AsyncClient, CallTimeout, Client, ClientException, ValidationErrors
+from middlewared.client import client as client_module
+from middlewared.client import ejson as json
+
+
+class Server:
+    """
+    In-process server speaking middlewared websocket protocol, running in its own thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.connections = {}
+        self.jobs = {}
+        self.job_id = itertools.count(1)
+        self.logins = 0
+        # Does not know about subscriptions to events of a single object
+        self.legacy = False
+        self.runner = None
+        self.url = None
+
+    def start(self):
+        self.thread.start()
+        self.url = self.run(self._start())
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get("/websocket", self.ws_handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return f"ws://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/websocket"
+
+    def stop(self):
+        self.run(self._stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _stop(self):
+        await self.runner.cleanup()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def ws_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscriptions = self.connections[ws] = {}
+        try:
+            async for msg in ws:
+                message = json.loads(msg.data)
+                if message["msg"] == "connect":
+                    await ws.send_str(json.dumps({"msg": "connected", "session": "session"}))
+                elif message["msg"] == "ping":
+                    await ws.send_str(json.dumps({"msg": "pong", "id": message["id"]}))
+                elif message["msg"] == "sub":
+                    subscriptions[message["id"]] = message["name"]
+                    await ws.send_str(json.dumps({"msg": "ready", "subs": [message["id"]]}))
+                elif message["msg"] == "unsub":
+                    subscriptions.pop(message["id"], None)
+                elif message["msg"] == "method":
+                    asyncio.ensure_future(self.call(ws, message))
+        finally:
+            self.connections.pop(ws)
+        return ws
+
+    async def call(self, ws, message):
+        try:
+            result = await getattr(self, message["method"].replace(".", "_"))(*message["params"])
+        except ValueError as e:
+            response = {"error": {"error": errno.EINVAL, "type": "VALIDATION", "reason": str(e),
+                                  "trace": {"formatted": ""}, "extra": [["data.name", str(e), errno.EINVAL]]}}
+        except Exception as e:
+            response = {"error": {"error": errno.EFAULT, "type": None, "reason": str(e),
+                                  "trace": {"formatted": ""}, "extra": None}}
+        else:
+            response = {"result": result}
+        await ws.send_str(json.dumps(dict(response, msg="result", id=message["id"])))
+
+    async def send_event(self, name, event_type, **kwargs):
+        event = dict(kwargs, msg=event_type.lower(), collection=name)
+        for ws, subscriptions in list(self.connections.items()):
+            if any(
+                i in (name, "*") or (not self.legacy and "id" in kwargs and i == f"{name}:{kwargs['id']}")
+                for i in subscriptions.values()
+            ):
+                await ws.send_str(json.dumps(event))
+
+    async def disconnect(self):
+        for ws in list(self.connections):
+            await ws.close()
+
+    async def auth_login(self, username, password):
+        self.logins += 1
+        return password == "secret"
+
+    async def test_sleep(self, delay, value):
+        await asyncio.sleep(delay)
+        return value
+
+    async def test_fail(self, error):
+        raise Exception(error)
+
+    async def test_validate(self, name):
+        raise ValueError(f"Invalid name {name}")
+
+    async def test_job(self, steps, error=None, delay=0.05):
+        job = {"id": next(self.job_id), "state": "RUNNING", "progress": {"percent": 0}, "result": None,
+               "error": None, "exception": None, "exc_info": None}
+        self.jobs[job["id"]] = job
+        asyncio.ensure_future(self.run_job(job, steps, error, delay))
+        if delay == 0:
+            # Finish before the client knows job id
+            await asyncio.sleep(0.1)
+        return job["id"]
+
+    async def run_job(self, job, steps, error, delay):
+        for i in range(steps):
+            await asyncio.sleep(delay)
+            job["progress"] = {"percent": (i + 1) * 100 / steps}
+            await self.send_event("core.get_jobs", "CHANGED", id=job["id"], fields=dict(job))
+
+        if error:
+            job.update(state="FAILED", error=error, exception=f"Exception: {error}")
+        else:
+            job.update(state="SUCCESS", result=steps)
+        await self.send_event("core.get_jobs", "CHANGED", id=job["id"], fields=dict(job))
+
+    async def core_get_jobs(self, filters):
+        return [job for job in self.jobs.values() if job["id"] == filters[0][2]]
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    server.start()
+    yield server
+    server.stop()
+
+
+async def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test__async_client__pipelined_calls(server):
+    async with AsyncClient(server.url) as c:
+        started = time.monotonic()
+        results = await asyncio.gather(*[c.call("test.sleep", 0.5 - i / 100, i) for i in range(50)])
+        assert results == list(range(50))
+        # Calls were in flight at the same time
+        assert time.monotonic() - started < 2
+
+
+@pytest.mark.asyncio
+async def test__async_client__errors(server):
+    async with AsyncClient(server.url) as c:
+        with pytest.raises(ClientException) as e:
+            await c.call("test.fail", "Broken")
+        assert e.value.error == "Broken"
+        assert e.value.errno == errno.EFAULT
+
+        with pytest.raises(ValidationErrors) as e:
+            await c.call("test.validate", "x")
+        assert e.value.errors[0].attribute == "data.name"
+
+        with pytest.raises(CallTimeout):
+            await c.call("test.sleep", 1, None, timeout=0.1)
+
+        assert await c.ping()
+
+
+@pytest.mark.asyncio
+async def test__async_client__subscription_iteration(server):
+    async with AsyncClient(server.url) as c:
+        received = []
+        async with await c.subscribe("test.event") as subscription:
+            for i in range(3):
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+                    server.send_event("test.event", "ADDED", id=i, fields={"value": i}), server.loop
+                ))
+
+            async for event in subscription:
+                received.append(event["fields"]["value"])
+                if len(received) == 3:
+                    break
+
+        assert received == [0, 1, 2]
+        # Iteration stops once unsubscribed
+        assert [event async for event in subscription] == []
+
+
+@pytest.mark.asyncio
+async def test__async_client__job(server):
+    async with AsyncClient(server.url) as c:
+        progress = []
+        results = await asyncio.gather(
+            c.call("test.job", 3, job=True, callback=lambda job: progress.append(job["progress"]["percent"])),
+            c.call("test.job", 5, job=True),
+            # Job finished before it could be subscribed to
+            c.call("test.job", 1, None, 0, job=True),
+        )
+        assert results == [3, 5, 1]
+        assert progress == sorted(progress) and progress[-1] == 100
+
+        with pytest.raises(ClientException) as e:
+            await c.call("test.job", 1, "Job failed", job=True)
+        assert e.value.error == "Job failed"
+        assert e.value.trace == "Exception: Job failed"
+
+        # Job subscriptions are removed once job is finished
+        assert not c._subscriptions
+
+
+@pytest.mark.asyncio
+async def test__async_client__job_without_events(server, monkeypatch):
+    monkeypatch.setattr(client_module, "JOB_POLL_INTERVAL", 0.1)
+    server.legacy = True
+    async with AsyncClient(server.url) as c:
+        assert await asyncio.wait_for(c.call("test.job", 2, job=True), 5) == 2
+
+
+@pytest.mark.asyncio
+async def test__async_client__reconnect(server):
+    async with AsyncClient(server.url, reconnect=True) as c:
+        assert await c.call("auth.login", "root", "secret")
+        subscription = await c.subscribe("test.event")
+
+        pending = asyncio.ensure_future(c.call("test.sleep", 1, None))
+        await asyncio.sleep(0.1)
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(server.disconnect(), server.loop))
+
+        with pytest.raises(ClientException) as e:
+            await pending
+        assert e.value.errno == errno.ECONNRESET
+
+        # New calls wait until the connection is restored
+        assert await c.call("test.sleep", 0, "after") == "after"
+        assert server.logins == 2
+
+        await wait_for(lambda: len(server.connections) == 1 and list(server.connections.values())[0])
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            server.send_event("test.event", "CHANGED", id=1, fields={}), server.loop
+        ))
+        assert (await subscription.__anext__())["msg"] == "changed"
+
+    assert c.closed
+
+
+@pytest.mark.asyncio
+async def test__async_client__no_reconnect(server):
+    async with AsyncClient(server.url) as c:
+        subscription = await c.subscribe("test.event")
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(server.disconnect(), server.loop))
+
+        assert [event async for event in subscription] == []
+        assert c.closed
+        with pytest.raises(ClientException):
+            await c.call("test.sleep", 0, None)
+
+
+@pytest.mark.asyncio
+async def test__async_client__connection_refused():
+    with pytest.raises(OSError):
+        await AsyncClient("ws://127.0.0.1:1/websocket").connect()
+
+
+def test__client(server):
+    with Client(server.url) as c:
+        assert c.call("test.sleep", 0, {"a": 1}) == {"a": 1}
+        assert c.ping()
+
+        progress = []
+        assert c.call("test.job", 2, job=True, callback=lambda job: progress.append(job["progress"]["percent"])) == 2
+        assert progress[-1] == 100
+
+        events = []
+        c.subscribe("test.event", lambda event_type, **message: events.append((event_type, message["id"])))
+        server.run(server.send_event("test.event", "REMOVED", id=7))
+        deadline = time.monotonic() + 10
+        while not events:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert events == [("REMOVED", 7)]
+
+        with pytest.raises(ClientException):
+            c.call("test.fail", "Broken")
+
+
+def test__client__concurrent_threads(server):
+    with Client(server.url) as c:
+        results = {}
+
+        def call(i):
+            results[i] = c.call("test.sleep", 0.3, i)
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(10)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == {i: i for i in range(10)}
+        assert time.monotonic() - started < 2
+
+
+def test__client__called_from_callback(server):
+    with Client(server.url) as c:
+        errors = []
+
+        def callback(event_type, **message):
+            try:
+                c.call("test.sleep", 0, None)
+            except RuntimeError as e:
+                errors.append(e)
+
+        c.subscribe("test.event", callback)
+        server.run(server.send_event("test.event", "ADDED", id=1))
+        deadline = time.monotonic() + 10
+        while not errors:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+
+def test__application__targeted_subscription():
+    main = pytest.importorskip("middlewared.main")
+
+    middleware = Mock()
+    middleware.get_event_source.return_value = None
+    app = main.Application(middleware, asyncio.new_event_loop(), Mock(), Mock())
+    app._send = Mock()
+    app.loop.run_until_complete(app.subscribe("1", "core.get_jobs:2"))
+    app._send.reset_mock()
+
+    app.send_event("core.get_jobs", "CHANGED", id=1, fields={})
+    app._send.assert_not_called()
+
+    app.send_event("core.get_jobs", "CHANGED", id=2, fields={})
+    app._send.assert_called_once_with({"msg": "changed", "collection": "core.get_jobs", "id": 2, "fields": {}})
@@ -0,0 +1,170 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from middlewared.plugins.account import GroupService, UserService
+from middlewared.pytest.unit.middleware import Middleware
+from middlewared.schema import Bool, Dict, List, Schemas, Str, resolve_methods
+from middlewared.utils import filter_list
+
+QUERY_SCHEMAS = [
+    # Registered by `datastore.query`
+    List('query-filters', default=None, null=True),
+    Dict(
+        'query-options',
+        Str('extend', default=None, null=True),
+        Str('extend_context', default=None, null=True),
+        Str('prefix', default=None, null=True),
+        Dict('extra', additional_attrs=True),
+        List('order_by', default=[]),
+        List('select', default=[]),
+        Bool('count', default=False),
+        Bool('get', default=False),
+        default=None,
+        null=True,
+    ),
+]
+
+
+class DatastoreMiddleware(Middleware):
+    """
+    Serves `datastore.query` and `datastore.sql` from in-memory tables, extending rows like the datastore plugin.
+    """
+
+    def __init__(self, users, groups, memberships):
+        super().__init__()
+        self.tables = {'account.bsdusers': users, 'account.bsdgroups': groups}
+        self.memberships = memberships
+        self.services = {}
+        self['datastore.query'] = self.datastore_query
+        self['datastore.sql'] = Mock(side_effect=self.datastore_sql)
+
+    async def datastore_query(self, name, filters=None, options=None):
+        options = options or {}
+        prefix = options.get('prefix') or ''
+        rows = [
+            {k[len(prefix):] if k.startswith(prefix) else k: v for k, v in row.items()}
+            for row in self.tables[name]
+        ]
+        # Rows are filtered and ordered before they are extended
+        rows = filter_list(rows, filters, {'count': options.get('count'), 'order_by': options.get('order_by')})
+        if options.get('count'):
+            return rows
+        if options.get('extend'):
+            context = None
+            if options.get('extend_context'):
+                context = await self.method(options['extend_context'])()
+            rows = [await self.method(options['extend'])(row, context) for row in rows]
+        return filter_list(rows, None, {'select': options.get('select'), 'get': options.get('get')})
+
+    def datastore_sql(self, query, params=None):
+        if 'account_bsdgroupmembership' in query:
+            return [
+                {'id': i + 1, 'bsdgrpmember_group_id': group_id, 'bsdgrpmember_user_id': user_id}
+                for i, (group_id, user_id) in enumerate(self.memberships)
+                if params is None or user_id in params
+            ]
+        return [
+            {'id': row['id'], 'bsdusr_group_id': row['bsdusr_group']['id']} for row in self.tables['account.bsdusers']
+        ]
+
+    def method(self, name):
+        service, method = name.rsplit('.', 1)
+        return getattr(self.services[service], method)
+
+    async def call(self, name, *args):
+        if name in self:
+            result = self[name](*args)
+            return await result if asyncio.iscoroutine(result) else result
+        return await self.method(name)(*args)
+
+    async def run_in_thread(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(None, lambda: method(*args, **kwargs))
+
+
+@pytest.fixture
+def middleware(tmpdir):
+    groups = [{'id': i, 'bsdgrp_gid': 1000 + i, 'bsdgrp_group': f'group{i}'} for i in range(1, 4)]
+    users = [
+        {
+            'id': i,
+            'bsdusr_uid': 1000 + i,
+            'bsdusr_username': f'user{i}',
+            'bsdusr_home': str(tmpdir.join(f'user{i}')),
+            'bsdusr_group': {'id': 1 + i % 3},
+        }
+        for i in range(1, 7)
+    ]
+    tmpdir.join('user1', '.ssh', 'authorized_keys').write('ssh-ed25519 AAAA user1\n', ensure=True)
+    memberships = [(2, 1), (3, 1), (3, 2), (1, 5)]
+
+    middleware = DatastoreMiddleware(users, groups, memberships)
+    middleware.services['user'] = UserService(middleware)
+    middleware.services['group'] = GroupService(middleware)
+
+    schemas = Schemas()
+    for schema in QUERY_SCHEMAS:
+        schemas.add(schema)
+    resolve_methods(schemas, [service.query for service in middleware.services.values()])
+    return middleware
+
+
+def query(middleware, name, filters=None, options=None):
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(middleware.services[name].query(filters, options))
+
+
+def test__user_query__memberships_loaded_once(middleware):
+    users = query(middleware, 'user')
+
+    assert {user['username']: user['groups'] for user in users} == {
+        'user1': [2, 3], 'user2': [3], 'user3': [], 'user4': [], 'user5': [1], 'user6': [],
+    }
+    assert middleware['datastore.sql'].call_count == 1
+
+
+def test__user_query__sshpubkey_only_when_requested(middleware):
+    assert all('sshpubkey' not in user for user in query(middleware, 'user'))
+
+    users = query(middleware, 'user', [('username', 'in', ['user1', 'user2'])], {'extra': {'sshpubkey': True}})
+    assert [user['sshpubkey'] for user in users] == ['ssh-ed25519 AAAA user1\n', None]
+
+    user = query(middleware, 'user', [('id', '=', 1)], {'select': ['username', 'sshpubkey'], 'get': True})
+    assert user == {'username': 'user1', 'sshpubkey': 'ssh-ed25519 AAAA user1\n'}
+
+
+def test__user_query__filters_done_by_datastore(middleware):
+    datastore_query = middleware['datastore.query']
+    middleware['datastore.query'] = Mock(side_effect=datastore_query)
+
+    user = query(middleware, 'user', [('username', '=', 'user1'), ('groups', 'rin', 3)], {'get': True})
+    assert user['username'] == 'user1'
+    assert query(middleware, 'user', [['OR', [('uid', '>', 1004), ('id', '=', 1)]]], {'count': True}) == 3
+    assert [u['id'] for u in query(middleware, 'user', [], {'order_by': ['-uid']})] == [6, 5, 4, 3, 2, 1]
+    assert [u['id'] for u in query(middleware, 'user', [('groups', 'rin', 3)], {'order_by': ['-uid']})] == [2, 1]
+
+    assert [call[0][1:] for call in middleware['datastore.query'].call_args_list] == [
+        ([('username', '=', 'user1')], {'prefix': 'bsdusr_'}),
+        ([['OR', [('uid', '>', 1004), ('id', '=', 1)]]], {'prefix': 'bsdusr_', 'count': True}),
+        ([], {'prefix': 'bsdusr_', 'order_by': ['-uid']}),
+        ([], {'prefix': 'bsdusr_', 'order_by': ['-uid']}),
+    ]
+    # Memberships of the user that was found
+    assert middleware['datastore.sql'].call_args_list[0][0][1] == [1]
+
+
+def test__user_extend__without_context(middleware):
+    user = asyncio.get_event_loop().run_until_complete(middleware.services['user'].user_extend({'id': 1}))
+
+    assert user['groups'] == [2, 3]
+
+
+def test__group_query__members(middleware):
+    groups = query(middleware, 'group')
+
+    # Auxiliary members first, then users having it as primary group
+    assert {group['group']: group['users'] for group in groups} == {
+        'group1': [5, 3, 6], 'group2': [1, 1, 4], 'group3': [1, 2, 2, 5],
+    }
+    assert middleware['datastore.sql'].call_count == 2
@@ -0,0 +1,180 @@
+import random
+
+import pytest
+
+from middlewared.plugins.attachment import AttachmentService
+from middlewared.pytest.unit.middleware import Middleware
+from middlewared.utils.path import PathTrie
+
+POOLS = ['tank', 'tank2', 'data']
+
+
+def random_dataset(rnd):
+    return '/'.join([rnd.choice(POOLS)] + [f'd{rnd.randint(0, 9)}' for i in range(rnd.randint(0, 4))])
+
+
+def populate(rnd, count):
+    return {
+        'sharing.smb.query': [
+            {'id': i, 'path': f'/mnt/{random_dataset(rnd)}'} for i in range(1, count + 1)
+        ],
+        'sharing.nfs.query': [
+            {'id': i, 'paths': [f'/mnt/{random_dataset(rnd)}' for j in range(rnd.randint(1, 3))]}
+            for i in range(1, count + 1)
+        ],
+        'iscsi.extent.query': [
+            {'id': i, 'type': rnd.choice(['DISK', 'FILE']), 'path': f'zvol/{random_dataset(rnd)}/vol{i}'}
+            for i in range(1, count + 1)
+        ],
+        'replication.query': [
+            {'id': i, 'source_datasets': [random_dataset(rnd) for j in range(rnd.randint(1, 3))]}
+            for i in range(1, count + 1)
+        ],
+        'pool.snapshottask.query': [
+            {'id': i, 'dataset': random_dataset(rnd), 'recursive': rnd.choice([True, False])}
+            for i in range(1, count + 1)
+        ],
+    }
+
+
+async def attachment_service(tables):
+    middleware = Middleware()
+    middleware['datastore.version'] = lambda: [1, 1, 1]
+    for name, rows in tables.items():
+        middleware[name] = middleware._query_filter(rows)
+
+    service = AttachmentService(middleware)
+    await service.register_source('smb', 'sharing.smb', lambda share: [share['path']])
+    await service.register_source('nfs', 'sharing.nfs', lambda share: share['paths'])
+    await service.register_source(
+        'iscsi_extents', 'iscsi.extent',
+        lambda extent: [extent['path'][len('zvol/'):]] if extent['path'].startswith('zvol/') else [],
+        [('type', '=', 'DISK')],
+    )
+    await service.register_source('replication', 'replication', lambda task: task['source_datasets'])
+    await service.register_source('snaptask', 'pool.snapshottask', lambda task: [task['dataset']])
+    return middleware, service
+
+
+def brute_force_pool_attachments(tables, pool):
+    """
+    Pool attachments as `pool.attachments` used to compute them.
+    """
+    path = f'/mnt/{pool}'
+    return {
+        'smb': [
+            smb['id'] for smb in tables['sharing.smb.query']
+            if smb['path'] == path or smb['path'].startswith(path + '/')
+        ],
+        'nfs': [
+            nfs['id'] for nfs in tables['sharing.nfs.query']
+            if any(p == path or p.startswith(path + '/') for p in nfs['paths'])
+        ],
+        'iscsi_extents': [
+            extent['id'] for extent in tables['iscsi.extent.query']
+            if extent['type'] == 'DISK' and extent['path'].startswith(f'zvol/{pool}/')
+        ],
+        'replication': [
+            repl['id'] for repl in tables['replication.query']
+            if any(ds == pool or ds.startswith(pool + '/') for ds in repl['source_datasets'])
+        ],
+        'snaptask': [
+            snap['id'] for snap in tables['pool.snapshottask.query']
+            if snap['dataset'] == pool or snap['dataset'].startswith(pool + '/')
+        ],
+    }
+
+
+def brute_force_storage_tasks(tables, path):
+    """
+    Snapshot tasks as `sharing.smb.get_storage_tasks` used to compute them.
+    """
+    result = set()
+    for task in tables['pool.snapshottask.query']:
+        mountpoint = f'/mnt/{task["dataset"]}'
+        if path == mountpoint or (path.startswith(f'{mountpoint}/') and task['recursive']):
+            result.add(task['id'])
+    return result
+
+
+async def storage_tasks(service, tables, path):
+    dataset = path[len('/mnt/'):]
+    tasks = {task['id']: task for task in tables['pool.snapshottask.query']}
+    return {
+        i['id'] for i in await service.attachments_above(dataset)
+        if i['source'] == 'snaptask' and (i['key'] == dataset or tasks[i['id']]['recursive'])
+    }
+
+
+def merge(a, b):
+    return {name: sorted(set(a[name]) | set(b[name])) for name in a}
+
+
+@pytest.mark.asyncio
+async def test__attachment__pool_attachments_match_brute_force():
+    rnd = random.Random(0)
+    tables = populate(rnd, 2000)
+    middleware, service = await attachment_service(tables)
+
+    for pool in POOLS:
+        result = merge(await service.attachments_for(f'/mnt/{pool}'), await service.attachments_for(pool))
+        assert result == brute_force_pool_attachments(tables, pool)
+
+
+@pytest.mark.asyncio
+async def test__attachment__storage_tasks_match_brute_force():
+    rnd = random.Random(1)
+    tables = populate(rnd, 2000)
+    middleware, service = await attachment_service(tables)
+
+    for i in range(200):
+        path = f'/mnt/{random_dataset(rnd)}'
+        assert await storage_tasks(service, tables, path) == brute_force_storage_tasks(tables, path)
+
+
+@pytest.mark.asyncio
+async def test__attachment__reloaded_when_database_changes():
+    tables = {
+        'sharing.smb.query': [{'id': 1, 'path': '/mnt/tank/a'}],
+        'sharing.nfs.query': [],
+        'iscsi.extent.query': [],
+        'replication.query': [],
+        'pool.snapshottask.query': [],
+    }
+    middleware, service = await attachment_service(tables)
+    assert (await service.attachments_for('/mnt/tank'))['smb'] == [1]
+
+    # Written by another process, e.g. the GUI
+    tables['sharing.smb.query'].append({'id': 2, 'path': '/mnt/tank/b'})
+    assert (await service.attachments_for('/mnt/tank'))['smb'] == [1]
+    middleware['datastore.version'] = lambda: [1, 2, 2]
+    assert (await service.attachments_for('/mnt/tank'))['smb'] == [1, 2]
+
+    tables['sharing.smb.query'].pop(0)
+    middleware['datastore.version'] = lambda: [1, 1, 3]
+    assert (await service.attachments_for('/mnt/tank'))['smb'] == [2]
+
+    # Database was modified too recently to tell whether it has changed since
+    tables['sharing.smb.query'][0]['path'] = '/mnt/data/b'
+    middleware['datastore.version'] = lambda: None
+    assert (await service.attachments_for('/mnt/tank'))['smb'] == []
+    assert (await service.attachments_for('/mnt/data'))['smb'] == [2]
+
+
+def test__path_trie():
+    trie = PathTrie()
+    trie.add('/mnt/tank/a', 1)
+    trie.add('/mnt/tank/a/b', 2)
+    trie.add('/mnt/tank2', 3)
+    trie.add('tank/a', 4)
+
+    assert trie.under('/mnt/tank') == {1, 2}
+    assert trie.under('/mnt/tank/') == {1, 2}
+    assert trie.under('/mnt/tank/a/b/c') == set()
+    assert trie.under('tank') == {4}
+    assert sorted(trie.above('/mnt/tank/a/b/c')) == [('/mnt/tank/a', 1), ('/mnt/tank/a/b', 2)]
+
+    trie.remove(2)
+    assert trie.under('/mnt/tank') == {1}
+    trie.remove(1)
+    assert trie.root == {'': {'mnt': {'tank2': {None: {3}}}}, 'tank': {'a': {None: {4}}}}
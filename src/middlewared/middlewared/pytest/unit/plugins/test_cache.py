@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from middlewared.plugins.cache import CacheService
+from middlewared.pytest.unit.middleware import Middleware
+
+CALLERS = 200
+
+
+class ThreadMiddleware(Middleware):
+    async def run_in_thread(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(None, lambda: method(*args, **kwargs))
+
+
+@pytest.fixture
+def cache():
+    return CacheService(ThreadMiddleware())
+
+
+def test__cache__put_get_semantics(cache):
+    cache.put('key', {'value': 1}, 0)
+
+    assert cache.has_key('key')  # noqa: W601
+    assert cache.get('key') == {'value': 1}
+    assert cache.pop('key') == {'value': 1}
+    assert cache.pop('key') is None
+    with pytest.raises(KeyError):
+        cache.get('key')
+
+
+def test__cache__namespaces(cache):
+    cache.put('key', 1, 0, 'a')
+    cache.put('key', 2, 0, 'b')
+
+    assert not cache.has_key('key')  # noqa: W601
+    assert cache.get('key', 'a') == 1
+    cache.clear('a')
+    assert not cache.has_key('key', 'a')  # noqa: W601
+    assert cache.get('key', 'b') == 2
+
+
+@pytest.mark.asyncio
+async def test__get_or_compute__concurrent_misses_compute_once(cache):
+    calls = []
+
+    def compute():
+        calls.append(threading.get_ident())
+        time.sleep(0.1)
+        return {'pools': ['tank']}
+
+    results = await asyncio.gather(*[cache.get_or_compute('key', 60, compute) for i in range(CALLERS)])
+
+    assert results == [{'pools': ['tank']}] * CALLERS
+    assert len(calls) == 1
+    assert cache.get('key') == {'pools': ['tank']}
+
+    stats = cache.stats()
+    assert stats['misses'] == CALLERS
+
+
+@pytest.mark.asyncio
+async def test__get_or_compute__different_keys_in_parallel(cache):
+    running = 0
+    max_running = 0
+
+    async def compute():
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return 'value'
+
+    await asyncio.gather(*[
+        cache.get_or_compute(f'key{i % 10}', 60, compute, 'ns') for i in range(CALLERS)
+    ])
+
+    assert max_running == 10
+    assert cache.stats()['namespaces']['ns']['entries'] == 10
+
+
+@pytest.mark.asyncio
+async def test__get_or_compute__error_is_not_cached(cache):
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        if calls == 1:
+            raise ValueError('failed')
+        return 'value'
+
+    results = await asyncio.gather(*[cache.get_or_compute('key', 60, compute) for i in range(CALLERS)],
+                                   return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not cache.has_key('key')  # noqa: W601
+
+    assert await cache.get_or_compute('key', 60, compute) == 'value'
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test__get_or_compute__cancelled_caller(cache):
+    async def compute():
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    first = asyncio.ensure_future(cache.get_or_compute('key', 60, compute))
+    second = asyncio.ensure_future(cache.get_or_compute('key', 60, compute))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    assert await second == 'value'
+    assert cache.get('key') == 'value'
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import queue
+import sys
+import time
+
+import pytest
+
+from middlewared.logger import BoundedQueueHandler, QueueLogging, RateLimitFilter
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.records = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.records.append(record)
+
+
+@pytest.fixture
+def test_logger():
+    logger = logging.getLogger('middlewared.test_logger')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    yield logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+
+def test__bounded_queue_handler__drops_when_full(test_logger):
+    handler = BoundedQueueHandler(queue.Queue(maxsize=10))
+    test_logger.addHandler(handler)
+
+    for i in range(25):
+        test_logger.info('message %d', i)
+
+    assert handler.queue.qsize() == 10
+    assert handler.dropped == 15
+
+
+def test__bounded_queue_handler__formats_in_caller(test_logger):
+    handler = BoundedQueueHandler(queue.Queue())
+    test_logger.addHandler(handler)
+    args = ['mutable']
+
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        test_logger.error('value %r', args, exc_info=True)
+    args.append('changed')
+
+    record = handler.queue.get_nowait()
+    assert record.getMessage().startswith("value ['mutable']")
+    assert 'ValueError: boom' in record.getMessage()
+    assert record.args is None and record.exc_info is None
+
+
+def test__rate_limit_filter():
+    rate_limit = RateLimitFilter(rate=0, burst=5)
+
+    def record(name, level):
+        return logging.LogRecord(name, level, __file__, 0, 'msg', None, None)
+
+    assert sum(rate_limit.filter(record('a', logging.INFO)) for i in range(20)) == 5
+    assert sum(rate_limit.filter(record('b', logging.INFO)) for i in range(20)) == 5
+    assert all(rate_limit.filter(record('a', logging.ERROR)) for i in range(20))
+    assert rate_limit.suppressed == {'a': 15, 'b': 15}
+
+
+def test__queue_logging__handlers_run_in_listener(test_logger):
+    slow = SlowHandler(0)
+    test_logger.addHandler(slow)
+    pipeline = QueueLogging()
+    pipeline.start(test_logger)
+    try:
+        test_logger.info('hello %s', 'world')
+    finally:
+        pipeline.stop()
+
+    assert test_logger.handlers == [pipeline.handler]
+    assert [r.getMessage() for r in slow.records] == ['hello world']
+    assert pipeline.stats()['dropped'] == 0
+
+
+def _loop_lag(test_logger, count):
+    async def log():
+        for i in range(count):
+            test_logger.info('message %d', i)
+            await asyncio.sleep(0)
+
+    async def measure():
+        lag = 0
+        task = asyncio.ensure_future(log())
+        while not task.done():
+            start = time.monotonic()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.monotonic() - start - 0.001)
+        return lag
+
+    return asyncio.get_event_loop().run_until_complete(measure())
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='timing')
+def test__queue_logging__event_loop_lag(test_logger):
+    """
+    Logging with a slow handler (e.g. file on a busy disk) must not stall the loop.
+    """
+    slow = SlowHandler(0.005)
+    test_logger.addHandler(slow)
+    sync_lag = _loop_lag(test_logger, 50)
+
+    slow.records.clear()
+    pipeline = QueueLogging()
+    pipeline.start(test_logger)
+    try:
+        queue_lag = _loop_lag(test_logger, 50)
+    finally:
+        pipeline.stop()
+
+    assert len(slow.records) == 50
+    assert sync_lag >= 0.005
+    assert queue_lag < sync_lag
@@ -0,0 +1,314 @@
+import copy
+import random
+
+import pytest
+
+from middlewared.schema import (
+    accepts, Any, Bool, compile_attribute, Cron, Dict, Error, Float, Int, IPAddr, List, NOT_PROVIDED, Patch, Path, Ref,
+    resolve_methods, Schemas, Str, Time, UnixPerm,
+)
+from middlewared.service_exception import ValidationErrors
+
+
+def even(value):
+    if value is not None and value % 2:
+        raise ValueError('Value should be even')
+
+
+POOL_CREATE = Dict(
+    'pool_create',
+    Str('name', required=True),
+    Bool('encryption', default=False),
+    Str('deduplication', enum=[None, 'ON', 'VERIFY', 'OFF'], default=None, null=True),
+    Dict(
+        'topology',
+        List('data', items=[
+            Dict(
+                'datavdevs',
+                Str('type', enum=['RAIDZ1', 'RAIDZ2', 'RAIDZ3', 'MIRROR', 'STRIPE'], required=True),
+                List('disks', items=[Str('disk')], required=True),
+            ),
+        ], required=True),
+        List('cache', items=[
+            Dict(
+                'cachevdevs',
+                Str('type', enum=['STRIPE'], required=True),
+                List('disks', items=[Str('disk')], required=True),
+            ),
+        ]),
+        List('log', items=[
+            Dict(
+                'logvdevs',
+                Str('type', enum=['STRIPE', 'MIRROR'], required=True),
+                List('disks', items=[Str('disk')], required=True),
+            ),
+        ]),
+        List('spares', items=[Str('disk')], default=[]),
+        required=True,
+    ),
+    register=True,
+)
+POOL_CREATE_PAYLOAD = {
+    'name': 'tank',
+    'encryption': False,
+    'topology': {
+        'data': [{'type': 'RAIDZ2', 'disks': [f'da{i * 6 + j}' for j in range(6)]} for i in range(4)],
+        'cache': [{'type': 'STRIPE', 'disks': ['nvd0']}],
+        'log': [{'type': 'MIRROR', 'disks': ['nvd1', 'nvd2']}],
+        'spares': ['da24', 'da25'],
+    },
+}
+
+SHARING_SMB_CREATE = Dict(
+    'sharingsmb_create',
+    Str('path', required=True),
+    Bool('home', default=False),
+    Str('name'),
+    Str('comment'),
+    Bool('ro', default=False),
+    Bool('browsable', default=True),
+    Bool('recyclebin', default=False),
+    Bool('showhiddenfiles', default=False),
+    Bool('guestok', default=False),
+    Bool('guestonly', default=False),
+    Bool('abe', default=False),
+    List('hostsallow', default=[]),
+    List('hostsdeny', default=[]),
+    List('vfsobjects', default=['zfs_space', 'zfsacl', 'streams_xattr']),
+    Int('storage_task'),
+    Str('auxsmbconf'),
+    Bool('default_permissions'),
+    register=True
+)
+SHARING_SMB_CREATE_PAYLOAD = {
+    'path': '/mnt/tank/share',
+    'name': 'share',
+    'comment': 'Department share',
+    'hostsallow': ['192.168.0.0/24', '10.0.0.0/8'],
+    'auxsmbconf': 'veto files = /.snap/',
+    'storage_task': 1,
+}
+
+USER_CREATE = Dict(
+    'user_create',
+    Int('uid'),
+    Str('username', required=True),
+    Int('group'),
+    Bool('group_create', default=False),
+    Str('home', default='/nonexistent'),
+    Str('home_mode', default='755'),
+    Str('shell', default='/bin/csh'),
+    Str('full_name', required=True),
+    Str('email'),
+    Str('password'),
+    Bool('password_disabled', default=False),
+    Bool('locked', default=False),
+    Bool('microsoft_account', default=False),
+    Bool('sudo', default=False),
+    Str('sshpubkey', null=True),
+    List('groups', default=[]),
+    Dict('attributes', additional_attrs=True),
+    register=True,
+)
+USER_CREATE_PAYLOAD = {
+    'uid': 1001,
+    'username': 'jdoe',
+    'group_create': True,
+    'home': '/mnt/tank/home/jdoe',
+    'full_name': 'John Doe',
+    'email': 'jdoe@example.com',
+    'password': 'secret',
+    'groups': [41, 42],
+    'attributes': {'preferences': {'theme': 'dark'}},
+}
+
+MISC = Dict(
+    'misc',
+    Any('any'),
+    Path('path'),
+    Time('time'),
+    Float('float'),
+    Float('float_required', required=True, default=1.0),
+    IPAddr('ip', cidr=True),
+    UnixPerm('mode'),
+    Int('even', validators=[even]),
+    Int('choice', enum=[1, 2, 3], null=True),
+    Str('nonempty', empty=False),
+    List('unique', items=[Int('item')], unique=True),
+    List('multi', items=[Str('str'), Int('int')]),
+    List('dicts', items=[Dict('item', Int('id', required=True), Bool('flag', default=True))], unique=True),
+    List('enum', enum=['a', 'b']),
+    Cron('schedule', begin_end=True),
+    Dict('nested', Dict('inner', Int('even', validators=[even]), null=True), additional_attrs=True),
+    Dict('update', Int('x', required=True), Int('y', default=1), update=True),
+)
+MISC_PAYLOAD = {
+    'any': {'a': [1, 2]},
+    'path': '/mnt/tank/',
+    'time': '18:00',
+    'float': '1.5',
+    'ip': '192.168.0.1/24',
+    'mode': '755',
+    'even': 2,
+    'choice': 2,
+    'nonempty': 'x',
+    'unique': [1, '2', 3],
+    'multi': [1, 2],
+    'dicts': [{'id': 1}, {'id': 2}],
+    'enum': ['a'],
+    'schedule': {'minute': '0', 'hour': '*', 'begin': '08:00', 'end': '18:00'},
+    'nested': {'inner': {'even': 4}, 'other': [1]},
+    'update': {'y': 2},
+}
+
+SCHEMAS = [
+    (POOL_CREATE, POOL_CREATE_PAYLOAD),
+    (SHARING_SMB_CREATE, SHARING_SMB_CREATE_PAYLOAD),
+    (USER_CREATE, USER_CREATE_PAYLOAD),
+    (MISC, MISC_PAYLOAD),
+]
+
+FUZZ_VALUES = [None, 0, 1, 2, 7, -1, '', '0', '3', 'abc', '18:00', '25:61', '/mnt//a/', '1.2.3.4', '::1/64',
+               '999', True, False, 1.5, [], [1], [1, 1], ['a', 'b'], [{}], [{'id': 1}, {'id': 1}], {},
+               {'x': 1}, {'minute': '61'}]
+
+
+def interpretive(attr, value):
+    """
+    Validation as it is done by `Attribute.clean` and `Attribute.validate`.
+    """
+    value = attr.clean(value if value is NOT_PROVIDED else copy.deepcopy(value))
+    attr.validate(value)
+    return value
+
+
+def compiled(attr, value):
+    clean, validate = compile_attribute(attr)
+    value = clean(value)
+    if validate is not None:
+        validate(value)
+    return value
+
+
+def outcome(f, attr, value):
+    try:
+        return 'ok', f(attr, value)
+    except ValidationErrors as e:
+        return 'verrors', list(e)
+    except Exception as e:
+        return type(e).__name__, str(e)
+
+
+def mutate(value, rnd):
+    if isinstance(value, dict) and value and rnd.random() < 0.7:
+        value = dict(value)
+        key = rnd.choice(list(value.keys()))
+        action = rnd.random()
+        if action < 0.2:
+            del value[key]
+        elif action < 0.3:
+            value['unexpected'] = rnd.choice(FUZZ_VALUES)
+        else:
+            value[key] = mutate(value[key], rnd)
+        return value
+    if isinstance(value, list) and value and rnd.random() < 0.7:
+        value = list(value)
+        index = rnd.randrange(len(value))
+        value[index] = mutate(value[index], rnd)
+        return value
+    return copy.deepcopy(rnd.choice(FUZZ_VALUES))
+
+
+@pytest.mark.parametrize('attr,payload', SCHEMAS, ids=[attr.name for attr, payload in SCHEMAS])
+def test__compiled__valid_payload(attr, payload):
+    expected = interpretive(attr, payload)
+    original = copy.deepcopy(payload)
+
+    assert compiled(attr, payload) == expected
+    assert payload == original
+
+
+@pytest.mark.parametrize('attr,payload', SCHEMAS, ids=[attr.name for attr, payload in SCHEMAS])
+def test__compiled__fuzzed_equivalence(attr, payload):
+    rnd = random.Random(attr.name)
+    for i in range(2000):
+        value = payload
+        for j in range(rnd.randint(1, 3)):
+            value = mutate(value, rnd)
+        original = copy.deepcopy(value)
+
+        assert outcome(compiled, attr, value) == outcome(interpretive, attr, value), value
+        assert value == original
+
+
+@pytest.mark.parametrize('attr', [attr for attr, payload in SCHEMAS] + list(MISC.attrs.values()))
+def test__compiled__not_provided_and_null(attr):
+    for value in (NOT_PROVIDED, None):
+        assert outcome(compiled, attr, value) == outcome(interpretive, attr, value)
+
+
+def mutable_ids(value):
+    if isinstance(value, dict):
+        return {id(value)}.union(*map(mutable_ids, value.values()))
+    if isinstance(value, (list, set)):
+        return {id(value)}.union(*map(mutable_ids, value))
+    return set()
+
+
+@pytest.mark.parametrize('attr,payload', SCHEMAS, ids=[attr.name for attr, payload in SCHEMAS])
+def test__compiled__values_are_not_shared(attr, payload):
+    assert not mutable_ids(compiled(attr, payload)) & mutable_ids(payload)
+
+
+def test__accepts__nested_values_are_not_shared():
+    @accepts(Dict('data', Dict('attributes', additional_attrs=True), List('tags'), additional_attrs=True), Any('extra'))
+    def update(self, data, extra):
+        data['attributes']['preferences']['theme'] = 'dark'
+        data['tags'][0]['name'] = 'changed'
+        data['other']['x'].append(2)
+        extra['value'].append(2)
+        return data, extra
+
+    resolve_methods(Schemas(), [update])
+
+    data = {'attributes': {'preferences': {'theme': 'light'}}, 'tags': [{'name': 'a'}], 'other': {'x': [1]}}
+    extra = {'value': [1]}
+    original = copy.deepcopy((data, extra))
+    update(None, data, extra)
+
+    assert (data, extra) == original
+
+
+def test__compiled__defaults_are_not_shared():
+    clean, validate = compile_attribute(SHARING_SMB_CREATE)
+    first = clean({'path': '/mnt/tank'})
+    first['vfsobjects'].append('catia')
+
+    assert clean({'path': '/mnt/tank'})['vfsobjects'] == ['zfs_space', 'zfsacl', 'streams_xattr']
+
+
+def test__accepts__resolved_and_arguments_not_modified():
+    schemas = Schemas()
+    schemas.add(USER_CREATE.copy())
+
+    @accepts(Int('id'), Patch('user_create', 'user_update', ('attr', {'update': True})))
+    def update(self, id, data):
+        data.pop('username')
+        return id, data
+
+    @accepts(Ref('user_create'))
+    def create(self, data):
+        return data
+
+    resolve_methods(schemas, [update, create])
+
+    data = {'username': 'jdoe', 'uid': '1001'}
+    assert update(None, '1', data) == (1, {'uid': 1001})
+    assert data == {'username': 'jdoe', 'uid': '1001'}
+
+    with pytest.raises(Error) as e:
+        create(None, {'username': 'jdoe'})
+    assert str(e.value) == '[full_name] attribute required'
+    with pytest.raises(Error) as e:
+        create(None, {'username': 'jdoe', 'full_name': 'John', 'uid': 'x'})
+    assert str(e.value) == '[uid] Not an integer'
@@ -0,0 +1,135 @@
+import asyncio
+import sys
+
+import pytest
+
+from middlewared.shell import ShellWorker
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+class Receiver(object):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.frames = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send(self, text):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            self.frames.append(text)
+        finally:
+            self.in_flight -= 1
+
+    @property
+    def output(self):
+        return ''.join(self.frames)
+
+
+async def run(receiver, cmd, **kwargs):
+    worker = ShellWorker(asyncio.get_event_loop(), receiver.send, cmd, **kwargs)
+    worker.start()
+    return worker, await asyncio.wait_for(worker.wait(), 30)
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__coalesces_large_output():
+    receiver = Receiver()
+
+    worker, returncode = await run(receiver, python(
+        'import sys\n'
+        'for i in range(20000):\n'
+        '    sys.stdout.write("line %06d\\n" % i)\n'
+    ))
+
+    assert returncode == 0
+    lines = receiver.output.split('\r\n')
+    assert lines[:-1] == ['line %06d' % i for i in range(20000)]
+    assert all(len(frame.encode()) <= worker.frame_size for frame in receiver.frames)
+    # ~240KB of output must not turn into one websocket message per pty read
+    assert len(receiver.frames) < 100
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__frame_size_limit():
+    receiver = Receiver()
+
+    worker, returncode = await run(receiver, python('print("x" * 100000)'), frame_size=4096)
+
+    assert receiver.output.strip() == 'x' * 100000
+    assert all(len(frame) <= 4096 for frame in receiver.frames)
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__backpressure():
+    receiver = Receiver(delay=0.05)
+
+    worker, returncode = await run(receiver, python('print("y" * 500000)'), frame_size=16384)
+
+    assert receiver.output.strip() == 'y' * 500000
+    # Reading is paused while a frame is being sent
+    assert receiver.max_in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__paused_while_sending():
+    release = asyncio.Event()
+    sends = []
+
+    async def send(text):
+        sends.append(text)
+        await release.wait()
+
+    worker = ShellWorker(asyncio.get_event_loop(), send, python('print("z" * 1000000)'), frame_size=4096)
+    worker.start()
+    await asyncio.sleep(0.5)
+
+    assert len(sends) == 1
+    assert not worker._reading
+    assert len(worker._buffer) < 4096 * 2
+
+    release.set()
+    await asyncio.wait_for(worker.wait(), 30)
+    assert ''.join(sends).strip() == 'z' * 1000000
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__split_utf8():
+    receiver = Receiver()
+
+    await run(receiver, python('import sys; sys.stdout.buffer.write("ção".encode() * 1000)'), frame_size=7)
+
+    assert receiver.output == 'ção' * 1000
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__input_and_resize():
+    receiver = Receiver()
+    worker = ShellWorker(asyncio.get_event_loop(), receiver.send, python(
+        'import os, sys\n'
+        'sys.stdin.readline()\n'
+        'print("size", *os.get_terminal_size())\n'
+    ))
+    worker.start()
+    worker.resize(132, 43)
+    worker.write(b'go\n')
+
+    assert await asyncio.wait_for(worker.wait(), 30) == 0
+    assert 'size 132 43' in receiver.output
+
+
+@pytest.mark.asyncio
+async def test__shell_worker__send_failure_drains_output():
+    async def send(text):
+        raise ConnectionResetError()
+
+    worker = ShellWorker(asyncio.get_event_loop(), send, python('print("w" * 1000000)'), frame_size=4096)
+    worker.start()
+
+    assert await asyncio.wait_for(worker.wait(), 30) == 0
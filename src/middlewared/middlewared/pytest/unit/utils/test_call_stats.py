@@ -0,0 +1,98 @@
+import concurrent.futures
+import random
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from middlewared.schema import accepts, Dict, Int, Str
+from middlewared.utils.call_stats import (
+    CallStats, CallTiming, current_call, LatencyHistogram, timed, timed_in_process,
+)
+
+
+def test__histogram__buckets_are_contiguous():
+    previous = -1
+    for index in range(LatencyHistogram.index(10 ** 10)):
+        lowest, highest = LatencyHistogram.bounds(index)
+        assert lowest == previous + 1
+        assert LatencyHistogram.index(lowest) == index
+        assert LatencyHistogram.index(highest) == index
+        # Relative error is bound by sub-bucket count
+        assert highest - lowest <= max(lowest / LatencyHistogram.SUB_BUCKETS, 0)
+        previous = highest
+
+
+def test__histogram__percentiles():
+    rnd = random.Random(0)
+    values = sorted(rnd.uniform(0.0001, 2) for i in range(10000))
+    histogram = LatencyHistogram()
+    for value in rnd.sample(values, len(values)):
+        histogram.record(value)
+
+    for percentile in (50, 90, 99, 99.9):
+        exact = values[int(len(values) * percentile / 100) - 1]
+        assert histogram.percentile(percentile) == pytest.approx(exact, rel=1 / 16)
+
+    summary = histogram.summary()
+    assert summary["count"] == 10000
+    assert summary["min"] == values[0]
+    assert summary["max"] == values[-1]
+    assert summary["p999"] <= values[-1]
+
+
+def test__histogram__empty():
+    assert LatencyHistogram().summary() == {"count": 0, "total": 0.0, "mean": None, "min": None, "max": None,
+                                            "p50": None, "p90": None, "p99": None, "p999": None}
+
+
+def test__call_stats__record():
+    stats = CallStats(slow_calls=2, slow_threshold=1)
+    arguments = Mock(return_value=["********"])
+    stats.record("pool.query", "conn_thread_pool", 0.001, 0.0005, 0.0001, arguments=arguments)
+    stats.record("pool.query", "io_thread", 0.002, 0.0001, error=True, arguments=arguments)
+    arguments.assert_not_called()
+
+    result = stats.get()["methods"]["pool.query"]
+    assert result["count"] == 2
+    assert result["errors"] == 1
+    assert result["paths"] == {"conn_thread_pool": 1, "io_thread": 1}
+    assert result["queue_wait"]["count"] == 2
+    assert result["validation"]["count"] == 1
+    assert result["latency"]["max"] == 0.002
+
+
+def test__call_stats__slow_calls_ring_buffer():
+    stats = CallStats(slow_calls=2, slow_threshold=1)
+    for i, duration in enumerate([3, 1, 2]):
+        stats.record("disk.query", "coroutine", duration, arguments=lambda: [i])
+    stats.record("disk.query", "coroutine", 5, arguments=Mock(side_effect=ValueError()))
+
+    slow = stats.get()["slow_calls"]
+    assert [(call["duration"], call["arguments"]) for call in slow] == [(5, None), (2, [2])]
+
+    stats.reset()
+    assert stats.get()["methods"] == {}
+    assert stats.get()["slow_calls"] == []
+
+
+def test__timed__validation_accounted():
+    @accepts(Dict("data", Str("name"), Int("size")))
+    def method(self, data):
+        return data
+
+    timing = CallTiming()
+    assert timed(timing, method, None, {"size": "1"}) == {"size": 1}
+    assert timing.started >= timing.submitted
+    assert timing.validation > 0
+    assert current_call.get() is None
+
+
+def test__timed_in_process():
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        submitted = time.monotonic()
+        started, validation, result = executor.submit(timed_in_process, sum, [1, 2]).result()
+
+    assert result == 3
+    assert submitted <= started <= time.monotonic()
+    assert validation == 0
@@ -0,0 +1,164 @@
+import random
+
+from OpenSSL import crypto
+import pytest
+
+from middlewared.utils.certificates import (
+    CATree, CERTIFICATE_CACHE, certificate_info, csr_info, normalize_private_key, signedby_id
+)
+
+KEY = crypto.PKey()
+KEY.generate_key(crypto.TYPE_RSA, 1024)
+
+
+def make_certificate(cn, serial, issuer=None):
+    cert = crypto.X509()
+    cert.get_subject().C = 'US'
+    cert.get_subject().CN = cn
+    cert.set_serial_number(serial)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(86400)
+    cert.set_issuer(issuer.get_subject() if issuer else cert.get_subject())
+    cert.set_version(2)
+    cert.set_pubkey(KEY)
+    cert.sign(KEY, 'sha256')
+    return cert
+
+
+@pytest.fixture(scope='module')
+def hierarchy():
+    """
+    Two root CAs, each with intermediate CAs four levels deep and hundreds of leaf certificates.
+    """
+    rnd = random.Random(0)
+    cas = []
+    certs = []
+    objs = {}
+    serial = 1
+    for root in range(2):
+        level = [None]
+        for depth in range(5):
+            next_level = []
+            for parent in level:
+                for i in range(1 if depth == 0 else 2):
+                    id = len(cas) + 1
+                    obj = make_certificate(f'ca{id}', serial, objs.get(parent))
+                    objs[id] = obj
+                    cas.append({
+                        'id': id,
+                        'serial': serial if rnd.random() > 0.1 else None,
+                        'signedby': {'id': parent} if parent else None,
+                        'certificate': crypto.dump_certificate(crypto.FILETYPE_PEM, obj).decode(),
+                    })
+                    serial += rnd.randint(1, 3)
+                    next_level.append(id)
+            level = next_level
+
+    for id in range(1, 401):
+        ca = rnd.choice(cas)
+        certs.append({
+            'id': id,
+            'serial': serial if rnd.random() > 0.1 else None,
+            'signedby': {'id': ca['id']},
+        })
+        serial += rnd.randint(1, 3)
+
+    return cas, certs
+
+
+def brute_force_serial(cas, certs, ca_id):
+    """
+    Serial as `certificateauthority.get_serial_for_certificate` used to compute it with a query per CA.
+    """
+    by_id = {ca['id']: ca for ca in cas}
+    ca = by_id[ca_id]
+    if ca['signedby']:
+        return brute_force_serial(cas, certs, ca['signedby']['id'])
+
+    def cert_serials(ca_id):
+        return [cert['serial'] for cert in certs if cert['signedby']['id'] == ca_id]
+
+    def child_serials(ca_id):
+        serials = []
+        for child in [ca for ca in cas if ca['signedby'] and ca['signedby']['id'] == ca_id]:
+            serials.extend(child_serials(child['id']))
+        serials.extend(cert_serials(ca_id))
+        serials.append(by_id[ca_id]['serial'])
+        return serials
+
+    serials = list(filter(None, cert_serials(ca_id) + child_serials(ca_id)))
+    if not serials:
+        return int(ca['serial'] or 0) + 1
+    return max(serials) + 1
+
+
+def test__ca_tree__next_serial(hierarchy):
+    cas, certs = hierarchy
+    tree = CATree(cas, certs)
+
+    for ca in cas:
+        assert tree.next_serial(ca['id']) == brute_force_serial(cas, certs, ca['id'])
+
+
+def test__ca_tree__chain(hierarchy):
+    cas, certs = hierarchy
+    tree = CATree(cas, certs)
+    by_id = {ca['id']: ca for ca in cas}
+
+    for ca in cas:
+        chain = tree.chain(ca['id'])
+        assert len(chain) <= 5
+        assert by_id[chain[-1]]['signedby'] is None
+        for child, parent in zip(chain, chain[1:]):
+            assert signedby_id(by_id[child]) == parent
+
+    root = tree.root(cas[-1]['id'])
+    assert len(tree.subtree(root)) == 1 + 2 + 4 + 8 + 16
+
+
+def test__ca_tree__circular():
+    tree = CATree([
+        {'id': 1, 'serial': 1, 'signedby': 2},
+        {'id': 2, 'serial': 5, 'signedby': 1},
+    ])
+
+    assert tree.chain(1) == [1, 2]
+    assert tree.next_serial(1) == 6
+
+
+def test__ca_tree__empty_serials():
+    tree = CATree([{'id': 1, 'serial': None, 'signedby': None}], [{'id': 1, 'serial': None, 'signedby': 1}])
+
+    assert tree.next_serial(1) == 1
+
+
+def test__certificate_info__cached(hierarchy):
+    cas, certs = hierarchy
+    CERTIFICATE_CACHE.clear()
+    misses = CERTIFICATE_CACHE.misses
+
+    for i in range(3):
+        infos = [certificate_info(ca['certificate']) for ca in cas]
+
+    assert CERTIFICATE_CACHE.misses - misses == len(cas)
+    assert infos[0]['DN'] == '/C=US/CN=ca1'
+    assert infos[0]['pem'] == cas[0]['certificate']
+    assert infos[0]['from'] and infos[0]['until']
+
+
+def test__certificate_info__invalid():
+    assert certificate_info('garbage') is None
+    assert csr_info('garbage') is None
+    assert normalize_private_key('garbage') is None
+
+
+def test__csr_info_and_private_key():
+    req = crypto.X509Req()
+    req.get_subject().CN = 'example.com'
+    req.set_pubkey(KEY)
+    req.sign(KEY, 'sha256')
+    pem = crypto.dump_certificate_request(crypto.FILETYPE_PEM, req).decode()
+
+    assert csr_info(pem) == {'pem': pem, 'DN': '/CN=example.com'}
+    key = crypto.dump_privatekey(crypto.FILETYPE_PEM, KEY).decode()
+    assert normalize_private_key(key) == key
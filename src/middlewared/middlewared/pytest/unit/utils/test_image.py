@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+
+from middlewared.utils.image import BLOCK_SIZE, ImageFetchError, fetch_image
+
+RAW = b'boot' * 1000 + bytes(BLOCK_SIZE * 8) + b'data' * 50000 + bytes(BLOCK_SIZE * 3)
+IMAGE = gzip.compress(RAW)
+SHA256 = hashlib.sha256(IMAGE).hexdigest()
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    served = []
+    ranges = True
+    fail_after = None
+
+    def do_GET(self):
+        start = 0
+        m = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if m and self.ranges:
+            start = int(m.group(1))
+            if start >= len(IMAGE):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(IMAGE) - 1}/{len(IMAGE)}')
+        else:
+            self.send_response(200)
+        body = IMAGE[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.fail_after is not None:
+            body = body[:self.fail_after]
+        self.served.append(len(body))
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.served = []
+    RangeHandler.ranges = True
+    RangeHandler.fail_after = None
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), RangeHandler)
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/image.img.gz'
+    httpd.shutdown()
+
+
+def test__fetch_image__http(server, tmpdir):
+    progress = []
+    dest = str(tmpdir.join('image.img'))
+
+    fetch_image(server, str(tmpdir.join('image.img.gz')), dest, SHA256, lambda r, t: progress.append((r, t)))
+
+    with open(dest, 'rb') as f:
+        assert f.read() == RAW
+    assert progress[-1] == (len(IMAGE), len(IMAGE))
+    assert RangeHandler.served == [len(IMAGE)]
+
+
+def test__fetch_image__sparse(server, tmpdir):
+    dest = str(tmpdir.join('image.img'))
+
+    fetch_image(server, str(tmpdir.join('image.img.gz')), dest, SHA256)
+
+    assert os.stat(dest).st_size == len(RAW)
+    assert os.stat(dest).st_blocks * 512 < len(RAW)
+
+
+def test__fetch_image__resume(server, tmpdir):
+    cache = str(tmpdir.join('image.img.gz'))
+    with open(cache, 'wb') as f:
+        f.write(IMAGE[:len(IMAGE) // 2])
+
+    fetch_image(server, cache, str(tmpdir.join('image.img')), SHA256)
+
+    assert RangeHandler.served == [len(IMAGE) - len(IMAGE) // 2]
+    with open(cache, 'rb') as f:
+        assert f.read() == IMAGE
+
+
+def test__fetch_image__resume_after_interrupted_download(server, tmpdir):
+    cache = str(tmpdir.join('image.img.gz'))
+    dest = str(tmpdir.join('image.img'))
+    RangeHandler.fail_after = len(IMAGE) // 3
+
+    with pytest.raises(Exception):
+        fetch_image(server, cache, dest, SHA256)
+    assert not os.path.exists(dest)
+    assert os.stat(cache).st_size == len(IMAGE) // 3
+
+    RangeHandler.fail_after = None
+    fetch_image(server, cache, dest, SHA256)
+
+    assert RangeHandler.served == [len(IMAGE) // 3, len(IMAGE) - len(IMAGE) // 3]
+    with open(dest, 'rb') as f:
+        assert f.read() == RAW
+
+
+def test__fetch_image__no_range_support(server, tmpdir):
+    cache = str(tmpdir.join('image.img.gz'))
+    with open(cache, 'wb') as f:
+        f.write(IMAGE[:100])
+    RangeHandler.ranges = False
+
+    fetch_image(server, cache, str(tmpdir.join('image.img')), SHA256)
+
+    with open(cache, 'rb') as f:
+        assert f.read() == IMAGE
+
+
+def test__fetch_image__cached(server, tmpdir):
+    cache = str(tmpdir.join('image.img.gz'))
+    with open(cache, 'wb') as f:
+        f.write(IMAGE)
+
+    fetch_image(server, cache, str(tmpdir.join('image.img')), SHA256)
+
+    assert RangeHandler.served == []
+
+
+def test__fetch_image__file_url(tmpdir):
+    source = tmpdir.join('source.img.gz')
+    source.write_binary(IMAGE)
+    dest = str(tmpdir.join('image.img'))
+
+    fetch_image(f'file://{source}', str(tmpdir.join('image.img.gz')), dest, SHA256)
+
+    with open(dest, 'rb') as f:
+        assert f.read() == RAW
+
+
+def test__fetch_image__checksum_mismatch(server, tmpdir):
+    cache = str(tmpdir.join('image.img.gz'))
+    dest = str(tmpdir.join('image.img'))
+
+    with pytest.raises(ImageFetchError):
+        fetch_image(server, cache, dest, '0' * 64)
+
+    assert not os.path.exists(cache)
+    assert not os.path.exists(dest)
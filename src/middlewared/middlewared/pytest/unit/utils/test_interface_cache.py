@@ -0,0 +1,211 @@
+import errno
+import socket
+import struct
+import threading
+
+import pytest
+
+from middlewared.utils.interface_cache import (
+    InterfaceStateCache, NetlinkWatcher, parse_netlink_messages, parse_routing_messages,
+)
+
+LO = socket.if_indextoname(1)
+MISSING_INDEX = 65535
+
+
+def netlink_message(type, payload):
+    return struct.pack("=IHHII", 16 + len(payload), type, 0, 0, 0) + payload + b"\0" * (-len(payload) % 4)
+
+
+def newlink(name, index=MISSING_INDEX):
+    name = name.encode() + b"\0"
+    attr = struct.pack("=HH", 4 + len(name), 3) + name + b"\0" * (-len(name) % 4)
+    return netlink_message(16, struct.pack("=BxHiII", 0, 1, index, 0, 0) + attr)
+
+
+def newaddr(index):
+    return netlink_message(20, struct.pack("=BBBBI", socket.AF_INET, 8, 0, 0, index))
+
+
+def ifannounce(name, index=MISSING_INDEX):
+    return struct.pack("=HBBH16sH", 24, 5, 0x11, index, name.encode(), 1)
+
+
+def ifinfo(index):
+    return struct.pack("=HBBiiH", 16, 5, 0xe, 0, 0, index)
+
+
+def test__parse_netlink_messages():
+    assert parse_netlink_messages(newlink("vlan5") + newaddr(1) + netlink_message(3, b"")) == {"vlan5", LO}
+    assert parse_netlink_messages(netlink_message(3, b"")) == set()
+
+
+@pytest.mark.parametrize("data", [
+    # Address of an interface that is already gone
+    newaddr(MISSING_INDEX),
+    # Messages were lost
+    newlink("vlan5") + netlink_message(4, b""),
+])
+def test__parse_netlink_messages__unknown_changes(data):
+    assert parse_netlink_messages(data) is None
+
+
+def test__parse_routing_messages():
+    assert parse_routing_messages(ifannounce("lagg0") + ifinfo(1)) == {"lagg0", LO}
+    assert parse_routing_messages(ifinfo(MISSING_INDEX)) is None
+
+
+class System:
+    def __init__(self, states):
+        self.states = states
+        self.listed = 0
+        self.fetched = []
+
+    def list_states(self):
+        self.listed += 1
+        return {name: dict(state) for name, state in self.states.items()}
+
+    def get_state(self, name):
+        self.fetched.append(name)
+        state = self.states.get(name)
+        return dict(state) if state is not None else None
+
+
+@pytest.fixture
+def system():
+    return System({"em0": {"name": "em0", "mtu": 1500}, "em1": {"name": "em1", "mtu": 1500}})
+
+
+def test__interface_state_cache__incremental_updates(system):
+    cache = InterfaceStateCache(system.list_states, system.get_state)
+    # As if a watcher was running
+    cache.thread = threading.current_thread()
+    cache.refresh()
+    states, generation = cache.get()
+
+    system.states["em0"]["mtu"] = 9000
+    cache.refresh({"em0"})
+    assert cache.get() == ({"em0": {"name": "em0", "mtu": 9000}, "em1": {"name": "em1", "mtu": 1500}}, generation + 1)
+
+    # Event that did not change anything
+    cache.refresh({"em1"})
+    assert cache.get_generation() == generation + 1
+
+    del system.states["em1"]
+    system.states["vlan5"] = {"name": "vlan5", "mtu": 1500}
+    cache.refresh({"em1", "vlan5"})
+    assert sorted(cache.get()[0]) == ["em0", "vlan5"]
+    assert cache.get_generation() == generation + 2
+
+    assert system.listed == 1
+    assert sorted(system.fetched) == ["em0", "em1", "em1", "vlan5"]
+
+
+def test__interface_state_cache__without_watcher(system):
+    cache = InterfaceStateCache(system.list_states, system.get_state)
+
+    generation = cache.get_generation()
+    assert cache.get_generation() == generation
+    system.states["em0"]["mtu"] = 9000
+    assert cache.get_generation() == generation + 1
+    assert system.listed == 3
+
+
+def test__interface_state_cache__returns_copies(system):
+    cache = InterfaceStateCache(system.list_states, system.get_state)
+
+    cache.get()[0]["em0"]["mtu"] = 9000
+    assert cache.get()[0]["em0"]["mtu"] == 1500
+
+
+class Reader(socket.socket):
+    def __init__(self, sock):
+        super().__init__(fileno=sock.detach())
+        self.errors = []
+
+    def recv(self, *args):
+        if self.errors:
+            super().recv(*args)
+            raise self.errors.pop()
+        return super().recv(*args)
+
+
+@pytest.fixture
+def watched(system):
+    reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    reader = Reader(reader)
+    updated = threading.Condition()
+
+    class Cache(InterfaceStateCache):
+        def refresh(self, names=None):
+            super().refresh(names)
+            with updated:
+                updated.notify_all()
+
+    cache = Cache(system.list_states, system.get_state)
+    cache.get()
+    cache.start(NetlinkWatcher(reader))
+
+    def send(data):
+        with updated:
+            writer.send(data)
+            assert updated.wait(5)
+
+    # Initial reload once the watcher is running
+    send(b"")
+
+    yield cache, reader, writer, send
+
+    cache.stop()
+    writer.close()
+
+
+def test__interface_state_cache__watcher(system, watched):
+    cache, reader, writer, send = watched
+    listed = system.listed
+
+    system.states["em0"]["mtu"] = 9000
+    system.states["vlan5"] = {"name": "vlan5", "mtu": 1500}
+    generation = cache.get_generation()
+    send(newlink("em0") + newlink("vlan5"))
+
+    assert cache.get_generation() == generation + 1
+    assert cache.get()[0]["vlan5"] == {"name": "vlan5", "mtu": 1500}
+    assert system.listed == listed
+    assert cache.stats()["watching"]
+
+
+def test__interface_state_cache__watcher_lost_messages(system, watched):
+    cache, reader, writer, send = watched
+    listed = system.listed
+
+    system.states["em2"] = {"name": "em2", "mtu": 1500}
+    reader.errors.append(OSError(errno.ENOBUFS, "No buffer space available"))
+    send(newlink("em0"))
+
+    # Everything is reloaded
+    assert system.listed == listed + 1
+    assert "em2" in cache.get()[0]
+
+
+def test__interface_state_cache__watcher_failure(system, watched):
+    cache, reader, writer, send = watched
+
+    thread = cache.thread
+    reader.errors.append(OSError(errno.EBADF, "Bad file descriptor"))
+    writer.send(newlink("em0"))
+    thread.join(5)
+
+    # States are no longer trusted
+    assert not cache.stats()["watching"]
+    system.states["em0"]["mtu"] = 9000
+    assert cache.get()[0]["em0"]["mtu"] == 9000
+
+
+def test__netlink_watcher():
+    try:
+        watcher = NetlinkWatcher()
+    except (AttributeError, OSError):
+        pytest.skip("rtnetlink is not available")
+
+    watcher.close()
@@ -0,0 +1,256 @@
+import asyncio
+import os
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from middlewared.job import Job, JobLogFollowEventSource, JobsQueue
+from middlewared.service import job
+from middlewared.utils.job_logs import JobLogStore
+
+
+def old_logs_excerpt(path):
+    head = []
+    tail = []
+    lines = 0
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if len(head) < 5:
+                head.append(line)
+
+            tail.append(line)
+            tail = tail[-5:]
+
+            lines += 1
+
+    if lines > 10:
+        return "%s[%d more lines]\n%s" % ("".join(head), lines - 10, "".join(tail))
+    else:
+        return "".join(head + tail)
+
+
+def lines(start, stop):
+    return b"".join(b"line %08d\n" % i for i in range(start, stop))
+
+
+@pytest.fixture
+def store(tmpdir):
+    return JobLogStore(str(tmpdir), max_size=64 * 1024, tail_size=16 * 1024, max_total_size=1024 * 1024)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"single line",
+    b"\xd0\xbf\xd1\x80\xd0\xb8\xd0\xb2\xd0\xb5\xd1\x82\nwithout trailing newline",
+    lines(0, 10),
+    lines(0, 11),
+    lines(0, 1000),
+])
+def test__job_log__small(store, data):
+    log = store.open(1)
+    for i in range(0, len(data), 7):
+        log.write(data[i:i + 7])
+    log.close()
+
+    with open(log.path, "rb") as f:
+        assert f.read() == data
+    if data.count(b"\n") >= 10:
+        assert log.excerpt == old_logs_excerpt(log.path)
+    else:
+        # Previous implementation repeated lines of short logs
+        assert log.excerpt == data.decode("utf-8")
+    assert log.read(0, len(data) + 1) == (data, len(data))
+
+
+def test__job_log__truncated_keeps_head_and_tail(store):
+    log = store.open(1)
+    # 2 MB written by a job logging a line at a time
+    for i in range(200000):
+        log.write(b"line %08d\n" % i)
+    log.close()
+
+    size = os.path.getsize(log.path)
+    assert size <= store.max_size + 64
+    with open(log.path, "rb") as f:
+        contents = f.read()
+    assert contents.startswith(lines(0, 100))
+    assert contents.endswith(lines(199900, 200000))
+    assert b" bytes skipped]\n" in contents
+
+    excerpt = log.excerpt.splitlines()
+    assert excerpt[:5] == [f"line {i:08d}" for i in range(5)]
+    assert excerpt[5] == "[199990 more lines]"
+    assert excerpt[6:] == [f"line {i:08d}" for i in range(199995, 200000)]
+    assert store.stats()["disk_usage"] == size
+
+
+def test__job_log__read_from_offset(store):
+    data = lines(0, 20000)
+    log = store.open(1)
+    log.write(data)
+
+    # Offset inside the part of the log that is only kept in memory
+    offset = len(data) - 1000
+    assert log.read(offset) == (data[offset:], len(data))
+
+    # Offset inside the skipped part
+    note, offset = log.read(store.max_size)
+    assert note.endswith(b" bytes skipped]\n")
+    assert offset == len(data) - store.tail_size
+
+    log.close()
+    assert log.read(offset) == (data[offset:], len(data))
+    assert log.read(10, 20) == (data[10:30], 30)
+
+
+def test__job_log__follow_while_writing(store):
+    data = lines(0, 4000)
+    log = store.open(1)
+    received = []
+
+    def follow():
+        offset = 0
+        while True:
+            chunk, offset = log.read(offset, 1000)
+            if chunk:
+                received.append(chunk)
+            elif log.closed:
+                break
+            else:
+                log.wait(offset, 1)
+
+    reader = threading.Thread(target=follow)
+    reader.start()
+    for i in range(0, len(data), 100):
+        log.write(data[i:i + 100])
+    log.close()
+    reader.join(10)
+
+    assert not reader.is_alive()
+    assert b"".join(received) == data
+
+
+def test__job_log_store__disk_budget(tmpdir):
+    store = JobLogStore(str(tmpdir), max_size=64 * 1024, tail_size=16 * 1024, max_total_size=100 * 1024)
+    running = store.open(1)
+    running.write(lines(0, 1000))
+
+    for job_id in range(2, 12):
+        log = store.open(job_id)
+        for i in range(1000):
+            log.write(b"line %08d\n" % i)
+        log.close()
+
+    # Oldest finished logs are removed, the running job log is kept
+    assert store.stats()["disk_usage"] <= store.max_total_size
+    assert store.stats()["removed"] > 0
+    assert store.get(1) is running
+    assert store.get(11) is not None
+    assert store.get(2) is None
+    assert sorted(os.listdir(str(tmpdir))) == sorted(f"{job_id}.log" for job_id in store.logs)
+    assert store.stats()["disk_usage"] == sum(os.path.getsize(log.path) for log in store.logs.values())
+
+    store.remove(11)
+    assert not os.path.exists(os.path.join(str(tmpdir), "11.log"))
+    assert store.stats()["disk_usage"] == sum(os.path.getsize(log.path) for log in store.logs.values())
+
+
+def test__job_log_store__removes_stale_logs(tmpdir):
+    tmpdir.join("1.log").write("previous run")
+    store = JobLogStore(str(tmpdir))
+    store.open(2).close()
+
+    assert os.listdir(str(tmpdir)) == ["2.log"]
+
+
+@job(logs=True)
+def logging_job(job, count):
+    for i in range(count):
+        job.logs_fd.write(b"line %08d\n" % i)
+    return count
+
+
+@pytest.fixture
+def middleware(store):
+    middleware = Mock()
+    middleware.dump_args = lambda args, method=None: args
+
+    async def run_in_thread(method, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+    middleware.run_in_thread = run_in_thread
+    middleware.jobs = JobsQueue(middleware)
+    middleware.jobs.logs = store
+    return middleware
+
+
+@pytest.mark.asyncio
+async def test__job__high_volume_logs(middleware, store):
+    jobs = [
+        Job(middleware, "test.logging_job", None, logging_job, [count], logging_job._job, None)
+        for count in (10, 100000, 100000)
+    ]
+    for j in jobs:
+        middleware.jobs.add(j)
+    await asyncio.gather(*[j.run(middleware.jobs) for j in jobs])
+
+    assert [j.result for j in jobs] == [10, 100000, 100000]
+    assert jobs[0].logs_excerpt == lines(0, 10).decode()
+    assert "[99990 more lines]" in jobs[1].logs_excerpt
+    assert all(os.path.getsize(j.logs_path) <= store.max_size + 64 for j in jobs)
+
+    middleware.jobs.remove(jobs[1].id)
+    assert not os.path.exists(jobs[1].logs_path)
+
+
+def test__job_log_follow_event_source(middleware, store):
+    data = lines(0, 4000)
+    log = store.open(1)
+    log.write(data[:1000])
+
+    events = []
+    app = Mock()
+    app.send_event = lambda name, event_type, **kwargs: events.append(kwargs["fields"])
+    event_source = JobLogFollowEventSource(middleware, app, "1", "core.job_log_follow:1:500", "1:500")
+    thread = threading.Thread(target=event_source.run)
+    thread.start()
+
+    log.write(data[1000:])
+    log.close()
+    thread.join(10)
+
+    assert not thread.is_alive()
+    assert "".join(event["data"] for event in events) == data[500:].decode()
+    assert events[-1]["offset"] == len(data)
+
+
+def test__job_log_follow_event_source__split_multibyte_characters(middleware, tmpdir):
+    middleware.jobs.logs = JobLogStore(str(tmpdir), max_size=1024 * 1024, tail_size=16 * 1024,
+                                       max_total_size=1024 * 1024)
+    # Reads return 64 KiB at most, the first one ends in the middle of a character
+    data = ("a" + "é" * 40000).encode() + b"\xc3"
+    log = middleware.jobs.logs.open(1)
+    log.write(data)
+    log.close()
+
+    events = []
+    app = Mock()
+    app.send_event = lambda name, event_type, **kwargs: events.append(kwargs["fields"])
+    JobLogFollowEventSource(middleware, app, "1", "core.job_log_follow:1", "1").run()
+
+    assert len(events) == 3
+    assert "".join(event["data"] for event in events) == "a" + "é" * 40000 + "\ufffd"
+    for event in events[:-1]:
+        data[:event["offset"]].decode()
+    assert events[-1]["offset"] == len(data)
+
+
+@pytest.mark.parametrize("arg", [None, "", "x", "1:x", "1:-5"])
+def test__job_log_follow_event_source__invalid_arg(middleware, store, arg):
+    store.open(1).write(lines(0, 10))
+
+    app = Mock()
+    JobLogFollowEventSource(middleware, app, "1", "core.job_log_follow", arg).run()
+
+    app.send_event.assert_not_called()
@@ -0,0 +1,121 @@
+from unittest.mock import patch
+
+import pytest
+
+from middlewared.utils.cache import approximate_size, LRUCache
+
+
+def test__lru_cache__put_get_pop():
+    cache = LRUCache(10, 1024 * 1024)
+    cache.put("", "key", {"a": [1, 2]})
+
+    assert cache.has("", "key")
+    assert not cache.has("other", "key")
+    assert cache.get("", "key") == {"a": [1, 2]}
+    with pytest.raises(KeyError):
+        cache.get("other", "key")
+
+    assert cache.pop("", "key") == {"a": [1, 2]}
+    assert cache.pop("", "key") is None
+    assert cache.bytes == 0
+
+
+def test__lru_cache__timeout():
+    cache = LRUCache(10, 1024 * 1024)
+    with patch("middlewared.utils.cache.time.monotonic", return_value=100):
+        cache.put("", "forever", 1)
+        cache.put("", "key", 2, 10)
+
+    with patch("middlewared.utils.cache.time.monotonic", return_value=109):
+        assert cache.get("", "key") == 2
+
+    with patch("middlewared.utils.cache.time.monotonic", return_value=110):
+        # Expired keys are only removed when read
+        assert cache.has("", "key")
+        with pytest.raises(KeyError) as e:
+            cache.get("", "key")
+        assert e.value.args[0] == "key has expired"
+        assert not cache.has("", "key")
+        assert cache.get("", "forever") == 1
+
+    assert cache.stats()["expirations"] == 1
+
+
+def test__lru_cache__evicts_least_recently_used():
+    cache = LRUCache(3, 1024 * 1024)
+    for key in "abc":
+        cache.put("", key, key, 60)
+    cache.get("", "a")
+    cache.put("", "d", "d", 60)
+
+    assert [cache.has("", key) for key in "abcd"] == [True, False, True, True]
+    assert cache.stats()["evictions"] == 1
+
+
+def test__lru_cache__evicts_by_size():
+    value = "x" * 1000
+    cache = LRUCache(100, approximate_size(value) * 3)
+    for i in range(5):
+        cache.put("ns", str(i), value, 60)
+
+    assert [cache.has("ns", str(i)) for i in range(5)] == [False, False, True, True, True]
+    assert cache.bytes == approximate_size(value) * 3
+
+    cache.put("ns", "huge", value * 4, 60)
+    assert not cache.has("ns", "huge")
+    assert cache.stats()["namespaces"]["ns"]["evictions"] == 3
+
+
+def test__lru_cache__never_evicts_entries_without_timeout():
+    value = "x" * 1000
+    cache = LRUCache(3, approximate_size(value) * 3)
+    cache.put("update", "applied", True)
+    cache.put("update", "notified", value * 4)
+    for i in range(5):
+        cache.put("ns", str(i), i, 60)
+
+    assert cache.get("update", "applied") is True
+    assert cache.get("update", "notified") == value * 4
+    assert [cache.has("ns", str(i)) for i in range(5)] == [False] * 5
+    assert cache.stats()["evictions"] == 5
+
+    cache.pop("update", "notified")
+    for i in range(5):
+        cache.put("ns", str(i), i, 60)
+
+    assert [cache.has("ns", str(i)) for i in range(5)] == [False, False, False, True, True]
+    assert cache.get("update", "applied") is True
+
+
+def test__lru_cache__clear_namespace():
+    cache = LRUCache(10, 1024 * 1024)
+    cache.put("a", "key", 1)
+    cache.put("b", "key", 2)
+
+    cache.clear("a")
+    assert not cache.has("a", "key")
+    assert cache.get("b", "key") == 2
+
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def test__lru_cache__stats():
+    cache = LRUCache(10, 1024 * 1024)
+    cache.put("a", "key", 1)
+    cache.get("a", "key")
+    cache.get("a", "key")
+    with pytest.raises(KeyError):
+        cache.get("b", "key")
+
+    stats = cache.stats()
+    assert stats["entries"] == 1
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+    assert stats["namespaces"]["a"] == {"hits": 2, "misses": 0, "evictions": 0, "expirations": 0,
+                                        "entries": 1, "bytes": approximate_size(1)}
+    assert stats["namespaces"]["b"]["misses"] == 1
+
+
+def test__approximate_size__nested():
+    assert approximate_size(["x" * 1000]) > 1000
+    assert approximate_size({"key": {"nested": "x" * 1000}}) > 1000
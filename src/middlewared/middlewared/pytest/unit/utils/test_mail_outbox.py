@@ -0,0 +1,106 @@
+from email.mime.text import MIMEText
+import smtplib
+import socket
+
+import pytest
+
+from middlewared.utils.mail_outbox import MailOutbox
+
+aiosmtpd_controller = pytest.importorskip('aiosmtpd.controller')
+
+
+class Handler:
+    def __init__(self):
+        self.messages = []
+        self.reject = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        subject = envelope.content.decode().split('Subject: ', 1)[1].split('\n', 1)[0].strip()
+        if subject in self.reject:
+            return '554 Rejected'
+        self.messages.append((session.peer, subject, envelope.rcpt_tos))
+        return '250 OK'
+
+
+@pytest.fixture
+def smtpd():
+    handler = Handler()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    controller = aiosmtpd_controller.Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    handler.connections = 0
+
+    def connect():
+        handler.connections += 1
+        return smtplib.SMTP('127.0.0.1', port, timeout=10)
+
+    handler.connect = connect
+    yield handler
+    controller.stop()
+
+
+def message(subject):
+    msg = MIMEText('text')
+    msg['Subject'] = subject
+    return msg
+
+
+def test__mail_outbox__batch_over_one_session(tmpdir, smtpd):
+    outbox = MailOutbox(str(tmpdir.join('outbox.db')))
+    for i in range(5):
+        assert outbox.append('from@example.com', ['to@example.com'], message(f'subject {i}'), now=0)
+
+    assert outbox.send(smtpd.connect, now=0) == 0
+    assert outbox.send(smtpd.connect, now=1000) == 5
+
+    assert smtpd.connections == 1
+    assert len({peer for peer, subject, rcpt in smtpd.messages}) == 1
+    assert [subject for peer, subject, rcpt in smtpd.messages] == [f'subject {i}' for i in range(5)]
+    assert len(outbox) == 0
+
+
+def test__mail_outbox__deduplicates_subject(tmpdir):
+    outbox = MailOutbox(str(tmpdir.join('outbox.db')), dedup_window=3600)
+
+    assert outbox.append('from@example.com', ['to@example.com'], message('disk failed'), now=0)
+    assert not outbox.append('from@example.com', ['to@example.com'], message('disk failed'), now=100)
+    assert outbox.append('from@example.com', ['to@example.com'], message('other'), now=100)
+    assert outbox.append('from@example.com', ['to@example.com'], message('disk failed'), now=4000)
+    assert len(outbox) == 3
+
+
+def test__mail_outbox__backoff_and_drop(tmpdir, smtpd):
+    outbox = MailOutbox(str(tmpdir.join('outbox.db')), max_attempts=3, backoff=60)
+    outbox.append('from@example.com', ['to@example.com'], message('rejected'), now=0)
+    outbox.append('from@example.com', ['to@example.com'], message('accepted'), now=0)
+    smtpd.reject.add('rejected')
+
+    # Delivered after first retry delay, rejected one is retried with doubled delay
+    assert outbox.send(smtpd.connect, now=60) == 1
+    assert outbox.due(now=60 + 119) == []
+    assert [i[3]['Subject'] for i in outbox.due(now=60 + 120)] == ['rejected']
+
+    assert outbox.send(smtpd.connect, now=180) == 0
+    assert len(outbox) == 0
+
+
+def test__mail_outbox__server_unreachable(tmpdir):
+    outbox = MailOutbox(str(tmpdir.join('outbox.db')), backoff=60)
+    outbox.append('from@example.com', ['to@example.com'], message('subject'), now=0)
+
+    def connect():
+        raise ConnectionRefusedError()
+
+    assert outbox.send(connect, now=60) == 0
+    assert outbox.due(now=60) == []
+    assert outbox.due(now=180)[0][4] == 2
+
+
+def test__mail_outbox__persistent(tmpdir, smtpd):
+    path = str(tmpdir.join('outbox.db'))
+    MailOutbox(path).append('from@example.com', ['a@example.com', 'b@example.com'], message('subject'), now=0)
+
+    assert MailOutbox(path).send(smtpd.connect, now=1000) == 1
+    assert smtpd.messages[0][2] == ['a@example.com', 'b@example.com']
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from middlewared.utils.mount import MountinfoBackend, MountTable
+
+MOUNTINFO = """\
+22 1 0:21 / / rw,relatime shared:1 - zfs boot-pool/ROOT/default rw,xattr
+36 22 98:0 /mnt1 /mnt/tank rw,noatime master:1 - zfs tank rw
+37 36 0:40 / /mnt/tank/share rw - zfs tank/share rw
+38 36 0:41 / /mnt/tank/with\\040space rw - zfs tank/with\\040space rw
+39 22 0:42 / /mnt/tank/share rw - nullfs /mnt/other rw
+40 22 0:43 / /media rw shared:2 master:3 - tmpfs tmpfs rw
+"""
+
+
+@pytest.fixture
+def table(tmpdir):
+    path = tmpdir.join("mountinfo")
+    path.write(MOUNTINFO)
+    return MountTable(MountinfoBackend(str(path)).read())
+
+
+def test__mountinfo__parse(table):
+    assert table.mounts[0] == {"source": "boot-pool/ROOT/default", "dest": "/", "fstype": "zfs",
+                               "options": ["rw", "relatime"]}
+    assert table.mounts[3]["dest"] == "/mnt/tank/with space"
+    assert table.mounts[5] == {"source": "tmpfs", "dest": "/media", "fstype": "tmpfs", "options": ["rw"]}
+
+
+def test__mountinfo__invalid_line():
+    assert MountinfoBackend.parse_line("36 35 98:0 / /mnt rw") is None
+
+
+@pytest.mark.parametrize("path,dest", [
+    ("/", "/"),
+    ("/etc/passwd", "/"),
+    ("/mnt/tank", "/mnt/tank"),
+    ("/mnt/tank/", "/mnt/tank"),
+    ("/mnt/tankfoo", "/"),
+    ("/mnt/tank/dir/file", "/mnt/tank"),
+    ("/mnt/tank/with space/file", "/mnt/tank/with space"),
+])
+def test__mount_table__path_to_mount(table, path, dest):
+    assert table.path_to_mount(path)["dest"] == dest
+
+
+def test__mount_table__overmount(table):
+    # Last mount on a directory hides the previous ones
+    assert table.path_to_mount("/mnt/tank/share/file")["source"] == "/mnt/other"
+    assert table.is_mounted(path="/mnt/tank/share")
+    assert table.is_mounted(source="tank/share")
+
+
+def test__mount_table__is_mounted(table):
+    assert table.is_mounted(path="/mnt/tank/")
+    assert not table.is_mounted(path="/mnt/tank/dir")
+    assert not table.is_mounted(source="tank/missing")
+    assert not table.is_mounted()
+
+
+def test__mount_table__is_mounted_matches_path_only(table):
+    # Like the GUI helper it replaces, `source` is ignored when `path` is given
+    assert table.is_mounted(path="/mnt/tank/share", source="tank/missing")
+    assert not table.is_mounted(path="/mnt/tank/dir", source="tank/share")
+
+
+def test__mount_table__is_mounted_resolves_symlinks(tmpdir):
+    real = tmpdir.mkdir("real")
+    tmpdir.join("link").mksymlinkto(real)
+    table = MountTable([{"source": "tank/jail", "dest": os.path.realpath(str(real)), "fstype": "zfs",
+                         "options": []}])
+
+    assert table.is_mounted(path=str(tmpdir.join("link")))
+    assert table.is_mounted(path=str(tmpdir.join("link", "..", "real")))
+
+
+def test__mountinfo__self():
+    if not os.path.exists("/proc/self/mountinfo"):
+        pytest.skip("/proc/self/mountinfo is not available")
+
+    table = MountTable(MountinfoBackend().read())
+    assert table.path_to_mount(os.getcwd()) is not None
@@ -0,0 +1,204 @@
+import asyncio
+import random
+import selectors
+import time
+
+import pytest
+
+from middlewared.utils.periodic import PeriodicScheduler
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    """
+    Instead of blocking for `timeout` seconds advances the clock of `loop` by `timeout`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.time = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.time += timeout
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(VirtualClockSelector())
+
+    def time(self):
+        return self._selector.time
+
+
+@pytest.fixture
+def loop():
+    loop = VirtualClockLoop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def run_for(loop, seconds):
+    loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def recorder(loop, duration=0, error=None):
+    runs = []
+
+    async def call():
+        runs.append(loop.time())
+        await asyncio.sleep(duration)
+        if error is not None:
+            raise error
+
+    return runs, call
+
+
+def test__periodic__fixed_rate(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop, duration=7)
+    scheduler.add("test.task", call, 60)
+    scheduler.start()
+    run_for(loop, 3600)
+
+    # Run duration does not delay the next run
+    assert runs == [pytest.approx(i * 60) for i in range(61)]
+    task = scheduler.get()[0]
+    assert task["runs"] == 60
+    assert task["history"][-1]["duration"] == pytest.approx(7)
+    assert task["history"][-1]["state"] == "SUCCESS"
+
+
+def test__periodic__run_on_start(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop)
+    scheduler.add("test.task", call, 60, run_on_start=False)
+    scheduler.start()
+    run_for(loop, 150)
+
+    assert runs == [pytest.approx(60), pytest.approx(120)]
+
+
+def test__periodic__jitter(loop):
+    scheduler = PeriodicScheduler(loop, rng=random.Random(0))
+    tasks = [recorder(loop) for i in range(10)]
+    for i, (runs, call) in enumerate(tasks):
+        scheduler.add(f"test.task{i}", call, 60, jitter=10)
+    scheduler.start()
+    run_for(loop, 601)
+
+    # Tasks do not all start at the same moment
+    assert len({round(runs[0], 3) for runs, call in tasks}) == 10
+    for runs, call in tasks:
+        assert len(runs) == 10
+        # Jitter does not accumulate
+        for i, run in enumerate(runs):
+            assert i * 60 <= run <= i * 60 + 10
+
+
+def test__periodic__never_overlaps(loop):
+    scheduler = PeriodicScheduler(loop)
+    running = []
+    runs = []
+
+    async def call():
+        assert not running
+        running.append(True)
+        runs.append(loop.time())
+        await asyncio.sleep(150)
+        running.pop()
+
+    scheduler.add("test.task", call, 60)
+    scheduler.start()
+    run_for(loop, 601)
+
+    # Runs at 0, 180, 360 and 540, slots in between are skipped
+    assert runs == [pytest.approx(t) for t in (0, 180, 360, 540)]
+    task = scheduler.get()[0]
+    assert task["skipped"] == 7
+    assert task["running"]
+
+
+def test__periodic__timeout(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop, duration=100)
+    scheduler.add("test.task", call, 60, timeout=30)
+    scheduler.start()
+    run_for(loop, 150)
+
+    assert runs == [pytest.approx(t) for t in (0, 60, 120)]
+    task = scheduler.get()[0]
+    assert task["timeouts"] == 2
+    assert task["last_exception"] == "Timed out after 30 seconds"
+    assert task["history"][0]["state"] == "TIMEOUT"
+    assert task["history"][0]["duration"] == pytest.approx(30)
+
+
+def test__periodic__failure(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop, error=ValueError("Broken"))
+    scheduler.add("test.task", call, 60)
+    scheduler.start()
+    run_for(loop, 90)
+
+    # Failing task keeps being scheduled
+    assert len(runs) == 2
+    task = scheduler.get()[0]
+    assert task["failures"] == 2
+    assert "ValueError: Broken" in task["last_exception"]
+    assert [run["state"] for run in task["history"]] == ["FAILED", "FAILED"]
+
+
+def test__periodic__next_run(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop)
+    scheduler.add("test.task", call, 60)
+    scheduler.start()
+    run_for(loop, 90)
+
+    assert scheduler.get()[0]["next_run"] == pytest.approx(time.time() + 30, abs=1)
+
+    scheduler.stop()
+    run_for(loop, 300)
+    assert len(runs) == 2
+    assert scheduler.get()[0]["next_run"] is None
+
+
+def test__periodic__manual_run(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop, duration=10)
+    scheduler.add("test.task", call, 60)
+    scheduler.start()
+    run_for(loop, 20)
+
+    assert loop.run_until_complete(scheduler.run("test.task")) == "SUCCESS"
+    # Waits for a running run instead of starting another one
+    loop.run_until_complete(asyncio.sleep(35))
+    assert loop.run_until_complete(asyncio.gather(scheduler.run("test.task"), scheduler.run("test.task"))) == [
+        "SUCCESS", "SUCCESS",
+    ]
+    run_for(loop, 50)
+
+    assert runs == [pytest.approx(t) for t in (0, 20, 60, 120)]
+    # Last run is not finished yet
+    assert [run["trigger"] for run in scheduler.get()[0]["history"]] == ["SCHEDULE", "MANUAL", "SCHEDULE"]
+
+    with pytest.raises(KeyError):
+        loop.run_until_complete(scheduler.run("test.missing"))
+
+
+def test__periodic__missed_slots_are_not_made_up(loop):
+    scheduler = PeriodicScheduler(loop)
+    runs, call = recorder(loop)
+    scheduler.add("test.task", call, 60)
+    scheduler.start()
+    run_for(loop, 1)
+
+    # Event loop blocked for 5 minutes
+    loop._selector.time += 300
+    run_for(loop, 100)
+
+    assert runs == [pytest.approx(t) for t in (0, 301, 360)]
@@ -0,0 +1,145 @@
+import asyncio
+import textwrap
+import time
+
+import pytest
+
+from middlewared.utils import load_modules
+from middlewared.utils.plugins import SetupDependencyError, run_setups, setup_order
+
+PLUGIN = textwrap.dedent('''\
+    import asyncio
+    import time
+
+    from middlewared.service import setup_depends
+
+
+    @setup_depends({depends})
+    async def setup(middleware):
+        middleware.events.append(("start", {name!r}, time.monotonic()))
+        await asyncio.sleep({sleep})
+        middleware.events.append(("end", {name!r}, time.monotonic()))
+''')
+
+
+class Middleware(object):
+    def __init__(self):
+        self.events = []
+
+    def event(self, kind, name):
+        return [i[2] for i in self.events if i[0] == kind and i[1] == name][0]
+
+
+def load_plugins(tmpdir, plugins):
+    for name, (depends, sleep) in plugins.items():
+        tmpdir.join(f'{name}.py').write(PLUGIN.format(
+            name=name, depends=', '.join(repr(i) for i in depends), sleep=sleep,
+        ))
+    timings = {}
+    modules = load_modules(str(tmpdir), timings)
+    return [(m.__name__.rsplit('.', 1)[-1], m.setup) for m in modules], timings
+
+
+@pytest.mark.asyncio
+async def test__run_setups__ordering_and_concurrency(tmpdir):
+    setups, timings = load_plugins(tmpdir, {
+        'pool': ([], 0.3),
+        'network': ([], 0.3),
+        'sharing': (['pool', 'network'], 0.1),
+        'alert': (['sharing'], 0.1),
+        'ipmi': ([], 0.3),
+    })
+    middleware = Middleware()
+    done = []
+
+    start = time.monotonic()
+    profile = await run_setups(middleware, setups, done.append)
+    elapsed = time.monotonic() - start
+
+    assert set(timings) == {'pool', 'network', 'sharing', 'alert', 'ipmi'}
+    assert sorted(done) == sorted(profile) == sorted(timings)
+
+    # Dependencies finished before their dependents started
+    assert middleware.event('start', 'sharing') >= middleware.event('end', 'pool')
+    assert middleware.event('start', 'sharing') >= middleware.event('end', 'network')
+    assert middleware.event('start', 'alert') >= middleware.event('end', 'sharing')
+    assert done.index('alert') > done.index('sharing')
+
+    # Independent setups ran concurrently: 0.3 + 0.1 + 0.1 instead of 1.1 seconds
+    assert middleware.event('start', 'ipmi') < middleware.event('end', 'pool')
+    assert elapsed < 0.9
+
+    assert profile['sharing']['depends'] == ['pool', 'network']
+    assert profile['pool']['duration'] >= 0.3
+    assert profile['alert']['start'] >= 0.4
+
+
+@pytest.mark.asyncio
+async def test__run_setups__sync_setup():
+    called = []
+
+    def setup(middleware):
+        called.append(middleware)
+
+    profile = await run_setups('middleware', [('sync', setup)])
+
+    assert called == ['middleware']
+    assert profile['sync']['duration'] >= 0
+
+
+@pytest.mark.asyncio
+async def test__run_setups__undeclared_setups_run_in_order():
+    events = []
+
+    def legacy(name, sleep):
+        async def setup(middleware):
+            events.append(('start', name))
+            await asyncio.sleep(sleep)
+            events.append(('end', name))
+        return name, setup
+
+    async def independent(middleware):
+        events.append(('start', 'independent'))
+    independent._setup_depends = ()
+
+    profile = await run_setups(None, [legacy('alert', 0.1), legacy('crypto', 0), ('ipmi', independent)])
+
+    # Setups without `setup_depends` wait for every setup before them
+    assert events.index(('start', 'crypto')) > events.index(('end', 'alert'))
+    assert profile['crypto']['depends'] == ['alert']
+    # Declared setups only wait for what they depend on
+    assert events.index(('start', 'independent')) < events.index(('end', 'alert'))
+
+
+@pytest.mark.asyncio
+async def test__run_setups__failure_propagates():
+    async def broken(middleware):
+        raise RuntimeError('broken')
+
+    async def dependent(middleware):
+        pass
+    dependent._setup_depends = ('broken',)
+
+    with pytest.raises(RuntimeError):
+        await run_setups(None, [('broken', broken), ('dependent', dependent)])
+
+
+def test__setup_order__unknown_dependency_ignored():
+    def a(middleware):
+        pass
+    a._setup_depends = ('missing',)
+
+    assert setup_order([('a', a)]) == [('a', a, [])]
+
+
+def test__setup_order__cycle():
+    def a(middleware):
+        pass
+    a._setup_depends = ('b',)
+
+    def b(middleware):
+        pass
+    b._setup_depends = ('a',)
+
+    with pytest.raises(SetupDependencyError):
+        setup_order([('a', a), ('b', b)])
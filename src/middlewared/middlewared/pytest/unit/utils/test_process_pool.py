@@ -0,0 +1,103 @@
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+import os
+import time
+
+import pytest
+
+from middlewared.utils.process_pool import ProcessPool
+
+
+@pytest.fixture
+def pool():
+    pool = ProcessPool(2, max_tasks=3)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.fixture
+def unlimited_pool():
+    pool = ProcessPool(2)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test__process_pool__recycle_after_max_tasks():
+    pool = ProcessPool(1, max_tasks=3)
+    try:
+        pids = [await pool.run("os.getpid", os.getpid) for i in range(9)]
+    finally:
+        pool.shutdown()
+
+    assert len(set(pids)) == 3
+    assert all(pids.count(pid) == 3 for pid in pids)
+    assert pool.stats()["recycled"] == 3
+    assert pool.stats()["generation"] == 4
+
+
+@pytest.mark.asyncio
+async def test__process_pool__recycle_with_queued_tasks(pool):
+    # Workers are recycled while tasks are still waiting in the old executor queue
+    results = await asyncio.wait_for(
+        asyncio.gather(*[pool.run("time.sleep", time.sleep, 0.05) for i in range(12)]), 10,
+    )
+
+    assert results == [None] * 12
+    assert pool.stats()["recycled"] >= 1
+    assert pool.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test__process_pool__recycle_after_max_rss():
+    pool = ProcessPool(1, max_rss=1)
+    try:
+        pids = [await pool.run("os.getpid", os.getpid) for i in range(3)]
+    finally:
+        pool.shutdown()
+
+    assert len(set(pids)) == 3
+    assert pool.stats()["recycled"] == 3
+
+
+@pytest.mark.asyncio
+async def test__process_pool__crash_recovery(pool):
+    pid = await pool.run("os.getpid", os.getpid)
+
+    with pytest.raises(BrokenProcessPool):
+        await pool.run("os._exit", os._exit, 1)
+
+    # New workers are started
+    assert await pool.run("os.getpid", os.getpid) != pid
+    stats = pool.stats()
+    assert stats["crashed"] == 1
+    assert stats["generation"] == 2
+    assert stats["methods"]["os._exit"]["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test__process_pool__task_error(pool):
+    with pytest.raises(ValueError):
+        await pool.run("int", int, "x")
+
+    assert await pool.run("int", int, "1") == 1
+    stats = pool.stats()
+    assert stats["crashed"] == 0
+    assert stats["methods"]["int"]["errors"] == 1
+    assert stats["methods"]["int"]["execution"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test__process_pool__queue_wait(unlimited_pool):
+    pool = unlimited_pool
+    tasks = [asyncio.ensure_future(pool.run("time.sleep", time.sleep, 0.2)) for i in range(6)]
+    await asyncio.sleep(0.1)
+    assert pool.stats()["in_flight"] == 6
+    assert pool.stats()["queued"] == 4
+    await asyncio.gather(*tasks)
+
+    stats = pool.stats()["methods"]["time.sleep"]
+    assert stats["execution"]["count"] == 6
+    assert stats["execution"]["min"] >= 0.2
+    # Last tasks had to wait for two others to finish
+    assert stats["queue_wait"]["max"] >= 0.3
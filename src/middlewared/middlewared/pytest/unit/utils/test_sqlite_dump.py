@@ -0,0 +1,138 @@
+import sqlite3
+
+import pytest
+
+from middlewared.utils.sqlite_dump import copy_database, dump_json, dump_sql, read_transaction, snapshot
+
+ROWS = 20000
+
+
+@pytest.fixture
+def database(tmpdir):
+    path = str(tmpdir.join("source.db"))
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE account_bsdgroups (id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+                                        bsdgrp_gid integer NOT NULL, bsdgrp_group varchar(120) NOT NULL UNIQUE);
+        CREATE TABLE account_bsdusers (id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+                                       bsdusr_username varchar(16) NOT NULL, bsdusr_full_name varchar(120),
+                                       bsdusr_quota real, bsdusr_key blob,
+                                       bsdusr_group_id integer NOT NULL REFERENCES account_bsdgroups (id));
+        CREATE INDEX account_bsdusers_group ON account_bsdusers (bsdusr_group_id);
+        CREATE VIEW account_view AS SELECT bsdusr_username FROM account_bsdusers;
+        CREATE TRIGGER account_trigger AFTER DELETE ON account_bsdgroups BEGIN SELECT 1; END;
+    """)
+    conn.executemany("INSERT INTO account_bsdgroups (bsdgrp_gid, bsdgrp_group) VALUES (?, ?)",
+                     [(1000 + i, f"group{i}") for i in range(100)])
+    conn.executemany(
+        "INSERT INTO account_bsdusers (bsdusr_username, bsdusr_full_name, bsdusr_quota, bsdusr_key, "
+        "bsdusr_group_id) VALUES (?, ?, ?, ?, ?)",
+        [
+            (f"user{i}", None if i % 7 == 0 else f"O'Neil \"{i}\"\nline; ünïcode", i / 3 if i % 5 else None,
+             bytes([i % 256, 0, 255]) if i % 3 == 0 else None, i % 100 + 1)
+            for i in range(ROWS)
+        ],
+    )
+    conn.execute('CREATE TABLE "odd ""name""" ("select" text)')
+    conn.execute('INSERT INTO "odd ""name""" VALUES (\'x\')')
+    conn.execute("DELETE FROM account_bsdusers WHERE id = ?", (ROWS,))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def contents(path):
+    conn = sqlite3.connect(path)
+    try:
+        master = conn.execute("SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY name").fetchall()
+        tables = {
+            name: conn.execute(f'SELECT * FROM "{name.replace(chr(34), chr(34) * 2)}" ORDER BY rowid').fetchall()
+            for type, name, tbl_name, sql in master if type == "table"
+        }
+        return master, tables
+    finally:
+        conn.close()
+
+
+def test__dump_sql__round_trip(database, tmpdir):
+    with read_transaction(database) as conn:
+        script = "".join(f"{statement};\n" for statement in dump_sql(conn, schema=True))
+
+    restored = str(tmpdir.join("restored.db"))
+    conn = sqlite3.connect(restored)
+    conn.executescript(script)
+    conn.close()
+
+    master, tables = contents(restored)
+    assert (master, tables) == contents(database)
+    assert len(tables["account_bsdusers"]) == ROWS - 1
+    assert tables["sqlite_sequence"] == [("account_bsdgroups", 100), ("account_bsdusers", ROWS)]
+
+
+def test__dump_sql__without_schema(database):
+    with read_transaction(database) as conn:
+        statements = list(dump_sql(conn, exclude={"account_bsdusers"}))
+
+    assert statements[0] == 'DELETE FROM "account_bsdgroups"'
+    assert statements[1] == ('INSERT INTO "account_bsdgroups" ("id", "bsdgrp_gid", "bsdgrp_group") '
+                             "VALUES (1,1000,'group0')")
+    assert not any('"account_bsdusers"' in statement for statement in statements)
+    assert not any(statement.startswith("CREATE") for statement in statements)
+
+
+def test__dump_sql__consistent_snapshot(database):
+    writer = sqlite3.connect(database, timeout=0)
+    with read_transaction(database) as conn:
+        statements = dump_sql(conn)
+        next(statements)
+
+        with pytest.raises(sqlite3.OperationalError):
+            writer.execute("DELETE FROM account_bsdusers")
+            writer.commit()
+
+        assert sum(statement.startswith('INSERT INTO "account_bsdusers"') for statement in statements) == ROWS - 1
+
+    writer.execute("DELETE FROM account_bsdusers")
+    writer.commit()
+
+
+def test__snapshot__does_not_block_writers(database):
+    writer = sqlite3.connect(database, timeout=0)
+    with snapshot(database) as conn:
+        statements = dump_sql(conn)
+        next(statements)
+
+        # Like a dump stalled on a full pipe nobody reads from
+        writer.execute("DELETE FROM account_bsdusers")
+        writer.commit()
+
+        assert sum(statement.startswith('INSERT INTO "account_bsdusers"') for statement in statements) == ROWS - 1
+
+
+def test__dump_json__batches(database):
+    tables = [{"table_name": "account_bsdgroups", "verbose_name": "Groups"}, {"table_name": "missing"},
+              {"table_name": "odd \"name\""}]
+    with read_transaction(database) as conn:
+        batches = list(dump_json(conn, tables, batch_size=30))
+
+    assert [(batch["table_name"], len(batch["entries"])) for batch in batches] == [
+        ("account_bsdgroups", 30), ("account_bsdgroups", 30), ("account_bsdgroups", 30), ("account_bsdgroups", 10),
+        ("odd \"name\"", 1),
+    ]
+    assert batches[0]["verbose_name"] == "Groups"
+    assert batches[0]["entries"][0] == {"id": 1, "bsdgrp_gid": 1000, "bsdgrp_group": "group0"}
+    assert "entries" not in tables[0]
+
+
+def test__dump_json__empty_table(database):
+    with read_transaction(database) as conn:
+        conn.execute("DELETE FROM account_bsdgroups")
+        assert list(dump_json(conn, [{"table_name": "account_bsdgroups"}])) == [
+            {"table_name": "account_bsdgroups", "entries": []},
+        ]
+
+
+def test__copy_database(database, tmpdir):
+    copy = str(tmpdir.join("copy.db"))
+    copy_database(database, copy)
+    assert contents(copy) == contents(database)
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import threading
+import time
+from unittest.mock import Mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+import pytest
+
+from middlewared.utils.transfer import AdaptiveChunkSize, DownloadSpool, open_pipe_writer, UploadSession
+
+PAYLOAD = os.urandom(3 * 1024 * 1024 + 17)
+
+
+def produce(w, payload, delay=0.001):
+    def target():
+        with os.fdopen(w, "wb") as f:
+            for i in range(0, len(payload), 100000):
+                f.write(payload[i:i + 100000])
+                time.sleep(delay)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def consume(r, received):
+    def target():
+        with os.fdopen(r, "rb") as f:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                received.extend(data)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def download_client(tmpdir, payload=PAYLOAD):
+    r, w = os.pipe()
+    spool = DownloadSpool(asyncio.get_event_loop(), os.fdopen(r, "rb"), dir=str(tmpdir))
+    produce(w, payload)
+
+    async def handler(request):
+        return await spool.respond(request, {"Content-Type": "application/octet-stream"})
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    return spool, TestClient(TestServer(app))
+
+
+async def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not await predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test__adaptive_chunk_size():
+    chunk_size = AdaptiveChunkSize(minimum=4, maximum=16)
+    for read, size in [(4, 8), (8, 16), (16, 16), (8, 16), (3, 8), (1, 4), (1, 4)]:
+        chunk_size.update(read)
+        assert chunk_size.size == size
+
+
+@pytest.mark.asyncio
+async def test__download__interrupted_and_resumed(tmpdir):
+    spool, client = download_client(tmpdir)
+    async with client:
+        resp = await client.get("/")
+        assert resp.status == 200
+        assert resp.headers["Accept-Ranges"] == "bytes"
+        received = await resp.content.readexactly(1024 * 1024 + 3)
+        etag = resp.headers["ETag"]
+        resp.close()
+
+        resp = await client.get("/", headers={"Range": f"bytes={len(received)}-", "If-Range": etag})
+        assert resp.status == 206
+        assert resp.headers["Content-Range"] == f"bytes {len(received)}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}"
+        received += await resp.read()
+
+    assert received == PAYLOAD
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test__download__ranges(tmpdir):
+    spool, client = download_client(tmpdir)
+    async with client:
+        resp = await client.get("/", headers={"Range": "bytes=-100"})
+        assert resp.status == 206
+        assert await resp.read() == PAYLOAD[-100:]
+
+        resp = await client.get("/", headers={"Range": "bytes=10-19"})
+        assert resp.status == 206
+        assert resp.headers["Content-Length"] == "10"
+        assert await resp.read() == PAYLOAD[10:20]
+
+        resp = await client.get("/", headers={"Range": f"bytes={len(PAYLOAD)}-"})
+        assert resp.status == 416
+        assert resp.headers["Content-Range"] == f"bytes */{len(PAYLOAD)}"
+
+        # Spool is complete, full response has known length
+        resp = await client.get("/", headers={"Range": "bytes=0-1,5-6"})
+        assert resp.status == 200
+        assert resp.headers["Content-Length"] == str(len(PAYLOAD))
+        assert await resp.read() == PAYLOAD
+
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test__download__if_range_mismatch(tmpdir):
+    spool, client = download_client(tmpdir)
+    async with client:
+        resp = await client.get("/", headers={"Range": "bytes=100-", "If-Range": '"stale"'})
+        assert resp.status == 200
+        assert "Content-Range" not in resp.headers
+        assert await resp.read() == PAYLOAD
+
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test__download__concurrent_clients(tmpdir):
+    spool, client = download_client(tmpdir)
+    async with client:
+        async def get():
+            resp = await client.get("/")
+            return await resp.read()
+
+        assert await asyncio.gather(get(), get(), get()) == [PAYLOAD] * 3
+
+    spool.close()
+    assert spool.closed
+
+
+@pytest.mark.asyncio
+async def test__upload__interrupted_and_resumed():
+    loop = asyncio.get_event_loop()
+    r, w = os.pipe()
+    received = bytearray()
+    consumer = consume(r, received)
+    session = UploadSession(loop, await open_pipe_writer(loop, os.fdopen(w, "wb")), Mock(), len(PAYLOAD))
+
+    app = web.Application()
+    app.router.add_route("*", "/", session.handle)
+    async with TestClient(TestServer(app)) as client:
+        sent = 1024 * 1024 + 5
+        reader, writer = await asyncio.open_connection(client.host, client.port)
+        writer.write(b"PATCH / HTTP/1.1\r\n"
+                     b"Host: localhost\r\n"
+                     b"Upload-Offset: 0\r\n"
+                     b"Content-Length: " + str(len(PAYLOAD)).encode() + b"\r\n"
+                     b"\r\n" + PAYLOAD[:sent])
+        await writer.drain()
+
+        async def offset_is_sent():
+            resp = await client.head("/")
+            return resp.headers["Upload-Offset"] == str(sent)
+
+        await wait_for(offset_is_sent)
+        writer.close()
+
+        resp = await client.patch("/", headers={"Upload-Offset": "0"}, data=PAYLOAD)
+        assert resp.status == 409
+        assert resp.headers["Upload-Offset"] == str(sent)
+
+        resp = await client.patch("/", headers={"Upload-Offset": str(sent)}, data=PAYLOAD[sent:])
+        assert resp.status == 204
+        assert resp.headers["Upload-Offset"] == str(len(PAYLOAD))
+        assert session.closed
+
+        resp = await client.patch("/", headers={"Upload-Offset": str(len(PAYLOAD))}, data=b"x")
+        assert resp.status == 410
+
+    await loop.run_in_executor(None, consumer.join)
+    assert received == PAYLOAD
+    session.job.abort.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test__upload__too_long_and_aborted():
+    loop = asyncio.get_event_loop()
+    r, w = os.pipe()
+    received = bytearray()
+    consumer = consume(r, received)
+    session = UploadSession(loop, await open_pipe_writer(loop, os.fdopen(w, "wb")), Mock(), 10)
+
+    app = web.Application()
+    app.router.add_route("*", "/", session.handle)
+    async with TestClient(TestServer(app)) as client:
+        resp = await client.patch("/", data=b"x")
+        assert resp.status == 400
+
+        resp = await client.patch("/", headers={"Upload-Offset": "0"}, data=b"x" * 11)
+        assert resp.status == 413
+
+        resp = await client.delete("/")
+        assert resp.status == 204
+
+    await loop.run_in_executor(None, consumer.join)
+    assert received == b""
+    session.job.abort.assert_called_once_with()
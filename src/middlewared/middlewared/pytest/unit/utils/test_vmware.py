@@ -0,0 +1,236 @@
+import threading
+import time
+
+from middlewared.utils.vmware import SessionPool, VMSnapshotOrchestrator, VSphereSession, VSphereVM
+
+
+class FakeVM(VSphereVM):
+    def __init__(self, host, uuid, datastores, delay=0, passthrough=False, fail=False):
+        self.host = host
+        self.uuid = uuid
+        self.name = f"vm-{uuid}"
+        self.datastores = datastores
+        self.delay = delay
+        self.passthrough = passthrough
+        self.fail = fail
+        self.snapshots = set()
+
+    def depends_on_datastore(self, datastore):
+        return datastore in self.datastores
+
+    def can_snapshot(self):
+        return not self.passthrough
+
+    def snapshot_exists(self, name):
+        return name in self.snapshots
+
+    def create_snapshot(self, name, description):
+        with self.host.lock:
+            self.host.running += 1
+            self.host.max_running = max(self.host.max_running, self.host.running)
+        try:
+            time.sleep(self.delay)
+            if self.fail:
+                raise Exception("Insufficient disk space")
+            self.snapshots.add(name)
+        finally:
+            with self.host.lock:
+                self.host.running -= 1
+
+    def remove_snapshot(self, name):
+        if name not in self.snapshots:
+            return False
+        self.snapshots.remove(name)
+        return True
+
+
+class FakeHost:
+    def __init__(self, vms=()):
+        self.vms = {}
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.logins = 0
+        self.login_delay = 0
+        for vm in vms:
+            self.add(**vm)
+
+    def add(self, uuid, datastores, **kwargs):
+        self.vms[uuid] = FakeVM(self, uuid, datastores, **kwargs)
+
+
+class FakeSession(VSphereSession):
+    def __init__(self, host):
+        self.host = host
+        self.connected = True
+
+    def alive(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def powered_on_vms(self):
+        return list(self.host.vms.values())
+
+    def find_vm(self, uuid):
+        return self.host.vms.get(uuid)
+
+
+def inventory(hosts):
+    def connect(vmsnapobj):
+        if vmsnapobj["hostname"] not in hosts:
+            raise OSError("Connection refused")
+        host = hosts[vmsnapobj["hostname"]]
+        host.logins += 1
+        time.sleep(host.login_delay)
+        return FakeSession(host)
+
+    return connect
+
+
+def vmsnapobj(hostname, datastore="ds1"):
+    return {"hostname": hostname, "username": "root", "password": "secret", "datastore": datastore}
+
+
+def test__orchestrator__bounded_concurrency_per_host():
+    hosts = {
+        "esxi1": FakeHost([{"uuid": f"a{i}", "datastores": ["ds1"], "delay": 0.2} for i in range(8)]),
+        "esxi2": FakeHost([{"uuid": f"b{i}", "datastores": ["ds1"], "delay": 0.2} for i in range(8)]),
+    }
+    orchestrator = VMSnapshotOrchestrator(SessionPool(inventory(hosts)), concurrency=4)
+
+    start = time.monotonic()
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1"), vmsnapobj("esxi2")], "snap", "")
+    elapsed = time.monotonic() - start
+
+    assert login_failures == []
+    # Serial execution would take 16 * 0.2 seconds
+    assert elapsed < 1.2
+    for host in hosts.values():
+        assert host.max_running == 4
+        assert all(vm.snapshots == {"snap"} for vm in host.vms.values())
+    for item in items:
+        assert len(item["snapvms"]) == 8
+        assert item["snapvmfails"] == []
+        assert {outcome["status"] for outcome in item["outcomes"].values()} == {"SNAPSHOTTED"}
+
+
+def test__orchestrator__outcomes():
+    hosts = {
+        "esxi1": FakeHost([
+            {"uuid": "ok", "datastores": ["ds1"]},
+            {"uuid": "pt", "datastores": ["ds1"], "passthrough": True},
+            {"uuid": "fail", "datastores": ["ds1"], "fail": True},
+            {"uuid": "other", "datastores": ["ds2"]},
+        ]),
+    }
+    orchestrator = VMSnapshotOrchestrator(SessionPool(inventory(hosts)))
+
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1"), vmsnapobj("missing")], "snap", "")
+
+    assert [vmsnapobj["hostname"] for vmsnapobj, e in login_failures] == ["missing"]
+    item, = items
+    assert {uuid: outcome["status"] for uuid, outcome in item["outcomes"].items()} == {
+        "ok": "SNAPSHOTTED", "pt": "SKIPPED", "fail": "FAILED",
+    }
+    assert item["outcomes"]["fail"]["error"] == "Insufficient disk space"
+    assert item["snapvmskips"] == ["pt"]
+    assert item["snapvmfails"] == [["fail", "vm-fail"]]
+
+
+def test__orchestrator__vm_on_two_datastores_is_snapshotted_once():
+    hosts = {"esxi1": FakeHost([{"uuid": "a", "datastores": ["ds1", "ds2"], "delay": 0.1}])}
+    orchestrator = VMSnapshotOrchestrator(SessionPool(inventory(hosts)))
+
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1", "ds1"), vmsnapobj("esxi1", "ds2")], "snap", "")
+
+    assert hosts["esxi1"].max_running == 1
+    assert [item["outcomes"]["a"]["status"] for item in items] == ["SNAPSHOTTED", "SNAPSHOTTED"]
+
+    assert orchestrator.end("snap", items) == ([], [])
+    assert hosts["esxi1"].vms["a"].snapshots == set()
+
+
+def test__orchestrator__deadline():
+    hosts = {"esxi1": FakeHost([
+        {"uuid": "fast", "datastores": ["ds1"]},
+        {"uuid": "slow", "datastores": ["ds1"], "delay": 1},
+    ])}
+    orchestrator = VMSnapshotOrchestrator(SessionPool(inventory(hosts)), deadline=0.3)
+
+    start = time.monotonic()
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1")], "snap", "")
+    assert time.monotonic() - start < 0.6
+
+    item, = items
+    assert item["outcomes"]["fast"]["status"] == "SNAPSHOTTED"
+    assert item["outcomes"]["slow"]["status"] == "TIMEOUT"
+    assert item["snapvmfails"] == [["slow", "vm-slow"]]
+
+    # Snapshot that completed after the deadline is removed as well
+    orchestrator.deadline = 5
+    assert orchestrator.end("snap", items) == ([], [])
+    assert all(vm.snapshots == set() for vm in hosts["esxi1"].vms.values())
+
+
+def test__orchestrator__deadline_includes_login():
+    hosts = {
+        "esxi1": FakeHost([{"uuid": "a", "datastores": ["ds1"]}]),
+        "esxi2": FakeHost([{"uuid": "b", "datastores": ["ds1"]}]),
+    }
+    hosts["esxi2"].login_delay = 0.6
+    orchestrator = VMSnapshotOrchestrator(SessionPool(inventory(hosts)), deadline=0.3)
+
+    start = time.monotonic()
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1"), vmsnapobj("esxi2")], "snap", "")
+    assert time.monotonic() - start < 0.5
+
+    assert [item["vmsnapobj"]["hostname"] for item in items] == ["esxi1"]
+    assert [(vmsnapobj["hostname"], type(e)) for vmsnapobj, e in login_failures] == [("esxi2", TimeoutError)]
+
+    # Host that logged in after the deadline does not snapshot its VMs
+    time.sleep(0.6)
+    assert hosts["esxi1"].vms["a"].snapshots == {"snap"}
+    assert hosts["esxi2"].vms["b"].snapshots == set()
+
+
+def test__orchestrator__reuses_session_between_begin_and_end():
+    hosts = {"esxi1": FakeHost([{"uuid": "a", "datastores": ["ds1", "ds2"]}])}
+    pool = SessionPool(inventory(hosts))
+    orchestrator = VMSnapshotOrchestrator(pool)
+
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1", "ds1"), vmsnapobj("esxi1", "ds2")], "snap", "")
+    orchestrator.end("snap", items)
+    assert hosts["esxi1"].logins == 1
+
+    # Expired session is replaced
+    for session, last_used in pool.sessions.values():
+        session.disconnect()
+    items, login_failures = orchestrator.begin([vmsnapobj("esxi1")], "snap2", "")
+    assert hosts["esxi1"].logins == 2
+
+
+def test__session_pool__idle_timeout():
+    hosts = {"esxi1": FakeHost()}
+    pool = SessionPool(inventory(hosts), idle_timeout=0)
+
+    session = pool.get(vmsnapobj("esxi1"))
+    time.sleep(0.01)
+    assert pool.get(vmsnapobj("esxi1")) is not session
+    assert not session.alive()
+    assert hosts["esxi1"].logins == 2
+
+
+def test__session_pool__expire():
+    hosts = {"esxi1": FakeHost(), "esxi2": FakeHost()}
+    pool = SessionPool(inventory(hosts), idle_timeout=0.1)
+
+    idle = pool.get(vmsnapobj("esxi1"))
+    time.sleep(0.15)
+    used = pool.get(vmsnapobj("esxi2"))
+    pool.expire()
+
+    assert not idle.alive()
+    assert used.alive()
+    assert [key[0] for key in pool.sessions] == ["esxi2"]
@@ -4,10 +4,12 @@ from datetime import time
 import errno
 import ipaddress
 import os
+from time import perf_counter
 
 from croniter import croniter
 
 from middlewared.service_exception import ValidationErrors
+from middlewared.utils.call_stats import current_call
 
 NOT_PROVIDED = object()
 
@@ -815,6 +817,9 @@ def resolver(schemas, f):
     f.accepts.clear()
     f.accepts.extend(new_params)
 
+    if hasattr(f, 'compile_accepts'):
+        f.compile_accepts()
+
 
 def resolve_methods(schemas, to_resolve):
     while len(to_resolve) > 0:
@@ -831,6 +836,366 @@ def resolve_methods(schemas, to_resolve):
             raise ValueError(f'Not all schemas could be resolved: {to_resolve}')
 
 
+IMMUTABLE_TYPES = (type(None), bool, int, float, str, bytes, time)
+
+
+def _copy_default(default):
+    """
+    Returns a function returning a copy of `default`, without copying immutable values.
+    """
+    if isinstance(default, IMMUTABLE_TYPES):
+        return lambda: default
+    return lambda: copy.deepcopy(default)
+
+
+def _copy_value(value):
+    """
+    Copy of `value` that does not share anything with it.
+    """
+    if isinstance(value, IMMUTABLE_TYPES):
+        return value
+    # Much faster than `deepcopy` for JSON payloads
+    if type(value) is dict:
+        return {k: _copy_value(v) for k, v in value.items()}
+    if type(value) is list:
+        return [_copy_value(v) for v in value]
+    return copy.deepcopy(value)
+
+
+def _compile_attribute_clean(attr):
+    # Attribute.clean
+    name = attr.name
+    null = attr.null
+    has_default = attr.has_default
+    default = _copy_default(attr.default)
+
+    def clean(value):
+        if value is None and null is False:
+            raise Error(name, 'null not allowed')
+        if value is NOT_PROVIDED:
+            if has_default:
+                return default()
+            else:
+                raise Error(name, 'attribute required')
+        return value
+
+    enum = attr.enum if isinstance(attr, EnumMixin) else None
+    if enum is None:
+        return clean
+
+    # EnumMixin.clean
+    def enum_clean(value):
+        value = clean(value)
+        if value is None and null:
+            return value
+        if not isinstance(value, (list, tuple)):
+            tmp = [value]
+        else:
+            tmp = value
+        for v in tmp:
+            if v not in enum:
+                raise Error(name, f'Invalid choice: {value}')
+        return value
+
+    return enum_clean
+
+
+def _compile_str_clean(attr, base):
+    name = attr.name
+    empty = attr.empty
+
+    def clean(value):
+        value = base(value)
+        if value is None:
+            return value
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = str(value)
+        if not isinstance(value, str):
+            raise Error(name, 'Not a string')
+        if not empty and not value:
+            raise Error(name, 'Empty value not allowed')
+        return value
+
+    return clean
+
+
+def _compile_path_clean(attr, base):
+    str_clean = _compile_str_clean(attr, base)
+
+    def clean(value):
+        value = str_clean(value)
+
+        if value is None:
+            return value
+
+        return os.path.normpath(value.strip().strip("/").strip())
+
+    return clean
+
+
+def _compile_bool_clean(attr, base):
+    name = attr.name
+
+    def clean(value):
+        value = base(value)
+        if value is None:
+            return value
+        if not isinstance(value, bool):
+            raise Error(name, 'Not a boolean')
+        return value
+
+    return clean
+
+
+def _compile_int_clean(attr, base):
+    name = attr.name
+
+    def clean(value):
+        value = base(value)
+        if value is None:
+            return value
+        if not isinstance(value, int) or isinstance(value, bool):
+            if isinstance(value, str) and value.isdigit():
+                return int(value)
+            raise Error(name, 'Not an integer')
+        return value
+
+    return clean
+
+
+def _compile_float_clean(attr, base):
+    name = attr.name
+    required = attr.required
+
+    def clean(value):
+        value = base(value)
+        if value is None and not required:
+            return attr.default
+        try:
+            # float(False) = 0.0
+            # float(True) = 1.0
+            if isinstance(value, bool):
+                raise TypeError()
+            return float(value)
+        except (TypeError, ValueError):
+            raise Error(name, 'Not a floating point number')
+
+    return clean
+
+
+def _compile_list_clean(attr, base):
+    name = attr.name
+    empty = attr.empty
+    default = _copy_default(attr.default)
+    items = [_compile_clean(i) for i in attr.items]
+
+    def clean(value):
+        value = base(value)
+        if value is None:
+            return default()
+        if not isinstance(value, list):
+            raise Error(name, 'Not a list')
+        if not empty and not value:
+            raise Error(name, 'Empty value not allowed')
+        if not items:
+            # Items are not cleaned, never share them with the caller
+            return _copy_value(value)
+        # Never modify caller's list
+        value = list(value)
+        item_clean = items[0]
+        for index, v in enumerate(value):
+            try:
+                value[index] = item_clean(v)
+            except Error as e:
+                raise Error(name, 'Item#{0} is not valid per list types: {1}'.format(index, e))
+        return value
+
+    return clean
+
+
+def _compile_dict_clean(attr, base):
+    name = attr.name
+    additional_attrs = attr.additional_attrs
+    update = attr.update
+    default = _copy_default(attr.default)
+    attrs = {key: _compile_clean(i) for key, i in attr.attrs.items()}
+    # Attributes populated when not provided
+    defaults = [
+        (i.name, attrs[key]) for key, i in attr.attrs.items()
+        if i.required or i.has_default
+    ] if not update else []
+
+    def clean(data):
+        data = base(data)
+
+        if data is None:
+            return default()
+
+        if not isinstance(data, dict):
+            raise Error(name, 'A dict was expected')
+
+        # Never modify caller's dict
+        data = dict(data)
+        for key, value in list(data.items()):
+            attr_clean = attrs.get(key)
+            if attr_clean is None:
+                if not additional_attrs:
+                    raise Error(key, 'Field was not expected')
+                data[key] = _copy_value(value)
+                continue
+
+            data[key] = attr_clean(value)
+
+        for attr_name, attr_clean in defaults:
+            if attr_name not in data:
+                data[attr_name] = attr_clean(NOT_PROVIDED)
+
+        return data
+
+    return clean
+
+
+def _compile_clean(attr):
+    """
+    Returns function equivalent to `attr.clean` that does not modify its argument and returns values that do not
+    share anything with it.
+
+    Attributes that have their own `clean` implementation (or lists with more than
+    one item type, which clean the same value several times) are called on a copy.
+    """
+    compilers = {
+        Attribute.clean: None,
+        EnumMixin.clean: None,
+        Str.clean: _compile_str_clean,
+        Path.clean: _compile_path_clean,
+        Bool.clean: _compile_bool_clean,
+        Int.clean: _compile_int_clean,
+        Float.clean: _compile_float_clean,
+        List.clean: _compile_list_clean,
+        Dict.clean: _compile_dict_clean,
+    }
+    method = type(attr).clean
+    if method not in compilers or (isinstance(attr, List) and len(attr.items) > 1):
+        return lambda value: attr.clean(value if value is NOT_PROVIDED else copy.deepcopy(value))
+
+    clean = _compile_attribute_clean(attr)
+    if compilers[method] is None:
+        # Values of any type (e.g. `Any`) are not rebuilt, never share them with the caller
+        attribute_clean = clean
+        return lambda value: _copy_value(attribute_clean(value))
+    return compilers[method](attr, clean)
+
+
+def _compile_attribute_validate(attr):
+    # Attribute.validate
+    name = attr.name
+    validators = attr.validators
+    if not validators:
+        return None
+
+    def validate(value):
+        verrors = ValidationErrors()
+
+        for validator in validators:
+            try:
+                validator(value)
+            except ValueError as e:
+                verrors.add(name, str(e))
+
+        if verrors:
+            raise verrors
+
+    return validate
+
+
+def _compile_list_validate(attr):
+    name = attr.name
+    unique = attr.unique
+    items = [v for v in map(_compile_validate, attr.items) if v is not None]
+    validate_attribute = _compile_attribute_validate(attr)
+    if not unique and not items and validate_attribute is None:
+        return None
+
+    def validate(value):
+        if value is None:
+            return
+
+        verrors = ValidationErrors()
+
+        s = set()
+        for i, v in enumerate(value):
+            if unique:
+                if isinstance(v, dict):
+                    v = tuple(sorted(list(v.items())))
+                if v in s:
+                    verrors.add(f"{name}.{i}", "This value is not unique.")
+                s.add(v)
+            for item_validate in items:
+                try:
+                    item_validate(v)
+                except ValidationErrors as e:
+                    verrors.add_child(f"{name}.{i}", e)
+
+        if verrors:
+            raise verrors
+
+        if validate_attribute is not None:
+            validate_attribute(value)
+
+    return validate
+
+
+def _compile_dict_validate(attr):
+    name = attr.name
+    attrs = [(i.name, v) for i, v in [(i, _compile_validate(i)) for i in attr.attrs.values()] if v is not None]
+    if not attrs:
+        return None
+
+    def validate(value):
+        if value is None:
+            return
+
+        verrors = ValidationErrors()
+
+        for attr_name, attr_validate in attrs:
+            if attr_name in value:
+                try:
+                    attr_validate(value[attr_name])
+                except ValidationErrors as e:
+                    verrors.add_child(name, e)
+
+        if verrors:
+            raise verrors
+
+    return validate
+
+
+def _compile_validate(attr):
+    """
+    Returns function equivalent to `attr.validate` or None if it would never fail.
+    """
+    method = type(attr).validate
+    if method is Attribute.validate:
+        return _compile_attribute_validate(attr)
+    if method is List.validate:
+        return _compile_list_validate(attr)
+    if method is Dict.validate:
+        return _compile_dict_validate(attr)
+    return attr.validate
+
+
+def compile_attribute(attr):
+    """
+    Compile `attr` into a (clean, validate) pair of functions.
+
+    `clean` returns the same value as `attr.clean` and raises the same errors,
+    but rebuilds containers it has to change instead of deep copying its
+    argument first. The value it returns never shares anything mutable with
+    its argument. `validate` is None when validation can never fail.
+    """
+    return _compile_clean(attr), _compile_validate(attr)
+
+
 def accepts(*schema):
     def wrap(f):
         # Make sure number of schemas is same as method argument
@@ -843,25 +1208,40 @@ def accepts(*schema):
             args_index += f._skip_arg
         assert len(schema) == f.__code__.co_argcount - args_index  # -1 for self
 
+        compiled = None
+
+        def compile_accepts():
+            """
+            Compile argument schemas into validators, called once schemas have been resolved.
+            """
+            nonlocal compiled
+            compiled = [compile_attribute(attr) for attr in nf.accepts]
+            return compiled
+
         def clean_and_validate_args(args, kwargs):
+            validators = compiled
+            if validators is None:
+                validators = compile_accepts()
+
+            # Cleaned arguments never share mutable values with the caller's ones
             args = list(args)
-            args = args[:args_index] + copy.deepcopy(args[args_index:])
-            kwargs = copy.deepcopy(kwargs)
+            kwargs = dict(kwargs)
 
             verrors = ValidationErrors()
 
             # Iterate over positional args first, excluding self
             i = 0
             for _ in args[args_index:]:
-                attr = nf.accepts[i]
+                clean, validate = validators[i]
 
-                value = attr.clean(args[args_index + i])
+                value = clean(args[args_index + i])
                 args[args_index + i] = value
 
-                try:
-                    attr.validate(value)
-                except ValidationErrors as e:
-                    verrors.extend(e)
+                if validate is not None:
+                    try:
+                        validate(value)
+                    except ValidationErrors as e:
+                        verrors.extend(e)
 
                 i += 1
 
@@ -870,38 +1250,51 @@ def accepts(*schema):
                 kwarg = f.__code__.co_varnames[x]
 
                 if kwarg in kwargs:
-                    attr = nf.accepts[i]
+                    clean, validate = validators[i]
                     i += 1
 
                     value = kwargs[kwarg]
-                elif len(nf.accepts) >= i + 1:
-                    attr = nf.accepts[i]
+                elif len(validators) >= i + 1:
+                    clean, validate = validators[i]
                     i += 1
                     value = NOT_PROVIDED
                 else:
                     i += 1
                     continue
 
-                value = attr.clean(value)
+                value = clean(value)
                 kwargs[kwarg] = value
 
-                try:
-                    attr.validate(value)
-                except ValidationErrors as e:
-                    verrors.extend(e)
+                if validate is not None:
+                    try:
+                        validate(value)
+                    except ValidationErrors as e:
+                        verrors.extend(e)
 
             if verrors:
                 raise verrors
 
             return args, kwargs
 
+        def timed_clean_and_validate_args(args, kwargs):
+            # Account validation time to the call being run (see `Middleware._call`)
+            timing = current_call.get()
+            if timing is None:
+                return clean_and_validate_args(args, kwargs)
+
+            start = perf_counter()
+            try:
+                return clean_and_validate_args(args, kwargs)
+            finally:
+                timing.validation += perf_counter() - start
+
         if asyncio.iscoroutinefunction(f):
             async def nf(*args, **kwargs):
-                args, kwargs = clean_and_validate_args(args, kwargs)
+                args, kwargs = timed_clean_and_validate_args(args, kwargs)
                 return await f(*args, **kwargs)
         else:
             def nf(*args, **kwargs):
-                args, kwargs = clean_and_validate_args(args, kwargs)
+                args, kwargs = timed_clean_and_validate_args(args, kwargs)
                 return f(*args, **kwargs)
 
         nf.__name__ = f.__name__
@@ -914,6 +1307,7 @@ def accepts(*schema):
             if i.startswith('_'):
                 setattr(nf, i, getattr(f, i))
         nf.accepts = list(schema)
+        nf.compile_accepts = compile_accepts
 
         return nf
     return wrap
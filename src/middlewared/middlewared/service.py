@@ -15,12 +15,12 @@ import time
 from middlewared.schema import accepts, Bool, Dict, Int, List, Ref, Str
 from middlewared.service_exception import CallException, CallError, ValidationError, ValidationErrors  # noqa
 from middlewared.utils import filter_list
-from middlewared.logger import Logger
+from middlewared.logger import Logger, logging_stats
 from middlewared.job import Job
 from middlewared.pipe import Pipes
 
 
-PeriodicTaskDescriptor = namedtuple("PeriodicTaskDescriptor", ["interval", "run_on_start"])
+PeriodicTaskDescriptor = namedtuple("PeriodicTaskDescriptor", ["interval", "run_on_start", "jitter", "timeout"])
 
 
 def item_method(fn):
@@ -117,9 +117,29 @@ def pass_app(fn):
     return fn
 
 
-def periodic(interval, run_on_start=True):
+def periodic(interval, run_on_start=True, jitter=0, timeout=None):
+    """
+    Run the method every `interval` seconds (plus up to `jitter` random seconds), cancelling runs that take longer
+    than `timeout` seconds.
+    """
+    def wrapper(fn):
+        fn._periodic = PeriodicTaskDescriptor(interval, run_on_start, jitter, timeout)
+        return fn
+
+    return wrapper
+
+
+def setup_depends(*plugins):
+    """
+    Flag a plugin `setup` function to only run after the `setup` of the
+    given plugins (module names) has finished.
+
+    This opts the setup in to running concurrently with any other setup it
+    does not depend on, so every plugin it relies on has to be listed. Setups
+    not using this decorator keep running one after another in plugin order.
+    """
     def wrapper(fn):
-        fn._periodic = PeriodicTaskDescriptor(interval, run_on_start)
+        fn._setup_depends = plugins
         return fn
 
     return wrapper
@@ -407,6 +427,50 @@ class CoreService(Service):
         job = self.middleware.jobs.all()[id]
         return job.abort()
 
+    @accepts(Bool('reset', default=False))
+    async def call_stats(self, reset):
+        """
+        Returns latency, thread/process pool queue wait and arguments validation time (in seconds) histogram
+        summaries for every called method, how many calls ran in a coroutine, thread, process or as a job, and the
+        slowest recent calls with their arguments redacted.
+
+        `reset` clears the statistics after they are read.
+        """
+        stats = self.middleware.call_stats.get()
+        if reset:
+            self.middleware.call_stats.reset()
+        return stats
+
+    @accepts()
+    async def periodic_tasks(self):
+        """
+        Returns periodic tasks with their interval, jitter and timeout (in seconds), whether they are running, when
+        they run next, how many times they ran, failed, timed out or were skipped because the previous run was still
+        going, last exception and history of recent runs.
+        """
+        return self.middleware.periodic.get()
+
+    @accepts(Str('name'))
+    async def periodic_task_run(self, name):
+        """
+        Runs periodic task `name` (e.g. `alert.process_alerts`) now, or waits for its current run to finish.
+
+        Returns state of the run: SUCCESS, FAILED or TIMEOUT.
+        """
+        if name not in self.middleware.periodic.tasks:
+            raise CallError(f'Periodic task {name} does not exist', errno.ENOENT)
+
+        return await self.middleware.periodic.run(name)
+
+    @accepts()
+    async def process_pool_stats(self):
+        """
+        Returns process pool size, how many calls are running or waiting for a worker, how many times workers were
+        recycled or crashed, and queue wait and execution time (in seconds) histogram summaries of every method run
+        in the pool.
+        """
+        return self.middleware.process_pool_stats()
+
     @accepts()
     def get_services(self):
         """Returns a list of all registered services."""
@@ -536,6 +600,17 @@ class CoreService(Service):
                 }
         return data
 
+    @accepts()
+    def startup_profile(self):
+        """
+        Returns how long it took to import and setup every plugin during
+        middlewared startup, in seconds.
+
+        `setup_start` is relative to the start of the first plugin setup and
+        `setup_depends` lists the plugins whose setup had to finish first.
+        """
+        return self.middleware.startup_profile
+
     @private
     async def call_hook(self, name, args, kwargs=None):
         kwargs = kwargs or {}
@@ -579,15 +654,28 @@ class CoreService(Service):
         """
         handler = logging._handlers.get('file')
         if handler:
-            stream = handler.stream
-            handler.stream = handler._open()
-            if sys.stdout is stream:
-                sys.stdout = handler.stream
-                sys.stderr = handler.stream
-            try:
-                stream.close()
-            except Exception:
-                pass
+            # File handler is run by the logging queue listener thread
+            with handler.lock:
+                stream = handler.stream
+                handler.stream = handler._open()
+                if sys.stdout is stream:
+                    sys.stdout = handler.stream
+                    sys.stderr = handler.stream
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+
+    @accepts()
+    def logging_stats(self):
+        """
+        Returns statistics of the logging queue.
+
+        `queue_size` is the number of log records waiting to be written,
+        `dropped` the number of records discarded because the queue was full
+        and `rate_limited` the number of records suppressed per logger.
+        """
+        return logging_stats()
 
     @private
     @accepts(Dict(
@@ -0,0 +1,199 @@
+import asyncio
+import codecs
+import errno
+import fcntl
+import logging
+import os
+import struct
+import termios
+
+logger = logging.getLogger(__name__)
+
+# Output of the shell is coalesced into frames of at most FRAME_SIZE bytes
+# sent at most every FRAME_INTERVAL seconds.
+FRAME_SIZE = 65536
+FRAME_INTERVAL = 0.01
+
+
+class ShellWorker(object):
+    """
+    Runs `cmd` in a new pty driven by the asyncio event loop.
+
+    Output is read from the pty master when the loop reports it readable and
+    is coalesced into text frames handed to the `send` coroutine.
+    Reading from the pty is paused while a frame is being sent so a slow
+    consumer blocks the shell instead of piling up output in memory.
+    """
+
+    def __init__(self, loop, send, cmd, env=None, cwd=None, frame_size=FRAME_SIZE, frame_interval=FRAME_INTERVAL):
+        self.loop = loop
+        self.send = send
+        self.cmd = cmd
+        self.env = env or {}
+        self.cwd = cwd
+        self.frame_size = frame_size
+        self.frame_interval = frame_interval
+        self.pid = None
+        self.master_fd = None
+        self.returncode = None
+
+        self._buffer = bytearray()
+        self._input = bytearray()
+        self._decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        self._flush_handle = None
+        self._reading = False
+        self._writing = False
+        self._sending = False
+        self._discard = False
+        self._eof = False
+        self._closed = loop.create_future()
+
+    def start(self):
+        self.pid, self.master_fd = os.forkpty()
+        if self.pid == 0:
+            try:
+                os.closerange(3, 1024)
+                if self.cwd:
+                    os.chdir(self.cwd)
+                os.execve(self.cmd[0], self.cmd, self.env)
+            finally:
+                os._exit(1)
+
+        os.set_blocking(self.master_fd, False)
+        self._resume_reading()
+
+    def write(self, data):
+        """
+        Write user input to the shell.
+        """
+        if self.master_fd is None:
+            return
+        self._input += data
+        if not self._writing:
+            self._on_writable()
+
+    def resize(self, cols, rows):
+        """
+        Set terminal window size. The kernel delivers SIGWINCH to the shell.
+        """
+        if self.master_fd is None:
+            return
+        fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+    async def wait(self):
+        """
+        Wait for the shell to exit and all its output to be sent.
+        """
+        return await asyncio.shield(self._closed)
+
+    def abandon(self):
+        """
+        Stop handling a shell process that could not be killed.
+        """
+        self._eof = True
+        self._finish()
+
+    def _resume_reading(self):
+        if not self._reading and not self._eof:
+            self.loop.add_reader(self.master_fd, self._on_readable)
+            self._reading = True
+
+    def _pause_reading(self):
+        if self._reading:
+            self.loop.remove_reader(self.master_fd)
+            self._reading = False
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master_fd, self.frame_size)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Linux returns EIO once the slave side of the pty is closed
+            if e.errno != errno.EIO:
+                logger.debug('Failed to read from shell pty', exc_info=True)
+            data = b''
+
+        if not data:
+            self._eof = True
+            self._pause_reading()
+            self._flush_now()
+            return
+
+        self._buffer += data
+        if len(self._buffer) >= self.frame_size:
+            self._flush_now()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.frame_interval, self._flush_now)
+
+    def _on_writable(self):
+        try:
+            while self._input:
+                written = os.write(self.master_fd, self._input)
+                del self._input[:written]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._input.clear()
+
+        if self._input and not self._writing:
+            self.loop.add_writer(self.master_fd, self._on_writable)
+            self._writing = True
+        elif not self._input and self._writing:
+            self.loop.remove_writer(self.master_fd)
+            self._writing = False
+
+    def _flush_now(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._sending:
+            return
+        self._sending = True
+        # Do not read any more output until current frames have been sent
+        self._pause_reading()
+        self.loop.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._buffer:
+                data = bytes(self._buffer[:self.frame_size])
+                del self._buffer[:self.frame_size]
+                text = self._decoder.decode(data, final=self._eof and not self._buffer)
+                if text and not self._discard:
+                    try:
+                        await self.send(text)
+                    except Exception:
+                        # Websocket is gone, keep draining the pty so the shell does not block
+                        logger.debug('Failed to send shell output', exc_info=True)
+                        self._discard = True
+        finally:
+            self._sending = False
+
+        if self._eof:
+            await self._reap()
+        else:
+            self._resume_reading()
+
+    async def _reap(self):
+        if self.pid and self.returncode is None:
+            try:
+                pid, status = await self.loop.run_in_executor(None, os.waitpid, self.pid, 0)
+                self.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            except ChildProcessError:
+                pass
+        self._finish()
+
+    def _finish(self):
+        self._pause_reading()
+        if self._writing:
+            self.loop.remove_writer(self.master_fd)
+            self._writing = False
+        if self.master_fd is not None:
+            try:
+                os.close(self.master_fd)
+            except OSError:
+                pass
+            self.master_fd = None
+        if not self._closed.done():
+            self._closed.set_result(self.returncode)
@@ -6,6 +6,7 @@ import re
 import sys
 import subprocess
 import threading
+import time
 from datetime import datetime, timedelta
 from itertools import chain
 from functools import wraps
@@ -321,7 +322,13 @@ class cache_with_autorefresh(object):
         return wrapper
 
 
-def load_modules(directory):
+def load_modules(directory, timings=None):
+    """
+    Import every python module in `directory`.
+
+    If a `timings` dict is given the time spent importing each module is
+    stored in it, keyed by the module short name.
+    """
     modules = []
     for f in os.listdir(directory):
         if not f.endswith('.py'):
@@ -332,12 +339,15 @@ def load_modules(directory):
             os.path.relpath(directory, os.path.dirname(os.path.dirname(__file__))).split('/') +
             [f]
         )
+        start = time.monotonic()
         fp, pathname, description = imp.find_module(f, [directory])
         try:
             modules.append(imp.load_module(name, fp, pathname, description))
         finally:
             if fp:
                 fp.close()
+        if timings is not None:
+            timings[f] = time.monotonic() - start
 
     return modules
 
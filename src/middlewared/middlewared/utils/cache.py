@@ -0,0 +1,156 @@
+# -*- coding=utf-8 -*-
+from collections import namedtuple, OrderedDict
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["LRUCache", "approximate_size"]
+
+CacheEntry = namedtuple("CacheEntry", ["value", "timeout", "size"])
+COUNTERS = ("hits", "misses", "evictions", "expirations")
+
+
+def approximate_size(value, depth=4):
+    """
+    Approximate memory used by `value` and (up to `depth` levels of) the containers it is made of.
+    """
+    size = sys.getsizeof(value)
+    if depth > 0:
+        if isinstance(value, dict):
+            size += sum(approximate_size(k, depth - 1) + approximate_size(v, depth - 1) for k, v in value.items())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += sum(approximate_size(v, depth - 1) for v in value)
+    return size
+
+
+class LRUCache:
+    """
+    Thread-safe cache of namespaced keys bound by entry count and approximate size in bytes. Least recently used
+    entries are evicted first.
+
+    `timeout` of an entry is a number of seconds it is valid for (0 means forever). Expired entries are removed when
+    they are read. Entries that never expire are often used as persistent flags, so they are never evicted: they count
+    towards the bounds but only entries with a timeout are evicted to make room.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counters = {}
+
+    def _count(self, namespace, counter):
+        counters = self.counters.get(namespace)
+        if counters is None:
+            counters = self.counters[namespace] = dict.fromkeys(COUNTERS, 0)
+        counters[counter] += 1
+
+    def _remove(self, k):
+        entry = self.entries.pop(k)
+        self.bytes -= entry.size
+        return entry
+
+    def has(self, namespace, key):
+        with self.lock:
+            return (namespace, key) in self.entries
+
+    def get(self, namespace, key):
+        """
+        Raises:
+            KeyError: not found in the cache or expired
+        """
+        k = (namespace, key)
+        with self.lock:
+            entry = self.entries.get(k)
+            if entry is None:
+                self._count(namespace, "misses")
+                raise KeyError(key)
+
+            if entry.timeout > 0 and time.monotonic() >= entry.timeout:
+                self._remove(k)
+                self._count(namespace, "expirations")
+                self._count(namespace, "misses")
+                raise KeyError(f"{key} has expired")
+
+            self.entries.move_to_end(k)
+            self._count(namespace, "hits")
+            return entry.value
+
+    def put(self, namespace, key, value, timeout=0):
+        if timeout != 0:
+            timeout = time.monotonic() + timeout
+
+        k = (namespace, key)
+        size = approximate_size(value)
+        with self.lock:
+            if k in self.entries:
+                self._remove(k)
+
+            if timeout != 0 and size > self.max_bytes:
+                logger.debug("Not caching %r in %r: %d bytes is more than cache size", key, namespace, size)
+                self._count(namespace, "evictions")
+                return
+
+            self.entries[k] = CacheEntry(value, timeout, size)
+            self.bytes += size
+
+            self._evict()
+
+    def _evict(self):
+        excess_entries = len(self.entries) - self.max_entries
+        excess_bytes = self.bytes - self.max_bytes
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+
+        evicted = []
+        for k, entry in self.entries.items():
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            if entry.timeout == 0:
+                continue
+            evicted.append(k)
+            excess_entries -= 1
+            excess_bytes -= entry.size
+
+        for k in evicted:
+            self._remove(k)
+            self._count(k[0], "evictions")
+
+    def pop(self, namespace, key):
+        """
+        Removes `key` and returns its value or None.
+        """
+        with self.lock:
+            k = (namespace, key)
+            if k in self.entries:
+                return self._remove(k).value
+
+    def clear(self, namespace=None):
+        with self.lock:
+            for k in [k for k in self.entries if namespace is None or k[0] == namespace]:
+                self._remove(k)
+
+    def stats(self):
+        with self.lock:
+            namespaces = {
+                namespace: dict(counters, entries=0, bytes=0)
+                for namespace, counters in self.counters.items()
+            }
+            for (namespace, key), entry in self.entries.items():
+                stats = namespaces.setdefault(namespace, dict(dict.fromkeys(COUNTERS, 0), entries=0, bytes=0))
+                stats["entries"] += 1
+                stats["bytes"] += entry.size
+
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                **{counter: sum(stats[counter] for stats in namespaces.values()) for counter in COUNTERS},
+                "namespaces": namespaces,
+            }
@@ -0,0 +1,217 @@
+# -*- coding=utf-8 -*-
+from collections import deque
+import contextvars
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["LatencyHistogram", "CallStats", "CallTiming", "current_call", "timed", "timed_in_process"]
+
+# Timing of the method call being run in the current task (or executor thread)
+current_call = contextvars.ContextVar("current_call", default=None)
+
+
+class CallTiming:
+    """
+    When the call was submitted, when it started running (after waiting in thread or process pool queue) and how
+    long its arguments validation took.
+    """
+
+    __slots__ = ("submitted", "started", "validation")
+
+    def __init__(self):
+        self.submitted = self.started = time.monotonic()
+        self.validation = 0.0
+
+
+def timed(timing, method, *args):
+    """
+    Runs `method` (in executor), setting `timing` of the call.
+    """
+    timing.started = time.monotonic()
+    token = current_call.set(timing)
+    try:
+        return method(*args)
+    finally:
+        current_call.reset(token)
+
+
+def timed_in_process(method, *args):
+    """
+    Runs `method` in process pool returning its start time, validation time and result (as `timing` can't be shared
+    with another process). Monotonic clock is system-wide so start time is comparable with the parent process.
+    """
+    timing = CallTiming()
+    result = timed(timing, method, *args)
+    return timing.started, timing.validation, result
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations with microsecond resolution and `SUB_BUCKET_BITS` bits of precision (a value is
+    off by less than 1/16th), similar to HdrHistogram.
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    @classmethod
+    def index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return ((shift + 1) << cls.SUB_BUCKET_BITS) + (value >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def bounds(cls, index):
+        """
+        Lowest and highest value (in microseconds) counted in bucket `index`.
+        """
+        if index < cls.SUB_BUCKETS:
+            return index, index
+
+        shift = (index >> cls.SUB_BUCKET_BITS) - 1
+        lowest = ((index & (cls.SUB_BUCKETS - 1)) + cls.SUB_BUCKETS) << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def record(self, seconds):
+        # Same as `self.index` inlined as this is called for every method call
+        value = int(seconds * 1000000)
+        if value < self.SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - self.SUB_BUCKET_BITS - 1
+            index = ((shift + 1) << self.SUB_BUCKET_BITS) + (value >> shift) - self.SUB_BUCKETS
+
+        try:
+            self.counts[index] += 1
+        except IndexError:
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+            self.counts[index] += 1
+
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percentile):
+        """
+        Duration (in seconds) `percentile` percent of recorded values are lower than or equal to.
+        """
+        if not self.count:
+            return None
+
+        rank = max(1, self.count * percentile / 100)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds(index)[1] / 1000000, self.max)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            **{f"p{str(p).replace('.', '')}": self.percentile(p) for p in (50, 90, 99, 99.9)},
+        }
+
+
+class MethodStats:
+    __slots__ = ("errors", "paths", "latency", "queue_wait", "validation")
+
+    def __init__(self):
+        self.errors = 0
+        self.paths = {}
+        self.latency = LatencyHistogram()
+        self.queue_wait = LatencyHistogram()
+        self.validation = LatencyHistogram()
+
+
+class CallStats:
+    """
+    Latency histograms of every called method and the slowest recent calls.
+
+    Calls taking at least `slow_threshold` seconds are kept in a ring buffer of `slow_calls` entries along with their
+    (redacted) arguments. Not thread-safe: calls are recorded in the event loop thread.
+    """
+
+    def __init__(self, slow_calls=100, slow_threshold=1.0):
+        self.methods = {}
+        self.slow_threshold = slow_threshold
+        self.slow = deque(maxlen=slow_calls)
+
+    def record(self, name, path, duration, queue_wait=None, validation=None, error=False, arguments=None):
+        """
+        Records call of `name` that took `duration` seconds.
+
+        `path` is how the call was run (e.g. coroutine, thread or process). `arguments` is a callable returning
+        redacted call arguments, only called for slow calls.
+        """
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = MethodStats()
+
+        paths = stats.paths
+        paths[path] = paths.get(path, 0) + 1
+        stats.latency.record(duration)
+        if queue_wait is not None:
+            stats.queue_wait.record(queue_wait)
+        if validation:
+            stats.validation.record(validation)
+        if error:
+            stats.errors += 1
+
+        if duration >= self.slow_threshold:
+            try:
+                arguments = arguments() if arguments is not None else None
+            except Exception:
+                logger.debug("Failed to dump arguments of %r", name, exc_info=True)
+                arguments = None
+
+            self.slow.append({
+                "method": name,
+                "path": path,
+                "time": time.time(),
+                "duration": duration,
+                "queue_wait": queue_wait,
+                "validation": validation,
+                "error": error,
+                "arguments": arguments,
+            })
+
+    def reset(self):
+        self.methods.clear()
+        self.slow.clear()
+
+    def get(self):
+        return {
+            "methods": {
+                name: {
+                    "count": stats.latency.count,
+                    "errors": stats.errors,
+                    "paths": dict(stats.paths),
+                    "latency": stats.latency.summary(),
+                    "queue_wait": stats.queue_wait.summary(),
+                    "validation": stats.validation.summary(),
+                }
+                for name, stats in self.methods.items()
+            },
+            "slow_calls": sorted(self.slow, key=lambda call: call["duration"], reverse=True),
+            "slow_threshold": self.slow_threshold,
+        }
@@ -0,0 +1,204 @@
+# -*- coding=utf-8 -*-
+from collections import defaultdict, OrderedDict
+import hashlib
+import logging
+import threading
+
+import dateutil
+import dateutil.parser
+from OpenSSL import crypto
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["certificate_info", "csr_info", "normalize_private_key", "signedby_id", "CATree"]
+
+
+class PEMCache:
+    """
+    LRU cache of values computed from PEM text, keyed by SHA-256 of the text.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pem, compute):
+        key = hashlib.sha256(pem.encode()).digest()
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+
+        value = compute(pem)
+        with self.lock:
+            self.misses += 1
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+CERTIFICATE_CACHE = PEMCache()
+PRIVATE_KEY_CACHE = PEMCache()
+CSR_CACHE = PEMCache()
+
+
+def _dn(obj):
+    return '/' + '/'.join([
+        '%s=%s' % (c[0].decode(), c[1].decode())
+        for c in obj.get_subject().get_components()
+    ])
+
+
+def _ctime(asn1_time):
+    return dateutil.parser.parse(asn1_time).astimezone(dateutil.tz.tzutc()).ctime()
+
+
+def _certificate_info(pem):
+    try:
+        obj = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+    except Exception:
+        logger.debug('Failed to load certificate', exc_info=True)
+        return None
+
+    return {
+        'pem': crypto.dump_certificate(crypto.FILETYPE_PEM, obj).decode(),
+        'from': _ctime(obj.get_notBefore()),
+        'until': _ctime(obj.get_notAfter()),
+        'DN': _dn(obj),
+    }
+
+
+def certificate_info(pem):
+    """
+    Returns dict with normalized `pem`, validity dates (`from`, `until`) and
+    `DN` of a PEM encoded certificate, or None if it can not be loaded.
+    """
+    return CERTIFICATE_CACHE.get(pem, _certificate_info)
+
+
+def _csr_info(pem):
+    try:
+        obj = crypto.load_certificate_request(crypto.FILETYPE_PEM, pem)
+    except Exception:
+        logger.debug('Failed to load csr', exc_info=True)
+        return None
+
+    return {
+        'pem': crypto.dump_certificate_request(crypto.FILETYPE_PEM, obj).decode(),
+        'DN': _dn(obj),
+    }
+
+
+def csr_info(pem):
+    """
+    Returns dict with normalized `pem` and `DN` of a PEM encoded certificate
+    signing request, or None if it can not be loaded.
+    """
+    return CSR_CACHE.get(pem, _csr_info)
+
+
+def _normalize_private_key(pem):
+    try:
+        obj = crypto.load_privatekey(crypto.FILETYPE_PEM, pem)
+    except Exception:
+        logger.debug('Failed to load privatekey', exc_info=True)
+        return None
+
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM, obj).decode()
+
+
+def normalize_private_key(pem):
+    """
+    Returns normalized PEM encoded private key or None if it can not be loaded.
+    """
+    return PRIVATE_KEY_CACHE.get(pem, _normalize_private_key)
+
+
+def signedby_id(row):
+    signedby = row.get('signedby')
+    if isinstance(signedby, dict):
+        return signedby['id']
+    return signedby
+
+
+class CATree:
+    """
+    In-memory index of certificate authorities and the certificates they signed.
+
+    `cas` and `certs` are datastore rows having `id`, `serial` and `signedby`
+    (either an id or the signing CA row).
+    """
+
+    def __init__(self, cas, certs=()):
+        self.cas = {ca['id']: ca for ca in cas}
+        self.parent = {}
+        self.children = defaultdict(list)
+        for ca in cas:
+            parent = signedby_id(ca)
+            if parent is not None and parent in self.cas:
+                self.parent[ca['id']] = parent
+                self.children[parent].append(ca['id'])
+
+        self.certs = defaultdict(list)
+        for cert in certs:
+            parent = signedby_id(cert)
+            if parent is not None:
+                self.certs[parent].append(cert)
+
+    def chain(self, ca_id):
+        """
+        Returns list of CA ids from `ca_id` up to its root CA.
+        """
+        chain = [ca_id]
+        while chain[-1] in self.parent:
+            parent = self.parent[chain[-1]]
+            if parent in chain:
+                logger.warning('Certificate authority %r is signed by itself through %r', ca_id, chain)
+                break
+            chain.append(parent)
+        return chain
+
+    def root(self, ca_id):
+        return self.chain(ca_id)[-1]
+
+    def subtree(self, ca_id):
+        """
+        Returns ids of `ca_id` and of all CAs it signed directly or indirectly.
+        """
+        result = []
+        seen = set()
+        stack = [ca_id]
+        while stack:
+            id = stack.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+            result.append(id)
+            stack.extend(self.children[id])
+        return result
+
+    def next_serial(self, ca_id):
+        """
+        Returns serial for a new certificate signed by `ca_id`.
+
+        Serials are unique within the whole hierarchy under the root CA of `ca_id`.
+        """
+        serials = []
+        for id in self.subtree(self.root(ca_id)):
+            serials.append(self.cas[id]['serial'])
+            serials.extend(cert['serial'] for cert in self.certs[id])
+
+        # There is for a case when user might have old certs in the db whose serial value isn't set in the db
+        serials = [int(serial) for serial in serials if serial]
+        if not serials:
+            return 1
+        return max(serials) + 1
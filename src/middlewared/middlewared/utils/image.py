@@ -0,0 +1,210 @@
+# -*- coding=utf-8 -*-
+import hashlib
+import logging
+import os
+import stat
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["ImageFetchError", "fetch_image"]
+
+CHUNK_SIZE = 1048576
+BLOCK_SIZE = 65536
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+class SparseWriter:
+    """
+    Writes a byte stream to `fileobj` skipping blocks made only of zeros.
+
+    Output is consumed in `block_size` aligned blocks so holes always cover
+    whole blocks. `fileobj` must be new or already zeroed (e.g. a fresh zvol).
+    """
+
+    def __init__(self, fileobj, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.zero_block = ZERO_BLOCK if block_size == BLOCK_SIZE else bytes(block_size)
+        self.buffer = b''
+        self.offset = 0
+        self.skipped = 0
+
+    def write(self, data):
+        if self.buffer:
+            data = self.buffer + data
+        end = len(data) - len(data) % self.block_size
+        view = memoryview(data)
+        for i in range(0, end, self.block_size):
+            self._write_block(view[i:i + self.block_size])
+        self.buffer = data[end:]
+
+    def _write_block(self, block):
+        if block == self.zero_block[:len(block)]:
+            self.skipped += len(block)
+        else:
+            self.fileobj.seek(self.offset)
+            self.fileobj.write(block)
+        self.offset += len(block)
+
+    def close(self):
+        if self.buffer:
+            self._write_block(memoryview(self.buffer))
+            self.buffer = b''
+        # Trailing holes are not allocated by seek, extend regular files to their real size.
+        if stat.S_ISREG(os.fstat(self.fileobj.fileno()).st_mode):
+            self.fileobj.truncate(self.offset)
+        self.fileobj.flush()
+
+
+class _Pipeline:
+    def __init__(self, dest):
+        self.sha256 = hashlib.sha256()
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.writer = SparseWriter(dest)
+
+    def feed(self, data):
+        self.sha256.update(data)
+        if not self.decompressor.eof:
+            try:
+                self.writer.write(self.decompressor.decompress(data))
+            except zlib.error as e:
+                raise ImageFetchError(f'Image is not a valid gzip file: {e}')
+
+    def finish(self):
+        if not self.decompressor.eof:
+            raise ImageFetchError('Image stream ended before the end of the gzip file')
+        self.writer.write(self.decompressor.flush())
+        self.writer.close()
+
+
+def _open(url, offset):
+    """
+    Open `url` starting at `offset`.
+
+    Returns a tuple of (fileobj, offset the stream actually starts at, total size or None).
+    """
+    if urllib.parse.urlparse(url).scheme == 'file':
+        f = open(urllib.request.url2pathname(urllib.parse.urlparse(url).path), 'rb')
+        total = os.fstat(f.fileno()).st_size
+        f.seek(min(offset, total))
+        return f, min(offset, total), total
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 416:
+            # Range not satisfiable: nothing left past `offset`
+            return None, offset, offset
+        raise
+
+    length = response.headers.get('Content-Length')
+    length = int(length) if length is not None else None
+    if offset and response.status == 206:
+        return response, offset, (offset + length if length is not None else None)
+    return response, 0, length
+
+
+def fetch_image(url, cache_path, dest_path, sha256, progress=None, chunk_size=CHUNK_SIZE):
+    """
+    Download a gzipped image from `url` into `dest_path` in a single pass.
+
+    Compressed bytes are appended to `cache_path` as they arrive while being
+    hashed and decompressed at the same time, and zero blocks of the output
+    are skipped so `dest_path` ends up sparse.
+
+    If `cache_path` already holds a partial (or complete) download its contents
+    are replayed through the pipeline and the download resumes from its end
+    using an HTTP Range request, so a retry never downloads twice.
+
+    `progress` is called with (bytes received, total bytes or None).
+    On checksum mismatch both `cache_path` and `dest_path` are removed and
+    `ImageFetchError` is raised.
+    """
+    if os.path.exists(dest_path) and stat.S_ISREG(os.stat(dest_path).st_mode):
+        raise ImageFetchError(f'{dest_path} file already exists.')
+
+    try:
+        with open(cache_path, 'ab+') as cache, open(dest_path, 'wb') as dest:
+            received, total, digest = _fetch(url, cache, dest, progress, chunk_size)
+    except ImageFetchError:
+        # Cached data is corrupt, do not resume from it
+        _unlink(cache_path, dest_path)
+        raise
+    except Exception:
+        # Keep the partial download around so a retry resumes it
+        _unlink(dest_path)
+        raise
+
+    if progress:
+        progress(received, total or received)
+
+    if digest != sha256:
+        logger.debug('Checksum failed, removing file: %s', cache_path)
+        _unlink(cache_path, dest_path)
+        raise ImageFetchError(f'Checksum mismatch for {url}')
+
+
+def _fetch(url, cache, dest, progress, chunk_size):
+    pipeline = _Pipeline(dest)
+
+    cache.seek(0)
+    received = 0
+    while True:
+        data = cache.read(chunk_size)
+        if not data:
+            break
+        pipeline.feed(data)
+        received += len(data)
+
+    total = None
+    if not pipeline.decompressor.eof:
+        src, start, total = _open(url, received)
+        if src is not None:
+            with src:
+                if start != received:
+                    logger.debug('Server does not support resuming %s, downloading from start', url)
+                    cache.seek(0)
+                    cache.truncate()
+                    dest.seek(0)
+                    dest.truncate()
+                    pipeline = _Pipeline(dest)
+                    received = 0
+                cache.seek(0, os.SEEK_END)
+                if progress:
+                    progress(received, total)
+                while True:
+                    data = src.read(chunk_size)
+                    if not data:
+                        break
+                    cache.write(data)
+                    pipeline.feed(data)
+                    received += len(data)
+                    if progress:
+                        progress(received, total)
+
+        if not pipeline.decompressor.eof and (total is None or received < total):
+            # Connection dropped, the partial download in cache is resumed on retry
+            raise ConnectionError(f'Download of {url} interrupted at {received} bytes')
+
+    pipeline.finish()
+    return received, total, pipeline.sha256.hexdigest()
+
+
+def _unlink(*paths):
+    for path in paths:
+        try:
+            if stat.S_ISREG(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,321 @@
+# -*- coding=utf-8 -*-
+import copy
+import errno
+import logging
+import select
+import socket
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["InterfaceStateCache", "NetlinkWatcher", "RoutingSocketWatcher", "default_watcher"]
+
+# <net/route.h>
+RTM_NEWADDR = 0xc
+RTM_DELADDR = 0xd
+RTM_IFINFO = 0xe
+RTM_IFANNOUNCE = 0x11
+RT_MSGHDR = struct.Struct("=HBB")
+IF_MSGHDR = struct.Struct("=HBBiiH")
+IF_ANNOUNCEMSGHDR = struct.Struct("=HBBH16sH")
+
+# <linux/netlink.h>, <linux/rtnetlink.h>
+NLMSG_OVERRUN = 4
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR_LINUX = 20
+RTM_DELADDR_LINUX = 21
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+IFLA_IFNAME = 3
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTATTR = struct.Struct("=HH")
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _index_to_name(index):
+    """
+    Returns `None` if interface `index` is already gone (its name can not be known anymore).
+    """
+    try:
+        return socket.if_indextoname(index)
+    except OSError:
+        return None
+
+
+def parse_routing_messages(data):
+    """
+    Names of interfaces changed according to BSD routing socket messages in `data`.
+
+    Returns `None` if it can not be known which interfaces have changed.
+    """
+    names = set()
+    offset = 0
+    while offset + RT_MSGHDR.size <= len(data):
+        msglen, version, type = RT_MSGHDR.unpack_from(data, offset)
+        if msglen < RT_MSGHDR.size:
+            return None
+
+        if type == RTM_IFANNOUNCE and offset + IF_ANNOUNCEMSGHDR.size <= len(data):
+            name = IF_ANNOUNCEMSGHDR.unpack_from(data, offset)[4]
+            names.add(name.split(b"\0", 1)[0].decode("ascii", "ignore"))
+        elif type in (RTM_IFINFO, RTM_NEWADDR, RTM_DELADDR) and offset + IF_MSGHDR.size <= len(data):
+            name = _index_to_name(IF_MSGHDR.unpack_from(data, offset)[5])
+            if name is None:
+                return None
+            names.add(name)
+
+        offset += msglen
+
+    return names
+
+
+def _parse_rtattrs(data, offset, end):
+    attrs = {}
+    while offset + RTATTR.size <= end:
+        length, type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def parse_netlink_messages(data):
+    """
+    Names of interfaces changed according to rtnetlink messages in `data`.
+
+    Returns `None` if it can not be known which interfaces have changed.
+    """
+    names = set()
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        msglen, type, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+        if msglen < NLMSGHDR.size:
+            return None
+        end = min(offset + msglen, len(data))
+        payload = offset + NLMSGHDR.size
+
+        if type == NLMSG_OVERRUN:
+            return None
+        elif type in (RTM_NEWLINK, RTM_DELLINK) and payload + IFINFOMSG.size <= end:
+            index = IFINFOMSG.unpack_from(data, payload)[2]
+            name = _parse_rtattrs(data, payload + IFINFOMSG.size, end).get(IFLA_IFNAME)
+            if name is not None:
+                names.add(name.split(b"\0", 1)[0].decode("ascii", "ignore"))
+            else:
+                name = _index_to_name(index)
+                if name is None:
+                    return None
+                names.add(name)
+        elif type in (RTM_NEWADDR_LINUX, RTM_DELADDR_LINUX) and payload + IFADDRMSG.size <= end:
+            name = _index_to_name(IFADDRMSG.unpack_from(data, payload)[4])
+            if name is None:
+                return None
+            names.add(name)
+
+        offset += _align(msglen)
+
+    return names
+
+
+class RoutingSocketWatcher:
+    """
+    Reports interfaces changed according to a BSD routing socket (interface state, address and arrival/departure
+    messages).
+    """
+
+    def __init__(self, sock=None):
+        self.sock = sock or socket.socket(socket.AF_ROUTE, socket.SOCK_RAW, 0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        return parse_routing_messages(self.sock.recv(65536))
+
+    def close(self):
+        self.sock.close()
+
+
+class NetlinkWatcher:
+    """
+    Reports interfaces changed according to Linux rtnetlink link and address notifications.
+    """
+
+    def __init__(self, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        return parse_netlink_messages(self.sock.recv(65536))
+
+    def close(self):
+        self.sock.close()
+
+
+def default_watcher():
+    """
+    Watcher for the platform we are running on or `None` if interface changes can not be watched.
+    """
+    try:
+        if hasattr(socket, "AF_ROUTE"):
+            return RoutingSocketWatcher()
+        if hasattr(socket, "AF_NETLINK"):
+            return NetlinkWatcher()
+    except OSError:
+        logger.warning("Unable to watch network interface changes", exc_info=True)
+    return None
+
+
+class InterfaceStateCache:
+    """
+    Network interface states (`{name: state}`) that are loaded once and then only reloaded for interfaces a
+    `watcher` reports as changed.
+
+    `list_states()` returns the states of all interfaces, `get_state(name)` returns the state of a single interface or
+    `None` if it does not exist. They are called with the cache lock held so events can not be applied out of order.
+
+    `generation` is incremented every time a state changes. Until a watcher is started (or if it fails) states are
+    loaded on every `get()`.
+    """
+
+    def __init__(self, list_states, get_state):
+        self.list_states = list_states
+        self.get_state = get_state
+        self.lock = threading.Lock()
+        self.states = {}
+        self.loaded = False
+        self.generation = 0
+        self.reloads = 0
+        self.updates = 0
+
+        self.watcher = None
+        self.thread = None
+        self._stop = threading.Event()
+
+    def get(self):
+        """
+        Returns `{name: state}` and the generation those states belong to.
+        """
+        with self.lock:
+            self._load()
+            return copy.deepcopy(self.states), self.generation
+
+    def get_generation(self):
+        """
+        Cheap way to know if any state has changed since a previous `get()`.
+        """
+        with self.lock:
+            self._load()
+            return self.generation
+
+    def invalidate(self):
+        """
+        Makes the next `get()` reload all states (e.g. after changes that are not reported by the watcher).
+        """
+        with self.lock:
+            self.loaded = False
+
+    def refresh(self, names=None):
+        """
+        Reloads states of interfaces `names` (all interfaces if `None`).
+        """
+        with self.lock:
+            if names is None or not self.loaded:
+                self._reload()
+                return
+            if not names:
+                return
+
+            changed = False
+            for name in names:
+                state = self.get_state(name)
+                if state is None:
+                    changed |= self.states.pop(name, None) is not None
+                elif self.states.get(name) != state:
+                    self.states[name] = state
+                    changed = True
+            self.updates += 1
+            if changed:
+                self.generation += 1
+
+    def _load(self):
+        if not self.loaded or self.thread is None:
+            self._reload()
+
+    def _reload(self):
+        states = self.list_states()
+        self.reloads += 1
+        if states != self.states:
+            self.states = states
+            self.generation += 1
+        self.loaded = True
+
+    def start(self, watcher):
+        self.watcher = watcher
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._watch, name="interface_state_cache", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        thread = self.thread
+        if thread is None:
+            return
+
+        self._stop.set()
+        thread.join()
+
+    def _watch(self):
+        try:
+            # Events that happened before the watcher was started are not known
+            self.invalidate()
+            while not self._stop.is_set():
+                if not select.select([self.watcher], [], [], 1)[0]:
+                    continue
+
+                # Coalesce a burst of events into a single update
+                names = set()
+                while names is not None and select.select([self.watcher], [], [], 0)[0]:
+                    try:
+                        changed = self.watcher.read()
+                    except OSError as e:
+                        if e.errno != errno.ENOBUFS:
+                            raise
+                        # Kernel dropped messages
+                        changed = None
+                    names = None if changed is None else names | changed
+
+                try:
+                    self.refresh(names)
+                except Exception:
+                    logger.warning("Failed to update interface states", exc_info=True)
+                    self.invalidate()
+        except Exception:
+            logger.error("Interface state watcher failed", exc_info=True)
+        finally:
+            with self.lock:
+                self.thread = None
+            self.watcher.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "generation": self.generation,
+                "interfaces": len(self.states),
+                "watching": self.thread is not None,
+                "reloads": self.reloads,
+                "updates": self.updates,
+            }
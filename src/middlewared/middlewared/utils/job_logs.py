@@ -0,0 +1,277 @@
+# -*- coding=utf-8 -*-
+from collections import OrderedDict
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["JobLog", "JobLogStore"]
+
+EXCERPT_LINES = 5
+EXCERPT_HEAD_SIZE = 8192
+
+
+def decode(data):
+    return data.decode("utf-8", "ignore")
+
+
+class JobLog:
+    """
+    Log file of a single job, written with `write` like a binary file.
+
+    At most `store.max_size` bytes are kept: once a job writes more than that, the beginning of the log stays in the
+    file and only the last `store.tail_size` bytes are kept in memory; they are appended to the file (after a note
+    saying how much was skipped) when the log is closed.
+
+    Offsets used by `read` count every byte written by the job, so readers can follow the log while it is written.
+    """
+
+    def __init__(self, store, job_id, path):
+        self.store = store
+        self.job_id = job_id
+        self.path = path
+        self.file = open(path, "wb")
+        self.head_limit = max(store.max_size - store.tail_size, 0)
+
+        self.condition = threading.Condition()
+        self.closed = False
+        self.removed = False
+        # Bytes written by the job
+        self.size = 0
+        self.lines = 0
+        # Bytes written by the job that are stored at the beginning of the file
+        self.head_size = 0
+        # Where the kept tail starts (in bytes written by the job and in the file) once the log is closed
+        self.tail_start = None
+        self.tail_offset = None
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.excerpt = None
+
+    def write(self, data):
+        with self.condition:
+            if self.closed:
+                raise ValueError("I/O operation on closed job log")
+
+            written = 0
+            if self.head_size < self.head_limit:
+                chunk = data[:self.head_limit - self.head_size]
+                self.file.write(chunk)
+                written = len(chunk)
+                self.head_size += written
+
+            if len(self.head) < EXCERPT_HEAD_SIZE:
+                self.head += data[:EXCERPT_HEAD_SIZE - len(self.head)]
+
+            self.tail += data
+            if len(self.tail) > self.store.tail_size:
+                del self.tail[:-self.store.tail_size]
+
+            self.size += len(data)
+            self.lines += data.count(b"\n")
+            self.condition.notify_all()
+
+        if written:
+            self.store.account(written)
+
+        return len(data)
+
+    def flush(self):
+        with self.condition:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        """
+        Writes the kept tail of a truncated log to the file and computes the log excerpt.
+        """
+        with self.condition:
+            if self.closed:
+                return
+
+            written = 0
+            tail = self.tail
+            self.tail_start = self.size - len(tail)
+            if self.tail_start > self.head_size:
+                note = f"\n[{self.tail_start - self.head_size} bytes skipped]\n".encode("ascii")
+                self.file.write(note)
+                written += len(note)
+            else:
+                tail = tail[self.head_size - self.tail_start:]
+                self.tail_start = self.head_size
+            self.tail_offset = self.head_size + written
+            self.file.write(tail)
+            written += len(tail)
+            self.file.close()
+
+            self.excerpt = self._excerpt()
+            self.closed = True
+            # Bytes needed to follow the log are in the file now
+            self.head = self.tail = bytearray()
+            self.condition.notify_all()
+
+        if written:
+            self.store.account(written)
+
+    def _excerpt(self):
+        if len(self.tail) == self.size:
+            lines = decode(self.tail).splitlines(True)
+            head = lines[:EXCERPT_LINES]
+            tail = lines[EXCERPT_LINES:][-EXCERPT_LINES:]
+            more = len(lines) - len(head) - len(tail)
+        else:
+            head = decode(self.head).splitlines(True)[:EXCERPT_LINES]
+            # First line of the tail is likely incomplete
+            tail = decode(self.tail).splitlines(True)[1:][-EXCERPT_LINES:]
+            more = self.lines + (0 if self.tail.endswith(b"\n") else 1) - len(head) - len(tail)
+
+        if more > 0:
+            return "%s[%d more lines]\n%s" % ("".join(head), more, "".join(tail))
+
+        return "".join(head + tail)
+
+    def read(self, offset, size=65536):
+        """
+        Reads up to `size` bytes written by the job starting at `offset`. Returns them with the offset to read from
+        next. Skipped part of a truncated log is returned as a note.
+        """
+        with self.condition:
+            if self.removed:
+                return b"", offset
+
+            tail_start = self.tail_start if self.closed else self.size - len(self.tail)
+            if offset < self.head_size:
+                end = min(offset + size, self.head_size)
+                if not self.closed:
+                    self.file.flush()
+                return self._read_file(offset, end - offset), end
+
+            if offset < tail_start:
+                return f"[{tail_start - offset} bytes skipped]\n".encode("ascii"), tail_start
+
+            if not self.closed:
+                data = bytes(self.tail[offset - tail_start:offset - tail_start + size])
+                return data, offset + len(data)
+
+            data = self._read_file(self.tail_offset + offset - tail_start, size)
+            return data, offset + len(data)
+
+    def _read_file(self, offset, size):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                return f.read(size)
+        except FileNotFoundError:
+            return b""
+
+    def wait(self, offset, timeout=None):
+        """
+        Waits until there is something to read at `offset` or the log is closed. Returns whether there is.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.size > offset or self.closed or self.removed, timeout
+            ) and self.size > offset and not self.removed
+
+    def unlink(self):
+        with self.condition:
+            if self.removed:
+                return 0
+
+            self.removed = True
+            if not self.closed:
+                self.file.close()
+                self.closed = True
+            self.condition.notify_all()
+
+        try:
+            size = os.path.getsize(self.path)
+            os.unlink(self.path)
+        except FileNotFoundError:
+            size = 0
+        return size
+
+
+class JobLogStore:
+    """
+    Log files of jobs stored in `path`.
+
+    Each log is capped at `max_size` bytes (see `JobLog`); once all logs take more than `max_total_size` bytes,
+    logs of finished jobs are removed oldest first.
+    """
+
+    def __init__(self, path="/tmp/middlewared/jobs", max_size=16 * 1024 * 1024, tail_size=1024 * 1024,
+                 max_total_size=128 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.tail_size = min(tail_size, max_size)
+        self.max_total_size = max_total_size
+        self.lock = threading.Lock()
+        self.logs = OrderedDict()
+        self.disk_usage = 0
+        self.removed = 0
+        self.prepared = False
+
+    def _prepare(self):
+        os.makedirs(self.path, exist_ok=True)
+        # Logs of the previous run, job ids start over
+        for name in os.listdir(self.path):
+            if name.endswith(".log"):
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError:
+                    pass
+        self.prepared = True
+
+    def open(self, job_id):
+        with self.lock:
+            if not self.prepared:
+                self._prepare()
+
+            log = self.logs[job_id] = JobLog(self, job_id, os.path.join(self.path, f"{job_id}.log"))
+            return log
+
+    def get(self, job_id):
+        return self.logs.get(job_id)
+
+    def remove(self, job_id):
+        with self.lock:
+            log = self.logs.pop(job_id, None)
+        if log is not None:
+            size = log.unlink()
+            with self.lock:
+                self.disk_usage -= size
+
+    def account(self, size):
+        """
+        Accounts `size` bytes written to a log file, removing logs of finished jobs if the disk budget is exceeded.
+        """
+        evicted = []
+        with self.lock:
+            self.disk_usage += size
+            if self.disk_usage <= self.max_total_size:
+                return
+
+            for job_id, log in list(self.logs.items()):
+                if self.disk_usage <= self.max_total_size:
+                    break
+
+                if log.closed:
+                    del self.logs[job_id]
+                    self.disk_usage -= os.path.getsize(log.path) if os.path.exists(log.path) else 0
+                    evicted.append(log)
+
+        for log in evicted:
+            logger.debug("Removing log of job %d to stay within job logs disk budget", log.job_id)
+            log.unlink()
+            self.removed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "logs": len(self.logs),
+                "disk_usage": self.disk_usage,
+                "max_total_size": self.max_total_size,
+                "removed": self.removed,
+            }
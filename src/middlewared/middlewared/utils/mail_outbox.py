@@ -0,0 +1,168 @@
+# -*- coding=utf-8 -*-
+from contextlib import closing
+import email
+import json
+import logging
+import smtplib
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["MailOutbox"]
+
+# Failures of a single message, any other error makes the SMTP session unusable
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class MailOutbox:
+    """
+    Durable queue of messages that could not be sent, stored in SQLite.
+
+    Failed deliveries are retried with exponential backoff (`backoff` seconds
+    doubled after every attempt, at most `max_backoff`) and dropped after
+    `max_attempts`. A message whose subject is already queued since less than
+    `dedup_window` seconds ago is not queued again.
+    """
+
+    def __init__(self, path, max_attempts=8, backoff=60, max_backoff=6 * 3600, dedup_window=3600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dedup_window = dedup_window
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created REAL NOT NULL,
+                    subject TEXT NOT NULL,
+                    from_addr TEXT NOT NULL,
+                    to_addrs TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30, isolation_level=None))
+
+    def _delay(self, attempts):
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+    def append(self, from_addr, to_addrs, msg, attempts=1, now=None):
+        """
+        Queue `msg` (an `email.message.Message`) to be sent later.
+
+        `attempts` is the number of delivery attempts already made.
+        Returns False if a message with the same subject was queued recently.
+        """
+        now = time.time() if now is None else now
+        subject = msg["Subject"] or ""
+        with self._connect() as conn:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                duplicate = conn.execute(
+                    "SELECT 1 FROM outbox WHERE subject = ? AND created > ?", (subject, now - self.dedup_window),
+                ).fetchone()
+                if duplicate:
+                    logger.debug("Not queueing duplicate message %r", subject)
+                    return False
+
+                conn.execute(
+                    "INSERT INTO outbox (created, subject, from_addr, to_addrs, message, attempts, next_attempt) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (now, subject, from_addr, json.dumps(to_addrs), msg.as_string(), attempts,
+                     now + self._delay(attempts)),
+                )
+                return True
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def due(self, now=None, limit=100):
+        """
+        Returns list of (id, from_addr, to_addrs, message, attempts) ready to be sent.
+        """
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            return [
+                (id, from_addr, json.loads(to_addrs), email.message_from_string(message), attempts)
+                for id, from_addr, to_addrs, message, attempts in conn.execute(
+                    "SELECT id, from_addr, to_addrs, message, attempts FROM outbox WHERE next_attempt <= ? "
+                    "ORDER BY id LIMIT ?", (now, limit),
+                )
+            ]
+
+    def delivered(self, id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (id,))
+
+    def failed(self, id, attempts, now=None):
+        """
+        Record a failed delivery attempt. Returns False if the message was dropped.
+        """
+        now = time.time() if now is None else now
+        attempts += 1
+        with self._connect() as conn:
+            if attempts >= self.max_attempts:
+                conn.execute("DELETE FROM outbox WHERE id = ?", (id,))
+                return False
+
+            conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts, now + self._delay(attempts), id),
+            )
+            return True
+
+    def send(self, connect, server=None, now=None, batch_size=100):
+        """
+        Send due messages over a single SMTP session.
+
+        `connect()` returns an authenticated `smtplib.SMTP` and is only called if
+        there is something to send and no `server` was given. A session given as
+        `server` is left open. Returns number of messages delivered.
+        """
+        messages = self.due(now, batch_size)
+        if not messages:
+            return 0
+
+        sent = 0
+        own_server = server is None
+        try:
+            if own_server:
+                server = connect()
+
+            for i, (id, from_addr, to_addrs, msg, attempts) in enumerate(messages):
+                try:
+                    server.sendmail(from_addr, to_addrs, msg.as_string())
+                except MESSAGE_ERRORS:
+                    logger.debug("Sending queued message %r failed", msg["Subject"], exc_info=True)
+                    if not self.failed(id, attempts, now):
+                        logger.warning("Dropping queued message %r after %d attempts", msg["Subject"],
+                                       attempts + 1)
+                except Exception:
+                    # Session is unusable, try the rest of the batch next time
+                    for id, from_addr, to_addrs, msg, attempts in messages[i:]:
+                        self.failed(id, attempts, now)
+                    raise
+                else:
+                    self.delivered(id)
+                    sent += 1
+        except Exception:
+            logger.debug("Sending mail queue failed", exc_info=True)
+            if own_server and server is None:
+                for id, from_addr, to_addrs, msg, attempts in messages:
+                    self.failed(id, attempts, now)
+        finally:
+            if own_server and server is not None:
+                try:
+                    server.quit()
+                except Exception:
+                    pass
+
+        return sent
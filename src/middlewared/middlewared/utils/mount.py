@@ -0,0 +1,118 @@
+# -*- coding=utf-8 -*-
+import importlib.util
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["MountTable", "GetmntinfoBackend", "MountinfoBackend", "default_backend"]
+
+RE_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def mount_entry(source, dest, fstype, options):
+    return {
+        "source": source,
+        "dest": dest,
+        "fstype": fstype,
+        "options": options,
+    }
+
+
+class GetmntinfoBackend:
+    """
+    Reads mounted filesystems using getmntinfo(3).
+    """
+
+    def read(self):
+        import bsd
+
+        mounts = []
+        for m in bsd.getmntinfo():
+            try:
+                options = sorted(flag.name.lower() for flag in m.flags)
+            except Exception:
+                options = []
+            mounts.append(mount_entry(m.source, m.dest, m.fstype, options))
+        return mounts
+
+
+class MountinfoBackend:
+    """
+    Reads mounted filesystems from Linux `/proc/self/mountinfo`.
+    """
+
+    def __init__(self, path="/proc/self/mountinfo"):
+        self.path = path
+
+    def read(self):
+        with open(self.path) as f:
+            return [m for m in map(self.parse_line, f.read().splitlines()) if m is not None]
+
+    @staticmethod
+    def unescape(s):
+        return RE_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), s)
+
+    @classmethod
+    def parse_line(cls, line):
+        # 36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+        fields = line.split()
+        try:
+            separator = fields.index("-", 6)
+            dest = fields[4]
+            options = fields[5].split(",")
+            fstype, source = fields[separator + 1:separator + 3]
+        except ValueError:
+            logger.debug("Invalid mountinfo line: %r", line)
+            return None
+
+        return mount_entry(cls.unescape(source), cls.unescape(dest), fstype, options)
+
+
+def default_backend():
+    if importlib.util.find_spec("bsd") is None:
+        return MountinfoBackend()
+    return GetmntinfoBackend()
+
+
+class MountTable:
+    """
+    Indexed snapshot of mounted filesystems.
+    """
+
+    def __init__(self, mounts):
+        self.mounts = mounts
+        self.by_source = {}
+        self.by_dest = {}
+        for m in mounts:
+            self.by_source.setdefault(m["source"], []).append(m)
+            # Later mounts hide earlier mounts on the same directory
+            self.by_dest[m["dest"]] = m
+
+    def path_to_mount(self, path):
+        """
+        Returns the mount `path` belongs to (the one with longest mountpoint prefix) or None.
+        """
+        path = os.path.normpath(path)
+        while True:
+            m = self.by_dest.get(path)
+            if m is not None:
+                return m
+
+            if path in ("/", ""):
+                return None
+
+            path = os.path.dirname(path)
+
+    def is_mounted(self, path=None, source=None):
+        """
+        Returns whether there is a filesystem mounted on `path` or, if `path` is not given, from `source`.
+        """
+        if path is not None:
+            return os.path.realpath(path) in self.by_dest
+
+        if source is not None:
+            return source in self.by_source
+
+        return False
@@ -4,9 +4,86 @@ import os
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["is_child"]
+__all__ = ["is_child", "PathTrie"]
 
 
 def is_child(child: str, parent: str):
     rel = os.path.relpath(child, parent)
     return rel == "." or not rel.startswith("..")
+
+
+class PathTrie:
+    """
+    Maps "/"-separated keys (filesystem paths or dataset names) to sets of items.
+
+    Lookups walk one node per path component, so they cost O(depth) instead of
+    scanning every stored key.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.items = {}
+
+    @staticmethod
+    def _parts(key):
+        return key.rstrip("/").split("/")
+
+    def add(self, key, item):
+        node = self.root
+        for part in self._parts(key):
+            node = node.setdefault(part, {})
+        node.setdefault(None, set()).add(item)
+        self.items.setdefault(item, set()).add(key)
+
+    def remove(self, item):
+        for key in self.items.pop(item, ()):
+            parts = self._parts(key)
+            nodes = [self.root]
+            for part in parts:
+                nodes.append(nodes[-1][part])
+
+            nodes[-1][None].discard(item)
+            # Prune branches left empty
+            for i in range(len(parts), 0, -1):
+                if nodes[i].get(None) or any(part is not None for part in nodes[i]):
+                    break
+                del nodes[i - 1][parts[i - 1]]
+
+    def clear(self):
+        self.root = {}
+        self.items = {}
+
+    def under(self, key):
+        """
+        Returns set of items stored at `key` or any of its children.
+        """
+        node = self.root
+        for part in self._parts(key):
+            node = node.get(part)
+            if node is None:
+                return set()
+
+        result = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for part, child in node.items():
+                if part is None:
+                    result |= child
+                else:
+                    stack.append(child)
+        return result
+
+    def above(self, key):
+        """
+        Returns list of (key, item) stored at `key` or any of its parents.
+        """
+        result = []
+        node = self.root
+        parts = self._parts(key)
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            result.extend(("/".join(parts[:i + 1]), item) for item in node.get(None, ()))
+        return result
@@ -0,0 +1,171 @@
+# -*- coding=utf-8 -*-
+import asyncio
+from collections import deque
+import logging
+import random
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["PeriodicScheduler"]
+
+
+class PeriodicTask:
+    def __init__(self, name, call, interval, run_on_start, jitter, timeout, history):
+        self.name = name
+        self.call = call
+        self.interval = interval
+        self.run_on_start = run_on_start
+        self.jitter = jitter
+        self.timeout = timeout
+
+        # Loop time of the current schedule slot (without jitter), slots are `interval` apart
+        self.slot = None
+        self.next_run = None
+        self.handle = None
+        self.future = None
+
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.last_exception = None
+        self.history = deque(maxlen=history)
+
+
+class PeriodicScheduler:
+    """
+    Runs periodic tasks at a fixed rate: runs start every `interval` seconds (plus up to `jitter` random seconds)
+    regardless of how long previous runs took.
+
+    A run is skipped if the previous run of the same task is still going. Runs taking more than `timeout` seconds are
+    cancelled (a method running in a thread can not be interrupted, it is only no longer waited for). Last `history`
+    runs of every task are kept.
+    """
+
+    def __init__(self, loop=None, history=10, rng=None):
+        self.loop = loop
+        self.history = history
+        self.rng = rng or random.Random()
+        self.tasks = {}
+        self.started = False
+
+    def add(self, name, call, interval, run_on_start=True, jitter=0, timeout=None):
+        """
+        Adds task `name` running coroutine function `call` every `interval` seconds.
+        """
+        if name in self.tasks:
+            raise ValueError(f"Periodic task {name!r} already exists")
+
+        task = self.tasks[name] = PeriodicTask(name, call, interval, run_on_start, jitter, timeout, self.history)
+        if self.started:
+            self._start(task)
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+
+        self.started = True
+        for task in self.tasks.values():
+            self._start(task)
+
+    def stop(self):
+        self.started = False
+        for task in self.tasks.values():
+            if task.handle is not None:
+                task.handle.cancel()
+                task.handle = None
+
+    def _start(self, task):
+        task.slot = self.loop.time()
+        if not task.run_on_start:
+            task.slot += task.interval
+        self._schedule(task)
+
+    def _schedule(self, task):
+        task.next_run = task.slot + (self.rng.uniform(0, task.jitter) if task.jitter else 0)
+        task.handle = self.loop.call_at(task.next_run, self._tick, task)
+
+    def _tick(self, task):
+        if self._running(task):
+            logger.debug("Periodic task %s is still running, skipping it", task.name)
+            task.skipped += 1
+        else:
+            task.future = asyncio.ensure_future(self._run(task, "SCHEDULE"), loop=self.loop)
+
+        # Slots missed when the loop was blocked for longer than `interval` are not made up for
+        now = self.loop.time()
+        task.slot += task.interval
+        if task.slot <= now:
+            task.slot += (now - task.slot) // task.interval * task.interval + task.interval
+        self._schedule(task)
+
+    def _running(self, task):
+        return task.future is not None and not task.future.done()
+
+    async def _run(self, task, trigger):
+        logger.debug("Calling periodic task %s", task.name)
+        started_at = time.time()
+        started = self.loop.time()
+        state = "SUCCESS"
+        try:
+            if task.timeout is None:
+                await task.call()
+            else:
+                await asyncio.wait_for(task.call(), task.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Periodic task %s timed out after %d seconds", task.name, task.timeout)
+            state = "TIMEOUT"
+            task.timeouts += 1
+            task.last_exception = f"Timed out after {task.timeout} seconds"
+        except asyncio.CancelledError:
+            state = "ABORTED"
+            raise
+        except Exception as e:
+            logger.warning("Exception while calling periodic task %s", task.name, exc_info=True)
+            state = "FAILED"
+            task.failures += 1
+            task.last_exception = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        finally:
+            task.runs += 1
+            task.history.append({
+                "trigger": trigger,
+                "state": state,
+                "started": started_at,
+                "duration": self.loop.time() - started,
+            })
+
+        return state
+
+    async def run(self, name):
+        """
+        Runs task `name` now (or waits for its current run to finish) without changing its schedule.
+        """
+        task = self.tasks[name]
+        if not self._running(task):
+            task.future = asyncio.ensure_future(self._run(task, "MANUAL"), loop=self.loop)
+
+        return await asyncio.shield(task.future)
+
+    def get(self):
+        now = self.loop.time() if self.loop is not None else None
+        return [
+            {
+                "name": task.name,
+                "interval": task.interval,
+                "jitter": task.jitter,
+                "timeout": task.timeout,
+                "running": self._running(task),
+                "next_run": (
+                    time.time() + task.next_run - now if self.started and task.next_run is not None else None
+                ),
+                "runs": task.runs,
+                "failures": task.failures,
+                "timeouts": task.timeouts,
+                "skipped": task.skipped,
+                "last_exception": task.last_exception,
+                "history": list(task.history),
+            }
+            for task in self.tasks.values()
+        ]
@@ -0,0 +1,99 @@
+# -*- coding=utf-8 -*-
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["SetupDependencyError", "setup_order", "run_setups"]
+
+
+class SetupDependencyError(Exception):
+    pass
+
+
+def _depends(name, fn, names, previous):
+    if not hasattr(fn, '_setup_depends'):
+        # Setups that did not declare their dependencies run after every setup before them, as they always have
+        return list(previous)
+
+    depends = []
+    for dep in fn._setup_depends:
+        if dep not in names:
+            logger.warning('Plugin %r setup depends on %r which has no setup, ignoring', name, dep)
+            continue
+        depends.append(dep)
+    return depends
+
+
+def setup_order(setups):
+    """
+    Sort (name, setup) pairs so every plugin comes after the plugins it depends on.
+
+    A setup without `setup_depends` depends on every setup before it.
+    Plugins without dependencies between them keep their original order.
+    Raises `SetupDependencyError` if dependencies are circular.
+    """
+    names = {name for name, fn in setups}
+    pending = [
+        (name, fn, _depends(name, fn, names, [i[0] for i in setups[:index]]))
+        for index, (name, fn) in enumerate(setups)
+    ]
+    done = set()
+    ordered = []
+    while pending:
+        ready = [i for i in pending if all(dep in done for dep in i[2])]
+        if not ready:
+            raise SetupDependencyError(
+                'Circular plugin setup dependencies: ' + ', '.join(sorted(i[0] for i in pending))
+            )
+        for i in ready:
+            pending.remove(i)
+            done.add(i[0])
+            ordered.append(i)
+    return ordered
+
+
+async def run_setups(middleware, setups, on_done=None):
+    """
+    Call every plugin `setup(middleware)` in `setups`, a list of (name, setup) pairs.
+
+    A setup starts as soon as all the setups it depends on (declared with the
+    `setup_depends` decorator) have finished, so independent coroutine setups
+    run concurrently. Setups that do not use `setup_depends` wait for every
+    setup before them. `on_done(name)` is called after each setup finishes.
+
+    Returns a dict with `depends`, `start` (seconds since the first setup
+    started) and `duration` of every setup.
+    """
+    profile = {}
+    tasks = {}
+    begin = time.monotonic()
+
+    async def run(name, fn, depends):
+        if depends:
+            await asyncio.gather(*[tasks[dep] for dep in depends])
+        start = time.monotonic()
+        call = fn(middleware)
+        # Allow setup to be a coroutine
+        if asyncio.iscoroutinefunction(fn):
+            await call
+        profile[name] = {
+            'depends': depends,
+            'start': start - begin,
+            'duration': time.monotonic() - start,
+        }
+        if on_done:
+            on_done(name)
+
+    for name, fn, depends in setup_order(setups):
+        tasks[name] = asyncio.ensure_future(run(name, fn, depends))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except Exception:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    return profile
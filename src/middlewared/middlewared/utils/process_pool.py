@@ -0,0 +1,166 @@
+# -*- coding=utf-8 -*-
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+from middlewared.utils.call_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["ProcessPool"]
+
+# Number of tasks run by this worker process
+TASKS = 0
+
+
+def pool_task(max_tasks, max_rss, method, *args):
+    """
+    Runs `method` in a worker process. Returns when it started and finished running (monotonic clock is system-wide),
+    whether the worker has run `max_tasks` tasks or uses more than `max_rss` bytes of memory, worker pid and the
+    result.
+    """
+    global TASKS
+    started = time.monotonic()
+    try:
+        result = method(*args)
+    finally:
+        TASKS += 1
+    finished = time.monotonic()
+
+    recycle = bool(
+        (max_tasks and TASKS >= max_tasks) or
+        (max_rss and psutil.Process().memory_info().rss >= max_rss)
+    )
+    return started, finished, recycle, os.getpid(), result
+
+
+class MethodStats:
+    __slots__ = ("errors", "queue_wait", "execution")
+
+    def __init__(self):
+        self.errors = 0
+        self.queue_wait = LatencyHistogram()
+        self.execution = LatencyHistogram()
+
+
+class ProcessPool:
+    """
+    Pool of `max_workers` processes started (and set up by `initializer`) before they are needed.
+
+    `ProcessPoolExecutor` can not replace a single worker so once one of them has run `max_tasks` tasks or uses more
+    than `max_rss` bytes of memory the whole executor is replaced with a new one; the old one finishes the tasks it
+    was given and is shut down after that. The same happens when a worker crashes (the tasks it was running fail with
+    `BrokenProcessPool`).
+    """
+
+    def __init__(self, max_workers, initializer=None, max_tasks=None, max_rss=None, mp_context=None):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.mp_context = mp_context
+        self.executor = None
+        # Tasks submitted to every executor that is running or finishing its tasks
+        self.executors = {}
+        self.generation = 0
+        self.in_flight = 0
+        self.recycled = 0
+        self.crashed = 0
+        self.methods = {}
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=self.mp_context, initializer=self.initializer,
+            )
+            self.executors[self.executor] = 0
+            self.generation += 1
+            # Spawn the workers (running `initializer`) now instead of on first submit
+            self.executor._start_queue_management_thread()
+        return self.executor
+
+    def shutdown(self, wait=True):
+        self.executor = None
+        executors, self.executors = self.executors, {}
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+    def _replace(self, executor):
+        # Other tasks of the same executor might ask for it to be replaced too
+        if executor is self.executor:
+            self.executor = None
+            self._retire(executor)
+            self.start()
+
+    def _retire(self, executor):
+        # `shutdown` closes the call queue so tasks that were not picked up by workers yet would never run
+        if executor is not self.executor and self.executors.get(executor) == 0:
+            del self.executors[executor]
+            # `shutdown(wait=False)` closes queues the management thread is still using on Python 3.7
+            threading.Thread(target=executor.shutdown, daemon=True, name="ProcessPoolShutdown").start()
+
+    async def run(self, name, method, *args):
+        """
+        Runs `method(*args)` in a worker, recording its queue wait and execution time as `name`.
+        """
+        executor = self.start()
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = MethodStats()
+
+        submitted = time.monotonic()
+        self.in_flight += 1
+        self.executors[executor] += 1
+        try:
+            started, finished, recycle, pid, result = await asyncio.wrap_future(
+                executor.submit(pool_task, self.max_tasks, self.max_rss, method, *args)
+            )
+        except BrokenProcessPool:
+            stats.errors += 1
+            if executor is self.executor:
+                logger.warning("Process pool worker crashed running %r, starting new workers", name)
+                self.crashed += 1
+                self._replace(executor)
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            if executor in self.executors:
+                self.executors[executor] -= 1
+                self._retire(executor)
+
+        stats.queue_wait.record(max(started - submitted, 0))
+        stats.execution.record(finished - started)
+
+        if recycle and executor is self.executor:
+            logger.debug("Process pool worker %d needs to be recycled, starting new workers", pid)
+            self.recycled += 1
+            self._replace(executor)
+
+        return result
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "generation": self.generation,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.max_workers, 0),
+            "recycled": self.recycled,
+            "crashed": self.crashed,
+            "methods": {
+                name: {
+                    "errors": stats.errors,
+                    "queue_wait": stats.queue_wait.summary(),
+                    "execution": stats.execution.summary(),
+                }
+                for name, stats in self.methods.items()
+            },
+        }
@@ -0,0 +1,122 @@
+# -*- coding=utf-8 -*-
+import contextlib
+import os
+import shutil
+import sqlite3
+import tempfile
+
+__all__ = ["read_transaction", "copy_database", "snapshot", "dump_sql", "dump_json"]
+
+
+def quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+@contextlib.contextmanager
+def read_transaction(path):
+    """
+    Opens database at `path` within a read transaction, so everything read through the returned connection comes
+    from the same snapshot. Writers are blocked until the transaction ends.
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        # Deferred transaction only acquires the lock on first read
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+        yield conn
+    finally:
+        try:
+            conn.execute("ROLLBACK")
+        finally:
+            conn.close()
+
+
+def copy_database(path, dest):
+    """
+    Copies database file at `path` to `dest` while no one is allowed to write to it.
+    """
+    with read_transaction(path):
+        shutil.copyfile(path, dest)
+
+
+@contextlib.contextmanager
+def snapshot(path):
+    """
+    Copies database at `path` to a temporary file and opens the copy within a read transaction. Writers of the
+    original database are only blocked while it is being copied, not for as long as the copy is being read.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, "snapshot.db")
+        copy_database(path, copy)
+        with read_transaction(copy) as conn:
+            yield conn
+
+
+def dump_sql(conn, schema=False, exclude=None):
+    """
+    Yields SQL statements that `DELETE` and `INSERT` every row of every table.
+
+    With `schema` the dump is a single transaction (like `sqlite3 .dump`) that creates tables first and indexes,
+    triggers and views after the data is inserted, so it can be restored into an empty database.
+    """
+    exclude = exclude or set()
+    tables = [
+        (name, sql)
+        for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' ORDER BY rowid")
+        if name not in exclude
+    ]
+
+    if schema:
+        yield "BEGIN TRANSACTION"
+        for name, sql in tables:
+            # `sqlite_sequence` is created along with the first AUTOINCREMENT table
+            if not name.startswith("sqlite_"):
+                yield sql
+
+    for name, sql in tables:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quote_identifier(name)})")]
+
+        yield f"DELETE FROM {quote_identifier(name)}"
+
+        # Let SQLite render the values so that every type (including blobs and floats) round-trips exactly
+        prefix = "INSERT INTO %s (%s) VALUES (" % (
+            quote_identifier(name), ", ".join(map(quote_identifier, columns)),
+        )
+        values = " || ',' || ".join(f"quote({quote_identifier(column)})" for column in columns)
+        query = "SELECT ? || %s || ')' FROM %s" % (values, quote_identifier(name))
+        for row in conn.execute(query, (prefix,)):
+            yield row[0]
+
+    if schema:
+        for sql, in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger', 'view') AND sql IS NOT NULL "
+            "ORDER BY rowid"
+        ):
+            yield sql
+
+        yield "COMMIT"
+
+
+def dump_json(conn, tables, batch_size=1000):
+    """
+    For every dict in `tables` yields its copies with `entries` set to batches of at most `batch_size` rows of
+    `table_name` (at least one batch per table). Tables that can not be read are skipped.
+    """
+    for table in tables:
+        try:
+            cursor = conn.execute(f"SELECT * FROM {quote_identifier(table['table_name'])}")
+        except sqlite3.OperationalError:
+            continue
+
+        columns = [column[0] for column in cursor.description]
+        first = True
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows and not first:
+                break
+
+            yield dict(table, entries=[dict(zip(columns, row)) for row in rows])
+            first = False
+
+            if len(rows) < batch_size:
+                break
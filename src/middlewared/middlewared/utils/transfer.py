@@ -0,0 +1,298 @@
+# -*- coding=utf-8 -*-
+import asyncio
+import functools
+import logging
+import os
+import tempfile
+import uuid
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["AdaptiveChunkSize", "open_pipe_reader", "open_pipe_writer", "DownloadSpool", "UploadSession",
+           "UploadError"]
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class AdaptiveChunkSize:
+    """
+    Buffer size that doubles while reads fill the whole buffer and shrinks back when they do not.
+    """
+
+    def __init__(self, minimum=MIN_CHUNK_SIZE, maximum=MAX_CHUNK_SIZE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = minimum
+
+    def update(self, read):
+        if read >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+        elif read < self.size // 4:
+            self.size = max(self.size // 2, self.minimum)
+
+
+async def open_pipe_reader(loop, f):
+    """
+    Returns transport and `asyncio.StreamReader` for the read end of a pipe. The pipe is closed by the transport on
+    EOF.
+    """
+    reader = asyncio.StreamReader(limit=MAX_CHUNK_SIZE * 2)
+    transport, protocol = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), f)
+    return transport, reader
+
+
+async def open_pipe_writer(loop, f):
+    """
+    Returns `asyncio.StreamWriter` for the write end of a pipe.
+    """
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, f)
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class DownloadSpool:
+    """
+    Copies job output pipe to an unlinked temporary file.
+
+    Clients are served from that file while it is still being written so that the same output can be downloaded
+    again, resumed (`Range`, `If-Range`) or downloaded by several clients at once.
+    """
+
+    def __init__(self, loop, source, dir=None):
+        self.loop = loop
+        fd, path = tempfile.mkstemp(prefix="download-", dir=dir)
+        os.unlink(path)
+        self.fd = fd
+        self.etag = f'"{uuid.uuid4().hex}"'
+        self.size = 0
+        self.complete = False
+        self.error = None
+        self.readers = 0
+        self.closed = False
+        self.changed = asyncio.Condition()
+        self.task = asyncio.ensure_future(self._spool(source), loop=loop)
+
+    async def _run(self, method, *args):
+        return await self.loop.run_in_executor(None, functools.partial(method, *args))
+
+    async def _spool(self, source):
+        transport = None
+        chunk_size = AdaptiveChunkSize()
+        try:
+            transport, reader = await open_pipe_reader(self.loop, source)
+            while True:
+                data = await reader.read(chunk_size.size)
+                if not data:
+                    break
+
+                chunk_size.update(len(data))
+                await self._run(_write_all, self.fd, data)
+                async with self.changed:
+                    self.size += len(data)
+                    self.changed.notify_all()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Error spooling download", exc_info=True)
+            self.error = e
+        finally:
+            if transport is not None:
+                transport.close()
+            async with self.changed:
+                self.complete = True
+                self.changed.notify_all()
+
+    async def wait(self, offset):
+        """
+        Waits until there is data past `offset` or the spool is complete. Returns current size.
+        """
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.size > offset or self.complete)
+            return self.size
+
+    async def wait_complete(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.complete)
+
+    def close(self):
+        """
+        Stops spooling and releases the file once no client is reading it.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.task.cancel()
+        if not self.readers:
+            os.close(self.fd)
+
+    async def respond(self, request, headers):
+        """
+        Serves spooled output honoring `Range` and `If-Range` request headers.
+        """
+        if self.closed:
+            return web.Response(status=410)
+
+        self.readers += 1
+        try:
+            return await self._respond(request, headers)
+        finally:
+            self.readers -= 1
+            if self.closed and not self.readers:
+                os.close(self.fd)
+
+    async def _respond(self, request, headers):
+        headers = dict(headers, **{"Accept-Ranges": "bytes", "ETag": self.etag})
+
+        byte_range = None
+        if "Range" in request.headers and request.headers.get("If-Range", self.etag) == self.etag:
+            try:
+                byte_range = request.http_range
+            except ValueError:
+                # Unsupported (e.g. multiple ranges) or invalid `Range` is ignored
+                pass
+
+        if byte_range is not None:
+            # Range is relative to the complete length which is only known once job output is exhausted
+            await self.wait_complete()
+            if self.error is not None:
+                return web.Response(status=500, body=str(self.error))
+
+            start, stop, _ = byte_range.indices(self.size)
+            if start >= stop:
+                headers["Content-Range"] = f"bytes */{self.size}"
+                return web.Response(status=416, headers=headers)
+
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{self.size}"
+            headers["Content-Length"] = str(stop - start)
+            resp = web.StreamResponse(status=206, headers=headers)
+        else:
+            start, stop = 0, None
+            if self.complete and self.error is None:
+                headers["Content-Length"] = str(self.size)
+            resp = web.StreamResponse(status=200, headers=headers)
+            if not self.complete:
+                resp.enable_chunked_encoding()
+
+        await resp.prepare(request)
+        if request.method != "HEAD":
+            await self._send(resp, start, stop)
+        await resp.write_eof()
+        return resp
+
+    async def _send(self, resp, offset, stop):
+        while stop is None or offset < stop:
+            available = await self.wait(offset)
+            if offset >= available:
+                if self.error is not None:
+                    raise self.error
+                break
+
+            if stop is not None:
+                available = min(available, stop)
+            data = await self._run(os.pread, self.fd, min(available - offset, MAX_CHUNK_SIZE), offset)
+            await resp.write(data)
+            offset += len(data)
+
+
+class UploadError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        super().__init__(message)
+
+
+class UploadSession:
+    """
+    Upload of `length` bytes into job input pipe that can be sent in several requests.
+
+    Every chunk is appended at `Upload-Offset` which must match the amount of data received so far, so an interrupted
+    request can be resumed from the offset reported by `HEAD`.
+    """
+
+    def __init__(self, loop, writer, job, length):
+        self.loop = loop
+        self.writer = writer
+        self.job = job
+        self.length = length
+        self.offset = 0
+        self.lock = asyncio.Lock()
+        self.closed = False
+
+    def headers(self):
+        return {
+            "Upload-Offset": str(self.offset),
+            "Upload-Length": str(self.length),
+        }
+
+    async def append(self, offset, content):
+        """
+        Copies request `content` stream to job input pipe. Data received before the request is interrupted is kept.
+        """
+        async with self.lock:
+            if self.closed:
+                raise UploadError(410, "Upload is finished")
+
+            if offset != self.offset:
+                raise UploadError(409, f"Upload offset is {self.offset}")
+
+            chunk_size = AdaptiveChunkSize()
+            while True:
+                data = await content.read(chunk_size.size)
+                if not data:
+                    break
+
+                if self.offset + len(data) > self.length:
+                    raise UploadError(413, f"Upload length is {self.length}")
+
+                chunk_size.update(len(data))
+                self.writer.write(data)
+                await self.writer.drain()
+                self.offset += len(data)
+
+            if self.offset == self.length:
+                self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    def abort(self):
+        if not self.closed:
+            self.job.abort()
+            self.close()
+
+    async def handle(self, request):
+        """
+        `HEAD` reports current offset, `PATCH` appends a chunk, `DELETE` aborts the upload.
+        """
+        if request.method == "HEAD":
+            return web.Response(status=200, headers=self.headers())
+
+        if request.method == "DELETE":
+            self.abort()
+            return web.Response(status=204)
+
+        if request.method != "PATCH":
+            return web.Response(status=405)
+
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return web.Response(status=400, body="Valid Upload-Offset header is required")
+
+        try:
+            await self.append(offset, request.content)
+        except UploadError as e:
+            return web.Response(status=e.status, headers=self.headers(), body=e.message)
+
+        return web.Response(status=204, headers=self.headers())
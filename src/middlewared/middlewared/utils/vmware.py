@@ -0,0 +1,406 @@
+# -*- coding=utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["VSphereSession", "VSphereVM", "SessionPool", "VMSnapshotOrchestrator"]
+
+
+class VSphereSession:
+    """
+    Authenticated session to a vCenter/ESXi host.
+    """
+
+    def alive(self):
+        raise NotImplementedError
+
+    def disconnect(self):
+        raise NotImplementedError
+
+    def powered_on_vms(self):
+        """
+        Returns list of `VSphereVM` that are powered on.
+        """
+        raise NotImplementedError
+
+    def find_vm(self, uuid):
+        """
+        Returns `VSphereVM` with BIOS `uuid` or None.
+        """
+        raise NotImplementedError
+
+
+class VSphereVM:
+    """
+    Virtual machine handle. `uuid` and `name` attributes must be set.
+    """
+
+    uuid = None
+    name = None
+
+    def depends_on_datastore(self, datastore):
+        raise NotImplementedError
+
+    def can_snapshot(self):
+        raise NotImplementedError
+
+    def snapshot_exists(self, name):
+        raise NotImplementedError
+
+    def create_snapshot(self, name, description):
+        """
+        Create snapshot and wait for it to complete.
+        """
+        raise NotImplementedError
+
+    def remove_snapshot(self, name):
+        """
+        Remove snapshot and wait for it to complete. Returns False if it does not exist.
+        """
+        raise NotImplementedError
+
+
+def session_key(vmsnapobj):
+    return vmsnapobj["hostname"], vmsnapobj["username"], vmsnapobj["password"]
+
+
+class SessionPool:
+    """
+    Keeps authenticated sessions so that they can be reused between snapshot
+    tasks. Sessions unused for more than `idle_timeout` seconds are closed by
+    `expire`, which has to be called periodically.
+
+    `connect(vmsnapobj)` returns a new `VSphereSession`.
+    """
+
+    def __init__(self, connect, idle_timeout=600):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, vmsnapobj):
+        key = session_key(vmsnapobj)
+        self.expire()
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                session, last_used = self.sessions.pop(key, (None, None))
+
+            if session is not None:
+                try:
+                    alive = session.alive()
+                except Exception:
+                    alive = False
+                if not alive:
+                    logger.debug("VMware session to %s has expired", vmsnapobj["hostname"])
+                    self._disconnect(session)
+                    session = None
+
+            if session is None:
+                session = self.connect(vmsnapobj)
+
+            with self.lock:
+                self.sessions[key] = (session, time.monotonic())
+
+            return session
+
+    def expire(self):
+        """
+        Close sessions unused for more than `idle_timeout` seconds.
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, (session, last_used) in self.sessions.items()
+                       if now - last_used > self.idle_timeout]
+            sessions = [self.sessions.pop(key)[0] for key in expired]
+
+        for session in sessions:
+            self._disconnect(session)
+
+    def _disconnect(self, session):
+        try:
+            session.disconnect()
+        except Exception:
+            logger.debug("Error closing VMware session", exc_info=True)
+
+    def close(self):
+        with self.lock:
+            sessions = [session for session, last_used in self.sessions.values()]
+            self.sessions.clear()
+
+        for session in sessions:
+            self._disconnect(session)
+
+
+class BeginState:
+    """
+    Shared between `VMSnapshotOrchestrator.begin` and its host threads: hosts only start snapshotting VMs if the
+    deadline has not `expired` yet and are then added to `started`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expired = False
+        self.started = set()
+
+
+class VMSnapshotOrchestrator:
+    """
+    Creates and removes VMware snapshots around a ZFS snapshot.
+
+    Hosts are processed concurrently and at most `concurrency` VMs are
+    snapshotted at a time on each host. Once `deadline` seconds have passed,
+    `begin` returns without waiting for the remaining VMs so the ZFS snapshot
+    can be taken (it will only be crash-consistent for these VMs); their
+    snapshots are waited for and removed in `end`. Logging in and listing VMs
+    count against the deadline too: hosts that have not got that far by then
+    are reported as login failures and none of their VMs are snapshotted.
+
+    Per-VM outcomes are recorded in `outcomes` of each context item, mapping
+    VM uuid to dict with `name`, `status` (one of `SNAPSHOTTED`, `EXISTS`,
+    `SKIPPED`, `FAILED`, `TIMEOUT`), `error` and `duration`.
+    """
+
+    def __init__(self, pool, concurrency=4, deadline=300):
+        self.pool = pool
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def begin(self, vmsnapobjs, vmsnapname, vmsnapdescription):
+        """
+        Returns list of context items (one for each `vmsnapobj` that we could log in to)
+        and list of (vmsnapobj, exception) login failures.
+        """
+        start = time.monotonic()
+        hosts = list(self._group(vmsnapobjs).values())
+        state = BeginState()
+
+        executor = ThreadPoolExecutor(max(len(hosts), 1))
+        try:
+            results = [
+                executor.submit(self._begin_host, state, host_vmsnapobjs, vmsnapname, vmsnapdescription)
+                for host_vmsnapobjs in hosts
+            ]
+        finally:
+            executor.shutdown(wait=False)
+
+        wait(results, timeout=self._remaining(start))
+        with state.lock:
+            state.expired = True
+        # These hosts are only returning their snapshot futures
+        wait([f for f, host_vmsnapobjs in zip(results, hosts)
+              if session_key(host_vmsnapobjs[0]) in state.started])
+
+        items = []
+        login_failures = []
+        futures = []
+        for f, host_vmsnapobjs in zip(results, hosts):
+            if not f.done():
+                logger.warning("VMware login to %s did not complete in %d seconds, proceeding",
+                               host_vmsnapobjs[0]["hostname"], self.deadline)
+                e = TimeoutError(f"Login and listing VMs did not complete in {self.deadline} seconds")
+                login_failures.extend((vmsnapobj, e) for vmsnapobj in host_vmsnapobjs)
+                continue
+
+            host_items, host_login_failures, host_futures = f.result()
+            items.extend(host_items)
+            login_failures.extend(host_login_failures)
+            futures.extend(host_futures)
+
+        done, not_done = wait(futures, timeout=self._remaining(start))
+        if not_done:
+            logger.warning("%d VMware snapshot(s) %s did not complete in %d seconds, proceeding",
+                           len(not_done), vmsnapname, self.deadline)
+            with self.lock:
+                self.pending[vmsnapname] = list(not_done)
+
+        for item in items:
+            vm_futures = item.pop("futures")
+            for vm_uuid, f in vm_futures.items():
+                if f in done:
+                    outcome = f.result()
+                else:
+                    outcome = {"name": item["outcomes"][vm_uuid]["name"], "status": "TIMEOUT",
+                               "error": None, "duration": time.monotonic() - start}
+                item["outcomes"][vm_uuid] = outcome
+                if outcome["status"] in ("FAILED", "TIMEOUT"):
+                    item["snapvmfails"].append([vm_uuid, outcome["name"]])
+
+        return items, login_failures
+
+    def _remaining(self, start):
+        return max(self.deadline - (time.monotonic() - start), 0)
+
+    def _group(self, vmsnapobjs):
+        hosts = {}
+        for vmsnapobj in vmsnapobjs:
+            hosts.setdefault(session_key(vmsnapobj), []).append(vmsnapobj)
+        return hosts
+
+    def _begin_host(self, state, vmsnapobjs, vmsnapname, vmsnapdescription):
+        items = []
+        login_failures = []
+        try:
+            session = self.pool.get(vmsnapobjs[0])
+            vms = session.powered_on_vms()
+        except Exception as e:
+            logger.warning("VMware login to %s failed", vmsnapobjs[0]["hostname"], exc_info=True)
+            return items, [(vmsnapobj, e) for vmsnapobj in vmsnapobjs], []
+
+        snapshot = []
+        for vmsnapobj in vmsnapobjs:
+            item = {
+                "vmsnapobj": vmsnapobj,
+                "snapvms": [],
+                "snapvmfails": [],
+                "snapvmskips": [],
+                "outcomes": {},
+                "futures": {},
+            }
+            for vm in vms:
+                try:
+                    if not vm.depends_on_datastore(vmsnapobj["datastore"]):
+                        continue
+                    can_snapshot = vm.can_snapshot()
+                except Exception:
+                    logger.debug("Error inspecting VM %s", vm.name, exc_info=True)
+                    continue
+
+                if not can_snapshot:
+                    # TODO:
+                    # we can try to shutdown the VM, if the user provided us an ok to do
+                    # so (might need a new list property in obj to know which VMs are
+                    # fine to shutdown and a UI to specify such exceptions)
+                    # otherwise can skip VM snap and then make a crash-consistent zfs
+                    # snapshot for this VM
+                    logger.info("Can't snapshot VM %s that depends on datastore %s. "
+                                "Possibly using PT devices. Skipping.", vm.name, vmsnapobj["datastore"])
+                    item["snapvmskips"].append(vm.uuid)
+                    item["outcomes"][vm.uuid] = {"name": vm.name, "status": "SKIPPED", "error": None,
+                                                 "duration": 0}
+                    continue
+
+                snapshot.append((item, vm))
+                item["outcomes"][vm.uuid] = {"name": vm.name}
+                item["snapvms"].append(vm.uuid)
+
+            items.append(item)
+
+        with state.lock:
+            if state.expired:
+                # `begin` has already returned, these VMs would be snapshotted after the ZFS snapshot
+                logger.debug("Not snapshotting VMs on %s, deadline has passed", vmsnapobjs[0]["hostname"])
+                return [], [], []
+            state.started.add(session_key(vmsnapobjs[0]))
+
+        executor = ThreadPoolExecutor(self.concurrency)
+        # A VM might use more than one datastore mapped to the same ZFS filesystem. It is only snapshotted once.
+        futures = {}
+        try:
+            for item, vm in snapshot:
+                if vm.uuid not in futures:
+                    futures[vm.uuid] = executor.submit(self._snapshot_vm, vm, vmsnapname, vmsnapdescription)
+                item["futures"][vm.uuid] = futures[vm.uuid]
+        finally:
+            executor.shutdown(wait=False)
+
+        return items, login_failures, list(futures.values())
+
+    def _snapshot_vm(self, vm, vmsnapname, vmsnapdescription):
+        start = time.monotonic()
+        status = "SNAPSHOTTED"
+        error = None
+        try:
+            if vm.snapshot_exists(vmsnapname):
+                logger.debug("Not creating snapshot %s for VM %s because it already exists", vmsnapname, vm.name)
+                status = "EXISTS"
+            else:
+                vm.create_snapshot(vmsnapname, vmsnapdescription)
+        except Exception as e:
+            logger.warning("Snapshot of VM %s failed", vm.name, exc_info=True)
+            status = "FAILED"
+            error = getattr(e, "msg", None) or str(e)
+
+        return {"name": vm.name, "status": status, "error": error, "duration": time.monotonic() - start}
+
+    def end(self, vmsnapname, items):
+        """
+        Remove snapshots created by `begin`.
+
+        Returns list of (vmsnapobj, exception) login failures and list of
+        (vmsnapobj, vm_name, error) snapshot removal failures.
+        """
+        with self.lock:
+            pending = self.pending.pop(vmsnapname, [])
+        if pending:
+            wait(pending, timeout=self.deadline)
+
+        hosts = {}
+        for item in items:
+            hosts.setdefault(session_key(item["vmsnapobj"]), []).append(item)
+
+        with ThreadPoolExecutor(max(len(hosts), 1)) as executor:
+            results = [executor.submit(self._end_host, vmsnapname, host_items) for host_items in hosts.values()]
+
+        login_failures = []
+        failures = []
+        for f in results:
+            host_login_failures, host_failures = f.result()
+            login_failures.extend(host_login_failures)
+            failures.extend(host_failures)
+
+        return login_failures, failures
+
+    def _end_host(self, vmsnapname, items):
+        try:
+            session = self.pool.get(items[0]["vmsnapobj"])
+        except Exception as e:
+            logger.warning("VMware login failed to %s", items[0]["vmsnapobj"]["hostname"], exc_info=True)
+            return [(item["vmsnapobj"], e) for item in items], []
+
+        remove = {}
+        for item in items:
+            fails = {vm_uuid for vm_uuid, vm_name in item["snapvmfails"]}
+            for vm_uuid in item["snapvms"]:
+                outcome = item.get("outcomes", {}).get(vm_uuid, {})
+                # Snapshots that have timed out in `begin` might have been completed since then
+                if vm_uuid in fails and outcome.get("status") != "TIMEOUT":
+                    continue
+                if vm_uuid in item["snapvmskips"]:
+                    continue
+                remove.setdefault(vm_uuid, item["vmsnapobj"])
+
+        failures = []
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for vmsnapobj, vm_name, error in executor.map(
+                lambda args: self._remove_snapshot(session, vmsnapname, *args), remove.items()
+            ):
+                if error is not None:
+                    failures.append((vmsnapobj, vm_name, error))
+
+        return [], failures
+
+    def _remove_snapshot(self, session, vmsnapname, vm_uuid, vmsnapobj):
+        vm = None
+        try:
+            vm = session.find_vm(vm_uuid)
+            if not vm:
+                logger.debug("Could not find VM %s", vm_uuid)
+                return vmsnapobj, None, None
+
+            vm.remove_snapshot(vmsnapname)
+        except Exception as e:
+            logger.debug("Exception removing snapshot %s on %s", vmsnapname, vm_uuid, exc_info=True)
+            return vmsnapobj, vm.name if vm else vm_uuid, getattr(e, "msg", None) or str(e)
+
+        return vmsnapobj, vm.name, None
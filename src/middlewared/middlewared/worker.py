@@ -5,9 +5,11 @@ import asyncio
 import concurrent.futures
 import functools
 import importlib
+import logging
 import os
 import select
 import setproctitle
+import sys
 import threading
 from . import logger
 
@@ -20,11 +22,22 @@ class FakeMiddleware(object):
     """
 
     def __init__(self):
-        self.client = None
+        self._client = None
+        self._client_lock = threading.Lock()
         self.logger = logger.Logger('worker')
         self.logger.getLogger()
         self.logger.configure_logging('console')
 
+    @property
+    def client(self):
+        """
+        Middleware connection kept for the lifetime of the worker.
+        """
+        with self._client_lock:
+            if self._client is None:
+                self._client = Client(py_exceptions=True, reconnect=True)
+            return self._client
+
     async def run_in_thread(self, method, *args, **kwargs):
         executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         try:
@@ -38,17 +51,14 @@ class FakeMiddleware(object):
             executor.shutdown(wait=False)
 
     async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=False, job=None):
-        with Client(py_exceptions=True) as c:
-            self.client = c
-            job_options = getattr(methodobj, '_job', None)
-            if job and job_options:
-                params = list(params) if params else []
-                params.insert(0, FakeJob(job['id'], self.client))
-            if asyncio.iscoroutinefunction(methodobj):
-                return await methodobj(*params)
-            else:
-                return methodobj(*params)
-        self.client = None
+        job_options = getattr(methodobj, '_job', None)
+        if job and job_options:
+            params = list(params) if params else []
+            params.insert(0, FakeJob(job['id'], self.client))
+        if asyncio.iscoroutinefunction(methodobj):
+            return await methodobj(*params)
+        else:
+            return methodobj(*params)
 
     async def _run(self, service_mod, service_name, method, args, job=None):
         module = importlib.import_module(service_mod)
@@ -69,8 +79,7 @@ class FakeMiddleware(object):
         return self.client.call(method, *params, timeout=timeout, **kwargs)
 
     async def call_hook(self, name, *args, **kwargs):
-        with Client(py_exceptions=True) as c:
-            return c.call('core.call_hook', name, args, kwargs)
+        return self.client.call('core.call_hook', name, args, kwargs)
 
 
 class FakeJob(object):
@@ -133,9 +142,30 @@ def watch_parent():
     os._exit(1)
 
 
+def warmup():
+    """
+    Imports heavy modules used by process pool methods so that first calls do not have to.
+    """
+    try:
+        import libzfs  # noqa
+    except ImportError:
+        pass
+
+    try:
+        sys.path.append('/usr/local/www')
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+        import django
+        from django.apps import apps
+        if not apps.ready:
+            django.setup()
+    except Exception:
+        logging.getLogger('middlewared.worker').warning('Failed to set up django', exc_info=True)
+
+
 def worker_init(debug_level, log_handler):
     global MIDDLEWARE
     MIDDLEWARE = FakeMiddleware()
     setproctitle.setproctitle('middlewared (worker)')
     threading.Thread(target=watch_parent, daemon=True).start()
     logger.setup_logging('worker', debug_level, log_handler)
+    warmup()
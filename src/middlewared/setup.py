@@ -8,7 +8,7 @@ from setuptools import find_packages, setup
 
 
 install_requires = [
-    'ws4py',
+    'aiohttp',
     'python-dateutil',
     'aiohttp_wsgi',
     'markdown',